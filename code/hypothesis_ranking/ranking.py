@@ -1,11 +1,22 @@
-from openai import OpenAI
 import time
 import re
 import os
+import sys
 import json
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 import random
+# share the LLM layer of MOOSE-Chem's `Method` package (the `src` folder)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from Method.llm_client import get_llm_client, get_llm_backend_name
+from Method.llm_router import setup_llm_router, get_llm_router, resolve_llm_client
+from Method.llm_dispatcher import setup_llm_dispatcher, get_llm_dispatcher
+from Method.rate_limiter import setup_rate_limiter, setup_llm_circuit_breakers, call_llm_with_retry, estimate_num_tokens, LLMContextLengthError, LLMFatalError, LLMGiveUpError
+from Method.llm_budget import setup_llm_retry_budgets, setup_llm_failure_ledger, get_llm_failure_ledger, start_llm_retry_budget, record_llm_give_up
+from Method.batch_llm import get_batch_backend, build_batch_request, run_batch
+from Method.utils import stream_chat_completion_with_early_stop, get_regex_early_stop_fn, record_llm_request_telemetry
+from Method.llm_telemetry import setup_llm_telemetry, save_llm_telemetry
+from Method.llm_traffic import setup_llm_traffic_recorder, get_llm_traffic_recorder, record_llm_traffic
 
 # Configuration
 API_KEY = "[REDACTED_API_KEY]"
@@ -15,6 +26,40 @@ CLASSNAME = "test"
 OPT_PATH = r"[REDACTED_PATH]\ranking\\" + CLASSNAME
 SAVED_PATH = r"[REDACTED_PATH]\ranking\\" + CLASSNAME + "\\res"
 CONCURRENCY_NUM = 15
+# JSON file mapping model names to one or more backends, each with its own concurrency cap and rate limits (see Method.llm_router); "": every comparison goes to BASE_URL
+ROUTER_CONFIG = ""
+# central dispatcher of the LLM requests over priority classes (see Method.llm_dispatcher); the comparisons are a bulk job, so they belong to PRIORITY_CLASS
+DISPATCHER = False
+PRIORITY_CLASS = "batch"
+# quota of the provider, shared by all threads (0: no limit)
+REQUESTS_PER_MIN = 0
+TOKENS_PER_MIN = 0
+# submit the comparisons of all files as one offline batch ("": interactive requests; "openai": OpenAI's batch API; "local": local stand-in for testing)
+BATCH_BACKEND = ""
+BATCH_DIR = os.path.join(SAVED_PATH, "batches")
+BATCH_POLL_SECONDS = 60
+# stream the comparisons and stop reading once the selection line (PATTERN) is complete (only used by interactive requests)
+EARLY_STOP = False
+# per-stage telemetry (tokens, latency, retries, cost) of the comparisons, saved as SAVED_PATH/ranking_llm_telemetry.json
+TELEMETRY = False
+# prices in USD per million tokens, e.g., "gpt-4o:2.5:10" (model:input_price:output_price); models not listed cost 0
+MODEL_PRICES = ""
+# file to write the telemetry in the Prometheus text format ("": not written) / port to serve it at /metrics (0: not served)
+TELEMETRY_PROMETHEUS_PATH = ""
+TELEMETRY_PORT = 0
+# stage name of the comparisons in the telemetry, the retry budgets and the failure ledger
+STAGE = "compare"
+# JSON lines file where every comparison request is recorded, to be replayed by Method/llm_traffic_replay.py ("": not recorded); the prompts are kept as a hash ("hash") or in full ("full")
+TRAFFIC_PATH = ""
+TRAFFIC_PROMPTS = "hash"
+# a comparison gives up (and is recorded in FAILURE_LEDGER_PATH) after MAX_FAILED_ATTEMPTS failed attempts (e.g., invalid format), or after its failed attempts used MAX_RETRY_TOKENS (estimated) tokens (0: no limit); a comparison that gave up counts as candidate 1
+MAX_FAILED_ATTEMPTS = 10
+MAX_RETRY_TOKENS = 0
+# after this number of failed requests in a row to a backend, its requests fail fast (and their comparisons give up) for CIRCUIT_BREAKER_COOLDOWN_SECONDS (0: no circuit breaker)
+CIRCUIT_BREAKER_FAILURES = 10
+CIRCUIT_BREAKER_COOLDOWN_SECONDS = 60
+# JSON lines file of the comparisons that gave up, with their file and candidate ids ("": only printed)
+FAILURE_LEDGER_PATH = os.path.join(SAVED_PATH, "ranking_failure_ledger.jsonl")
 
 PROMPT_FOR_COMPARE = """You are assisting scientists with their research. Given a research question and two research hypothesis candidates proposed by large language models, your task is to predict which hypothesis is a better research hypothesis. By 'better', we mean the hypothesis is more valid and effective for the research question. 
 Please note:
@@ -30,63 +75,109 @@ Now, predict which hypothesis will be more effective if tested in real experimen
 
 PATTERN = r"\*\*Selection\s+of\s+research\s+hypothesis\s+candidate\*\*\s*[:：]\s*candidate\s*(\d+)"
 
-def get_llm_response(context, api_key=API_KEY, base_url=BASE_URL, model_name=MODEL_NAME):
-    """Get response from LLM API."""
-    client = OpenAI(api_key=api_key, base_url=base_url)
+# sampling parameters of every comparison (the same for interactive and batch requests)
+COMPARE_REQUEST_KWARGS = {"temperature": 0.7, "top_p": 0.95, "frequency_penalty": 0, "presence_penalty": 0}
+
+def get_llm_response(context, api_key=API_KEY, base_url=BASE_URL, model_name=MODEL_NAME, early_stop_fn=None):
+    """Get response from LLM API. If early_stop_fn is given, the response is streamed and cut off once early_stop_fn(response so far) is True."""
+    # the client (and its keep-alive connection pool) is shared by all comparisons of the process; process_file() sizes its pool
+    client = resolve_llm_client(0, api_key, base_url, model_name=model_name)
     message_text = [{"role": "user", "content": context}]
-    max_retries = 3000000
 
-    for attempt in range(max_retries):
-        try:
-            completion = client.chat.completions.create(
-                model=model_name, messages=message_text, temperature=0.7, top_p=0.95,
-                frequency_penalty=0, presence_penalty=0, stop=None
-            )
-            result = completion.choices[0].message.content.strip()
-            print("result:\n", result, "\n\n")
-            return result
-        except Exception as e:
-            error_message = str(e)
-            if any(keyword in error_message for keyword in ["maximum context length", "maximum length", "context length", "string too long", "length"]):
-                return "string too long"
-            print(f"API error, Attempt {attempt + 1} failed: {error_message}")
-            time.sleep(1)
-    raise Exception("Failed to get a valid result after max retries.")
-
-def compare_candidate(candidate_hypothesis, background_question, main_hypothesis, api_key=API_KEY, base_url=BASE_URL, model_name=MODEL_NAME, max_retries=10):
-    """Compare candidate hypothesis with main hypothesis using LLM."""
+    # requests go through the shared rate limiter and the circuit breaker of the backend (as the requests of the pipelines); retryable errors are retried with backoff, fatal ones (e.g., authentication) are raised, and an open circuit gives up on the comparison
+    start_time = time.time()
+    completion = None
+    try:
+        if early_stop_fn == None:
+            completion = call_llm_with_retry(lambda: client.chat.completions.create(
+                model=model_name, messages=message_text, stop=None, **COMPARE_REQUEST_KWARGS
+            ), estimated_tokens=estimate_num_tokens(context), backend=get_llm_backend_name(client), stage=STAGE)
+            result = completion.choices[0].message.content
+        else:
+            result = call_llm_with_retry(lambda: stream_chat_completion_with_early_stop(
+                client, early_stop_fn, model=model_name, messages=message_text, stop=None, **COMPARE_REQUEST_KWARGS
+            ), estimated_tokens=estimate_num_tokens(context), backend=get_llm_backend_name(client), stage=STAGE)
+    except LLMContextLengthError as e:
+        record_llm_traffic(STAGE, model_name, COMPARE_REQUEST_KWARGS["temperature"], context, start_time, time.time() - start_time, error=e)
+        # sending the same prompt again can not help
+        raise LLMGiveUpError("the comparison prompt is too long: {}".format(e), stage=STAGE, num_attempts=1, num_tokens=estimate_num_tokens(context)) from e
+    except Exception as e:
+        record_llm_traffic(STAGE, model_name, COMPARE_REQUEST_KWARGS["temperature"], context, start_time, time.time() - start_time, error=e)
+        raise
+    record_llm_request_telemetry(STAGE, model_name, time.time() - start_time, context, result, completion=completion)
+    record_llm_traffic(STAGE, model_name, COMPARE_REQUEST_KWARGS["temperature"], context, start_time, time.time() - start_time, generation=result)
+    result = result.strip()
+    print("result:\n", result, "\n\n")
+    return result
+
+def compare_candidate(candidate_hypothesis, background_question, main_hypothesis, api_key=API_KEY, base_url=BASE_URL, model_name=MODEL_NAME):
+    """Compare candidate hypothesis with main hypothesis using LLM. Failed attempts are counted in the retry budget of STAGE; raises LLMGiveUpError once it is used up (or the circuit of the backend is open)."""
     prompt = PROMPT_FOR_COMPARE.format(background_question, main_hypothesis, candidate_hypothesis)
-    for attempt in range(max_retries):
-        response = get_llm_response(prompt, api_key, base_url, model_name)
-        match = re.search(PATTERN, response)
-        if match and (selection := int(match.group(1))) in [1, 2]:
-            print(f"[compare_candidate] Success (attempt {attempt + 1}): Selected candidate {selection}")
+    retry_budget = start_llm_retry_budget(STAGE, prompt)
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            response = get_llm_response(prompt, api_key, base_url, model_name, early_stop_fn=get_regex_early_stop_fn(PATTERN) if EARLY_STOP else None)
+            selection = parse_selection(response)
+            assert selection is not None, "invalid format"
+            print(f"[compare_candidate] Success (attempt {attempt}): Selected candidate {selection}")
             return selection
-        print(f"[compare_candidate] Invalid format (attempt {attempt + 1}), retrying...")
-    print("[compare_candidate] Max retries reached, defaulting to candidate 1")
-    return 1
+        except LLMFatalError:
+            raise
+        except Exception as e:
+            print(f"[compare_candidate] Failed attempt {attempt} ({e!r}), retrying...")
+            retry_budget.fail(e)
 
-def process_file(file_path, concurrency_num=CONCURRENCY_NUM, saved_path=SAVED_PATH, api_key=API_KEY, base_url=BASE_URL, model_name=MODEL_NAME):
-    """Process a single JSON file and compute ranking."""
-    print(f"\n========== Processing file: {file_path} ==========")
+def compare_candidate_or_give_up(file_path, candidate_idx, candidate_hypothesis, background_question, main_hypothesis, api_key=API_KEY, base_url=BASE_URL, model_name=MODEL_NAME):
+    """compare_candidate(); a comparison that gave up is recorded in the failure ledger (with its file and candidate ids) and counts as candidate 1."""
+    try:
+        return compare_candidate(candidate_hypothesis, background_question, main_hypothesis, api_key, base_url, model_name)
+    except LLMGiveUpError as e:
+        record_llm_give_up(e, file_path=file_path, candidate_id=candidate_idx)
+        return 1
+
+def parse_selection(response):
+    """Return the selected candidate (1 or 2) in the response, or None if the format is invalid."""
+    match = re.search(PATTERN, response)
+    if match and (selection := int(match.group(1))) in [1, 2]:
+        return selection
+    return None
+
+def load_ranking_file(file_path):
+    """Load a single JSON file; return None if it can not be read."""
     try:
         with open(file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+            return json.load(f)
     except Exception as e:
-        print(f"[process_file] Failed to read {file_path}: {e}")
-        return
+        print(f"[load_ranking_file] Failed to read {file_path}: {e}")
+        return None
 
-    # Extract data
+def get_candidates(data):
+    """Extract background question, main hypothesis and the candidates to compare with from the data of a file."""
     background_question = data.get("Background Question", "")
     main_hypothesis = data.get("Main hypothesis", "")
     combined_list = data.get("fake generate hypothesis", []) + data.get("model generate hypothesis", [])
+    return background_question, main_hypothesis, combined_list
+
+def process_file(file_path, concurrency_num=CONCURRENCY_NUM, saved_path=SAVED_PATH, api_key=API_KEY, base_url=BASE_URL, model_name=MODEL_NAME):
+    """Process a single JSON file and compute ranking."""
+    print(f"\n========== Processing file: {file_path} ==========")
+    data = load_ranking_file(file_path)
+    if data is None:
+        return
+
+    # Extract data
+    background_question, main_hypothesis, combined_list = get_candidates(data)
     total_candidates = len(combined_list)
     print(f"[process_file] Total candidates to compare: {total_candidates}")
 
     # Compute rank
     rank_count = 16
+    # build the shared client with one pooled connection per worker before the workers start
+    resolve_llm_client(0, api_key, base_url, model_name=model_name, max_connections=concurrency_num)
     with ThreadPoolExecutor(max_workers=concurrency_num) as executor:
-        futures = {executor.submit(compare_candidate, candidate, background_question, main_hypothesis, api_key, base_url, model_name): candidate for candidate in combined_list}
+        futures = {executor.submit(compare_candidate_or_give_up, file_path, candidate_idx, candidate, background_question, main_hypothesis, api_key, base_url, model_name): candidate for candidate_idx, candidate in enumerate(combined_list)}
         for i, future in enumerate(as_completed(futures), 1):
             try:
                 if future.result() == 2:
@@ -96,11 +187,45 @@ def process_file(file_path, concurrency_num=CONCURRENCY_NUM, saved_path=SAVED_PA
                 print(f"[process_file] Error processing candidate: {e}")
 
     print(f"[process_file] Final Rank for {file_path}: {rank_count}")
+    save_ranking_result(file_path, data, rank_count, saved_path)
+
+def process_files_in_batch(json_files, backend, saved_path=SAVED_PATH, api_key=API_KEY, base_url=BASE_URL, model_name=MODEL_NAME, batch_dir=BATCH_DIR, poll_seconds=BATCH_POLL_SECONDS):
+    """Compare the candidates of all files in one offline batch, and compute and save the ranking of each file."""
+    # file_collection: [[file_idx, file_path, data, background_question, main_hypothesis, combined_list], ...]
+    file_collection = []
+    batch_requests = []
+    for file_idx, file_path in enumerate(json_files):
+        data = load_ranking_file(file_path)
+        if data is None:
+            continue
+        background_question, main_hypothesis, combined_list = get_candidates(data)
+        file_collection.append([file_idx, file_path, data, background_question, main_hypothesis, combined_list])
+        for candidate_idx, candidate in enumerate(combined_list):
+            prompt = PROMPT_FOR_COMPARE.format(background_question, main_hypothesis, candidate)
+            batch_requests.append(build_batch_request(f"{file_idx}-{candidate_idx}", model_name, [{"role": "user", "content": prompt}], **COMPARE_REQUEST_KWARGS))
+    print(f"[process_files_in_batch] {len(batch_requests)} comparisons from {len(file_collection)} files")
+    batch_path = os.path.join(batch_dir, f"compare_candidate_{time.strftime('%Y%m%d_%H%M%S')}.jsonl")
+    response_collection = run_batch(batch_requests, backend, batch_path, poll_seconds=poll_seconds)
 
-    # Save results
+    for file_idx, file_path, data, background_question, main_hypothesis, combined_list in file_collection:
+        rank_count = 16
+        for candidate_idx, candidate in enumerate(combined_list):
+            response = response_collection.get(f"{file_idx}-{candidate_idx}")
+            selection = parse_selection(response) if response is not None else None
+            if selection is None:
+                # failed in the batch or invalid format: compare with interactive requests
+                print(f"[process_files_in_batch] No valid batch response for candidate {candidate_idx} of {file_path}, retrying interactively...")
+                selection = compare_candidate_or_give_up(file_path, candidate_idx, candidate, background_question, main_hypothesis, api_key, base_url, model_name)
+            if selection == 2:
+                rank_count -= 1
+        print(f"[process_files_in_batch] Final Rank for {file_path}: {rank_count}")
+        save_ranking_result(file_path, data, rank_count, saved_path)
+
+def save_ranking_result(file_path, data, rank_count, saved_path=SAVED_PATH):
+    """Save the ranking of a single JSON file."""
     output_data = {
-        "Background Question": background_question,
-        "Main hypothesis": main_hypothesis,
+        "Background Question": data.get("Background Question", ""),
+        "Main hypothesis": data.get("Main hypothesis", ""),
         "Rank": rank_count,
         "fake generate hypothesis": data.get("fake generate hypothesis", []),
         "model generate hypothesis": data.get("model generate hypothesis", [])
@@ -110,9 +235,9 @@ def process_file(file_path, concurrency_num=CONCURRENCY_NUM, saved_path=SAVED_PA
     try:
         with open(output_file_path, "w", encoding="utf-8") as f:
             json.dump(output_data, f, ensure_ascii=False, indent=4)
-        print(f"[process_file] Results saved to: {output_file_path}")
+        print(f"[save_ranking_result] Results saved to: {output_file_path}")
     except Exception as e:
-        print(f"[process_file] Failed to save {output_file_path}: {e}")
+        print(f"[save_ranking_result] Failed to save {output_file_path}: {e}")
 
 def main():
     """Process all JSON files in the directory."""
@@ -125,6 +250,25 @@ def main():
     total_files = len(json_files)
     print(f"[main] Found {total_files} JSON files to process.")
     start_time = time.time()
+    setup_rate_limiter(requests_per_min=REQUESTS_PER_MIN, tokens_per_min=TOKENS_PER_MIN, max_concurrency=CONCURRENCY_NUM)
+    setup_llm_router(ROUTER_CONFIG)
+    setup_llm_dispatcher(DISPATCHER, max_concurrency=CONCURRENCY_NUM, default_class=PRIORITY_CLASS)
+    setup_llm_telemetry(TELEMETRY, prices_text=MODEL_PRICES, port=TELEMETRY_PORT)
+    setup_llm_traffic_recorder(TRAFFIC_PATH, prompt_mode=TRAFFIC_PROMPTS)
+    setup_llm_retry_budgets(max_attempts=MAX_FAILED_ATTEMPTS, max_tokens=MAX_RETRY_TOKENS)
+    setup_llm_circuit_breakers(failure_threshold=CIRCUIT_BREAKER_FAILURES, cooldown_seconds=CIRCUIT_BREAKER_COOLDOWN_SECONDS)
+    setup_llm_failure_ledger(FAILURE_LEDGER_PATH)
+
+    if BATCH_BACKEND:
+        json_files = [file_path for file_path in json_files if not os.path.exists(os.path.join(SAVED_PATH, os.path.basename(file_path).replace("random_", "ranking_res_")))]
+        print(f"[main] Submitting the comparisons of {len(json_files)} files (not processed yet) as one batch.")
+        backend = get_batch_backend(BATCH_BACKEND, get_llm_client(0, API_KEY, BASE_URL, model_name=MODEL_NAME, max_connections=CONCURRENCY_NUM), BATCH_DIR)
+        process_files_in_batch(json_files, backend)
+        print("[main] All files processed!")
+        if get_llm_failure_ledger() != None:
+            get_llm_failure_ledger().print_stats()
+        save_llm_telemetry(os.path.join(SAVED_PATH, "ranking.json"), prometheus_path=TELEMETRY_PROMETHEUS_PATH)
+        return
 
     for idx, file_path in enumerate(json_files, 1):
         output_file_path = os.path.join(SAVED_PATH, os.path.basename(file_path).replace("random_", "ranking_res_"))
@@ -141,6 +285,15 @@ def main():
         print(f"[main] Processed {idx} files, estimated remaining time: {remaining:.1f} seconds")
 
     print("[main] All files processed!")
+    if get_llm_router() != None:
+        get_llm_router().print_stats()
+    if get_llm_dispatcher() != None:
+        get_llm_dispatcher().print_stats()
+    if get_llm_traffic_recorder() != None:
+        get_llm_traffic_recorder().print_stats()
+    if get_llm_failure_ledger() != None:
+        get_llm_failure_ledger().print_stats()
+    save_llm_telemetry(os.path.join(SAVED_PATH, "ranking.json"), prometheus_path=TELEMETRY_PROMETHEUS_PATH)
 
 if __name__ == "__main__":
     main()
@@ -4,6 +4,7 @@ import re
 import csv
 from collections import defaultdict
 import random
+import sys
 
 # Configuration
 res_path = r"[REDACTED_PATH]\Math\result.json"
@@ -11,6 +12,8 @@ distance_path = r"[REDACTED_PATH]\spider\distance\Math"
 record_file = os.path.join(distance_path, "record.csv")
 distance_2_3_csv_path = r"[REDACTED_PATH]\class\code\output20250107.csv"
 class_name = "Math"
+# Jaccard similarity of the titles above which two papers are near duplicates (MinHash-LSH); 0: only remove the exact duplicates (by normalize_title)
+near_duplicate_threshold = 0
 
 def normalize_doi(doi):
     """Normalize DOI by removing non-alphanumeric characters and converting to lowercase."""
@@ -82,10 +85,22 @@ def load_inspiration_data(res_data, doi):
             return [[insp["title"], insp["abstract"]] for insp in item.get("inspiration", []) if "title" in insp and "abstract" in insp]
     return []
 
-def clean_duplicates(data):
-    """Remove duplicate titles from data list."""
+def clean_duplicates(data, threshold=None):
+    """Remove duplicate titles from data list; near duplicates too if threshold (default: near_duplicate_threshold) > 0."""
+    if threshold is None:
+        threshold = near_duplicate_threshold
     seen = set()
-    return [item for item in data if len(item) == 2 and normalize_title(item[0]) not in seen and not seen.add(normalize_title(item[0]))]
+    data = [item for item in data if len(item) == 2 and normalize_title(item[0]) not in seen and not seen.add(normalize_title(item[0]))]
+    if threshold > 0:
+        # imported here so that the default run (exact duplicates only) does not need the Method package
+        repo_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        if repo_dir not in sys.path:
+            sys.path.append(repo_dir)
+        from Method.minhash_lsh import deduplicate_title_abstract_pairs
+        data, removed = deduplicate_title_abstract_pairs(data, threshold=threshold)
+        if removed:
+            print(f"Removed {len(removed)} near-duplicate titles.")
+    return data
 
 def process_distance_file(file_path, existing_titles):
     """Process distance file, removing duplicates and excluding existing titles."""
@@ -0,0 +1,212 @@
+import os, re, json, hashlib, asyncio, threading, contextvars
+import concurrent.futures
+from Method.utils import llm_generation, allm_generation
+from Method.rate_limiter import LLMFatalError
+
+
+# Digests of the papers in the screening prompts: every screening window pastes the abstracts of its candidates, and the same papers reappear in every screening round and for every background question sharing a corpus; a bounded-length digest of each (title, abstract) is computed once and used in the screening prompts instead of the full abstract (the full abstract is still used for hypothesis generation)
+#   'extractive': the leading sentences of the abstract, up to max_chars (no LLM call)
+#   'llm': a summary of the abstract by an LLM call (stage 'abstract_digest'), cut to max_chars
+#   digests are cached by the hash of the content (and the digest config), in memory and in a JSON file (shared across runs)
+
+
+DIGEST_MODES = ["none", "extractive", "llm"]
+DEFAULT_DIGEST_MAX_CHARS = 400
+# threads computing the 'llm' digests of the sync entry points
+DIGEST_MAX_THREADS = 16
+# rough number of characters per word, used to ask the LLM for a digest of at most max_chars
+CHARS_PER_WORD = 6
+
+
+def get_digest_prompt(title, abstract, max_chars):
+    return "You are helping to screen scientific papers as potential inspirations for a research question. Please compress the abstract of the following paper into at most {} words, keeping its research problem, the key method or concept it proposes, and its main findings; do not add any information that is not in the abstract, and only output the compressed abstract. \nTitle: {} \nAbstract: {}".format(max(1, max_chars // CHARS_PER_WORD), title, abstract)
+
+
+## Function:
+#   the leading sentences of abstract, up to max_chars; the first sentence is cut at a word boundary if it is longer than max_chars
+def get_extractive_digest(abstract, max_chars):
+    abstract = abstract.strip()
+    if len(abstract) <= max_chars:
+        return abstract
+    digest = ""
+    for cur_sentence in re.split(r"(?<=[.!?])\s+", abstract):
+        if len(digest) + len(cur_sentence) + 1 > max_chars:
+            break
+        digest = (digest + " " + cur_sentence).strip()
+    if digest == "":
+        digest = abstract[:max(1, max_chars - 3)].rsplit(" ", 1)[0] + "..."
+    return digest
+
+
+class AbstractDigest(object):
+    ## Input
+    #   mode: 'extractive' / 'llm'
+    #   max_chars: upper bound of the length of a digest
+    #   cache_path: JSON file of the digests ({key: digest}); '': only cached in memory
+    #   model_name: model of the 'llm' digests
+    def __init__(self, mode, max_chars=DEFAULT_DIGEST_MAX_CHARS, cache_path="", model_name=None):
+        assert mode in ["extractive", "llm"], print("mode: ", mode)
+        assert max_chars > 0
+        assert mode != "llm" or model_name != None
+        self.mode = mode
+        self.max_chars = max_chars
+        self.cache_path = cache_path
+        self.model_name = model_name
+        # {key: digest}; see get_key()
+        self.digests = {}
+        if cache_path != "" and os.path.exists(cache_path):
+            with open(cache_path, 'r') as f:
+                self.digests = json.load(f)
+        self.if_dirty = False
+        # stats: number of hits / misses of the digest cache, and the characters of the abstracts and of their digests in the screening prompts
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_abstract_chars = 0
+        self.num_digest_chars = 0
+        self.lock = threading.Lock()
+
+    def get_key(self, title, abstract):
+        model_name = self.model_name if self.mode == "llm" else ""
+        return hashlib.sha256(json.dumps([self.mode, self.max_chars, model_name, title, abstract]).encode("utf-8")).hexdigest()
+
+    ## Output
+    #   keys: the key of each paper
+    #   missing_ids: the ids (in title_abstract_pairs) of the papers without a cached digest (only the first one of duplicated papers)
+    def lookup(self, title_abstract_pairs):
+        keys = [self.get_key(cur_ta[0], cur_ta[1]) for cur_ta in title_abstract_pairs]
+        missing_ids, missing_keys = [], set()
+        with self.lock:
+            for cur_id, cur_key in enumerate(keys):
+                if cur_key in self.digests:
+                    self.num_hits += 1
+                elif cur_key not in missing_keys:
+                    self.num_misses += 1
+                    missing_ids.append(cur_id)
+                    missing_keys.add(cur_key)
+        return keys, missing_ids
+
+    def add(self, key, digest):
+        with self.lock:
+            self.digests[key] = digest
+            self.if_dirty = True
+
+    ## Output
+    #   digests: [digest, ...] in the order of title_abstract_pairs
+    def collect(self, title_abstract_pairs, keys):
+        with self.lock:
+            digests = [self.digests[cur_key] for cur_key in keys]
+            self.num_abstract_chars += sum([len(cur_ta[1]) for cur_ta in title_abstract_pairs])
+            self.num_digest_chars += sum([len(cur_digest) for cur_digest in digests])
+        self.save()
+        return digests
+
+    # an abstract no longer than max_chars is its own digest; a failed LLM digest falls back to the extractive one
+    def compute_digest(self, title, abstract, client):
+        if self.mode == "extractive":
+            return get_extractive_digest(abstract, self.max_chars)
+        if len(abstract) <= self.max_chars:
+            return abstract
+        try:
+            digest = llm_generation(get_digest_prompt(title, abstract, self.max_chars), self.model_name, client, temperature=0.0, stage="abstract_digest")
+        except LLMFatalError:
+            raise
+        except Exception as e:
+            print("Warning: the LLM digest of '{}' failed ({}), use the extractive digest instead".format(title, repr(e)))
+            return get_extractive_digest(abstract, self.max_chars)
+        return get_extractive_digest(digest, self.max_chars)
+
+    async def acompute_digest(self, title, abstract, async_client):
+        if self.mode == "extractive":
+            return get_extractive_digest(abstract, self.max_chars)
+        if len(abstract) <= self.max_chars:
+            return abstract
+        try:
+            digest = await allm_generation(get_digest_prompt(title, abstract, self.max_chars), self.model_name, async_client, temperature=0.0, stage="abstract_digest")
+        except LLMFatalError:
+            raise
+        except Exception as e:
+            print("Warning: the LLM digest of '{}' failed ({}), use the extractive digest instead".format(title, repr(e)))
+            return get_extractive_digest(abstract, self.max_chars)
+        return get_extractive_digest(digest, self.max_chars)
+
+    ## Function:
+    #   the digests of title_abstract_pairs; the ones not cached are computed (concurrently for the 'llm' mode) and cached
+    ## Input
+    #   title_abstract_pairs: [[title, abstract, ...], ...]
+    ## Output
+    #   digests: [digest, ...]
+    def get_digests(self, title_abstract_pairs, client):
+        keys, missing_ids = self.lookup(title_abstract_pairs)
+        if len(missing_ids) > 0:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(DIGEST_MAX_THREADS, len(missing_ids))) as executor:
+                # the digests are computed in the context of the caller (e.g., its priority class; see Method.llm_dispatcher)
+                missing_digests = [executor.submit(contextvars.copy_context().run, self.compute_digest, title_abstract_pairs[cur_id][0], title_abstract_pairs[cur_id][1], client) for cur_id in missing_ids]
+                missing_digests = [cur_future.result() for cur_future in missing_digests]
+            for cur_id, cur_digest in zip(missing_ids, missing_digests):
+                self.add(keys[cur_id], cur_digest)
+        return self.collect(title_abstract_pairs, keys)
+
+    # asyncio version of get_digests()
+    async def aget_digests(self, title_abstract_pairs, async_client):
+        keys, missing_ids = self.lookup(title_abstract_pairs)
+        if len(missing_ids) > 0:
+            missing_digests = await asyncio.gather(*[self.acompute_digest(title_abstract_pairs[cur_id][0], title_abstract_pairs[cur_id][1], async_client) for cur_id in missing_ids])
+            for cur_id, cur_digest in zip(missing_ids, missing_digests):
+                self.add(keys[cur_id], cur_digest)
+        return self.collect(title_abstract_pairs, keys)
+
+    # write the new digests to self.cache_path (through a temporary file, so that an interrupted run never leaves a broken cache)
+    def save(self):
+        if self.cache_path == "":
+            return
+        with self.lock:
+            if not self.if_dirty:
+                return
+            tmp_path = self.cache_path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.digests, f)
+            os.replace(tmp_path, self.cache_path)
+            self.if_dirty = False
+
+    def print_stats(self):
+        print("Abstract digest; mode: {}; max chars: {}; cache hits: {}; cache misses: {}; abstract chars in the prompts: {} -> {}".format(self.mode, self.max_chars, self.num_hits, self.num_misses, self.num_abstract_chars, self.num_digest_chars))
+
+
+# None: the screening prompts use the full abstracts
+ABSTRACT_DIGEST = None
+
+
+def get_abstract_digest():
+    return ABSTRACT_DIGEST
+
+
+def set_abstract_digest(abstract_digest):
+    global ABSTRACT_DIGEST
+    ABSTRACT_DIGEST = abstract_digest
+
+
+## Function:
+#   set the digests of the whole process ('none': the full abstracts are used); the existing digests are kept when the config does not change
+def setup_abstract_digest(mode="none", max_chars=DEFAULT_DIGEST_MAX_CHARS, cache_path="", model_name=None):
+    assert mode in DIGEST_MODES, print("mode: ", mode)
+    if mode == "none":
+        set_abstract_digest(None)
+    elif get_abstract_digest() == None or (get_abstract_digest().mode, get_abstract_digest().max_chars, get_abstract_digest().cache_path, get_abstract_digest().model_name) != (mode, max_chars, cache_path, model_name):
+        set_abstract_digest(AbstractDigest(mode, max_chars=max_chars, cache_path=cache_path, model_name=model_name))
+    return get_abstract_digest()
+
+
+## Function:
+#   the abstracts of title_abstract_pairs to be used in the screening prompts: their digests if the digests are set up, otherwise the full abstracts
+## Input
+#   title_abstract_pairs: [[title, abstract, ...], ...]
+def get_screening_abstracts(title_abstract_pairs, client):
+    if get_abstract_digest() == None:
+        return [cur_ta[1] for cur_ta in title_abstract_pairs]
+    return get_abstract_digest().get_digests(title_abstract_pairs, client)
+
+
+async def aget_screening_abstracts(title_abstract_pairs, async_client):
+    if get_abstract_digest() == None:
+        return [cur_ta[1] for cur_ta in title_abstract_pairs]
+    return await get_abstract_digest().aget_digests(title_abstract_pairs, async_client)
@@ -2,7 +2,8 @@ from ast import List
 import numpy as np
 import json, random, copy, os, sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from Method.utils import load_dict_title_2_abstract, recover_generated_title_to_exact_version_of_title, load_bkg_and_insp_from_chem_annotation, load_chem_annotation, if_element_in_list_with_similarity_threshold
+from Method.title_index import TitleIndex, SimilarityMatcher
+from Method.utils import load_dict_title_2_abstract, recover_generated_title_to_exact_version_of_title, load_bkg_and_insp_from_chem_annotation, load_chem_annotation
 from sympy import N
 np.set_printoptions(precision=2)
 
@@ -234,7 +235,7 @@ def find_highest_scored_hypothesis_from_second_round(final_data_collection_path,
 def compare_similarity_between_inspiration_retrieval_and_similarity_retrieval(insp_file_path, simi_file_path, title_abstract_all_insp_literature_path="./title_abstract.json"):
     # dict_title_2_abstract: {'title': 'abstract', ...}
     title_abstract_collector, dict_title_2_abstract = load_dict_title_2_abstract(title_abstract_collector_path=title_abstract_all_insp_literature_path)     
-    groundtruth_insp_titles = list(dict_title_2_abstract.keys())
+    groundtruth_insp_titles = TitleIndex(list(dict_title_2_abstract.keys()))
 
     with open(insp_file_path, 'r') as f:
         insp_data = json.load(f)
@@ -489,12 +490,12 @@ def get_top_matched_score_for_each_background(file_root_name_path, data_id_range
 
 
 # to see how many components are shared between two lists (based on Jaccard similarity)
+# gold_list: [element, ...] or their SimilarityMatcher (built once when the same gold_list is compared with many gene_list)
 def count_intersection_with_jaccard_similarity(gene_list, gold_list):
-    cnt_intersection = 0
-    for cur_gold in gold_list:
-        # if cur_gold in gene_list:
-        if if_element_in_list_with_similarity_threshold(gene_list, cur_gold, threshold=0.65):
-            cnt_intersection += 1
+    if not isinstance(gold_list, SimilarityMatcher):
+        gold_list = SimilarityMatcher(gold_list)
+    # the number of elements in gold_list that are in gene_list (with a similarity threshold)
+    cnt_intersection = gold_list.count_matched_references(gene_list, threshold=0.65)
     return cnt_intersection
 
 
@@ -552,6 +553,8 @@ def get_average_ranking_position_for_hyp_with_gdth_insp(file_root_name_path, dat
         # cur_bkg_q_ori, cur_gdth_insps
         cur_bkg_q_ori = bkg_q_list[cur_id]
         cur_gdth_insps = dict_bkg2insp[cur_bkg_q_ori]
+        # tokenized once for all the hypotheses of the background
+        cur_gdth_insp_matcher = SimilarityMatcher(cur_gdth_insps)
         # load file
         cur_file_path = file_root_name_path + str(cur_id) + ".json"
         with open(cur_file_path, 'r') as f:
@@ -593,7 +596,7 @@ def get_average_ranking_position_for_hyp_with_gdth_insp(file_root_name_path, dat
                         cur_found_insps.append(cur_mut_id)
                 cur_found_insps = get_rid_of_mutation_ids_in_found_insps(cur_found_insps)
                 # cnt_intersection
-                cnt_intersection = count_intersection_with_jaccard_similarity(cur_found_insps, cur_gdth_insps)
+                cnt_intersection = count_intersection_with_jaccard_similarity(cur_found_insps, cur_gdth_insp_matcher)
                 cur_rank_ratio = (cur_ranked_id + 0.7) / len_gene_hyp_for_this_bkg_q
                 # rank_collection_cnt_matched_insp
                 if cnt_intersection not in rank_collection_cnt_matched_insp:
@@ -0,0 +1,204 @@
+import os, json, time, uuid, shutil, threading
+from concurrent.futures import ThreadPoolExecutor
+from Method.llm_cache import get_llm_cache, get_llm_cache_key
+from Method.rate_limiter import call_llm_with_retry, estimate_num_tokens
+from Method.utils import get_llm_messages
+
+
+# endpoint of every request in a batch file (the format of OpenAI's batch API)
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+# a batch in one of these statuses will not change anymore
+BATCH_TERMINAL_STATUSES = ["completed", "failed", "expired", "cancelled"]
+BATCH_BACKEND_TYPES = ["openai", "local"]
+DEFAULT_BATCH_POLL_SECONDS = 60
+
+
+## Function:
+#   one line of a batch file
+## Input
+#   custom_id: text; used to match the response to the request
+#   request_kwargs: other parameters of chat.completions.create() (e.g., top_p)
+def build_batch_request(custom_id, model_name, messages, temperature=1.0, **request_kwargs):
+    body = {"model": model_name, "messages": messages, "temperature": temperature}
+    body.update(request_kwargs)
+    return {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}
+
+
+def write_batch_file(batch_requests, batch_path):
+    batch_dir = os.path.dirname(os.path.abspath(batch_path))
+    os.makedirs(batch_dir, exist_ok=True)
+    with open(batch_path, 'w', encoding='utf-8') as f:
+        for cur_request in batch_requests:
+            f.write(json.dumps(cur_request, ensure_ascii=False) + "\n")
+
+
+def read_batch_file(batch_path):
+    with open(batch_path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip() != ""]
+
+
+## Function:
+#   parse the output lines of a batch
+## Output
+#   generation_collection: {custom_id: generation (text), ...}; failed requests are not included
+def parse_batch_output(output_lines):
+    generation_collection = {}
+    for cur_line in output_lines:
+        if cur_line.strip() == "":
+            continue
+        cur_output = json.loads(cur_line)
+        cur_response = cur_output.get("response")
+        if cur_output.get("error") != None or cur_response == None or cur_response.get("status_code") != 200:
+            print("Batch request {} failed: {}".format(cur_output.get("custom_id"), cur_output.get("error") if cur_output.get("error") != None else cur_response))
+            continue
+        generation_collection[cur_output["custom_id"]] = cur_response["body"]["choices"][0]["message"]["content"]
+    return generation_collection
+
+
+# submit batches to the batch API of OpenAI (also supported by Azure OpenAI with a batch deployment)
+class OpenAIBatchBackend(object):
+    def __init__(self, client):
+        self.client = client
+
+    ## Output
+    #   batch_id: text
+    def submit(self, batch_path):
+        with open(batch_path, 'rb') as f:
+            batch_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(input_file_id=batch_file.id, endpoint=BATCH_ENDPOINT, completion_window=BATCH_COMPLETION_WINDOW)
+        return batch.id
+
+    def get_status(self, batch_id):
+        return self.client.batches.retrieve(batch_id).status
+
+    ## Output
+    #   output_lines: [text, ...]; the lines of the output file and the error file
+    def get_output(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id)
+        output_lines = []
+        for cur_file_id in [batch.output_file_id, batch.error_file_id]:
+            if cur_file_id != None:
+                output_lines += self.client.files.content(cur_file_id).text.split("\n")
+        return output_lines
+
+
+# local stand-in of the batch API (for testing): a submitted batch is processed in the background with the interactive client, and the output file is written next to the input file in batch_dir
+class LocalFileBatchBackend(object):
+    def __init__(self, client, batch_dir, max_workers=8):
+        self.client = client
+        self.batch_dir = batch_dir
+        self.max_workers = max_workers
+        os.makedirs(batch_dir, exist_ok=True)
+
+    def get_input_path(self, batch_id):
+        return os.path.join(self.batch_dir, "{}_input.jsonl".format(batch_id))
+
+    def get_output_path(self, batch_id):
+        return os.path.join(self.batch_dir, "{}_output.jsonl".format(batch_id))
+
+    def submit(self, batch_path):
+        batch_id = "batch_local_{}".format(uuid.uuid4().hex)
+        shutil.copyfile(batch_path, self.get_input_path(batch_id))
+        threading.Thread(target=self.process, args=(batch_id,), daemon=True).start()
+        return batch_id
+
+    def process(self, batch_id):
+        batch_requests = read_batch_file(self.get_input_path(batch_id))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            output_list = list(executor.map(self.process_one_request, batch_requests))
+        # the output file appears at once (written to a temporary file first)
+        tmp_output_path = self.get_output_path(batch_id) + ".tmp"
+        with open(tmp_output_path, 'w', encoding='utf-8') as f:
+            for cur_output in output_list:
+                f.write(json.dumps(cur_output, ensure_ascii=False) + "\n")
+        os.replace(tmp_output_path, self.get_output_path(batch_id))
+
+    def process_one_request(self, batch_request):
+        body = batch_request["body"]
+        try:
+            completion = call_llm_with_retry(lambda: self.client.chat.completions.create(**body), estimated_tokens=estimate_num_tokens(json.dumps(body["messages"], ensure_ascii=False)))
+        except Exception as e:
+            return {"custom_id": batch_request["custom_id"], "response": None, "error": {"message": repr(e)}}
+        response_body = {"model": body["model"], "choices": [{"index": 0, "message": {"role": "assistant", "content": completion.choices[0].message.content}}]}
+        return {"custom_id": batch_request["custom_id"], "response": {"status_code": 200, "body": response_body}, "error": None}
+
+    def get_status(self, batch_id):
+        return "completed" if os.path.exists(self.get_output_path(batch_id)) else "in_progress"
+
+    def get_output(self, batch_id):
+        with open(self.get_output_path(batch_id), 'r', encoding='utf-8') as f:
+            return f.read().split("\n")
+
+
+## Input
+#   backend_type: "openai" / "local"
+#   client: the (sync) API client
+#   batch_dir: where LocalFileBatchBackend processes batches
+def get_batch_backend(backend_type, client, batch_dir):
+    assert backend_type in BATCH_BACKEND_TYPES, print("backend_type: ", backend_type)
+    if backend_type == "openai":
+        return OpenAIBatchBackend(client)
+    return LocalFileBatchBackend(client, batch_dir)
+
+
+## Function:
+#   submit one batch file and wait until the batch is finished
+## Input
+#   batch_requests: [build_batch_request(), ...]
+#   batch_path: where the batch file is written
+## Output
+#   generation_collection: {custom_id: generation (text), ...}; requests failed in the batch are not included
+def run_batch(batch_requests, backend, batch_path, poll_seconds=DEFAULT_BATCH_POLL_SECONDS):
+    if len(batch_requests) == 0:
+        return {}
+    write_batch_file(batch_requests, batch_path)
+    batch_id = backend.submit(batch_path)
+    print("Submitted batch {} with {} requests ({})".format(batch_id, len(batch_requests), batch_path))
+    start_time = time.time()
+    while True:
+        status = backend.get_status(batch_id)
+        if status in BATCH_TERMINAL_STATUSES:
+            break
+        print("Batch {}: {}; waited {:.0f} seconds".format(batch_id, status, time.time() - start_time))
+        time.sleep(poll_seconds)
+    if status != "completed":
+        print("Warning: batch {} finished with status: {}".format(batch_id, status))
+    generation_collection = parse_batch_output(backend.get_output(batch_id))
+    print("Batch {}: {} of {} requests succeeded".format(batch_id, len(generation_collection), len(batch_requests)))
+    return generation_collection
+
+
+## Function:
+#   batch version of llm_generation() for all the prompts of a stage: responses in the LLM response cache are not submitted, identical prompts are submitted once, and new responses are stored in the cache
+## Input
+#   prompts: [prompt0, prompt1, ...]
+#   batch_dir: the batch file is written to batch_dir/{stage}_{time}.jsonl
+## Output
+#   generations: [generation0, generation1, ...]; aligned with prompts; None if the request failed in the batch (the caller falls back to the interactive call)
+def batch_llm_generation(prompts, model_name, backend, batch_dir, temperature=1.0, stage=None, poll_seconds=DEFAULT_BATCH_POLL_SECONDS):
+    llm_cache = get_llm_cache()
+    # cache_keys: aligned with prompts; the cache key is also the custom_id of the request
+    cache_keys = [get_llm_cache_key(model_name, temperature, get_llm_messages(cur_prompt)) for cur_prompt in prompts]
+    generation_collection = {}
+    batch_requests = []
+    submitted_keys = set()
+    for cur_prompt, cur_key in zip(prompts, cache_keys):
+        if cur_key in generation_collection or cur_key in submitted_keys:
+            continue
+        if llm_cache != None:
+            cur_generation = llm_cache.get(cur_key, stage=stage)
+            if cur_generation != None:
+                generation_collection[cur_key] = cur_generation
+                continue
+        batch_requests.append(build_batch_request(cur_key, model_name, get_llm_messages(cur_prompt), temperature=temperature))
+        submitted_keys.add(cur_key)
+    print("Batch generation for stage {}: {} prompts; {} cached; {} to submit".format(stage, len(prompts), len(generation_collection), len(batch_requests)))
+    batch_path = os.path.join(batch_dir, "{}_{}.jsonl".format(stage, time.strftime("%Y%m%d_%H%M%S")))
+    new_generation_collection = run_batch(batch_requests, backend, batch_path, poll_seconds=poll_seconds)
+    for cur_key, cur_generation in new_generation_collection.items():
+        if llm_cache != None:
+            llm_cache.put(cur_key, cur_generation, model_name=model_name, stage=stage)
+        generation_collection[cur_key] = cur_generation
+    generations = [generation_collection.get(cur_key) for cur_key in cache_keys]
+    return generations
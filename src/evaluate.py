@@ -1,31 +1,35 @@
-import os, sys, argparse, json, time, copy, math
+import os, sys, argparse, json, time, copy, math, asyncio
 import numpy as np
-from openai import OpenAI, AzureOpenAI
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from Method.utils import load_chem_annotation, instruction_prompts, llm_generation_while_loop, recover_generated_title_to_exact_version_of_title, load_dict_title_2_abstract, if_element_in_list_with_similarity_threshold
+from Method.title_index import TitleIndex, SimilarityMatcher, get_title_match_stats
+from Method.utils import load_chem_annotation, instruction_prompts, llm_generation_while_loop, recover_generated_title_to_exact_version_of_title, load_dict_title_2_abstract, allm_generation_while_loop, get_structured_generation_from_raw_generation
+from Method.llm_router import resolve_llm_client
+from Method.rate_limiter import LLMGiveUpError
+from Method.llm_budget import record_llm_give_up
+from Method.batch_llm import get_batch_backend, batch_llm_generation
+from Method.llm_telemetry import save_llm_telemetry
+from Method.llm_dispatcher import set_llm_priority_class
+from Method.llm_cli import add_llm_args, add_llm_batch_args, check_llm_args, check_llm_batch_args, setup_llm_layer, print_llm_stats
 
 class Evaluate(object):
 
     def __init__(self, args) -> None:
         self.args = args
-        ## Set API client
-        # openai client
-        if args.api_type == 0:
-            self.client = OpenAI(api_key=args.api_key, base_url=args.base_url)
-        # azure client
-        elif args.api_type == 1:
-            self.client = AzureOpenAI(
-                azure_endpoint = args.base_url, 
-                api_key=args.api_key,  
-                api_version="2024-06-01"
-            )
-        else:
-            raise NotImplementedError
+        ## Set the LLM layer from the --llm_* arguments (shared by the whole process; see Method.llm_cli)
+        setup_llm_layer(args)
+        ## Set API client (shared by the whole process, so that its keep-alive connection pool is reused)
+        self.client = resolve_llm_client(args.api_type, args.api_key, args.base_url, model_name=args.model_name)
+        # the requests of this pipeline belong to self.llm_priority_class
+        self.llm_priority_class = args.llm_priority_class if args.llm_priority_class != "" else "default"
+        ## Set batch backend: evaluation by reference is submitted as one offline batch (higher throughput and lower cost, but higher latency); None: interactive requests
+        self.batch_backend = get_batch_backend(args.llm_batch_backend, self.client, args.llm_batch_dir) if args.llm_batch_backend != "" else None
         # annotated bkg research question and its annotated groundtruth inspiration paper titles
         self.bkg_q_list, self.dict_bkg2insp, self.dict_bkg2survey, self.dict_bkg2groundtruthHyp, self.dict_bkg2note, self.dict_bkg2idx, self.dict_idx2bkg, self.dict_bkg2reasoningprocess = load_chem_annotation(args.chem_annotation_path, self.args.if_use_strict_survey_question)   
         # title_abstract_collector: [[title, abstract], ...]
         # dict_title_2_abstract: {'title': 'abstract', ...}
         self.title_abstract_collector, self.dict_title_2_abstract = load_dict_title_2_abstract(title_abstract_collector_path=args.title_abstract_all_insp_literature_path)  
+        # title_index: TitleIndex of the titles in dict_title_2_abstract, to recover the generated titles to their exact version
+        self.title_index = TitleIndex(list(self.dict_title_2_abstract.keys()))
         ## load raw hypothesis
         # final_data_collection: {backgroud_question: {core_insp_title: hypthesis_mutation_collection, ...}, ...}
         #     hypthesis_mutation_collection: {mutation_id: [[hyp0, reasoning process0, feedback0], [hyp1, reasoning process1, feedback1], ...]}; mutation_id: 0, 1, 2, ... & 'recom'
@@ -34,11 +38,10 @@ class Evaluate(object):
         
 
     def run(self):
+        set_llm_priority_class(self.llm_priority_class)
         ## obtain ranked_hypothesis_collection and ranked_hypothesis_collection_with_matched_score
         if self.args.if_load_from_saved:
-            with open(self.args.output_dir, 'r') as f:
-                self.ranked_hypothesis_collection, self.ranked_hypothesis_collection_with_matched_score, self.matched_insp_hyp_collection = json.load(f)
-                print("Loaded data from ", self.args.output_dir)
+            self.load_ranked_hypothesis()
         else:
             ## hypothesis ranking
             # ranked_hypothesis_collection: {backgroud_question: ranked_hypothesis, ...}
@@ -47,8 +50,33 @@ class Evaluate(object):
             if self.args.if_with_gdth_hyp_annotation == 1:
                 # ranked_hypothesis_collection_with_matched_score: {backgroud_question: ranked_hypothesis_matched_score, ...}
                 #   ranked_hypothesis_matched_score: [[hyp, ave_score, scores, core_insp_title, round_id, [first_round_mutation_id, second_round_mutation_id], [matched_score, matched_score_reason]], ...] (here core_insp_title is the matched groundtruth inspiration paper title) (sorted by average score, in descending order)
-                self.ranked_hypothesis_collection_with_matched_score = self.automatic_evaluation_by_reference(self.ranked_hypothesis_collection)
+                if self.batch_backend != None:
+                    self.ranked_hypothesis_collection_with_matched_score = self.batch_automatic_evaluation_by_reference(self.ranked_hypothesis_collection)
+                else:
+                    self.ranked_hypothesis_collection_with_matched_score = self.automatic_evaluation_by_reference(self.ranked_hypothesis_collection)
+        self.analyse_and_save()
+
+
+    # asyncio version of run(): the hypotheses are evaluated by reference concurrently
+    async def arun(self):
+        set_llm_priority_class(self.llm_priority_class)
+        self.async_client = resolve_llm_client(self.args.api_type, self.args.api_key, self.args.base_url, model_name=self.args.model_name, if_async=True)
+        if self.args.if_load_from_saved:
+            self.load_ranked_hypothesis()
+        else:
+            self.ranked_hypothesis_collection = self.hypothesis_ranking(self.final_data_collection)
+            if self.args.if_with_gdth_hyp_annotation == 1:
+                self.ranked_hypothesis_collection_with_matched_score = await self.aautomatic_evaluation_by_reference(self.ranked_hypothesis_collection)
+        self.analyse_and_save()
+
+
+    def load_ranked_hypothesis(self):
+        with open(self.args.output_dir, 'r') as f:
+            self.ranked_hypothesis_collection, self.ranked_hypothesis_collection_with_matched_score, self.matched_insp_hyp_collection = json.load(f)
+            print("Loaded data from ", self.args.output_dir)
+
 
+    def analyse_and_save(self):
         ## analysis
         if self.args.if_with_gdth_hyp_annotation == 1:
             # print rank based on the number of matched inspirations
@@ -121,27 +149,82 @@ class Evaluate(object):
     # ranked_hypothesis_collection_with_matched_score: {backgroud_question: ranked_hypothesis_matched_score, ...}
     #   ranked_hypothesis_matched_score: [[hyp, ave_score, scores, core_insp_title, round_id, [first_round_mutation_id, second_round_mutation_id], [matched_score, matched_score_reason]], ...] (here core_insp_title is the matched groundtruth inspiration paper title); ranked by ave_score
     def automatic_evaluation_by_reference(self, ranked_hypothesis_collection):
-        ranked_hypothesis_collection_with_matched_score = {}
+        # hyp_ids_to_evaluate: {backgroud_question: [cur_id_hyp, ...], ...}
+        hyp_ids_to_evaluate = self.select_hypothesis_to_evaluate_by_reference(ranked_hypothesis_collection)
+        # matched_score_and_reason_collection: {backgroud_question: [[matched_score, reason], ...], ...}; aligned with hyp_ids_to_evaluate
+        matched_score_and_reason_collection = {}
+        for cur_background_question in hyp_ids_to_evaluate.keys():
+            ## start evaluation
+            cur_groundtruth_hyp = self.dict_bkg2groundtruthHyp[cur_background_question]
+            cur_keypoints = self.dict_bkg2note[cur_background_question]
+            # cur_matched_score_and_reason: [matched_score, reason]
+            matched_score_and_reason_collection[cur_background_question] = [self.evaluate_for_one_ranked_hypothesis(cur_background_question, ranked_hypothesis_collection[cur_background_question][cur_id_hyp], cur_groundtruth_hyp, cur_keypoints) for cur_id_hyp in hyp_ids_to_evaluate[cur_background_question]]
+        return self.organize_matched_score(ranked_hypothesis_collection, hyp_ids_to_evaluate, matched_score_and_reason_collection)
+
+
+    # asyncio version of automatic_evaluation_by_reference(): all the selected hypotheses (of all background questions) are evaluated concurrently
+    async def aautomatic_evaluation_by_reference(self, ranked_hypothesis_collection):
+        hyp_ids_to_evaluate = self.select_hypothesis_to_evaluate_by_reference(ranked_hypothesis_collection)
+        background_question_list = list(hyp_ids_to_evaluate.keys())
+        matched_score_and_reason_list = await asyncio.gather(*[asyncio.gather(*[self.aevaluate_for_one_ranked_hypothesis(cur_background_question, ranked_hypothesis_collection[cur_background_question][cur_id_hyp], self.dict_bkg2groundtruthHyp[cur_background_question], self.dict_bkg2note[cur_background_question]) for cur_id_hyp in hyp_ids_to_evaluate[cur_background_question]]) for cur_background_question in background_question_list])
+        matched_score_and_reason_collection = {cur_background_question: list(cur_matched_score_and_reason) for cur_background_question, cur_matched_score_and_reason in zip(background_question_list, matched_score_and_reason_list)}
+        return self.organize_matched_score(ranked_hypothesis_collection, hyp_ids_to_evaluate, matched_score_and_reason_collection)
+
+
+    # batch version of automatic_evaluation_by_reference(): the prompts of all the selected hypotheses (of all background questions) are submitted in one batch; responses that failed in the batch or can not be parsed are generated again with interactive requests
+    def batch_automatic_evaluation_by_reference(self, ranked_hypothesis_collection):
+        hyp_ids_to_evaluate = self.select_hypothesis_to_evaluate_by_reference(ranked_hypothesis_collection)
+        # bkg_hyp_id_list: [[backgroud_question, cur_id_hyp], ...]
+        bkg_hyp_id_list = [[cur_background_question, cur_id_hyp] for cur_background_question in hyp_ids_to_evaluate.keys() for cur_id_hyp in hyp_ids_to_evaluate[cur_background_question]]
+        prompt_list = [self.prepare_prompt_for_evaluation_by_reference(ranked_hypothesis_collection[cur_background_question][cur_id_hyp][0], self.dict_bkg2groundtruthHyp[cur_background_question], self.dict_bkg2note[cur_background_question]) for cur_background_question, cur_id_hyp in bkg_hyp_id_list]
+        generation_list = batch_llm_generation(prompt_list, self.args.model_name, self.batch_backend, self.args.llm_batch_dir, temperature=0.0, stage="reference_evaluation", poll_seconds=self.args.llm_batch_poll_seconds)
+        matched_score_and_reason_collection = {cur_background_question: [] for cur_background_question in hyp_ids_to_evaluate.keys()}
+        for (cur_background_question, cur_id_hyp), cur_generation in zip(bkg_hyp_id_list, generation_list):
+            try:
+                assert cur_generation != None
+                # structured_gene: [[matched_score, reason]]
+                structured_gene = get_structured_generation_from_raw_generation(cur_generation, template=['Matched score:', 'Reason:'])
+            except Exception as e:
+                print("Batch response can not be used ({}), evaluate with an interactive request..".format(repr(e)))
+                structured_gene = self.evaluate_for_one_ranked_hypothesis(cur_background_question, ranked_hypothesis_collection[cur_background_question][cur_id_hyp], self.dict_bkg2groundtruthHyp[cur_background_question], self.dict_bkg2note[cur_background_question])
+            matched_score_and_reason_collection[cur_background_question].append(structured_gene)
+        return self.organize_matched_score(ranked_hypothesis_collection, hyp_ids_to_evaluate, matched_score_and_reason_collection)
+
+
+    ## Function:
+    #   only evaluate those hypotheses whose core_insp_title is in the groundtruth inspiration paper titles
+    ## Output
+    # hyp_ids_to_evaluate: {backgroud_question: [cur_id_hyp, ...], ...}; cur_id_hyp is the index in ranked_hypothesis_collection[backgroud_question]
+    def select_hypothesis_to_evaluate_by_reference(self, ranked_hypothesis_collection):
+        hyp_ids_to_evaluate = {}
         for cur_background_question in ranked_hypothesis_collection.keys():
-            ranked_hypothesis_collection_with_matched_score[cur_background_question] = []
+            hyp_ids_to_evaluate[cur_background_question] = []
             # print("Evaluating for background question: {}; total number of hypotheses: {}".format(cur_background_question, len(ranked_hypothesis_collection[cur_background_question])))
+            # cur_groundtruth_insp_titles: [insp0, insp1, ...]
+            cur_groundtruth_insp_titles = self.dict_bkg2insp[cur_background_question]
+            # recover the groundtruth inspirations to the exact version of title (the ones in title_abstract.json, even chem_research_2024.xlsx is not counted as groundtruth here, since title_abstract.json might have conflicts with chem_research_2024.xlsx, and title_abstract.json is more complete, so we choose title_abstract.json as the groundtruth, although chem_research_2024.xlsx is our benchmark and title_abstract.json is only a processed intermediate file) 
+            cur_groundtruth_insp_titles = [recover_generated_title_to_exact_version_of_title(self.title_index, cur_gdth_insp) for cur_gdth_insp in cur_groundtruth_insp_titles]
+            # tokenized once for all the hypotheses of the background
+            cur_groundtruth_insp_matcher = SimilarityMatcher(cur_groundtruth_insp_titles)
             for cur_id_hyp in range(len(ranked_hypothesis_collection[cur_background_question])):
-                cur_hyp = ranked_hypothesis_collection[cur_background_question][cur_id_hyp][0]
                 ## check whether cur_core_insp_title is in the groundtruth inspiration paper titles
                 cur_core_insp_title = ranked_hypothesis_collection[cur_background_question][cur_id_hyp][3]
-                # cur_groundtruth_insp_titles: [insp0, insp1, ...]
-                cur_groundtruth_insp_titles = self.dict_bkg2insp[cur_background_question]
-                # recover the groundtruth inspirations to the exact version of title (the ones in title_abstract.json, even chem_research_2024.xlsx is not counted as groundtruth here, since title_abstract.json might have conflicts with chem_research_2024.xlsx, and title_abstract.json is more complete, so we choose title_abstract.json as the groundtruth, although chem_research_2024.xlsx is our benchmark and title_abstract.json is only a processed intermediate file) 
-                cur_groundtruth_insp_titles = [recover_generated_title_to_exact_version_of_title(list(self.dict_title_2_abstract.keys()), cur_gdth_insp) for cur_gdth_insp in cur_groundtruth_insp_titles]
                 # to see whether cur_core_insp_title is in cur_groundtruth_insp_titles
-                if_insp_in_groundtruth = if_element_in_list_with_similarity_threshold(cur_groundtruth_insp_titles, cur_core_insp_title, threshold=0.7)
+                if_insp_in_groundtruth = cur_groundtruth_insp_matcher.contains(cur_core_insp_title, threshold=0.7)
                 if if_insp_in_groundtruth == False:
                     continue
-                ## start evaluation
-                cur_groundtruth_hyp = self.dict_bkg2groundtruthHyp[cur_background_question]
-                cur_keypoints = self.dict_bkg2note[cur_background_question]
-                # cur_matched_score_and_reason: [matched_score, reason]
-                cur_matched_score_and_reason = self.evaluate_for_one_hypothesis(cur_hyp, cur_groundtruth_hyp, cur_keypoints)
+                hyp_ids_to_evaluate[cur_background_question].append(cur_id_hyp)
+        return hyp_ids_to_evaluate
+
+
+    # append the matched score and reason to the evaluated hypotheses (hypotheses whose evaluation gave up are skipped); see automatic_evaluation_by_reference() for the output
+    def organize_matched_score(self, ranked_hypothesis_collection, hyp_ids_to_evaluate, matched_score_and_reason_collection):
+        ranked_hypothesis_collection_with_matched_score = {}
+        for cur_background_question in hyp_ids_to_evaluate.keys():
+            ranked_hypothesis_collection_with_matched_score[cur_background_question] = []
+            for cur_id_hyp, cur_matched_score_and_reason in zip(hyp_ids_to_evaluate[cur_background_question], matched_score_and_reason_collection[cur_background_question]):
+                if cur_matched_score_and_reason == None:
+                    continue
                 ranked_hypothesis_collection_with_matched_score[cur_background_question].append(ranked_hypothesis_collection[cur_background_question][cur_id_hyp] + cur_matched_score_and_reason)
             print("Evaluating for background question: {}; total number of hypotheses: {}; number of hypotheses with matched score: {}".format(cur_background_question, len(ranked_hypothesis_collection[cur_background_question]), len(ranked_hypothesis_collection_with_matched_score[cur_background_question])))
         return ranked_hypothesis_collection_with_matched_score
@@ -154,11 +237,44 @@ class Evaluate(object):
     ## Output
     # matched_score: int in 1-5 Likert scale
     def evaluate_for_one_hypothesis(self, gene_hyp, gold_hyp, keypoints):
-        prompts = instruction_prompts('eval_matched_score')
-        full_prompt = prompts[0] + gene_hyp + prompts[1] + gold_hyp + prompts[2] + keypoints + prompts[3]
+        full_prompt = self.prepare_prompt_for_evaluation_by_reference(gene_hyp, gold_hyp, keypoints)
         # structured_gene: [matched_score, reason]
-        structured_gene = llm_generation_while_loop(full_prompt, self.args.model_name, self.client, if_structured_generation=True, template=['Matched score:', 'Reason:'], temperature=0.0)
+        structured_gene = llm_generation_while_loop(full_prompt, self.args.model_name, self.client, if_structured_generation=True, template=['Matched score:', 'Reason:'], temperature=0.0, stage="reference_evaluation")
         return structured_gene
+
+
+    async def aevaluate_for_one_hypothesis(self, gene_hyp, gold_hyp, keypoints):
+        full_prompt = self.prepare_prompt_for_evaluation_by_reference(gene_hyp, gold_hyp, keypoints)
+        structured_gene = await allm_generation_while_loop(full_prompt, self.args.model_name, self.async_client, if_structured_generation=True, template=['Matched score:', 'Reason:'], temperature=0.0, stage="reference_evaluation")
+        return structured_gene
+
+
+    ## Function:
+    # evaluate_for_one_hypothesis() for one hypothesis in ranked_hypothesis; the evaluation that gives up is recorded in the failure ledger
+    ## Input
+    # ranked_hypothesis_item: [hyp, ave_score, scores, core_insp_title, round_id, [first_round_mutation_id, second_round_mutation_id]]
+    ## Output
+    # structured_gene: [matched_score, reason]; None if the evaluation gave up
+    def evaluate_for_one_ranked_hypothesis(self, background_question, ranked_hypothesis_item, gold_hyp, keypoints):
+        try:
+            return self.evaluate_for_one_hypothesis(ranked_hypothesis_item[0], gold_hyp, keypoints)
+        except LLMGiveUpError as e:
+            record_llm_give_up(e, background_id=self.dict_bkg2idx[background_question], inspiration=ranked_hypothesis_item[3], mutation=ranked_hypothesis_item[5])
+            return None
+
+
+    async def aevaluate_for_one_ranked_hypothesis(self, background_question, ranked_hypothesis_item, gold_hyp, keypoints):
+        try:
+            return await self.aevaluate_for_one_hypothesis(ranked_hypothesis_item[0], gold_hyp, keypoints)
+        except LLMGiveUpError as e:
+            record_llm_give_up(e, background_id=self.dict_bkg2idx[background_question], inspiration=ranked_hypothesis_item[3], mutation=ranked_hypothesis_item[5])
+            return None
+
+
+    def prepare_prompt_for_evaluation_by_reference(self, gene_hyp, gold_hyp, keypoints):
+        prompts = instruction_prompts('eval_matched_score')
+        full_prompt = prompts[0] + gene_hyp + prompts[1] + gold_hyp + prompts[2] + keypoints + prompts[3]
+        return full_prompt
         
 
     ## Function:
@@ -171,6 +287,8 @@ class Evaluate(object):
     def analyse_gene_hyp_closest_to_gdth_hyp(self, ranked_hypothesis_collection_with_matched_score):
         matched_insp_hyp_collection = []
         for cur_background_question in ranked_hypothesis_collection_with_matched_score.keys():
+            # tokenized once for all the hypotheses of the background
+            cur_gdth_insp_matcher = SimilarityMatcher(self.dict_bkg2insp[cur_background_question])
             for cur_id_hyp in range(len(ranked_hypothesis_collection_with_matched_score[cur_background_question])):
                 cur_hyp = ranked_hypothesis_collection_with_matched_score[cur_background_question][cur_id_hyp][0]
                 cur_ave_score = ranked_hypothesis_collection_with_matched_score[cur_background_question][cur_id_hyp][1]
@@ -189,11 +307,9 @@ class Evaluate(object):
                 # should be no repeated inspirations
                 assert len(cur_used_insps_set) == len(cur_used_insps)
                 cur_full_gdth_insps = self.dict_bkg2insp[cur_background_question]
-                cnt_matched_insp = 0
                 # print("cur_used_insps_set: ", cur_used_insps_set)
-                for cur_gdth_insp in cur_full_gdth_insps:
-                    if if_element_in_list_with_similarity_threshold(cur_used_insps_set, cur_gdth_insp, threshold=0.7):
-                        cnt_matched_insp += 1
+                # the number of cur_full_gdth_insps that are in cur_used_insps_set (with a similarity threshold)
+                cnt_matched_insp = cur_gdth_insp_matcher.count_matched_references(cur_used_insps_set, threshold=0.7)
                 if cnt_matched_insp > 0:
                     matched_insp_hyp_collection.append([cur_hyp, cur_gdth_hyp, cur_ave_score, cur_scores, cnt_matched_insp, cur_used_insps_set, cur_full_gdth_insps, cur_matched_score_reason[0], cur_matched_score_reason[1], cur_round_id])
         # rank matched_insp_hyp_collection based on cnt_matched_insp
@@ -219,10 +335,14 @@ if __name__ == '__main__':
     parser.add_argument("--if_load_from_saved", type=int, default=0, help="whether load data that is previous to inter-EA recombination; when used, the framework will load data from output_dir, instead of generating from scratch; mainly used for debugging and improving inter-EA recombination") 
     parser.add_argument("--corpus_size", type=int, default=300, help="the number of total inspiration (paper) corpus (both groundtruth insp papers and non-groundtruth insp papers)")
     parser.add_argument("--if_with_gdth_hyp_annotation", type=int, default=1, help="whether we have groundtruth hypothesis annotation to calculate the matched score and following analysis. If we don't have groundtruth hypothesis annotation, here we only rank the generated hypotheses based on their automatic evaluation scores given by LLMs (validness, novelty, significance, and potential), but not calculate the matched score and do following analysis.")
+    add_llm_args(parser)
+    add_llm_batch_args(parser)
     args = parser.parse_args()
 
     assert args.model_name in ['chatgpt', 'chatgpt16k', 'gpt4', 'claude35S', 'gemini15P', 'llama318b', 'llama3170b', 'llama31405b']
     assert args.api_type in [0, 1]
+    check_llm_args(args)
+    check_llm_batch_args(args)
     assert args.if_use_strict_survey_question in [0, 1]
     assert args.if_save in [1]
     assert args.if_load_from_saved in [0, 1]
@@ -242,5 +362,13 @@ if __name__ == '__main__':
         print("Warning: {} already exists.".format(args.output_dir))
     else:
         evaluate = Evaluate(args)
-        evaluate.run()
+        if args.if_async == 1:
+            asyncio.run(evaluate.arun())
+        else:
+            evaluate.run()
+        # saved only after a run, so that a skipped run does not overwrite the telemetry of the run that wrote output_dir
+        save_llm_telemetry(args.output_dir, prometheus_path=args.llm_telemetry_prometheus_path)
+    print_llm_stats()
+    if get_title_match_stats().get_num_matches() > 0:
+        get_title_match_stats().print_stats()
     print("Evaluation finished.")
@@ -1,26 +1,29 @@
-import os, sys, argparse, json, time, copy, math
-from openai import OpenAI, AzureOpenAI
+import os, sys, argparse, json, time, copy, math, asyncio
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from Method.utils import load_chem_annotation, instruction_prompts, llm_generation, pick_score
+from Method.utils import load_chem_annotation, instruction_prompts, llm_generation, allm_generation, pick_score
+from Method.llm_router import resolve_llm_client
+from Method.structured_output import FOUR_ASPECT_SCORE_TEMPLATE
+from Method.rate_limiter import LLMFatalError, LLMGiveUpError
+from Method.llm_budget import record_llm_give_up, start_llm_retry_budget
+from Method.batch_llm import get_batch_backend, batch_llm_generation
+from Method.llm_telemetry import save_llm_telemetry
+from Method.self_evaluation_batch import evaluate_hypotheses_in_batches, aevaluate_hypotheses_in_batches, get_self_evaluation_batch_stats
+from Method.llm_dispatcher import set_llm_priority_class
+from Method.llm_cli import add_llm_args, add_llm_batch_args, check_llm_args, check_llm_batch_args, setup_llm_layer, print_llm_stats
 import numpy as np
 
 
 class GroundTruth_Hyp_Ranking(object):
     def __init__(self, args) -> None:
         self.args = args
-        ## Set API client
-        # openai client
-        if args.api_type == 0:
-            self.client = OpenAI(api_key=args.api_key, base_url=args.base_url)
-        # azure client
-        elif args.api_type == 1:
-            self.client = AzureOpenAI(
-                azure_endpoint = args.base_url, 
-                api_key=args.api_key,  
-                api_version="2024-06-01"
-            )
-        else:
-            raise NotImplementedError
+        ## Set the LLM layer from the --llm_* arguments (shared by the whole process; see Method.llm_cli)
+        setup_llm_layer(args)
+        ## Set API client (shared by the whole process, so that its keep-alive connection pool is reused)
+        self.client = resolve_llm_client(args.api_type, args.api_key, args.base_url, model_name=args.model_name)
+        # the requests of this pipeline belong to self.llm_priority_class
+        self.llm_priority_class = args.llm_priority_class if args.llm_priority_class != "" else "batch"
+        ## Set batch backend: the groundtruth hypotheses are evaluated in one offline batch by batch_looping(); None: interactive requests
+        self.batch_backend = get_batch_backend(args.llm_batch_backend, self.client, args.llm_batch_dir) if args.llm_batch_backend != "" else None
         # groundtruth hypothesis
         self.bkg_q_list, self.dict_bkg2insp, self.dict_bkg2survey, self.dict_bkg2groundtruthHyp, self.dict_bkg2note, self.dict_bkg2idx, self.dict_idx2bkg, self.dict_bkg2reasoningprocess = load_chem_annotation(args.chem_annotation_path, self.args.if_use_strict_survey_question, self.args.if_use_background_survey)      
         
@@ -31,26 +34,62 @@ class GroundTruth_Hyp_Ranking(object):
     # score_collection: ['score0', 'score1', 'score2', 'score3']
     # score_reason_collection: ['reason0', 'reason1', 'reason2', 'reason3']
     def four_aspects_self_numerical_evaluation_for_hyp(self, cur_hyp):
-        prompts = instruction_prompts("four_aspects_self_numerical_evaluation")
-        assert len(prompts) == 2
-        # cur_hypothesis_prompt: for evaluation, we only need the hypothesis itself, but not reasoning process
-        cur_hypothesis_prompt = "hypothesis: {}.".format(cur_hyp)
-        full_prompt = prompts[0] + cur_hypothesis_prompt + prompts[1]
+        full_prompt, prompt_prefix = self.prepare_prompt_for_four_aspects_self_numerical_evaluation(cur_hyp)
         # generation
+        # the cached generation is only used in the first try
+        if_read_cache = True
+        retry_budget = start_llm_retry_budget("self_evaluation", full_prompt)
         while True:
             try:
-                score_text = llm_generation(full_prompt, self.args.model_name, self.client)
+                score_text = llm_generation(full_prompt, self.args.model_name, self.client, stage="self_evaluation", if_read_cache=if_read_cache, structured_output_template=FOUR_ASPECT_SCORE_TEMPLATE, prompt_prefix=prompt_prefix)
+                if_read_cache = False
                 score_collection, score_reason_collection, if_successful = pick_score(score_text, full_prompt)
                 assert if_successful == True
                 break
             except AssertionError as e:
                 # if the format
                 print("AssertionError: {}, try again..".format(e))
+                retry_budget.fail(e)
+            except LLMFatalError:
+                raise
+            except Exception as e:
+                print("Exception: {}, try again..".format(e))
+                retry_budget.fail(e)
+        return score_collection, score_reason_collection
+
+
+    async def afour_aspects_self_numerical_evaluation_for_hyp(self, cur_hyp):
+        full_prompt, prompt_prefix = self.prepare_prompt_for_four_aspects_self_numerical_evaluation(cur_hyp)
+        if_read_cache = True
+        retry_budget = start_llm_retry_budget("self_evaluation", full_prompt)
+        while True:
+            try:
+                score_text = await allm_generation(full_prompt, self.args.model_name, self.async_client, stage="self_evaluation", if_read_cache=if_read_cache, structured_output_template=FOUR_ASPECT_SCORE_TEMPLATE, prompt_prefix=prompt_prefix)
+                if_read_cache = False
+                score_collection, score_reason_collection, if_successful = pick_score(score_text, full_prompt)
+                assert if_successful == True
+                break
+            except AssertionError as e:
+                print("AssertionError: {}, try again..".format(e))
+                retry_budget.fail(e)
+            except LLMFatalError:
+                raise
             except Exception as e:
                 print("Exception: {}, try again..".format(e))
+                retry_budget.fail(e)
         return score_collection, score_reason_collection
 
 
+    # prompt_prefix: the instructions shared by the evaluation of all the hypotheses; see llm_generation()
+    def prepare_prompt_for_four_aspects_self_numerical_evaluation(self, cur_hyp):
+        prompts = instruction_prompts("four_aspects_self_numerical_evaluation")
+        assert len(prompts) == 2
+        # cur_hypothesis_prompt: for evaluation, we only need the hypothesis itself, but not reasoning process
+        cur_hypothesis_prompt = "hypothesis: {}.".format(cur_hyp)
+        full_prompt = prompts[0] + cur_hypothesis_prompt + prompts[1]
+        return full_prompt, prompts[0]
+
+
     ## input
     # cur_bkg: text
     # cur_score_collection: ['score0', 'score1', 'score2', 'score3']; scores for groundtruth hypothesis
@@ -144,6 +183,9 @@ class GroundTruth_Hyp_Ranking(object):
 
 
     def looping(self):
+        set_llm_priority_class(self.llm_priority_class)
+        if self.args.self_eval_batch_size > 1:
+            return self.self_eval_batch_looping()
         # groundtruthHyp_fourScores_collection: [[cur_score_collection, cur_score_reason_collection, final_ratio_overall_and_four_aspects], ...]
         #   final_ratio_overall_and_four_aspects: [[first_ratio, last_ratio, ave_ratio], ...] (average score, validness score, novelty score, significance score, potential score)
         groundtruthHyp_fourScores_collection = []
@@ -152,7 +194,11 @@ class GroundTruth_Hyp_Ranking(object):
             cur_bkg = self.bkg_q_list[cur_id_bkg]
             cur_hyp = self.dict_bkg2groundtruthHyp[cur_bkg]
             # get scores for cur_hyp
-            cur_score_collection, cur_score_reason_collection = self.four_aspects_self_numerical_evaluation_for_hyp(cur_hyp)
+            try:
+                cur_score_collection, cur_score_reason_collection = self.four_aspects_self_numerical_evaluation_for_hyp(cur_hyp)
+            except LLMGiveUpError as e:
+                record_llm_give_up(e, background_id=cur_id_bkg)
+                continue
             # print("cur_score_collection: ", cur_score_collection)
             final_ratio_overall_and_four_aspects = self.get_rank_ratio_for_each_hyp(cur_id_bkg, cur_bkg, cur_score_collection)
             groundtruthHyp_fourScores_collection.append([cur_id_bkg, cur_score_collection, cur_score_reason_collection, final_ratio_overall_and_four_aspects])
@@ -164,6 +210,91 @@ class GroundTruth_Hyp_Ranking(object):
                 json.dump(groundtruthHyp_fourScores_collection, f)
         return ave_ave_index_ratio
 
+
+    # asyncio version of looping(): the groundtruth hypotheses of all background questions are evaluated concurrently
+    async def alooping(self):
+        set_llm_priority_class(self.llm_priority_class)
+        self.async_client = resolve_llm_client(self.args.api_type, self.args.api_key, self.args.base_url, model_name=self.args.model_name, if_async=True)
+        # score_and_reason_list: [[cur_score_collection, cur_score_reason_collection], ...]
+        if self.args.self_eval_batch_size > 1:
+            hyp_list = [self.dict_bkg2groundtruthHyp[cur_bkg] for cur_bkg in self.bkg_q_list]
+            score_and_reason_list = await aevaluate_hypotheses_in_batches(hyp_list, self.args.self_eval_batch_size, self.args.model_name, self.async_client, self.aevaluate_groundtruth_hyp)
+        else:
+            score_and_reason_list = await asyncio.gather(*[self.aevaluate_groundtruth_hyp(cur_id_bkg) for cur_id_bkg in range(len(self.bkg_q_list))])
+        return self.rank_ratio_and_save(score_and_reason_list)
+
+
+    # afour_aspects_self_numerical_evaluation_for_hyp() for the groundtruth hypothesis of one background question; None if the evaluation gave up (recorded in the failure ledger)
+    async def aevaluate_groundtruth_hyp(self, cur_id_bkg):
+        try:
+            return list(await self.afour_aspects_self_numerical_evaluation_for_hyp(self.dict_bkg2groundtruthHyp[self.bkg_q_list[cur_id_bkg]]))
+        except LLMGiveUpError as e:
+            record_llm_give_up(e, background_id=cur_id_bkg)
+            return None
+
+
+    # looping() with args.self_eval_batch_size groundtruth hypotheses (of different background questions; the evaluation prompt does not include the background question) scored in one request; the hypotheses that are not scored by their batched request are evaluated one by one
+    def self_eval_batch_looping(self):
+        hyp_list = [self.dict_bkg2groundtruthHyp[cur_bkg] for cur_bkg in self.bkg_q_list]
+        score_and_reason_list = evaluate_hypotheses_in_batches(hyp_list, self.args.self_eval_batch_size, self.args.model_name, self.client, self.evaluate_groundtruth_hyp)
+        return self.rank_ratio_and_save(score_and_reason_list)
+
+
+    # four_aspects_self_numerical_evaluation_for_hyp() for the groundtruth hypothesis of one background question; None if the evaluation gave up (recorded in the failure ledger)
+    def evaluate_groundtruth_hyp(self, cur_id_bkg):
+        try:
+            return list(self.four_aspects_self_numerical_evaluation_for_hyp(self.dict_bkg2groundtruthHyp[self.bkg_q_list[cur_id_bkg]]))
+        except LLMGiveUpError as e:
+            record_llm_give_up(e, background_id=cur_id_bkg)
+            return None
+
+
+    # batch version of looping(): the groundtruth hypotheses of all background questions are evaluated in one batch; responses that failed in the batch or can not be parsed are generated again with interactive requests
+    def batch_looping(self):
+        set_llm_priority_class(self.llm_priority_class)
+        prompt_list = [self.prepare_prompt_for_four_aspects_self_numerical_evaluation(self.dict_bkg2groundtruthHyp[cur_bkg])[0] for cur_bkg in self.bkg_q_list]
+        generation_list = batch_llm_generation(prompt_list, self.args.model_name, self.batch_backend, self.args.llm_batch_dir, stage="self_evaluation", poll_seconds=self.args.llm_batch_poll_seconds)
+        # score_and_reason_list: [[cur_score_collection, cur_score_reason_collection], ...]
+        score_and_reason_list = []
+        for cur_id_bkg, (cur_bkg, cur_prompt, cur_generation) in enumerate(zip(self.bkg_q_list, prompt_list, generation_list)):
+            try:
+                assert cur_generation != None
+                score_collection, score_reason_collection, if_successful = pick_score(cur_generation, cur_prompt)
+                assert if_successful == True
+            except Exception as e:
+                print("Batch response can not be used ({}), evaluate with an interactive request..".format(repr(e)))
+                try:
+                    score_collection, score_reason_collection = self.four_aspects_self_numerical_evaluation_for_hyp(self.dict_bkg2groundtruthHyp[cur_bkg])
+                except LLMGiveUpError as e:
+                    record_llm_give_up(e, background_id=cur_id_bkg)
+                    score_and_reason_list.append(None)
+                    continue
+            score_and_reason_list.append([score_collection, score_reason_collection])
+        return self.rank_ratio_and_save(score_and_reason_list)
+
+
+    ## Input
+    # score_and_reason_list: [[cur_score_collection, cur_score_reason_collection], ...]; aligned with self.bkg_q_list; None for the background questions whose evaluation gave up (skipped)
+    ## Output
+    # ave_ave_index_ratio: the same as looping()
+    def rank_ratio_and_save(self, score_and_reason_list):
+        groundtruthHyp_fourScores_collection = []
+        ave_index_ratio_list = []
+        for cur_id_bkg in range(len(self.bkg_q_list)):
+            cur_bkg = self.bkg_q_list[cur_id_bkg]
+            if score_and_reason_list[cur_id_bkg] == None:
+                continue
+            cur_score_collection, cur_score_reason_collection = score_and_reason_list[cur_id_bkg]
+            final_ratio_overall_and_four_aspects = self.get_rank_ratio_for_each_hyp(cur_id_bkg, cur_bkg, cur_score_collection)
+            groundtruthHyp_fourScores_collection.append([cur_id_bkg, cur_score_collection, cur_score_reason_collection, final_ratio_overall_and_four_aspects])
+            ave_index_ratio_list.append(final_ratio_overall_and_four_aspects[0][2])
+        ave_ave_index_ratio = np.mean(ave_index_ratio_list)
+        # save
+        if self.args.if_save:
+            with open(self.args.output_dir, 'w') as f:
+                json.dump(groundtruthHyp_fourScores_collection, f)
+        return ave_ave_index_ratio
+
         
         
 
@@ -184,13 +315,26 @@ if __name__ == "__main__":
     parser.add_argument("--evaluate_result_dir", type=str, default="./Checkpoints/evaluation_gpt4_corpus_300_survey_1_gdthInsp_1_intraEA_1_interEA_1_bkgid_")
     parser.add_argument("--if_save", type=int, default=1)
     parser.add_argument("--output_dir", type=str, default="./Checkpoints/groundtruth_hypothesis_automatic_scores_four_aspects.json")
+    add_llm_args(parser)
+    add_llm_batch_args(parser)
+    parser.add_argument("--self_eval_batch_size", type=int, default=1, help="number of groundtruth hypotheses scored in one self-evaluation request; the hypotheses whose scores can not be parsed from the batched response are evaluated one by one; 1: one hypothesis per request")
     args = parser.parse_args()
 
     assert args.api_type in [0, 1]
+    check_llm_args(args)
+    check_llm_batch_args(args)
+    assert args.self_eval_batch_size >= 1
     assert args.if_save in [0, 1]
     if not os.path.exists(args.output_dir):
         gtr = GroundTruth_Hyp_Ranking(args)
-        ave_ave_index_ratio = gtr.looping()
+        if args.if_async == 1:
+            ave_ave_index_ratio = asyncio.run(gtr.alooping())
+        elif args.llm_batch_backend != "":
+            ave_ave_index_ratio = gtr.batch_looping()
+        else:
+            ave_ave_index_ratio = gtr.looping()
+        # saved only after a run, so that a skipped run does not overwrite the telemetry of the run that wrote output_dir
+        save_llm_telemetry(args.output_dir, prometheus_path=args.llm_telemetry_prometheus_path)
     else:
         # groundtruthHyp_fourScores_collection: [[cur_id_bkg, cur_score_collection, cur_score_reason_collection, final_ratio_overall_and_four_aspects], ...]
         #   final_ratio_overall_and_four_aspects: [[first_ratio, last_ratio, ave_ratio], ...] (average score, validness score, novelty score, significance score, potential score)
@@ -210,4 +354,6 @@ if __name__ == "__main__":
         ave_ave_index_ratio_potential = np.mean(ave_index_ratio_potential_list)
 
     print("ave_ave_index_ratio_overall: {:.2f}; ave_ave_index_ratio_validness: {:.2f}; ave_ave_index_ratio_novelty: {:.2f}; ave_ave_index_ratio_significance: {:.2f}; ave_ave_index_ratio_potential: {:.2f}".format(ave_ave_index_ratio, ave_ave_index_ratio_validness, ave_ave_index_ratio_novelty, ave_ave_index_ratio_significance, ave_ave_index_ratio_potential))
-
+    print_llm_stats()
+    if args.self_eval_batch_size > 1:
+        get_self_evaluation_batch_stats().print_stats()
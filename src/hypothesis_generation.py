@@ -1,10 +1,19 @@
 from ast import Not
 from multiprocessing import Value
-import os, sys, argparse, json, time, copy, math
-from openai import OpenAI, AzureOpenAI
+import os, sys, argparse, json, time, copy, math, asyncio
 import numpy as np
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from Method.utils import load_chem_annotation, load_dict_title_2_abstract, load_found_inspirations, get_item_from_dict_with_very_similar_but_not_exact_key, instruction_prompts, llm_generation, get_structured_generation_from_raw_generation, pick_score, llm_generation_while_loop, recover_generated_title_to_exact_version_of_title, load_groundtruth_inspirations_as_screened_inspirations
+from Method.title_index import TitleIndex, get_title_match_stats
+from Method.utils import load_chem_annotation, load_dict_title_2_abstract, load_found_inspirations, get_item_from_dict_with_very_similar_but_not_exact_key, instruction_prompts, llm_generation, get_structured_generation_from_raw_generation, pick_score, llm_generation_while_loop, recover_generated_title_to_exact_version_of_title, load_groundtruth_inspirations_as_screened_inspirations, allm_generation, allm_generation_while_loop
+from Method.llm_router import resolve_llm_client
+from Method.structured_output import FOUR_ASPECT_SCORE_TEMPLATE
+from Method.rate_limiter import LLMFatalError, LLMGiveUpError
+from Method.llm_budget import record_llm_give_up, llm_give_up_context, start_llm_retry_budget, load_llm_failure_ledger
+from Method.llm_telemetry import save_llm_telemetry
+from Method.abstract_digest import setup_abstract_digest, get_abstract_digest, get_screening_abstracts, aget_screening_abstracts
+from Method.self_evaluation_batch import self_evaluation_batch, get_self_evaluation_batch, get_self_evaluation_batch_stats
+from Method.llm_dispatcher import set_llm_priority_class
+from Method.llm_cli import add_llm_args, check_llm_args, setup_llm_layer, print_llm_stats
 
 class HypothesisGenerationEA(object):
     # custom_rq (text) and custom_bs (text) are used when the user has their own research question and background survey to work on (but not those in the Tomato-Chem benchmark), and leverage MOOSE-Chem for inference
@@ -12,19 +21,14 @@ class HypothesisGenerationEA(object):
         self.args = args
         self.custom_rq = custom_rq
         self.custom_bs = custom_bs
-        ## Set API client
-        # openai client
-        if args.api_type == 0:
-            self.client = OpenAI(api_key=args.api_key, base_url=args.base_url)
-        # azure client
-        elif args.api_type == 1:
-            self.client = AzureOpenAI(
-                azure_endpoint = args.base_url, 
-                api_key=args.api_key,  
-                api_version="2024-06-01"
-            )
-        else:
-            raise NotImplementedError
+        ## Set the LLM layer from the --llm_* arguments (shared by the whole process; see Method.llm_cli)
+        setup_llm_layer(args)
+        ## Set API client (shared by the whole process, so that its keep-alive connection pool is reused)
+        self.client = resolve_llm_client(args.api_type, args.api_key, args.base_url, model_name=args.model_name)
+        ## Set digests of the inspiration abstracts in the additional rounds of inspiration screening (shared by the whole process; None: the full abstracts are used)
+        setup_abstract_digest(args.abstract_digest_mode, max_chars=args.abstract_digest_max_chars, cache_path=args.abstract_digest_cache_path, model_name=args.abstract_digest_model_name if args.abstract_digest_model_name != "" else args.model_name)
+        # the requests of this pipeline belong to self.llm_priority_class
+        self.llm_priority_class = args.llm_priority_class if args.llm_priority_class != "" else ("interactive" if custom_rq != None else "default")
         ## Load research background: Use the research question and background survey in Tomato-Chem or the custom ones from input
         if custom_rq == None and custom_bs == None:
             # annotated bkg research question and its annotated groundtruth inspiration paper titles
@@ -39,6 +43,8 @@ class HypothesisGenerationEA(object):
         # title_abstract_collector: [[title, abstract], ...]
         # dict_title_2_abstract: {'title': 'abstract', ...}
         self.title_abstract_collector, self.dict_title_2_abstract = load_dict_title_2_abstract(title_abstract_collector_path=args.title_abstract_all_insp_literature_path)
+        # title_index: TitleIndex of the titles in dict_title_2_abstract, to recover the generated titles to their exact version
+        self.title_index = TitleIndex(list(self.dict_title_2_abstract.keys()))
         ## Load the selected inspirations from the inspiration corpus (results from inspiration_screening.py)
         if args.if_use_gdth_insp == 0:
             # organized_insp: {'bq': [[title, reason], [title, reason], ...]}
@@ -62,6 +68,7 @@ class HypothesisGenerationEA(object):
     ## Output
     # final_data_collection: {backgroud_question: {core_insp_title: hypthesis_mutation_collection, ...}, ...}
     def hypothesis_generation_for_one_background_question(self, background_question_id, inspiration_ids=[-1], final_data_collection=None):
+        set_llm_priority_class(self.llm_priority_class)
         ### intra-EA mutation 
         print("\nHypothesis generation for one background question..")
         assert type(inspiration_ids) == list
@@ -77,17 +84,16 @@ class HypothesisGenerationEA(object):
         if backgroud_question not in final_data_collection:
             final_data_collection[backgroud_question] = {}
         # iterate over each core inspiration
-        for cur_insp_id in range(len(screened_insp_cur_bq)):
-            cur_insp_title = screened_insp_cur_bq[cur_insp_id][0]
-            if -1 not in inspiration_ids and cur_insp_id not in inspiration_ids:
-                continue
-            # only develop hypothesis for the inspirations that are in given inspiration_ids but are not in final_data_collection[backgroud_question]
-            if cur_insp_title in final_data_collection[backgroud_question]:
-                continue
+        for cur_insp_id, cur_insp_title in self.select_insp_to_develop(backgroud_question, inspiration_ids, final_data_collection):
             print("cur_insp_id: {}; cur_insp_title: {}".format(cur_insp_id, cur_insp_title))
             # generate hypothesis for one background question and one inspiration
             # hypthesis_mutation_collection: {mutation_id: [[hyp0, reasoning process0, feedback0], [hyp1, reasoning process1, feedback1], ...]}
-            hypthesis_mutation_collection = self.hypothesis_generation_for_one_bkg_one_insp(background_question_id, cur_insp_id)
+            try:
+                hypthesis_mutation_collection = self.develop_with_self_evaluation_batch(lambda: self.hypothesis_generation_for_one_bkg_one_insp(background_question_id, cur_insp_id))
+            except LLMGiveUpError as e:
+                # skip the inspiration; it is not in final_data_collection, so it is developed again when retried from the failure ledger
+                record_llm_give_up(e, background_id=background_question_id, inspiration=cur_insp_title, inspiration_id=cur_insp_id)
+                continue
             # save to final_data_collection
             final_data_collection[backgroud_question][cur_insp_title] = hypthesis_mutation_collection
         
@@ -104,6 +110,62 @@ class HypothesisGenerationEA(object):
                     self.save_file(final_data_collection, self.args.output_dir)
         return final_data_collection
 
+
+    ## Function
+    # async version of hypothesis_generation_for_one_background_question(): the inspirations of the first step are developed concurrently (the LLM requests in flight are bounded by the semaphore in Method.utils and by the shared rate limiter); the additional inspiration steps depend on the ranking of the previous step, so the steps themselves still run one after another
+    async def ahypothesis_generation_for_one_background_question(self, background_question_id, inspiration_ids=[-1], final_data_collection=None):
+        set_llm_priority_class(self.llm_priority_class)
+        print("\nHypothesis generation for one background question (asyncio)..")
+        assert type(inspiration_ids) == list
+        self.async_client = resolve_llm_client(self.args.api_type, self.args.api_key, self.args.base_url, model_name=self.args.model_name, if_async=True)
+        backgroud_question = self.dict_idx2bkg[background_question_id]
+        screened_insp_cur_bq = self.organized_insp[backgroud_question]
+        assert max(inspiration_ids) < len(screened_insp_cur_bq), "inspiration_ids should be less than the number of inspirations in the background question: max(inspiration_ids): {}; len(screened_insp_cur_bq): {}".format(max(inspiration_ids), len(screened_insp_cur_bq))
+        if final_data_collection == None:
+            final_data_collection = {}
+        if backgroud_question not in final_data_collection:
+            final_data_collection[backgroud_question] = {}
+        insp_to_develop = self.select_insp_to_develop(backgroud_question, inspiration_ids, final_data_collection)
+        for cur_insp_id, cur_insp_title in insp_to_develop:
+            print("cur_insp_id: {}; cur_insp_title: {}".format(cur_insp_id, cur_insp_title))
+        # None if the inspiration gave up (then it is skipped, the same as the sync version)
+        async def adevelop_one_insp(cur_insp_id, cur_insp_title):
+            try:
+                return await self.adevelop_with_self_evaluation_batch(lambda: self.ahypothesis_generation_for_one_bkg_one_insp(background_question_id, cur_insp_id))
+            except LLMGiveUpError as e:
+                record_llm_give_up(e, background_id=background_question_id, inspiration=cur_insp_title, inspiration_id=cur_insp_id)
+                return None
+        hypthesis_mutation_collection_list = await asyncio.gather(*[adevelop_one_insp(cur_insp_id, cur_insp_title) for cur_insp_id, cur_insp_title in insp_to_develop])
+        # insert in the order of the inspirations, the same as the sync version
+        for (cur_insp_id, cur_insp_title), hypthesis_mutation_collection in zip(insp_to_develop, hypthesis_mutation_collection_list):
+            if hypthesis_mutation_collection == None:
+                continue
+            final_data_collection[backgroud_question][cur_insp_title] = hypthesis_mutation_collection
+        if self.args.if_save:
+            self.save_file(final_data_collection, self.args.output_dir)
+        if self.args.max_inspiration_search_steps >= 2:
+            for cur_step_id in range(2, self.args.max_inspiration_search_steps+1):
+                final_data_collection = await self.acontroller_additional_inspiration_step_hypothesis_generation(background_question_id, final_data_collection, step_id=cur_step_id)
+                if self.args.if_save:
+                    self.save_file(final_data_collection, self.args.output_dir)
+        return final_data_collection
+
+
+    ## Output
+    # insp_to_develop: [[cur_insp_id, cur_insp_title], ...]; the inspirations in inspiration_ids that are not in final_data_collection[backgroud_question] yet
+    def select_insp_to_develop(self, backgroud_question, inspiration_ids, final_data_collection):
+        screened_insp_cur_bq = self.organized_insp[backgroud_question]
+        insp_to_develop = []
+        for cur_insp_id in range(len(screened_insp_cur_bq)):
+            cur_insp_title = screened_insp_cur_bq[cur_insp_id][0]
+            if -1 not in inspiration_ids and cur_insp_id not in inspiration_ids:
+                continue
+            # only develop hypothesis for the inspirations that are in given inspiration_ids but are not in final_data_collection[backgroud_question]
+            if cur_insp_title in final_data_collection[backgroud_question]:
+                continue
+            insp_to_develop.append([cur_insp_id, cur_insp_title])
+        return insp_to_develop
+
     
     ## Function
     # Controller for the second inspiration step hypothesis generation (by second round inspiration screening or self-exploration of extra knowledge)
@@ -115,6 +177,33 @@ class HypothesisGenerationEA(object):
     #   step_id: int; 1: about the first layer of inspiration/hypothesis node; 2: about the second layer of inspiration/hypothesis node; 3: about the third layer of inspiration/hypothesis node; ...
     def controller_additional_inspiration_step_hypothesis_generation(self, background_question_id, final_data_collection, step_id):
         assert step_id >= 2
+        ranked_top_core_insp_id_hyp_ave_score_list = self.rank_insp_for_additional_inspiration_step(background_question_id, final_data_collection, step_id)
+
+        ### inter-EA recombination
+        if self.args.if_mutate_between_diff_insp == 1:
+            final_data_collection = hyp_gene_ea.recombinational_mutation_between_diff_insp(background_question_id=background_question_id, ranked_top_insp_list=ranked_top_core_insp_id_hyp_ave_score_list, recom_inspiration_ids_user_input=self.args.recom_inspiration_ids, final_data_collection=final_data_collection, step_id=step_id)
+
+        ### self-explore extra knowledge
+        if self.args.if_self_explore == 1:
+            final_data_collection = hyp_gene_ea.self_explore_extra_knowledge_one_bkg_multiple_insp_node(background_question_id=background_question_id, ranked_top_insp_list=ranked_top_core_insp_id_hyp_ave_score_list, self_explore_inspiration_ids_user_input=self.args.self_explore_inspiration_ids, final_data_collection=final_data_collection, step_id=step_id)
+        
+        return final_data_collection
+
+
+    async def acontroller_additional_inspiration_step_hypothesis_generation(self, background_question_id, final_data_collection, step_id):
+        assert step_id >= 2
+        ranked_top_core_insp_id_hyp_ave_score_list = self.rank_insp_for_additional_inspiration_step(background_question_id, final_data_collection, step_id)
+        if self.args.if_mutate_between_diff_insp == 1:
+            final_data_collection = await self.arecombinational_mutation_between_diff_insp(background_question_id=background_question_id, ranked_top_insp_list=ranked_top_core_insp_id_hyp_ave_score_list, recom_inspiration_ids_user_input=self.args.recom_inspiration_ids, final_data_collection=final_data_collection, step_id=step_id)
+        if self.args.if_self_explore == 1:
+            final_data_collection = await self.aself_explore_extra_knowledge_one_bkg_multiple_insp_node(background_question_id=background_question_id, ranked_top_insp_list=ranked_top_core_insp_id_hyp_ave_score_list, self_explore_inspiration_ids_user_input=self.args.self_explore_inspiration_ids, final_data_collection=final_data_collection, step_id=step_id)
+        return final_data_collection
+
+
+    ## Output
+    # ranked_top_core_insp_id_hyp_ave_score_list: [[core_insp_id, hypothesis, hypothesis_score, [mutation_id], ave_score], ...]; None if neither inter-EA recombination nor self-explore is used
+    def rank_insp_for_additional_inspiration_step(self, background_question_id, final_data_collection, step_id):
+        ranked_top_core_insp_id_hyp_ave_score_list = None
         if self.args.if_mutate_between_diff_insp == 1 or self.args.if_self_explore == 1:
             ## Obtain a ranked list of core inspiration ids based on the average score of the best hypothesis from each inspiration
             bkg_question = self.dict_idx2bkg[background_question_id]
@@ -130,16 +219,7 @@ class HypothesisGenerationEA(object):
             for idx in range(len(ranked_top_core_insp_id_hyp_ave_score_list)):
                 print("\trank: {}, ave_score: {:.2f}; insp_id: {}; insp_title: {}".format(idx+1, ranked_top_core_insp_id_hyp_ave_score_list[idx][4], ranked_top_core_insp_id_hyp_ave_score_list[idx][0], self.dict_bkg_idx2insp[bkg_question][ranked_top_core_insp_id_hyp_ave_score_list[idx][0]]))
             print("Number of (all) ranked hypothesis nodes to determine which node to further exploit: {}".format(len(ranked_top_core_insp_id_hyp_ave_score_list)))
-
-        ### inter-EA recombination
-        if self.args.if_mutate_between_diff_insp == 1:
-            final_data_collection = hyp_gene_ea.recombinational_mutation_between_diff_insp(background_question_id=background_question_id, ranked_top_insp_list=ranked_top_core_insp_id_hyp_ave_score_list, recom_inspiration_ids_user_input=self.args.recom_inspiration_ids, final_data_collection=final_data_collection, step_id=step_id)
-
-        ### self-explore extra knowledge
-        if self.args.if_self_explore == 1:
-            final_data_collection = hyp_gene_ea.self_explore_extra_knowledge_one_bkg_multiple_insp_node(background_question_id=background_question_id, ranked_top_insp_list=ranked_top_core_insp_id_hyp_ave_score_list, self_explore_inspiration_ids_user_input=self.args.self_explore_inspiration_ids, final_data_collection=final_data_collection, step_id=step_id)
-        
-        return final_data_collection
+        return ranked_top_core_insp_id_hyp_ave_score_list
     
 
 
@@ -165,6 +245,90 @@ class HypothesisGenerationEA(object):
         print("\n\nInter-EA Step: {}".format(step_id))
         ## get filtered_ranked_top_insp_list (filter based on recom_inspiration_ids_user_input or args.recom_num_beam_size)
         # filtered_ranked_top_insp_list: [[core_insp_id, hypothesis, hypothesis_score, [mutation_id], ave_score], ...]; used to determine which nodes to further expand / explore
+        filtered_ranked_top_insp_list = self.filter_ranked_top_insp_list_for_recombination(ranked_top_insp_list, recom_inspiration_ids_user_input)
+
+        ## Prepare background and inspiration information
+        backgroud_question = self.dict_idx2bkg[background_question_id]
+        # backgroud_survey
+        backgroud_survey = self.dict_bkg2survey[backgroud_question]
+
+        # select the best hypothesis from each inspiration (with highest self-evaluation scores)
+        # best_hypothesis_collection_for_recomb: {core_insp_title: [[best_hypothesis, best_hypothesis_score, [best_mutation_id], best_ave_score]], ...}
+        best_hypothesis_collection_for_recomb, _ = self.select_top_self_evaluated_hypothesis(final_data_collection, backgroud_question, step_id=1, top_ratio_to_keep=1.0)
+        # iterate over each (insp, hyp) pair in filtered_ranked_top_insp_list
+        for cur_node_id in range(len(filtered_ranked_top_insp_list)):
+            # cur_insp_core_node: [title, reason, abstract]
+            cur_insp_core_node, other_mutations, this_mutation = self.prepare_node_for_recombination(backgroud_question, filtered_ranked_top_insp_list[cur_node_id], best_hypothesis_collection_for_recomb)
+            try:
+                ## screening all other (inspiration, hypothesis) pairs for recombination with the current (inspiration, hypothesis) pair
+                print("Inspiration screening..")
+                # selected_other_mutations: a subset of other_mutations; [[insp_title0, insp_abstract0, hyp0], [insp_title1, insp_abstract1, hyp1], ...]
+                selected_other_mutations = []
+                for cur_other_mutations in self.split_other_mutations_for_screening(other_mutations):
+                    selected_other_mutations += self.screen_other_mutations_window(backgroud_question, backgroud_survey, cur_insp_core_node, cur_other_mutations, this_mutation)
+                selected_other_mutations_titles = [item[0] for item in selected_other_mutations]
+                print("\tSelected {} inspirations for additional_round_inspiration_screening: {}".format(len(selected_other_mutations), selected_other_mutations_titles))
+                ## recombinational mutation between the current (inspiration, hypothesis) pair and the most matched (inspiration, hypothesis) pair
+                # cur_other_mutation: [insp_title, insp_abstract, hyp]
+                # cur_hypothesis_collection: [[hyp0, reasoning process0, feedback0], [hyp1, reasoning process1, feedback1], ...]
+                # with batched self-evaluation, the recombinations of the node are saved after the batch of the node is flushed
+                def develop_one_node():
+                    unsaved_node_result = []
+                    for cur_other_mutation in selected_other_mutations:
+                        cur_hypothesis_collection = self.hyothesis_generation_with_refinement(backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations=cur_other_mutation, recombination_type=2, this_mutation=this_mutation)
+                        if get_self_evaluation_batch() == None:
+                            self.save_recombination_result(final_data_collection, backgroud_question, cur_insp_core_node[0], this_recom_mutation_id, filtered_ranked_top_insp_list[cur_node_id], cur_other_mutation, cur_hypothesis_collection)
+                        else:
+                            unsaved_node_result.append([cur_other_mutation, cur_hypothesis_collection])
+                    return unsaved_node_result
+                for cur_other_mutation, cur_hypothesis_collection in self.develop_with_self_evaluation_batch(develop_one_node):
+                    self.save_recombination_result(final_data_collection, backgroud_question, cur_insp_core_node[0], this_recom_mutation_id, filtered_ranked_top_insp_list[cur_node_id], cur_other_mutation, cur_hypothesis_collection)
+            except LLMGiveUpError as e:
+                # skip the rest of the node (the recombinations saved before are kept)
+                record_llm_give_up(e, background_id=background_question_id, inspiration=cur_insp_core_node[0], mutation=this_recom_mutation_id)
+        return final_data_collection
+
+
+    # asyncio version of recombinational_mutation_between_diff_insp(): the nodes are developed concurrently, and so are the screening windows and the recombination lines of each node
+    async def arecombinational_mutation_between_diff_insp(self, background_question_id, ranked_top_insp_list, recom_inspiration_ids_user_input, final_data_collection, step_id):
+        assert step_id >= 2
+        this_recom_mutation_id = "inter_recom_{}".format(step_id-1)
+        print("\n\nInter-EA Step: {}".format(step_id))
+        filtered_ranked_top_insp_list = self.filter_ranked_top_insp_list_for_recombination(ranked_top_insp_list, recom_inspiration_ids_user_input)
+        backgroud_question = self.dict_idx2bkg[background_question_id]
+        backgroud_survey = self.dict_bkg2survey[backgroud_question]
+        best_hypothesis_collection_for_recomb, _ = self.select_top_self_evaluated_hypothesis(final_data_collection, backgroud_question, step_id=1, top_ratio_to_keep=1.0)
+
+        # develop one node; return [[cur_other_mutation, cur_hypothesis_collection], ...] ([] if the node gave up)
+        async def adevelop_one_node(cur_insp_core_node, other_mutations, this_mutation):
+            try:
+                return await self.adevelop_with_self_evaluation_batch(lambda: adevelop_one_node_or_raise(cur_insp_core_node, other_mutations, this_mutation))
+            except LLMGiveUpError as e:
+                record_llm_give_up(e, background_id=background_question_id, inspiration=cur_insp_core_node[0], mutation=this_recom_mutation_id)
+                return []
+
+        async def adevelop_one_node_or_raise(cur_insp_core_node, other_mutations, this_mutation):
+            cur_window_selected_other_mutations_list = await asyncio.gather(*[self.ascreen_other_mutations_window(backgroud_question, backgroud_survey, cur_insp_core_node, cur_other_mutations, this_mutation) for cur_other_mutations in self.split_other_mutations_for_screening(other_mutations)])
+            selected_other_mutations = [item for cur_window_selected_other_mutations in cur_window_selected_other_mutations_list for item in cur_window_selected_other_mutations]
+            print("\tcur_insp_title: {}; selected {} inspirations for additional_round_inspiration_screening: {}".format(cur_insp_core_node[0], len(selected_other_mutations), [item[0] for item in selected_other_mutations]))
+            hypothesis_collection_list = await asyncio.gather(*[self.ahyothesis_generation_with_refinement(backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations=cur_other_mutation, recombination_type=2, this_mutation=this_mutation) for cur_other_mutation in selected_other_mutations])
+            return list(zip(selected_other_mutations, hypothesis_collection_list))
+
+        # prepare all the nodes first (sequentially, since it modifies the shared inspiration nodes)
+        node_list = [self.prepare_node_for_recombination(backgroud_question, cur_node, best_hypothesis_collection_for_recomb) for cur_node in filtered_ranked_top_insp_list]
+        node_result_list = await asyncio.gather(*[adevelop_one_node(*cur_node) for cur_node in node_list])
+        # save in the same order as recombinational_mutation_between_diff_insp()
+        for cur_node_id in range(len(filtered_ranked_top_insp_list)):
+            for cur_other_mutation, cur_hypothesis_collection in node_result_list[cur_node_id]:
+                self.save_recombination_result(final_data_collection, backgroud_question, node_list[cur_node_id][0][0], this_recom_mutation_id, filtered_ranked_top_insp_list[cur_node_id], cur_other_mutation, cur_hypothesis_collection)
+        return final_data_collection
+
+
+    ## Function
+    # filter the ranked (insp, hyp) nodes based on recom_inspiration_ids_user_input or args.recom_num_beam_size
+    ## Output
+    # filtered_ranked_top_insp_list: [[core_insp_id, hypothesis, hypothesis_score, [mutation_id], ave_score], ...]
+    def filter_ranked_top_insp_list_for_recombination(self, ranked_top_insp_list, recom_inspiration_ids_user_input):
         if -1 in recom_inspiration_ids_user_input:
             # no filter, keep all
             assert len(recom_inspiration_ids_user_input) == 1
@@ -183,82 +347,82 @@ class HypothesisGenerationEA(object):
             smallest_ave_score_threshold = ranked_top_insp_list[num_top_insp_to_keep-1][4]
             filtered_ranked_top_insp_list = [item for item in ranked_top_insp_list if item[4] >= smallest_ave_score_threshold]
         print("Number of selected hypothesis nodes to further exploit: ", len(filtered_ranked_top_insp_list))
+        return filtered_ranked_top_insp_list
 
-        ## Prepare background and inspiration information
-        backgroud_question = self.dict_idx2bkg[background_question_id]
-        # backgroud_survey
-        backgroud_survey = self.dict_bkg2survey[backgroud_question]
+
+    ## Function
+    # prepare one (insp, hyp) node for inter-EA recombination
+    ## Input
+    # cur_node: [core_insp_id, hypothesis, hypothesis_score, [mutation_id], ave_score]
+    # best_hypothesis_collection_for_recomb: {core_insp_title: [[best_hypothesis, best_hypothesis_score, [best_mutation_id], best_ave_score]], ...}
+    ## Output
+    # cur_insp_core_node: [title, reason, abstract]
+    # other_mutations: [[insp_title0, insp_abstract0, hyp0], [insp_title1, insp_abstract1, hyp1], ...], here 0, 1 indicates the id of differnt inspirations
+    # this_mutation: hypothesis developed from the current inspiration; text
+    def prepare_node_for_recombination(self, backgroud_question, cur_node, best_hypothesis_collection_for_recomb):
         # screened_insp_cur_bq: [[title, reason], [title, reason], ...]
         screened_insp_cur_bq = self.organized_insp[backgroud_question]
-
-        # select the best hypothesis from each inspiration (with highest self-evaluation scores)
-        # best_hypothesis_collection_for_recomb: {core_insp_title: [[best_hypothesis, best_hypothesis_score, [best_mutation_id], best_ave_score]], ...}
-        best_hypothesis_collection_for_recomb, _ = self.select_top_self_evaluated_hypothesis(final_data_collection, backgroud_question, step_id=1, top_ratio_to_keep=1.0)
-        # iterate over each (insp, hyp) pair in filtered_ranked_top_insp_list
-        for cur_node_id in range(len(filtered_ranked_top_insp_list)):
-            cur_insp_id = filtered_ranked_top_insp_list[cur_node_id][0]
-            # add abstract to screened_insp_cur_bq in addition to title and reason
-            cur_insp_core_node = screened_insp_cur_bq[cur_insp_id]
-            cur_abstract = get_item_from_dict_with_very_similar_but_not_exact_key(self.dict_title_2_abstract, cur_insp_core_node[0])
-            cur_insp_core_node.append(cur_abstract)
-            # cur_insp_title
-            cur_insp_title = cur_insp_core_node[0]
-            print("\nInter-EA recombination for cur_insp_id: {}; cur_insp_title: {}".format(cur_insp_id, cur_insp_title))
-            ### recombinational mutation
-            ## first select the best hypothesis from every other inspiration (with highest average self-evaluation score)
-            # other_mutations: [[insp_title0, insp_abstract0, hyp0], [insp_title1, insp_abstract1, hyp1], ...], here 0, 1 indicates the id of differnt inspirations
-            # get cur_node_search_trail (all previous mutation ids) to avoid select the same inspiration again: ['mut_id_0', 'mut_id_1', ...]
-            cur_node_search_trail_raw = filtered_ranked_top_insp_list[cur_node_id][3]
-            cur_node_search_trail = [cur_insp_title]
-            for cur_node_search_trail_item in cur_node_search_trail_raw:
-                if ";" in cur_node_search_trail_item:
-                    cur_node_search_trail += cur_node_search_trail_item.split(";")
-                else:
-                    cur_node_search_trail.append(cur_node_search_trail_item)
-            other_mutations = [[tmp_insp_title, get_item_from_dict_with_very_similar_but_not_exact_key(self.dict_title_2_abstract, tmp_insp_title), best_hypothesis_collection_for_recomb[tmp_insp_title][0][0]] for tmp_insp_title in best_hypothesis_collection_for_recomb if tmp_insp_title not in cur_node_search_trail]
-            # this_mutation: hypothesis developed from the current inspiration; text
-            this_mutation = filtered_ranked_top_insp_list[cur_node_id][1]
-            ## screening all other (inspiration, hypothesis) pairs for recombination with the current (inspiration, hypothesis) pair
-            print("Inspiration screening..")
-            assert len(other_mutations) >= 1
-            # each screening inference will select 3 inspirations
-            if len(other_mutations) <= self.args.num_screening_keep_size:
-                selected_other_mutations = other_mutations
-            elif len(other_mutations) <= self.args.num_screening_window_size:
-                # selected_other_mutations: a subset of other_mutations; [[insp_title0, insp_abstract0, hyp0], [insp_title1, insp_abstract1, hyp1], ...]
-                selected_other_mutations = self.additional_round_inspiration_screening(backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations=other_mutations, this_mutation=this_mutation)
+        cur_insp_id = cur_node[0]
+        # add abstract to screened_insp_cur_bq in addition to title and reason
+        cur_insp_core_node = screened_insp_cur_bq[cur_insp_id]
+        cur_abstract = get_item_from_dict_with_very_similar_but_not_exact_key(self.dict_title_2_abstract, cur_insp_core_node[0], title_index=self.title_index)
+        cur_insp_core_node.append(cur_abstract)
+        # cur_insp_title
+        cur_insp_title = cur_insp_core_node[0]
+        print("\nInter-EA recombination for cur_insp_id: {}; cur_insp_title: {}".format(cur_insp_id, cur_insp_title))
+        ### recombinational mutation
+        ## first select the best hypothesis from every other inspiration (with highest average self-evaluation score)
+        # get cur_node_search_trail (all previous mutation ids) to avoid select the same inspiration again: ['mut_id_0', 'mut_id_1', ...]
+        cur_node_search_trail_raw = cur_node[3]
+        cur_node_search_trail = [cur_insp_title]
+        for cur_node_search_trail_item in cur_node_search_trail_raw:
+            if ";" in cur_node_search_trail_item:
+                cur_node_search_trail += cur_node_search_trail_item.split(";")
             else:
-                num_screening_itr = math.ceil(len(other_mutations) / self.args.num_screening_window_size)
-                selected_other_mutations = []
-                for cur_itr in range(num_screening_itr):
-                    cur_max_other_mutations_id = min((cur_itr+1)*self.args.num_screening_window_size, len(other_mutations))
-                    cur_other_mutations = other_mutations[cur_itr*self.args.num_screening_window_size: cur_max_other_mutations_id]
-                    if len(cur_other_mutations) <= self.args.num_screening_keep_size:
-                        cur_selected_other_mutations = cur_other_mutations
-                    else:
-                        cur_selected_other_mutations = self.additional_round_inspiration_screening(backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations=cur_other_mutations, this_mutation=this_mutation)    
-                    selected_other_mutations += cur_selected_other_mutations
-                    print("\tlen(cur_selected_other_mutations): {}".format(len(cur_selected_other_mutations)))
-                    if len(cur_selected_other_mutations) == 0:
-                        print("Warning: len(cur_selected_other_mutations) == 0; {}".format(cur_selected_other_mutations))
-            selected_other_mutations_titles = [item[0] for item in selected_other_mutations]
-            print("\tSelected {} inspirations for additional_round_inspiration_screening: {}".format(len(selected_other_mutations), selected_other_mutations_titles))
-            ## recombinational mutation between the current (inspiration, hypothesis) pair and the most matched (inspiration, hypothesis) pair
-            for cur_other_mutation in selected_other_mutations:
-                # print("\tWorking on cur_other_mutation: {}...".format(cur_other_mutation[0]))
-                # cur_other_mutation: [insp_title, insp_abstract, hyp]
-                # cur_hypothesis_collection: [[hyp0, reasoning process0, feedback0], [hyp1, reasoning process1, feedback1], ...]
-                cur_hypothesis_collection = self.hyothesis_generation_with_refinement(backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations=cur_other_mutation, recombination_type=2, this_mutation=this_mutation)
-                if this_recom_mutation_id not in final_data_collection[backgroud_question][cur_insp_title]:
-                    final_data_collection[backgroud_question][cur_insp_title][this_recom_mutation_id] = {}
-                # only pick the lask mutation id still might cause misundertanding, so we join all past mutation ids as the current mutation id
-                cur_node_prev_round_branch_mutation_id = ";".join(filtered_ranked_top_insp_list[cur_node_id][3])
-                if cur_node_prev_round_branch_mutation_id not in final_data_collection[backgroud_question][cur_insp_title][this_recom_mutation_id]:
-                    final_data_collection[backgroud_question][cur_insp_title][this_recom_mutation_id][cur_node_prev_round_branch_mutation_id] = {}
-                # print scores
-                print("\tcur_insp: {}; hyp_numerical_self_eval: {}".format(cur_other_mutation[0], cur_hypothesis_collection[-1][-1][0]))
-                final_data_collection[backgroud_question][cur_insp_title][this_recom_mutation_id][cur_node_prev_round_branch_mutation_id][cur_other_mutation[0]] = cur_hypothesis_collection
-        return final_data_collection
+                cur_node_search_trail.append(cur_node_search_trail_item)
+        other_mutations = [[tmp_insp_title, get_item_from_dict_with_very_similar_but_not_exact_key(self.dict_title_2_abstract, tmp_insp_title, title_index=self.title_index), best_hypothesis_collection_for_recomb[tmp_insp_title][0][0]] for tmp_insp_title in best_hypothesis_collection_for_recomb if tmp_insp_title not in cur_node_search_trail]
+        assert len(other_mutations) >= 1
+        this_mutation = cur_node[1]
+        return cur_insp_core_node, other_mutations, this_mutation
+
+
+    # split other_mutations into windows of args.num_screening_window_size; each screening inference will select 3 inspirations from a window
+    def split_other_mutations_for_screening(self, other_mutations):
+        num_screening_itr = math.ceil(len(other_mutations) / self.args.num_screening_window_size)
+        return [other_mutations[cur_itr*self.args.num_screening_window_size: min((cur_itr+1)*self.args.num_screening_window_size, len(other_mutations))] for cur_itr in range(num_screening_itr)]
+
+
+    # screen one window of other_mutations; windows with no more than args.num_screening_keep_size (insp, hyp) pairs are kept without screening
+    def screen_other_mutations_window(self, backgroud_question, backgroud_survey, cur_insp_core_node, cur_other_mutations, this_mutation):
+        if len(cur_other_mutations) <= self.args.num_screening_keep_size:
+            return cur_other_mutations
+        cur_selected_other_mutations = self.additional_round_inspiration_screening(backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations=cur_other_mutations, this_mutation=this_mutation)
+        if len(cur_selected_other_mutations) == 0:
+            print("Warning: len(cur_selected_other_mutations) == 0; {}".format(cur_selected_other_mutations))
+        return cur_selected_other_mutations
+
+
+    async def ascreen_other_mutations_window(self, backgroud_question, backgroud_survey, cur_insp_core_node, cur_other_mutations, this_mutation):
+        if len(cur_other_mutations) <= self.args.num_screening_keep_size:
+            return cur_other_mutations
+        cur_selected_other_mutations = await self.aadditional_round_inspiration_screening(backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations=cur_other_mutations, this_mutation=this_mutation)
+        if len(cur_selected_other_mutations) == 0:
+            print("Warning: len(cur_selected_other_mutations) == 0; {}".format(cur_selected_other_mutations))
+        return cur_selected_other_mutations
+
+
+    # save one recombination line to final_data_collection[backgroud_question][cur_insp_title][this_recom_mutation_id]
+    def save_recombination_result(self, final_data_collection, backgroud_question, cur_insp_title, this_recom_mutation_id, cur_node, cur_other_mutation, cur_hypothesis_collection):
+        if this_recom_mutation_id not in final_data_collection[backgroud_question][cur_insp_title]:
+            final_data_collection[backgroud_question][cur_insp_title][this_recom_mutation_id] = {}
+        # only pick the lask mutation id still might cause misundertanding, so we join all past mutation ids as the current mutation id
+        cur_node_prev_round_branch_mutation_id = ";".join(cur_node[3])
+        if cur_node_prev_round_branch_mutation_id not in final_data_collection[backgroud_question][cur_insp_title][this_recom_mutation_id]:
+            final_data_collection[backgroud_question][cur_insp_title][this_recom_mutation_id][cur_node_prev_round_branch_mutation_id] = {}
+        # print scores
+        if len(cur_hypothesis_collection[-1][-1]) > 0:
+            print("\tcur_insp: {}; hyp_numerical_self_eval: {}".format(cur_other_mutation[0], cur_hypothesis_collection[-1][-1][0]))
+        final_data_collection[backgroud_question][cur_insp_title][this_recom_mutation_id][cur_node_prev_round_branch_mutation_id][cur_other_mutation[0]] = cur_hypothesis_collection
     
 
     
@@ -274,6 +438,26 @@ class HypothesisGenerationEA(object):
     ## Output
     # selected_other_mutations: a subset of other_mutations; [[insp_title0, insp_abstract0, hyp0], [insp_title1, insp_abstract1, hyp1], ...]
     def additional_round_inspiration_screening(self, backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations, this_mutation):
+        other_abstracts = get_screening_abstracts(other_mutations, self.client)
+        full_prompt = self.prepare_prompt_for_additional_round_inspiration_screening(backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations, this_mutation, other_abstracts)
+        # generation
+        # structured_extra_knowledge: [[Title0, Reason0], [Title1, Reason1], ...]
+        # we might want the temperature for inspiration retrieval to be zero, for better reflecting heuristics & stable performance
+        structured_extra_knowledge = llm_generation_while_loop(full_prompt, self.args.model_name, self.client, if_structured_generation=True, template=['Title:', 'Reason:'], temperature=0.0, stage="screening")
+        return self.get_selected_other_mutations(other_mutations, structured_extra_knowledge)
+
+
+    async def aadditional_round_inspiration_screening(self, backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations, this_mutation):
+        other_abstracts = await aget_screening_abstracts(other_mutations, self.async_client)
+        full_prompt = self.prepare_prompt_for_additional_round_inspiration_screening(backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations, this_mutation, other_abstracts)
+        structured_extra_knowledge = await allm_generation_while_loop(full_prompt, self.args.model_name, self.async_client, if_structured_generation=True, template=['Title:', 'Reason:'], temperature=0.0, stage="screening")
+        return self.get_selected_other_mutations(other_mutations, structured_extra_knowledge)
+
+
+    # other_abstracts: the abstract of each of other_mutations in the prompt (their digests with --abstract_digest_mode; see Method.abstract_digest); None: the full abstracts
+    def prepare_prompt_for_additional_round_inspiration_screening(self, backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations, this_mutation, other_abstracts=None):
+        if other_abstracts == None:
+            other_abstracts = [cur_other_mutation[1] for cur_other_mutation in other_mutations]
         # prompts
         prompts = instruction_prompts("additional_round_inspiration_screening")
         assert len(prompts) == 6
@@ -282,13 +466,14 @@ class HypothesisGenerationEA(object):
         # other_mutations_prompt
         other_mutations_prompt = ""
         for cur_other_mutation_id, cur_other_mutation in enumerate(other_mutations):
-            other_mutations_prompt += "Next we will introduce potential inspiration candidate {}. Title: {}; Abstract: {}. This inspiration has been leveraged to generate hypothesis for the given background question. The hypothesis is: {}. \n".format(cur_other_mutation_id, cur_other_mutation[0], cur_other_mutation[1], cur_other_mutation[2])
+            other_mutations_prompt += "Next we will introduce potential inspiration candidate {}. Title: {}; Abstract: {}. This inspiration has been leveraged to generate hypothesis for the given background question. The hypothesis is: {}. \n".format(cur_other_mutation_id, cur_other_mutation[0], other_abstracts[cur_other_mutation_id], cur_other_mutation[2])
         full_prompt = prompts[0] + backgroud_question + prompts[1] + backgroud_survey + prompts[2] + cur_insp_core_node_prompt + prompts[3] + this_mutation + prompts[4] + other_mutations_prompt + prompts[5]
-        # generation
-        # structured_extra_knowledge: [[Title0, Reason0], [Title1, Reason1], ...]
-        # we might want the temperature for inspiration retrieval to be zero, for better reflecting heuristics & stable performance
-        structured_extra_knowledge = llm_generation_while_loop(full_prompt, self.args.model_name, self.client, if_structured_generation=True, template=['Title:', 'Reason:'], temperature=0.0)
-        structured_extra_knowledge = [[recover_generated_title_to_exact_version_of_title(list(self.dict_title_2_abstract.keys()), item[0]), item[1]] for item in structured_extra_knowledge]
+        return full_prompt
+
+
+    # structured_extra_knowledge: [[Title0, Reason0], [Title1, Reason1], ...]; the screening result
+    def get_selected_other_mutations(self, other_mutations, structured_extra_knowledge):
+        structured_extra_knowledge = [[recover_generated_title_to_exact_version_of_title(self.title_index, item[0]), item[1]] for item in structured_extra_knowledge]
         # selected_titles: [Title0, Title1, ...]
         selected_titles = [item[0] for item in structured_extra_knowledge]
         selected_other_mutations = [cur_other_mutation for cur_other_mutation in other_mutations if cur_other_mutation[0] in selected_titles]
@@ -390,6 +575,53 @@ class HypothesisGenerationEA(object):
         print("\n\nSelf-explore step: {}".format(step_id))
         ## get filtered_ranked_top_insp_list (filter based on recom_inspiration_ids_user_input or args.self_explore_num_beam_size)
         # filtered_ranked_top_insp_list: [[core_insp_id, hypothesis, hypothesis_score, [mutation_id], ave_score], ...]
+        filtered_ranked_top_insp_list = self.filter_ranked_top_insp_list_for_self_explore(ranked_top_insp_list, self_explore_inspiration_ids_user_input)
+
+        ## Prepare background and inspiration information
+        backgroud_question = self.dict_idx2bkg[background_question_id]
+        # backgroud_survey
+        backgroud_survey = self.dict_bkg2survey[backgroud_question]
+
+        # for cur_insp_id in range(len(screened_insp_cur_bq)):
+        for cur_node_id in range(len(filtered_ranked_top_insp_list)):
+            cur_insp_core_node, cur_hypothesis, cur_prev_mutation_ids = self.prepare_node_for_self_explore(backgroud_question, filtered_ranked_top_insp_list[cur_node_id])
+            # self_explored_knowledge_hypothesis_collection: {mutation_id: [[extra_knowledge_0, output_hyp_0, reasoning_process_0, feedback_0, refined_hyp_0], ...], ...}
+            try:
+                self_explored_knowledge_hypothesis_collection = self.develop_with_self_evaluation_batch(lambda: self.self_explore_extra_knowledge_one_bkg_one_insp_node_full_steps(backgroud_question, backgroud_survey, cur_insp_core_node, cur_hypothesis))
+            except LLMGiveUpError as e:
+                record_llm_give_up(e, background_id=background_question_id, inspiration=cur_insp_core_node[0], mutation=this_explore_mutation_id, prev_mutation_ids=cur_prev_mutation_ids)
+                continue
+            self.save_self_explore_result(final_data_collection, backgroud_question, cur_insp_core_node[0], this_explore_mutation_id, cur_prev_mutation_ids, self_explored_knowledge_hypothesis_collection)
+        return final_data_collection
+
+
+    # asyncio version of self_explore_extra_knowledge_one_bkg_multiple_insp_node(): the nodes are explored concurrently
+    async def aself_explore_extra_knowledge_one_bkg_multiple_insp_node(self, background_question_id, ranked_top_insp_list, self_explore_inspiration_ids_user_input, final_data_collection, step_id):
+        assert step_id >= 2
+        this_explore_mutation_id = "self_explore" if step_id == 2 else "self_explore_{}".format(step_id-1)
+        print("\n\nSelf-explore step: {}".format(step_id))
+        filtered_ranked_top_insp_list = self.filter_ranked_top_insp_list_for_self_explore(ranked_top_insp_list, self_explore_inspiration_ids_user_input)
+        backgroud_question = self.dict_idx2bkg[background_question_id]
+        backgroud_survey = self.dict_bkg2survey[backgroud_question]
+        # prepare all the nodes first (sequentially, since it modifies the shared inspiration nodes)
+        node_list = [self.prepare_node_for_self_explore(backgroud_question, cur_node) for cur_node in filtered_ranked_top_insp_list]
+        # None if the node gave up (then it is skipped, the same as the sync version)
+        async def aexplore_one_node(cur_insp_core_node, cur_hypothesis, cur_prev_mutation_ids):
+            try:
+                return await self.adevelop_with_self_evaluation_batch(lambda: self.aself_explore_extra_knowledge_one_bkg_one_insp_node_full_steps(backgroud_question, backgroud_survey, cur_insp_core_node, cur_hypothesis))
+            except LLMGiveUpError as e:
+                record_llm_give_up(e, background_id=background_question_id, inspiration=cur_insp_core_node[0], mutation=this_explore_mutation_id, prev_mutation_ids=cur_prev_mutation_ids)
+                return None
+        self_explored_knowledge_hypothesis_collection_list = await asyncio.gather(*[aexplore_one_node(*cur_node) for cur_node in node_list])
+        for (cur_insp_core_node, cur_hypothesis, cur_prev_mutation_ids), self_explored_knowledge_hypothesis_collection in zip(node_list, self_explored_knowledge_hypothesis_collection_list):
+            if self_explored_knowledge_hypothesis_collection == None:
+                continue
+            self.save_self_explore_result(final_data_collection, backgroud_question, cur_insp_core_node[0], this_explore_mutation_id, cur_prev_mutation_ids, self_explored_knowledge_hypothesis_collection)
+        return final_data_collection
+
+
+    # filter the ranked (insp, hyp) nodes based on self_explore_inspiration_ids_user_input or args.self_explore_num_beam_size
+    def filter_ranked_top_insp_list_for_self_explore(self, ranked_top_insp_list, self_explore_inspiration_ids_user_input):
         if -1 in self_explore_inspiration_ids_user_input:
              # no filter, keep all
             assert len(self_explore_inspiration_ids_user_input) == 1
@@ -406,38 +638,41 @@ class HypothesisGenerationEA(object):
             smallest_ave_score_threshold = ranked_top_insp_list[num_top_insp_to_keep-1][4]
             filtered_ranked_top_insp_list = [item for item in ranked_top_insp_list if item[4] >= smallest_ave_score_threshold]
         print("Number of selected hypothesis nodes to further exploit: ", len(filtered_ranked_top_insp_list))
+        return filtered_ranked_top_insp_list
 
-        ## Prepare background and inspiration information
-        backgroud_question = self.dict_idx2bkg[background_question_id]
-        # backgroud_survey
-        backgroud_survey = self.dict_bkg2survey[backgroud_question]
+
+    ## Function
+    # prepare one (insp, hyp) node for self-explore
+    ## Output
+    # cur_insp_core_node: [title, reason, abstract]
+    # cur_hypothesis: text
+    # cur_prev_mutation_ids: all previous mutation ids joined by ";"
+    def prepare_node_for_self_explore(self, backgroud_question, cur_node):
         # screened_insp_cur_bq: [[title, reason], [title, reason], ...]
         screened_insp_cur_bq = self.organized_insp[backgroud_question]
+        cur_insp_id = cur_node[0]
+        # add abstract in addition to title and reason in screened_insp_cur_bq
+        cur_insp_core_node = screened_insp_cur_bq[cur_insp_id]
+        cur_abstract = get_item_from_dict_with_very_similar_but_not_exact_key(self.dict_title_2_abstract, cur_insp_core_node[0], title_index=self.title_index)
+        cur_insp_core_node.append(cur_abstract)
+        # cur_insp_title
+        cur_insp_title = cur_insp_core_node[0]
+        print("cur_insp_id: {}; cur_insp_title: {}".format(cur_insp_id, cur_insp_title))
+        # self-explore extra knowledge for one background question and one inspiration and one hypothesis
+        cur_hypothesis = cur_node[1]
+        cur_prev_mutation_ids = cur_node[3]
+        cur_prev_mutation_ids = ";".join(cur_prev_mutation_ids)
+        return cur_insp_core_node, cur_hypothesis, cur_prev_mutation_ids
 
-        # for cur_insp_id in range(len(screened_insp_cur_bq)):
-        for cur_node_id in range(len(filtered_ranked_top_insp_list)):
-            cur_insp_id = filtered_ranked_top_insp_list[cur_node_id][0]
-            # add abstract in addition to title and reason in screened_insp_cur_bq
-            cur_insp_core_node = screened_insp_cur_bq[cur_insp_id]
-            cur_abstract = get_item_from_dict_with_very_similar_but_not_exact_key(self.dict_title_2_abstract, cur_insp_core_node[0])
-            cur_insp_core_node.append(cur_abstract)
-            # cur_insp_title
-            cur_insp_title = cur_insp_core_node[0]
-            print("cur_insp_id: {}; cur_insp_title: {}".format(cur_insp_id, cur_insp_title))
-            # self-explore extra knowledge for one background question and one inspiration and one hypothesis
-            cur_hypothesis = filtered_ranked_top_insp_list[cur_node_id][1]
-            cur_prev_mutation_ids = filtered_ranked_top_insp_list[cur_node_id][3]
-            cur_prev_mutation_ids = ";".join(cur_prev_mutation_ids)
-            # self_explored_knowledge_hypothesis_collection: {mutation_id: [[extra_knowledge_0, output_hyp_0, reasoning_process_0, feedback_0, refined_hyp_0], ...], ...}
-            self_explored_knowledge_hypothesis_collection = self.self_explore_extra_knowledge_one_bkg_one_insp_node_full_steps(backgroud_question, backgroud_survey, cur_insp_core_node, cur_hypothesis)
-            # save to final_data_collection
-            if this_explore_mutation_id not in final_data_collection[backgroud_question][cur_insp_title]:
-                final_data_collection[backgroud_question][cur_insp_title][this_explore_mutation_id] = {cur_prev_mutation_ids: self_explored_knowledge_hypothesis_collection}
-            else:
-                if cur_prev_mutation_ids in final_data_collection[backgroud_question][cur_insp_title][this_explore_mutation_id]:
-                    print("Warning: cur_prev_mutation_ids: {} already exists in final_data_collection[{}][{}][{}]".format(cur_prev_mutation_ids, backgroud_question, cur_insp_title, this_explore_mutation_id))
-                final_data_collection[backgroud_question][cur_insp_title][this_explore_mutation_id][cur_prev_mutation_ids] = self_explored_knowledge_hypothesis_collection
-        return final_data_collection
+
+    # save the self-explore result of one node to final_data_collection[backgroud_question][cur_insp_title][this_explore_mutation_id]
+    def save_self_explore_result(self, final_data_collection, backgroud_question, cur_insp_title, this_explore_mutation_id, cur_prev_mutation_ids, self_explored_knowledge_hypothesis_collection):
+        if this_explore_mutation_id not in final_data_collection[backgroud_question][cur_insp_title]:
+            final_data_collection[backgroud_question][cur_insp_title][this_explore_mutation_id] = {cur_prev_mutation_ids: self_explored_knowledge_hypothesis_collection}
+        else:
+            if cur_prev_mutation_ids in final_data_collection[backgroud_question][cur_insp_title][this_explore_mutation_id]:
+                print("Warning: cur_prev_mutation_ids: {} already exists in final_data_collection[{}][{}][{}]".format(cur_prev_mutation_ids, backgroud_question, cur_insp_title, this_explore_mutation_id))
+            final_data_collection[backgroud_question][cur_insp_title][this_explore_mutation_id][cur_prev_mutation_ids] = self_explored_knowledge_hypothesis_collection
 
 
 
@@ -451,32 +686,21 @@ class HypothesisGenerationEA(object):
     # hypthesis_mutation_collection: {mutation_id: [[hyp0, reasoning process0, feedback0], [hyp1, reasoning process1, feedback1], ...]}
     def hypothesis_generation_for_one_bkg_one_insp(self, background_question_id, inspiration_id):
         assert self.args.if_mutate_inside_same_bkg_insp in [0, 1]
-        ## prepare background and inspiration information
-        # backgroud_question
-        backgroud_question = self.dict_idx2bkg[background_question_id]
-        # backgroud_survey
-        backgroud_survey = self.dict_bkg2survey[backgroud_question]
-        # screened_insp_cur_bq: [[title, reason], [title, reason], ...]
-        screened_insp_cur_bq = self.organized_insp[backgroud_question]
-        # add abstract in addition to title and reason in screened_insp_cur_bq
-        cur_insp_core_node = screened_insp_cur_bq[inspiration_id]
-        cur_title = cur_insp_core_node[0]
-        # cur_abstract = self.dict_title_2_abstract[cur_title]
-        cur_abstract = get_item_from_dict_with_very_similar_but_not_exact_key(self.dict_title_2_abstract, cur_title)
-        # cur_insp_core_node: [title, reason, abstract]
-        cur_insp_core_node.append(cur_abstract)
+        backgroud_question, backgroud_survey, cur_insp_core_node = self.prepare_node_for_one_bkg_one_insp(background_question_id, inspiration_id)
 
         ## generate several distinct mutation hyp, and develop them by refinement for each line of mutation
         # hypthesis_mutation_collection: {mutation_id: [[hyp0, reasoning process0, feedback0], [hyp1, reasoning process1, feedback1], ...]}
         hypthesis_mutation_collection = {}
         # hypothesis_collection: [[hyp0, reasoning process0, feedback0], [hyp1, reasoning process1, feedback1], ...]
-        hypothesis_collection = self.hyothesis_generation_with_refinement(backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations=None)
+        with llm_give_up_context(mutation='0'):
+            hypothesis_collection = self.hyothesis_generation_with_refinement(backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations=None)
         hypthesis_mutation_collection['0'] = hypothesis_collection
         if self.args.if_mutate_inside_same_bkg_insp == 1:
             for cur_mutation_id in range(1, self.args.num_mutations):
                 # other_mutations: the most refined hypothesis from other mutations
                 other_mutations = [hypthesis_mutation_collection[mut_id][-1][0] for mut_id in hypthesis_mutation_collection]
-                hypothesis_collection = self.hyothesis_generation_with_refinement(backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations=other_mutations)
+                with llm_give_up_context(mutation=str(cur_mutation_id)):
+                    hypothesis_collection = self.hyothesis_generation_with_refinement(backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations=other_mutations)
                 hypthesis_mutation_collection[str(cur_mutation_id)] = hypothesis_collection
 
         ## re-combinational mutation between different mutation lines developed from the same bkq and insp
@@ -484,9 +708,54 @@ class HypothesisGenerationEA(object):
             print("Recombinational mutation")
             assert len(hypthesis_mutation_collection) > 1
             other_mutations = [hypthesis_mutation_collection[mut_id][-1][0] for mut_id in hypthesis_mutation_collection]
-            hypothesis_collection = self.hyothesis_generation_with_refinement(backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations=other_mutations, recombination_type=1)
+            with llm_give_up_context(mutation='recom'):
+                hypothesis_collection = self.hyothesis_generation_with_refinement(backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations=other_mutations, recombination_type=1)
             hypthesis_mutation_collection['recom'] = hypothesis_collection
         return hypthesis_mutation_collection
+
+
+    # async version of hypothesis_generation_for_one_bkg_one_insp(); the mutation lines of one insp depend on each other, so they are still developed one by one
+    async def ahypothesis_generation_for_one_bkg_one_insp(self, background_question_id, inspiration_id):
+        assert self.args.if_mutate_inside_same_bkg_insp in [0, 1]
+        backgroud_question, backgroud_survey, cur_insp_core_node = self.prepare_node_for_one_bkg_one_insp(background_question_id, inspiration_id)
+        hypthesis_mutation_collection = {}
+        with llm_give_up_context(mutation='0'):
+            hypothesis_collection = await self.ahyothesis_generation_with_refinement(backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations=None)
+        hypthesis_mutation_collection['0'] = hypothesis_collection
+        if self.args.if_mutate_inside_same_bkg_insp == 1:
+            for cur_mutation_id in range(1, self.args.num_mutations):
+                other_mutations = [hypthesis_mutation_collection[mut_id][-1][0] for mut_id in hypthesis_mutation_collection]
+                with llm_give_up_context(mutation=str(cur_mutation_id)):
+                    hypothesis_collection = await self.ahyothesis_generation_with_refinement(backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations=other_mutations)
+                hypthesis_mutation_collection[str(cur_mutation_id)] = hypothesis_collection
+            print("Recombinational mutation")
+            assert len(hypthesis_mutation_collection) > 1
+            other_mutations = [hypthesis_mutation_collection[mut_id][-1][0] for mut_id in hypthesis_mutation_collection]
+            with llm_give_up_context(mutation='recom'):
+                hypothesis_collection = await self.ahyothesis_generation_with_refinement(backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations=other_mutations, recombination_type=1)
+            hypthesis_mutation_collection['recom'] = hypothesis_collection
+        return hypthesis_mutation_collection
+
+
+    ## Output
+    # backgroud_question, backgroud_survey: text
+    # cur_insp_core_node: [title, reason, abstract]
+    def prepare_node_for_one_bkg_one_insp(self, background_question_id, inspiration_id):
+        ## prepare background and inspiration information
+        # backgroud_question
+        backgroud_question = self.dict_idx2bkg[background_question_id]
+        # backgroud_survey
+        backgroud_survey = self.dict_bkg2survey[backgroud_question]
+        # screened_insp_cur_bq: [[title, reason], [title, reason], ...]
+        screened_insp_cur_bq = self.organized_insp[backgroud_question]
+        # add abstract in addition to title and reason in screened_insp_cur_bq
+        cur_insp_core_node = screened_insp_cur_bq[inspiration_id]
+        cur_title = cur_insp_core_node[0]
+        # cur_abstract = self.dict_title_2_abstract[cur_title]
+        cur_abstract = get_item_from_dict_with_very_similar_but_not_exact_key(self.dict_title_2_abstract, cur_title, title_index=self.title_index)
+        # cur_insp_core_node: [title, reason, abstract]
+        cur_insp_core_node.append(cur_abstract)
+        return backgroud_question, backgroud_survey, cur_insp_core_node
             
 
     ## Function
@@ -512,26 +781,7 @@ class HypothesisGenerationEA(object):
         # hypothesis_collection: [[hyp0, reasoning process0, feedback0], [hyp1, reasoning process1, feedback1], ...]
         hypothesis_collection = []
         for cur_refine_iter in range(self.args.num_itr_self_refine):
-            # set parameters: same_mutation_prev_hyp, hyp_feedback, and other_mutations
-            if cur_refine_iter == 0:
-                same_mutation_prev_hyp, hyp_feedback = None, None
-            else:
-                # when recombine hyp from different insp islands, we need to keep seeing the different hyps from different insp islands during refinement
-                if recombination_type == 1 or recombination_type == 2:
-                    same_mutation_prev_hyp, hyp_feedback = hypothesis_collection[-1][0], hypothesis_collection[-1][2]
-                elif recombination_type == 0:
-                    same_mutation_prev_hyp, hyp_feedback = hypothesis_collection[-1][0], hypothesis_collection[-1][2]
-                    # when developing the second/third/... mutation line, and it is not the first hypothesis in this mutation line, it is not necessary to attend to hypotheses in other mutation lines (other_mutations)
-                    other_mutations = None
-                else:
-                    raise NotImplementedError
-            # set parameters: if_with_external_knowledge_feedback 
-            #   (only during the first iteration, the refinement will consider to add external knowledge to stick bkg and insp)
-            #   it is to prevent too much additional information in the final hypothesis (previously we add external knowledge at every refinement step)
-            if self.args.if_consider_external_knowledge_feedback_during_second_refinement and cur_refine_iter == 1:
-                if_with_external_knowledge_feedback = True
-            else:
-                if_with_external_knowledge_feedback = False
+            same_mutation_prev_hyp, hyp_feedback, other_mutations, if_with_external_knowledge_feedback = self.get_refinement_iteration_inputs(cur_refine_iter, hypothesis_collection, recombination_type, other_mutations)
             # cur_hypothesis_and_reasoning_process: [hyp, reasoning process]
             cur_hypothesis_and_reasoning_process = self.one_inference_for_one_hyp_gene(backgroud_question, backgroud_survey, cur_insp_core_node, same_mutation_prev_hyp=same_mutation_prev_hyp, hyp_feedback=hyp_feedback, other_mutations=other_mutations, recombination_type=recombination_type, this_mutation=this_mutation)
             # provide feedback
@@ -545,13 +795,60 @@ class HypothesisGenerationEA(object):
                     # hyp_numerical_self_eval: [score_collection, score_reason_collection]
                     # score_collection: ['score0', 'score1', 'score2', 'score3']
                     # score_reason_collection: ['reason0', 'reason1', 'reason2', 'reason3']
-                    hyp_numerical_self_eval = self.hypothesis_evaluation(cur_hypothesis_and_reasoning_process)
+                    hyp_numerical_self_eval = self.request_hypothesis_evaluation(cur_hypothesis_and_reasoning_process)
                     # cur_hypothesis_and_reasoning_process: [hyp, reasoning process, feedback, [score_collection, score_reason_collection]]
                     cur_hypothesis_and_reasoning_process.append(hyp_numerical_self_eval)
             hypothesis_collection.append(cur_hypothesis_and_reasoning_process)
         return hypothesis_collection
 
 
+    async def ahyothesis_generation_with_refinement(self, backgroud_question, backgroud_survey, cur_insp_core_node, other_mutations=None, recombination_type=0, this_mutation=None, if_self_eval_for_final_hyp=True):
+        assert recombination_type in [0, 1, 2]
+        assert this_mutation == None if recombination_type != 2 else this_mutation != None
+        print("New mutation line is developing..")
+        hypothesis_collection = []
+        for cur_refine_iter in range(self.args.num_itr_self_refine):
+            same_mutation_prev_hyp, hyp_feedback, other_mutations, if_with_external_knowledge_feedback = self.get_refinement_iteration_inputs(cur_refine_iter, hypothesis_collection, recombination_type, other_mutations)
+            cur_hypothesis_and_reasoning_process = await self.aone_inference_for_one_hyp_gene(backgroud_question, backgroud_survey, cur_insp_core_node, same_mutation_prev_hyp=same_mutation_prev_hyp, hyp_feedback=hyp_feedback, other_mutations=other_mutations, recombination_type=recombination_type, this_mutation=this_mutation)
+            hyp_feedback = await self.ahypothesis_refinement(cur_hypothesis_and_reasoning_process, if_with_external_knowledge_feedback=if_with_external_knowledge_feedback)
+            cur_hypothesis_and_reasoning_process.append(hyp_feedback)
+            if cur_refine_iter == self.args.num_itr_self_refine - 1 and if_self_eval_for_final_hyp:
+                hyp_numerical_self_eval = await self.arequest_hypothesis_evaluation(cur_hypothesis_and_reasoning_process)
+                cur_hypothesis_and_reasoning_process.append(hyp_numerical_self_eval)
+            hypothesis_collection.append(cur_hypothesis_and_reasoning_process)
+        return hypothesis_collection
+
+
+    ## Function
+    # the inputs of the cur_refine_iter-th iteration of hyothesis_generation_with_refinement()
+    ## Output
+    # same_mutation_prev_hyp, hyp_feedback: text or None
+    # other_mutations: [hyp0, hyp1, ...] or None
+    # if_with_external_knowledge_feedback: bool
+    def get_refinement_iteration_inputs(self, cur_refine_iter, hypothesis_collection, recombination_type, other_mutations):
+        # set parameters: same_mutation_prev_hyp, hyp_feedback, and other_mutations
+        if cur_refine_iter == 0:
+            same_mutation_prev_hyp, hyp_feedback = None, None
+        else:
+            # when recombine hyp from different insp islands, we need to keep seeing the different hyps from different insp islands during refinement
+            if recombination_type == 1 or recombination_type == 2:
+                same_mutation_prev_hyp, hyp_feedback = hypothesis_collection[-1][0], hypothesis_collection[-1][2]
+            elif recombination_type == 0:
+                same_mutation_prev_hyp, hyp_feedback = hypothesis_collection[-1][0], hypothesis_collection[-1][2]
+                # when developing the second/third/... mutation line, and it is not the first hypothesis in this mutation line, it is not necessary to attend to hypotheses in other mutation lines (other_mutations)
+                other_mutations = None
+            else:
+                raise NotImplementedError
+        # set parameters: if_with_external_knowledge_feedback 
+        #   (only during the first iteration, the refinement will consider to add external knowledge to stick bkg and insp)
+        #   it is to prevent too much additional information in the final hypothesis (previously we add external knowledge at every refinement step)
+        if self.args.if_consider_external_knowledge_feedback_during_second_refinement and cur_refine_iter == 1:
+            if_with_external_knowledge_feedback = True
+        else:
+            if_with_external_knowledge_feedback = False
+        return same_mutation_prev_hyp, hyp_feedback, other_mutations, if_with_external_knowledge_feedback
+
+
 
     ## Function
     # a full knowledge discovery procedure (to find the second and the third key points) by self-explored extra knowledge for one bkg one insp node (the insp node is the first key point)
@@ -567,18 +864,7 @@ class HypothesisGenerationEA(object):
         self_explored_knowledge_hypothesis_collection = {}
         for cur_mutation_id in range(self.args.num_mutations):
             for cur_iter_explore_id in range(self.args.num_self_explore_steps_each_line):
-                if cur_mutation_id == 0 and cur_iter_explore_id == 0:
-                    input_hyp = origin_hyp_node
-                    other_mutations = None
-                else:
-                    if cur_iter_explore_id == 0:
-                        input_hyp = origin_hyp_node
-                    else:
-                        input_hyp = self_explored_knowledge_hypothesis_collection[cur_mutation_id][-1][4]
-                    if cur_mutation_id == 0:
-                        other_mutations = None
-                    else:
-                        other_mutations = [self_explored_knowledge_hypothesis_collection[mut_id][-1][4] for mut_id in self_explored_knowledge_hypothesis_collection]
+                input_hyp, other_mutations = self.get_self_explore_step_inputs(cur_mutation_id, cur_iter_explore_id, origin_hyp_node, self_explored_knowledge_hypothesis_collection)
                 # hypothesis_collection: [extra_knowledge_0, output_hyp_0, reasoning_process_0, feedback_0, refined_hyp_0(, [score_collection, score_reason_collection])]; "(, [score_collection, score_reason_collection]) added if it is the last hypothesis in each line of mutation"
                 if_hyp_need_extra_knowledge, hypothesis_collection = self.self_explore_extra_knowledge_and_hyp_gene_and_refinement_single_step(backgroud_question, backgroud_survey, cur_insp_core_node, input_hyp=input_hyp, other_mutations=other_mutations)
                 assert if_hyp_need_extra_knowledge == 'Yes' or if_hyp_need_extra_knowledge == 'No'
@@ -590,10 +876,32 @@ class HypothesisGenerationEA(object):
                     # hyp_numerical_self_eval: [score_collection, score_reason_collection]
                     # score_collection: ['score0', 'score1', 'score2', 'score3']
                     # score_reason_collection: ['reason0', 'reason1', 'reason2', 'reason3']
-                    hyp_numerical_self_eval = self.hypothesis_evaluation([hypothesis_collection[4]])
+                    hyp_numerical_self_eval = self.request_hypothesis_evaluation([hypothesis_collection[4]])
                     # hypothesis_collection: [extra_knowledge_0, output_hyp_0, reasoning_process_0, feedback_0, refined_hyp_0, refined_reasoning_process_0, [score_collection, score_reason_collection]]
                     hypothesis_collection.append(hyp_numerical_self_eval)
-                    print("\tcur_mutation_id: {}; hyp_numerical_self_eval: {}".format(cur_mutation_id, hyp_numerical_self_eval[0]))
+                    if len(hyp_numerical_self_eval) > 0:
+                        print("\tcur_mutation_id: {}; hyp_numerical_self_eval: {}".format(cur_mutation_id, hyp_numerical_self_eval[0]))
+                self_explored_knowledge_hypothesis_collection[cur_mutation_id].append(hypothesis_collection)
+                if if_hyp_need_extra_knowledge == 'No':
+                    print("No need for extra knowledge, break the loop. cur_mutation_id: {}; cur_iter_explore_id: {}".format(cur_mutation_id, cur_iter_explore_id))
+                    break
+        return self_explored_knowledge_hypothesis_collection
+
+
+    async def aself_explore_extra_knowledge_one_bkg_one_insp_node_full_steps(self, backgroud_question, backgroud_survey, cur_insp_core_node, origin_hyp_node):
+        self_explored_knowledge_hypothesis_collection = {}
+        for cur_mutation_id in range(self.args.num_mutations):
+            for cur_iter_explore_id in range(self.args.num_self_explore_steps_each_line):
+                input_hyp, other_mutations = self.get_self_explore_step_inputs(cur_mutation_id, cur_iter_explore_id, origin_hyp_node, self_explored_knowledge_hypothesis_collection)
+                if_hyp_need_extra_knowledge, hypothesis_collection = await self.aself_explore_extra_knowledge_and_hyp_gene_and_refinement_single_step(backgroud_question, backgroud_survey, cur_insp_core_node, input_hyp=input_hyp, other_mutations=other_mutations)
+                assert if_hyp_need_extra_knowledge == 'Yes' or if_hyp_need_extra_knowledge == 'No'
+                if cur_mutation_id not in self_explored_knowledge_hypothesis_collection:
+                    self_explored_knowledge_hypothesis_collection[cur_mutation_id] = []
+                if cur_iter_explore_id == self.args.num_self_explore_steps_each_line - 1 or if_hyp_need_extra_knowledge == 'No':
+                    hyp_numerical_self_eval = await self.arequest_hypothesis_evaluation([hypothesis_collection[4]])
+                    hypothesis_collection.append(hyp_numerical_self_eval)
+                    if len(hyp_numerical_self_eval) > 0:
+                        print("\tcur_mutation_id: {}; hyp_numerical_self_eval: {}".format(cur_mutation_id, hyp_numerical_self_eval[0]))
                 self_explored_knowledge_hypothesis_collection[cur_mutation_id].append(hypothesis_collection)
                 if if_hyp_need_extra_knowledge == 'No':
                     print("No need for extra knowledge, break the loop. cur_mutation_id: {}; cur_iter_explore_id: {}".format(cur_mutation_id, cur_iter_explore_id))
@@ -601,6 +909,25 @@ class HypothesisGenerationEA(object):
         return self_explored_knowledge_hypothesis_collection
 
 
+    ## Output
+    # input_hyp: text; the hypothesis to explore extra knowledge for
+    # other_mutations: [hyp0, hyp1, ...] or None; the last refined hypothesis of the mutation lines developed so far
+    def get_self_explore_step_inputs(self, cur_mutation_id, cur_iter_explore_id, origin_hyp_node, self_explored_knowledge_hypothesis_collection):
+        if cur_mutation_id == 0 and cur_iter_explore_id == 0:
+            input_hyp = origin_hyp_node
+            other_mutations = None
+        else:
+            if cur_iter_explore_id == 0:
+                input_hyp = origin_hyp_node
+            else:
+                input_hyp = self_explored_knowledge_hypothesis_collection[cur_mutation_id][-1][4]
+            if cur_mutation_id == 0:
+                other_mutations = None
+            else:
+                other_mutations = [self_explored_knowledge_hypothesis_collection[mut_id][-1][4] for mut_id in self_explored_knowledge_hypothesis_collection]
+        return input_hyp, other_mutations
+
+
 
 
     ## Function
@@ -614,10 +941,50 @@ class HypothesisGenerationEA(object):
     ## Output
     # hypothesis_collection: [extra_knowledge_0, output_hyp_0, reasoning_process_0, feedback_0, refined_hyp_0]
     def self_explore_extra_knowledge_and_hyp_gene_and_refinement_single_step(self, backgroud_question, backgroud_survey, cur_insp_core_node, input_hyp, other_mutations=None):
+        ## self-explore of extra knowledge as additional complement key point
+        full_prompt = self.prepare_prompt_for_extra_knowledge_exploration(backgroud_question, backgroud_survey, cur_insp_core_node, input_hyp, other_mutations=other_mutations)
+        # structured_extra_knowledge: [Yes/No, extra_knowledge/reason for it is complete]
+        structured_extra_knowledge = llm_generation_while_loop(full_prompt, self.args.model_name, self.client, if_structured_generation=True, template=['If need extra knowledge:', 'Details:'], gene_format_constraint=[0, ['Yes', 'No']], if_only_return_one_structured_gene_component=True, stage="extra_knowledge_exploration")
+        if structured_extra_knowledge[0] == 'No':
+            hypothesis_collection = [structured_extra_knowledge[1], None, None, None, None]
+            return structured_extra_knowledge[0], hypothesis_collection
+        ## hypothesis generation
+        full_prompt = self.prepare_prompt_for_hypothesis_generation_with_extra_knowledge(backgroud_question, backgroud_survey, cur_insp_core_node, input_hyp, structured_extra_knowledge[1])
+        # structured_gene: [hyp, reasoning process]
+        sturctured_hyp_gene = llm_generation_while_loop(full_prompt, self.args.model_name, self.client, if_structured_generation=True, template=['Hypothesis:', 'Reasoning Process:'], if_only_return_one_structured_gene_component=True, stage="hypothesis_generation")
+        ## provide feedback to hypothesis
+        full_prompt = self.prepare_prompt_for_feedback_with_extra_knowledge(backgroud_question, backgroud_survey, cur_insp_core_node, structured_extra_knowledge[1], sturctured_hyp_gene[0])
+        feedback = llm_generation_while_loop(full_prompt, self.args.model_name, self.client, if_structured_generation=False, stage="refinement_feedback")
+        ## hypothesis refinement
+        full_prompt = self.prepare_prompt_for_refinement_with_extra_knowledge(backgroud_question, backgroud_survey, cur_insp_core_node, structured_extra_knowledge[1], sturctured_hyp_gene[0], feedback)
+        # structured_gene: [hyp, reasoning process]
+        sturctured_hyp_gene_refined = llm_generation_while_loop(full_prompt, self.args.model_name, self.client, if_structured_generation=True, template=['Refined Hypothesis:', 'Reasoning Process:'], if_only_return_one_structured_gene_component=True, stage="hypothesis_generation")
+        # hypothesis_collection: [extra_knowledge_0, output_hyp_0, reasoning_process_0, feedback_0, refined_hyp_0]
+        hypothesis_collection = [structured_extra_knowledge[1], sturctured_hyp_gene[0], sturctured_hyp_gene[1], feedback, sturctured_hyp_gene_refined[0], sturctured_hyp_gene_refined[1]]
+        return structured_extra_knowledge[0], hypothesis_collection
+
+
+    async def aself_explore_extra_knowledge_and_hyp_gene_and_refinement_single_step(self, backgroud_question, backgroud_survey, cur_insp_core_node, input_hyp, other_mutations=None):
+        full_prompt = self.prepare_prompt_for_extra_knowledge_exploration(backgroud_question, backgroud_survey, cur_insp_core_node, input_hyp, other_mutations=other_mutations)
+        structured_extra_knowledge = await allm_generation_while_loop(full_prompt, self.args.model_name, self.async_client, if_structured_generation=True, template=['If need extra knowledge:', 'Details:'], gene_format_constraint=[0, ['Yes', 'No']], if_only_return_one_structured_gene_component=True, stage="extra_knowledge_exploration")
+        if structured_extra_knowledge[0] == 'No':
+            hypothesis_collection = [structured_extra_knowledge[1], None, None, None, None]
+            return structured_extra_knowledge[0], hypothesis_collection
+        full_prompt = self.prepare_prompt_for_hypothesis_generation_with_extra_knowledge(backgroud_question, backgroud_survey, cur_insp_core_node, input_hyp, structured_extra_knowledge[1])
+        sturctured_hyp_gene = await allm_generation_while_loop(full_prompt, self.args.model_name, self.async_client, if_structured_generation=True, template=['Hypothesis:', 'Reasoning Process:'], if_only_return_one_structured_gene_component=True, stage="hypothesis_generation")
+        full_prompt = self.prepare_prompt_for_feedback_with_extra_knowledge(backgroud_question, backgroud_survey, cur_insp_core_node, structured_extra_knowledge[1], sturctured_hyp_gene[0])
+        feedback = await allm_generation_while_loop(full_prompt, self.args.model_name, self.async_client, if_structured_generation=False, stage="refinement_feedback")
+        full_prompt = self.prepare_prompt_for_refinement_with_extra_knowledge(backgroud_question, backgroud_survey, cur_insp_core_node, structured_extra_knowledge[1], sturctured_hyp_gene[0], feedback)
+        sturctured_hyp_gene_refined = await allm_generation_while_loop(full_prompt, self.args.model_name, self.async_client, if_structured_generation=True, template=['Refined Hypothesis:', 'Reasoning Process:'], if_only_return_one_structured_gene_component=True, stage="hypothesis_generation")
+        hypothesis_collection = [structured_extra_knowledge[1], sturctured_hyp_gene[0], sturctured_hyp_gene[1], feedback, sturctured_hyp_gene_refined[0], sturctured_hyp_gene_refined[1]]
+        return structured_extra_knowledge[0], hypothesis_collection
+
+
+    ## Function
+    # prompts of the four steps of self_explore_extra_knowledge_and_hyp_gene_and_refinement_single_step()
+    def prepare_prompt_for_extra_knowledge_exploration(self, backgroud_question, backgroud_survey, cur_insp_core_node, input_hyp, other_mutations=None):
         # core insp prompt
         cur_insp_core_node_prompt = "title: {}; abstract: {}.".format(cur_insp_core_node[0], cur_insp_core_node[2])
-
-        ## self-explore of extra knowledge as additional complement key point
         if other_mutations == None:
             prompts = instruction_prompts("self_extra_knowledge_exploration")
             assert len(prompts) == 5
@@ -630,31 +997,31 @@ class HypothesisGenerationEA(object):
                 cur_other_mutation_prompt = "Next is afterwards hypothesis {} that we want to avoid: {}.\n".format(cur_other_mutation_id, cur_other_mutation)
                 other_mutations_prompt += cur_other_mutation_prompt
             full_prompt = prompts[0] + backgroud_question + prompts[1] + backgroud_survey + prompts[2] + cur_insp_core_node_prompt + prompts[3] + input_hyp + prompts[4] + other_mutations_prompt + prompts[5]
-        # structured_extra_knowledge: [Yes/No, extra_knowledge/reason for it is complete]
-        structured_extra_knowledge = llm_generation_while_loop(full_prompt, self.args.model_name, self.client, if_structured_generation=True, template=['If need extra knowledge:', 'Details:'], gene_format_constraint=[0, ['Yes', 'No']], if_only_return_one_structured_gene_component=True)
-        if structured_extra_knowledge[0] == 'No':
-            hypothesis_collection = [structured_extra_knowledge[1], None, None, None, None]
-            return structured_extra_knowledge[0], hypothesis_collection
-        ## hypothesis generation
+        return full_prompt
+
+
+    def prepare_prompt_for_hypothesis_generation_with_extra_knowledge(self, backgroud_question, backgroud_survey, cur_insp_core_node, input_hyp, extra_knowledge):
+        cur_insp_core_node_prompt = "title: {}; abstract: {}.".format(cur_insp_core_node[0], cur_insp_core_node[2])
         prompts = instruction_prompts("hypothesis_generation_with_extra_knowledge")
         assert len(prompts) == 6
-        full_prompt = prompts[0] + backgroud_question + prompts[1] + backgroud_survey + prompts[2] + cur_insp_core_node_prompt + prompts[3] + input_hyp + prompts[4] + structured_extra_knowledge[1] + prompts[5]
-        # structured_gene: [hyp, reasoning process]
-        sturctured_hyp_gene = llm_generation_while_loop(full_prompt, self.args.model_name, self.client, if_structured_generation=True, template=['Hypothesis:', 'Reasoning Process:'], if_only_return_one_structured_gene_component=True)
-        ## provide feedback to hypothesis
+        full_prompt = prompts[0] + backgroud_question + prompts[1] + backgroud_survey + prompts[2] + cur_insp_core_node_prompt + prompts[3] + input_hyp + prompts[4] + extra_knowledge + prompts[5]
+        return full_prompt
+
+
+    def prepare_prompt_for_feedback_with_extra_knowledge(self, backgroud_question, backgroud_survey, cur_insp_core_node, extra_knowledge, hyp):
+        cur_insp_core_node_prompt = "title: {}; abstract: {}.".format(cur_insp_core_node[0], cur_insp_core_node[2])
         prompts = instruction_prompts("provide_feedback_to_hypothesis_four_aspects_with_extra_knowledge")
         assert len(prompts) == 6
-        full_prompt = prompts[0] + backgroud_question + prompts[1] + backgroud_survey + prompts[2] + cur_insp_core_node_prompt + prompts[3] + structured_extra_knowledge[1] + prompts[4] + sturctured_hyp_gene[0] + prompts[5]
-        feedback = llm_generation_while_loop(full_prompt, self.args.model_name, self.client, if_structured_generation=False)
-        ## hypothesis refinement
+        full_prompt = prompts[0] + backgroud_question + prompts[1] + backgroud_survey + prompts[2] + cur_insp_core_node_prompt + prompts[3] + extra_knowledge + prompts[4] + hyp + prompts[5]
+        return full_prompt
+
+
+    def prepare_prompt_for_refinement_with_extra_knowledge(self, backgroud_question, backgroud_survey, cur_insp_core_node, extra_knowledge, hyp, feedback):
+        cur_insp_core_node_prompt = "title: {}; abstract: {}.".format(cur_insp_core_node[0], cur_insp_core_node[2])
         prompts = instruction_prompts("hypothesis_refinement_with_feedback_with_extra_knowledge")
         assert len(prompts) == 7
-        full_prompt = prompts[0] + backgroud_question + prompts[1] + backgroud_survey + prompts[2] + cur_insp_core_node_prompt + prompts[3] + structured_extra_knowledge[1] + prompts[4] + sturctured_hyp_gene[0] + prompts[5] + feedback + prompts[6]
-        # structured_gene: [hyp, reasoning process]
-        sturctured_hyp_gene_refined = llm_generation_while_loop(full_prompt, self.args.model_name, self.client, if_structured_generation=True, template=['Refined Hypothesis:', 'Reasoning Process:'], if_only_return_one_structured_gene_component=True)
-        # hypothesis_collection: [extra_knowledge_0, output_hyp_0, reasoning_process_0, feedback_0, refined_hyp_0]
-        hypothesis_collection = [structured_extra_knowledge[1], sturctured_hyp_gene[0], sturctured_hyp_gene[1], feedback, sturctured_hyp_gene_refined[0], sturctured_hyp_gene_refined[1]]
-        return structured_extra_knowledge[0], hypothesis_collection
+        full_prompt = prompts[0] + backgroud_question + prompts[1] + backgroud_survey + prompts[2] + cur_insp_core_node_prompt + prompts[3] + extra_knowledge + prompts[4] + hyp + prompts[5] + feedback + prompts[6]
+        return full_prompt
         
     
 
@@ -678,6 +1045,53 @@ class HypothesisGenerationEA(object):
     ## Output
     # structured_gene: [hyp, reasoning process]
     def one_inference_for_one_hyp_gene(self, backgroud_question, backgroud_survey, cur_insp_core_node, same_mutation_prev_hyp=None, hyp_feedback=None, other_mutations=None, recombination_type=0, this_mutation=None):
+        full_prompt, template, prompt_prefix = self.prepare_prompt_for_one_hyp_gene(backgroud_question, backgroud_survey, cur_insp_core_node, same_mutation_prev_hyp=same_mutation_prev_hyp, hyp_feedback=hyp_feedback, other_mutations=other_mutations, recombination_type=recombination_type, this_mutation=this_mutation)
+        ## generation
+        # the cached generation is only used in the first try
+        if_read_cache = True
+        retry_budget = start_llm_retry_budget("hypothesis_generation", full_prompt)
+        while True:
+            try:
+                cur_gene = llm_generation(full_prompt, self.args.model_name, self.client, stage="hypothesis_generation", if_read_cache=if_read_cache, prompt_prefix=prompt_prefix)
+                if_read_cache = False
+                cur_structured_gene = get_structured_generation_from_raw_generation(cur_gene, template=template)
+                break
+            except AssertionError as e:
+                # if the format
+                print("AssertionError: {}, try again..".format(e))
+                retry_budget.fail(e)
+        
+        # cur_structured_gene: [[hyp, reasoning process]] --> [hyp, reasoning process]
+        assert len(cur_structured_gene) == 1 and len(cur_structured_gene[0]) == 2
+        cur_structured_gene = cur_structured_gene[0]
+        return cur_structured_gene
+
+
+    async def aone_inference_for_one_hyp_gene(self, backgroud_question, backgroud_survey, cur_insp_core_node, same_mutation_prev_hyp=None, hyp_feedback=None, other_mutations=None, recombination_type=0, this_mutation=None):
+        full_prompt, template, prompt_prefix = self.prepare_prompt_for_one_hyp_gene(backgroud_question, backgroud_survey, cur_insp_core_node, same_mutation_prev_hyp=same_mutation_prev_hyp, hyp_feedback=hyp_feedback, other_mutations=other_mutations, recombination_type=recombination_type, this_mutation=this_mutation)
+        if_read_cache = True
+        retry_budget = start_llm_retry_budget("hypothesis_generation", full_prompt)
+        while True:
+            try:
+                cur_gene = await allm_generation(full_prompt, self.args.model_name, self.async_client, stage="hypothesis_generation", if_read_cache=if_read_cache, prompt_prefix=prompt_prefix)
+                if_read_cache = False
+                cur_structured_gene = get_structured_generation_from_raw_generation(cur_gene, template=template)
+                break
+            except AssertionError as e:
+                print("AssertionError: {}, try again..".format(e))
+                retry_budget.fail(e)
+        assert len(cur_structured_gene) == 1 and len(cur_structured_gene[0]) == 2
+        cur_structured_gene = cur_structured_gene[0]
+        return cur_structured_gene
+
+
+    ## Function
+    # prepare the prompt of one_inference_for_one_hyp_gene(); see one_inference_for_one_hyp_gene() for the input
+    ## Output
+    # full_prompt: text
+    # template: ['Hypothesis:', 'Reasoning Process:'] or ['Refined Hypothesis:', 'Reasoning Process:']
+    # prompt_prefix: the beginning of full_prompt shared by all the hypotheses developed from the same background and core inspiration (instructions, background question, survey and core inspiration); see llm_generation()
+    def prepare_prompt_for_one_hyp_gene(self, backgroud_question, backgroud_survey, cur_insp_core_node, same_mutation_prev_hyp=None, hyp_feedback=None, other_mutations=None, recombination_type=0, this_mutation=None):
         # check input
         assert recombination_type in [0, 1, 2]
         # set recombination_type to -1 when the baseline_type is 2
@@ -780,21 +1194,12 @@ class HypothesisGenerationEA(object):
                 raise ValueError("should not have this case")
         else:
             raise ValueError("recombination_type: {} is not supported".format(recombination_type))
-             
-        ## generation
-        while True:
-            try:
-                cur_gene = llm_generation(full_prompt, self.args.model_name, self.client)
-                cur_structured_gene = get_structured_generation_from_raw_generation(cur_gene, template=template)
-                break
-            except AssertionError as e:
-                # if the format
-                print("AssertionError: {}, try again..".format(e))
-        
-        # cur_structured_gene: [[hyp, reasoning process]] --> [hyp, reasoning process]
-        assert len(cur_structured_gene) == 1 and len(cur_structured_gene[0]) == 2
-        cur_structured_gene = cur_structured_gene[0]
-        return cur_structured_gene
+        # all the instructions start with the background question, the survey, and then the core inspiration (if any), followed by the hypothesis-specific parts
+        prompt_prefix = prompts[0] + backgroud_question + prompts[1] + backgroud_survey + prompts[2]
+        if recombination_type != -1:
+            prompt_prefix += cur_insp_core_node_prompt
+        assert full_prompt.startswith(prompt_prefix)
+        return full_prompt, template, prompt_prefix
 
 
 
@@ -805,6 +1210,25 @@ class HypothesisGenerationEA(object):
     ## Output
     # feedback: text
     def hypothesis_refinement(self, cur_hypothesis_and_reasoning_process, if_with_external_knowledge_feedback=False):
+        full_prompt = self.prepare_prompt_for_hypothesis_refinement(cur_hypothesis_and_reasoning_process, if_with_external_knowledge_feedback=if_with_external_knowledge_feedback)
+        # generation
+        while True:
+            try:
+                feedback = llm_generation(full_prompt, self.args.model_name, self.client, stage="refinement_feedback")
+                break
+            except AssertionError as e:
+                # if the format
+                print("AssertionError: {}, try again..".format(e))
+        return feedback
+
+
+    async def ahypothesis_refinement(self, cur_hypothesis_and_reasoning_process, if_with_external_knowledge_feedback=False):
+        full_prompt = self.prepare_prompt_for_hypothesis_refinement(cur_hypothesis_and_reasoning_process, if_with_external_knowledge_feedback=if_with_external_knowledge_feedback)
+        feedback = await allm_generation(full_prompt, self.args.model_name, self.async_client, stage="refinement_feedback")
+        return feedback
+
+
+    def prepare_prompt_for_hypothesis_refinement(self, cur_hypothesis_and_reasoning_process, if_with_external_knowledge_feedback=False):
         # cur_hypothesis_and_reasoning_process_prompt
         cur_hypothesis_and_reasoning_process_prompt = "hypothesis: {}; reasoning process: {}.".format(cur_hypothesis_and_reasoning_process[0], cur_hypothesis_and_reasoning_process[1])
         # instructions
@@ -823,15 +1247,7 @@ class HypothesisGenerationEA(object):
 
         assert len(prompts) == 2
         full_prompt = prompts[0] + cur_hypothesis_and_reasoning_process_prompt + prompts[1]
-        # generation
-        while True:
-            try:
-                feedback = llm_generation(full_prompt, self.args.model_name, self.client)
-                break
-            except AssertionError as e:
-                # if the format
-                print("AssertionError: {}, try again..".format(e))
-        return feedback
+        return full_prompt
         
 
     ## Function
@@ -842,25 +1258,96 @@ class HypothesisGenerationEA(object):
     # score_collection: ['score0', 'score1', 'score2', 'score3']
     # score_reason_collection: ['reason0', 'reason1', 'reason2', 'reason3']
     def hypothesis_evaluation(self, cur_hypothesis_and_reasoning_process):
-        # cur_hypothesis_prompt: for evaluation, we only need the hypothesis itself, but not reasoning process
-        cur_hypothesis_prompt = "hypothesis: {}.".format(cur_hypothesis_and_reasoning_process[0])
-        # instructions
-        prompts = instruction_prompts("four_aspects_self_numerical_evaluation")
-        assert len(prompts) == 2
-        full_prompt = prompts[0] + cur_hypothesis_prompt + prompts[1]
+        full_prompt, prompt_prefix = self.prepare_prompt_for_hypothesis_evaluation(cur_hypothesis_and_reasoning_process)
         # generation
+        # the cached generation is only used in the first try
+        if_read_cache = True
+        retry_budget = start_llm_retry_budget("self_evaluation", full_prompt)
         while True:
             try:
-                score_text = llm_generation(full_prompt, self.args.model_name, self.client)
+                score_text = llm_generation(full_prompt, self.args.model_name, self.client, stage="self_evaluation", if_read_cache=if_read_cache, structured_output_template=FOUR_ASPECT_SCORE_TEMPLATE, prompt_prefix=prompt_prefix)
+                if_read_cache = False
                 score_collection, score_reason_collection, if_successful = pick_score(score_text, full_prompt)
                 assert if_successful == True
                 break
             except AssertionError as e:
                 # if the format
                 print("AssertionError: {}, try again..".format(e))
+                retry_budget.fail(e)
+            except LLMFatalError:
+                raise
+            except Exception as e:
+                print("Exception: {}, try again..".format(e))
+                retry_budget.fail(e)
+        return score_collection, score_reason_collection
+
+
+    async def ahypothesis_evaluation(self, cur_hypothesis_and_reasoning_process):
+        full_prompt, prompt_prefix = self.prepare_prompt_for_hypothesis_evaluation(cur_hypothesis_and_reasoning_process)
+        if_read_cache = True
+        retry_budget = start_llm_retry_budget("self_evaluation", full_prompt)
+        while True:
+            try:
+                score_text = await allm_generation(full_prompt, self.args.model_name, self.async_client, stage="self_evaluation", if_read_cache=if_read_cache, structured_output_template=FOUR_ASPECT_SCORE_TEMPLATE, prompt_prefix=prompt_prefix)
+                if_read_cache = False
+                score_collection, score_reason_collection, if_successful = pick_score(score_text, full_prompt)
+                assert if_successful == True
+                break
+            except AssertionError as e:
+                print("AssertionError: {}, try again..".format(e))
+                retry_budget.fail(e)
+            except LLMFatalError:
+                raise
             except Exception as e:
                 print("Exception: {}, try again..".format(e))
+                retry_budget.fail(e)
         return score_collection, score_reason_collection
+
+
+    ## Function
+    # hypothesis_evaluation() right away, or (with args.self_eval_batch_size > 1) a placeholder filled when the self-evaluation batch of the current unit of work is flushed; see develop_with_self_evaluation_batch()
+    def request_hypothesis_evaluation(self, cur_hypothesis_and_reasoning_process):
+        batch = get_self_evaluation_batch()
+        if batch == None:
+            return self.hypothesis_evaluation(cur_hypothesis_and_reasoning_process)
+        return batch.add(cur_hypothesis_and_reasoning_process[0])
+
+
+    async def arequest_hypothesis_evaluation(self, cur_hypothesis_and_reasoning_process):
+        batch = get_self_evaluation_batch()
+        if batch == None:
+            return await self.ahypothesis_evaluation(cur_hypothesis_and_reasoning_process)
+        return batch.add(cur_hypothesis_and_reasoning_process[0])
+
+
+    ## Function
+    # run develop_fn() (one unit of work of an EA step: the mutation lines of one inspiration, or one node of an additional inspiration step) with the self-evaluations it requests scored args.self_eval_batch_size hypotheses per request, when develop_fn() is finished (see Method.self_evaluation_batch)
+    def develop_with_self_evaluation_batch(self, develop_fn):
+        with self_evaluation_batch(self.args.self_eval_batch_size) as batch:
+            result = develop_fn()
+            if batch != None:
+                batch.flush(self.args.model_name, self.client, lambda cur_hyp: self.hypothesis_evaluation([cur_hyp]))
+        return result
+
+
+    # adevelop_fn() returns an awaitable
+    async def adevelop_with_self_evaluation_batch(self, adevelop_fn):
+        with self_evaluation_batch(self.args.self_eval_batch_size) as batch:
+            result = await adevelop_fn()
+            if batch != None:
+                await batch.aflush(self.args.model_name, self.async_client, lambda cur_hyp: self.ahypothesis_evaluation([cur_hyp]))
+        return result
+
+
+    # prompt_prefix: the instructions shared by the evaluation of all the hypotheses; see llm_generation()
+    def prepare_prompt_for_hypothesis_evaluation(self, cur_hypothesis_and_reasoning_process):
+        # cur_hypothesis_prompt: for evaluation, we only need the hypothesis itself, but not reasoning process
+        cur_hypothesis_prompt = "hypothesis: {}.".format(cur_hypothesis_and_reasoning_process[0])
+        # instructions
+        prompts = instruction_prompts("four_aspects_self_numerical_evaluation")
+        assert len(prompts) == 2
+        full_prompt = prompts[0] + cur_hypothesis_prompt + prompts[1]
+        return full_prompt, prompts[0]
     
 
     def save_file(self, data, file_path):
@@ -927,10 +1414,22 @@ if __name__ == "__main__":
     parser.add_argument("--if_consider_external_knowledge_feedback_during_second_refinement", type=int, default=0, help="during the second hypothsis refinement, whether the feedback to hypothesis will consider to add external knowledge to make the hypothesis more complete")
     parser.add_argument("--corpus_size", type=int, default=300, help="the number of total inspiration (paper) corpus (both groundtruth insp papers and non-groundtruth insp papers)")
     parser.add_argument("--baseline_type", type=int, default=0, help="0: not using baseline; 1: MOOSE w/o novelty and clarity checker (Scimon); 2. MOOSE w/o novelty retrieval (<Large Language Models are Zero Shot Hypothesis Proposers>); 3: MOOSE-Chem w/o significance checker")
+    add_llm_args(parser)
+    parser.add_argument("--abstract_digest_mode", type=str, default="none", help="abstracts of the inspiration candidates in the additional rounds of inspiration screening; none: the full abstracts; extractive: their leading sentences up to --abstract_digest_max_chars; llm: their LLM summaries (stage 'abstract_digest'); the digests are computed once per paper and cached (the full abstracts are still used for hypothesis generation)")
+    parser.add_argument("--abstract_digest_max_chars", type=int, default=400, help="upper bound of the length of a digest (characters)")
+    parser.add_argument("--abstract_digest_cache_path", type=str, default="", help="JSON file to cache the digests across runs; '': only cached in memory")
+    parser.add_argument("--abstract_digest_model_name", type=str, default="", help="model of the llm digests; '': --model_name")
+    parser.add_argument("--self_eval_batch_size", type=int, default=1, help="number of hypotheses scored in one self-evaluation request; the evaluations of each unit of work of the EA (the mutation lines of one inspiration, or one node of an additional inspiration step) are collected and scored in batches when the unit is finished, and the hypotheses whose scores can not be parsed from the batched response are evaluated one by one; 1: one hypothesis per request right away")
+    parser.add_argument("--retry_from_failure_ledger", type=int, default=0, help="whether to develop (only) the inspirations of --background_question_id that gave up in --llm_failure_ledger_path, instead of --inspiration_ids; use with --if_load_from_saved 1 to add them to the saved results")
     args = parser.parse_args()
 
     assert args.model_name in ['chatgpt', 'chatgpt16k', 'gpt4', 'claude35S', 'gemini15P', 'llama318b', 'llama3170b', 'llama31405b']
     assert args.api_type in [0, 1]
+    check_llm_args(args)
+    assert args.abstract_digest_mode in ['none', 'extractive', 'llm']
+    assert args.abstract_digest_max_chars > 0
+    assert args.self_eval_batch_size >= 1
+    assert args.retry_from_failure_ledger in [0, 1]
     assert args.if_use_background_survey in [0, 1]
     assert args.if_use_strict_survey_question in [0, 1]
     assert args.if_save in [1]
@@ -967,17 +1466,36 @@ if __name__ == "__main__":
             final_data_collection = json.load(f)
     else:
         final_data_collection = None
+
+    # retry the inspirations that gave up in a previous run (the ones already in final_data_collection are skipped by select_insp_to_develop())
+    if args.retry_from_failure_ledger == 1:
+        assert args.llm_failure_ledger_path != ""
+        failed_inspiration_ids = sorted(set([cur_entry["inspiration_id"] for cur_entry in load_llm_failure_ledger(args.llm_failure_ledger_path, background_id=args.background_question_id) if cur_entry.get("inspiration_id") != None]))
+        print("Retry {} inspirations from the failure ledger: {}".format(len(failed_inspiration_ids), failed_inspiration_ids))
+        args.inspiration_ids = failed_inspiration_ids if len(failed_inspiration_ids) > 0 else [-1]
    
-    # skip if the output_dir already exists
+    # skip if the output_dir already exists (unless we continue from it)
     # Q: overlook args.if_load_from_saved for recent experiments
-    if os.path.exists(args.output_dir):
+    if os.path.exists(args.output_dir) and args.if_load_from_saved == 0:
         print("Warning: {} already exists.".format(args.output_dir))
     else:
         # initialize an object
         hyp_gene_ea = HypothesisGenerationEA(args, custom_rq=custom_rq, custom_bs=custom_bs)
         # hypothesis generation for one background question
-        final_data_collection = hyp_gene_ea.hypothesis_generation_for_one_background_question(background_question_id=args.background_question_id, inspiration_ids=args.inspiration_ids, final_data_collection=final_data_collection)
+        if args.if_async == 1:
+            final_data_collection = asyncio.run(hyp_gene_ea.ahypothesis_generation_for_one_background_question(background_question_id=args.background_question_id, inspiration_ids=args.inspiration_ids, final_data_collection=final_data_collection))
+        else:
+            final_data_collection = hyp_gene_ea.hypothesis_generation_for_one_background_question(background_question_id=args.background_question_id, inspiration_ids=args.inspiration_ids, final_data_collection=final_data_collection)
+        # saved only after a run, so that a skipped run does not overwrite the telemetry of the run that wrote output_dir
+        save_llm_telemetry(args.output_dir, prometheus_path=args.llm_telemetry_prometheus_path)
 
     duration = time.time() - start_time
+    print_llm_stats()
+    if get_abstract_digest() != None:
+        get_abstract_digest().print_stats()
+    if args.self_eval_batch_size > 1:
+        get_self_evaluation_batch_stats().print_stats()
+    if get_title_match_stats().get_num_matches() > 0:
+        get_title_match_stats().print_stats()
     
     print("Finished within {} seconds!".format(duration))
\ No newline at end of file
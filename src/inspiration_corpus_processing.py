@@ -1,5 +1,7 @@
-import os, json, re, markdown, random, argparse
+import os, sys, json, re, markdown, random, argparse
 import pandas as pd
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Method.minhash_lsh import MinHashLSH, deduplicate_title_abstract_pairs
 
 # Function: 
 #   (1) read from markdown file to load the title and abstract from noise papers, and then 
@@ -83,6 +85,10 @@ class InspCorpusProcessing(object):
                     final_collection.append([cur_title, cur_abstract])
         # just one more paper to make it reach to 2884, which adds up with 116 papers from groundtruth inspiration will just lead to 3000 corpus
         final_collection.append(["Nitrate reduction enables safer aryldiazonium chemistry", "Aryldiazonium salts remain a staple in organic synthesis and are still prepared largely in accord with the protocol developed in the 19th century. Because of the favorable reactivity that often cannot be achieved with other aryl(pseudo)halides, diazonium chemistry continues to grow. Facile extrusion of dinitrogen contributes to the desired reactivity but is also reason for safety concerns. Explosions have occurred since the discovery of these reagents and still result in accidents. In this study, we report a diazonium chemistry paradigm shift based on nitrate reduction using thiosulfate or dihalocuprates as electron donors that avoids diazonium accumulation. Because nitrate reduction is rate-limiting, aryldiazoniums are produced as fleeting intermediates, which results in a safer and often more efficient deaminative halogenation in a single step from anilines."])
+        # remove the near duplicate papers (e.g., the same paper exported in several files)
+        if self.args.near_duplicate_threshold > 0:
+            final_collection, removed_collection = deduplicate_title_abstract_pairs(final_collection, threshold=self.args.near_duplicate_threshold)
+            print("Number of near duplicate papers removed: ", len(removed_collection))
         # save
         print("len(final_collection): ", len(final_collection))
         with open("final_collection_3000.json", 'w') as f:
@@ -362,6 +368,12 @@ class InspCorpusProcessing(object):
         with open(self.args.json_file_path, 'r') as f:
             # random_papers: [[title, abstract], ...]
             random_papers = json.load(f)
+        # the (noise) papers that are near duplicates of the papers already in the collection (e.g., the groundtruth inspiration papers) or of each other are not added
+        if self.args.near_duplicate_threshold > 0:
+            lsh = MinHashLSH()
+            lsh.add_batch([cur_item[0] for cur_item in self.title_abstract_collector])
+            random_papers, removed_papers = deduplicate_title_abstract_pairs(random_papers, threshold=self.args.near_duplicate_threshold, lsh=lsh)
+            print("Number of near duplicate (noise) papers removed: ", len(removed_papers))
         assert len(random_papers) >= non_gdth_insp_paper_num
         random.shuffle(random_papers)
         selected_random_papers = random_papers[:non_gdth_insp_paper_num]
@@ -391,10 +403,12 @@ if __name__ == '__main__':
     parser.add_argument("--json_file_path", type=str, default="./final_collection_3000.json", help="the folder name containing json files")
     parser.add_argument("--corpus_size", type=int, default=300, help="the number of total inspiration (paper) corpus (both groundtruth insp papers and non-groundtruth insp papers)")
     parser.add_argument("--if_save", type=int, default=1, help="whether save screening results")
+    parser.add_argument("--near_duplicate_threshold", type=float, default=0, help="Jaccard similarity of the titles above which two papers are near duplicates (found with MinHash-LSH), and only the first one is kept in the corpus; 0: no deduplication")
     parser.add_argument("--output_dir", type=str, default='./title_abstract.json', help="shouldn't set this dir, the name of output_dir will be set automatically")
     args = parser.parse_args()
 
     assert args.if_save in [0, 1]
+    assert args.near_duplicate_threshold >= 0 and args.near_duplicate_threshold <= 1
     assert args.output_dir == './title_abstract.json' 
     args.output_dir = './Data/Inspiration_Corpus_{}.json'.format(args.corpus_size)
     
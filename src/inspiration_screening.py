@@ -1,7 +1,15 @@
-import os, sys, argparse, json
-from openai import OpenAI, AzureOpenAI
+import os, sys, argparse, json, asyncio
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from Method.utils import instruction_prompts, load_chem_annotation, organize_raw_inspirations, load_dict_title_2_abstract, recover_generated_title_to_exact_version_of_title, llm_generation_while_loop
+from Method.title_index import TitleIndex, SimilarityMatcher, get_title_match_stats
+from Method.utils import instruction_prompts, load_chem_annotation, organize_raw_inspirations, load_dict_title_2_abstract, recover_generated_titles_to_exact_version_of_titles, ordered_set, llm_generation_while_loop, allm_generation_while_loop, get_template_early_stop_fn
+from Method.llm_router import resolve_llm_client
+from Method.rate_limiter import LLMGiveUpError
+from Method.llm_budget import record_llm_give_up
+from Method.llm_telemetry import save_llm_telemetry
+from Method.abstract_digest import setup_abstract_digest, get_abstract_digest, get_screening_abstracts, aget_screening_abstracts
+from Method.llm_cascade import get_llm_cascade_tiers, get_llm_cascade_start_tier, record_llm_cascade_call, record_llm_escalation
+from Method.llm_dispatcher import set_llm_priority_class
+from Method.llm_cli import add_llm_args, check_llm_args, setup_llm_layer, print_llm_stats
 
 
 # Coarse grained inspiration screening
@@ -11,19 +19,16 @@ class Screening(object):
         self.args = args
         self.custom_rq = custom_rq
         self.custom_bs = custom_bs
-        ## Set API client
-        # openai client
-        if args.api_type == 0:
-            self.client = OpenAI(api_key=args.api_key, base_url=args.base_url)
-        # azure client
-        elif args.api_type == 1:
-            self.client = AzureOpenAI(
-                azure_endpoint = args.base_url, 
-                api_key=args.api_key,  
-                api_version="2024-06-01"
-            )
-        else:
-            raise NotImplementedError
+        ## Set the LLM layer from the --llm_* arguments (shared by the whole process; see Method.llm_cli): e.g., the first screening rounds run on a cheap model of the cascade, and the later rounds and the windows with a low-confidence selection escalate to a stronger one
+        setup_llm_layer(args, cascade_escalate_round=args.llm_cascade_escalate_round)
+        ## Set API client (shared by the whole process, so that its keep-alive connection pool is reused)
+        self.client = resolve_llm_client(args.api_type, args.api_key, args.base_url, model_name=args.model_name)
+        # the requests of this pipeline belong to self.llm_priority_class
+        self.llm_priority_class = args.llm_priority_class if args.llm_priority_class != "" else ("interactive" if custom_rq != None else "default")
+        ## Set digests of the abstracts in the screening prompts (shared by the whole process; None: the full abstracts are used)
+        setup_abstract_digest(args.abstract_digest_mode, max_chars=args.abstract_digest_max_chars, cache_path=args.abstract_digest_cache_path, model_name=args.abstract_digest_model_name if args.abstract_digest_model_name != "" else args.model_name)
+        ## Stream the screening responses and stop reading once num_screening_keep_size [Title, Reason] blocks are complete (None: wait for the full response)
+        self.screening_early_stop_fn = get_template_early_stop_fn(['Title:', 'Reason:'], args.num_screening_keep_size) if args.llm_early_stop == 1 else None
         ## Load research background: Use the research question and background survey in Tomato-Chem or the custom ones from input
         if custom_rq == None and custom_bs == None:
             # annotated bkg research question and its annotated groundtruth inspiration paper titles
@@ -38,10 +43,15 @@ class Screening(object):
         # title_abstract_collector: [[title, abstract], ...]
         # dict_title_2_abstract: {'title': 'abstract', ...}
         self.title_abstract_collector, self.dict_title_2_abstract = load_dict_title_2_abstract(title_abstract_collector_path=args.title_abstract_all_insp_literature_path)   
+        # title_index: TitleIndex of the titles in dict_title_2_abstract, to recover the generated titles to their exact version
+        self.title_index = TitleIndex(list(self.dict_title_2_abstract.keys()))
+        # recovered_titles: {generated title: exact version of title}; filled with the titles of each screening round in one batch (see recover_titles()), and reused by check_how_many_hit_groundtruth_insp()
+        self.recovered_titles = {}
 
 
     # The main function to run coarse-grained inspiration screening. Multiple rounds of screening for each background research question supported.
     def run(self):
+        set_llm_priority_class(self.llm_priority_class)
         # Dict_bkg_q_2_screen_results: {'bq': [screen_results_round1, screen_results_round2, ...], ...}
         Dict_bkg_q_2_screen_results = {}
         # Dict_bkg_q_2_ratio_hit: {'bq': [ratio_hit_round1, ratio_hit_round2, ...], ...}
@@ -60,7 +70,7 @@ class Screening(object):
                     # first round of screening, inspiration_candidates are the full inspirations corpus
                     cur_next_round_inspiration_candidates = self.title_abstract_collector
                 print("\nScreening Round: {}; Number of inspiration candidates: {}".format(cur_screen_round, len(cur_next_round_inspiration_candidates)))
-                screen_results, cur_next_round_inspiration_candidates = self.one_round_screening(cur_bkg_q, cur_next_round_inspiration_candidates)
+                screen_results, cur_next_round_inspiration_candidates = self.one_round_screening(cur_bkg_q, cur_next_round_inspiration_candidates, screen_round=cur_screen_round)
                 print("Screening Round: {}; len(screen_results): {}".format(cur_screen_round, len(screen_results)))
                 # ratio_hit: [ratio_hit_in_top1, ratio_hit_in_top3]
                 # when using custom_rq, we don't know the groundtruth insp to check ratio hit
@@ -83,7 +93,45 @@ class Screening(object):
         # organized_Dict_bkg_q_2_screen_results: {'bq': [screen_results_round1_org, screen_results_round2_org, ...]}
         #   screen_results_round1_org: [[title, reason], [title, reason], ...]
         organized_Dict_bkg_q_2_screen_results = organize_raw_inspirations(Dict_bkg_q_2_screen_results)
-        
+        self.save_screen_results(organized_Dict_bkg_q_2_screen_results, Dict_bkg_q_2_ratio_hit)
+
+
+    # asyncio version of run(): the background research questions are screened concurrently, and so are the screening windows inside each round
+    async def arun(self):
+        set_llm_priority_class(self.llm_priority_class)
+        self.async_client = resolve_llm_client(self.args.api_type, self.args.api_key, self.args.base_url, model_name=self.args.model_name, if_async=True)
+        # Dict_bkg_q_2_screen_results / Dict_bkg_q_2_ratio_hit: see run()
+        Dict_bkg_q_2_screen_results = {}
+        Dict_bkg_q_2_ratio_hit = {}
+        selected_bkg_questions = [cur_bkg_q for cur_bkg_q_id, cur_bkg_q in enumerate(self.bkg_q_list) if self.args.background_question_id == -1 or cur_bkg_q_id == self.args.background_question_id]
+        # screen_results_and_ratio_hit_list: [[screen_results_all_rounds, ratio_hit_all_rounds], ...]
+        screen_results_and_ratio_hit_list = await asyncio.gather(*[self.ascreening_for_one_bkg_q(cur_bkg_q) for cur_bkg_q in selected_bkg_questions])
+        for cur_bkg_q, cur_screen_results_and_ratio_hit in zip(selected_bkg_questions, screen_results_and_ratio_hit_list):
+            Dict_bkg_q_2_screen_results[cur_bkg_q] = cur_screen_results_and_ratio_hit[0]
+            if self.custom_rq == None:
+                Dict_bkg_q_2_ratio_hit[cur_bkg_q] = cur_screen_results_and_ratio_hit[1]
+        organized_Dict_bkg_q_2_screen_results = organize_raw_inspirations(Dict_bkg_q_2_screen_results)
+        self.save_screen_results(organized_Dict_bkg_q_2_screen_results, Dict_bkg_q_2_ratio_hit)
+
+
+    ## Function
+    #   all rounds of screening for one background research question (the rounds are sequential, since each round screens the selected ones from the previous round)
+    ## Output
+    #   screen_results_all_rounds: [screen_results_round1, screen_results_round2, ...]
+    #   ratio_hit_all_rounds: [ratio_hit_round1, ratio_hit_round2, ...]; [] when using custom_rq
+    async def ascreening_for_one_bkg_q(self, cur_bkg_q):
+        screen_results_all_rounds, ratio_hit_all_rounds = [], []
+        cur_next_round_inspiration_candidates = self.title_abstract_collector
+        for cur_screen_round in range(self.args.num_round_of_screening):
+            print("\nbkg_q: {}; Screening Round: {}; Number of inspiration candidates: {}".format(cur_bkg_q, cur_screen_round, len(cur_next_round_inspiration_candidates)))
+            screen_results, cur_next_round_inspiration_candidates = await self.aone_round_screening(cur_bkg_q, cur_next_round_inspiration_candidates, screen_round=cur_screen_round)
+            screen_results_all_rounds.append(screen_results)
+            if self.custom_rq == None:
+                ratio_hit_all_rounds.append(self.check_how_many_hit_groundtruth_insp(cur_bkg_q, screen_results))
+        return screen_results_all_rounds, ratio_hit_all_rounds
+
+
+    def save_screen_results(self, organized_Dict_bkg_q_2_screen_results, Dict_bkg_q_2_ratio_hit):
         # save files
         if self.args.if_save:
             with open(self.args.output_dir, 'w') as f:
@@ -98,10 +146,36 @@ class Screening(object):
     ## Input
     #   bkg_research_question: background research question (text)
     #   inspiration_candidates: inspiration corpus to select matched ones with the background: [[title, abstract], [title, abstract], ...]
+    #   screen_round: index of the round of screening; the windows of the later rounds start from a stronger model of the cascade of 'screening' (see Method.llm_cascade)
     ## Output
     #   screen_results: [[[title, reason], [title, reason]], [[], []], ...]
     #   next_round_inspiration_candidates: [[title, abstract], [title, abstract], ...]
-    def one_round_screening(self, bkg_research_question, inspiration_candidates=None):
+    def one_round_screening(self, bkg_research_question, inspiration_candidates=None, screen_round=0):
+        # screening_windows: [[cur_title_abstract_pairs, full_prompt, prompt_prefix], ...]
+        candidate_abstracts = get_screening_abstracts(inspiration_candidates, self.client)
+        screening_windows = self.prepare_screening_windows(bkg_research_question, inspiration_candidates, candidate_abstracts)
+        structured_gene_list = [self.screen_one_window(cur_full_prompt, bkg_research_question, prompt_prefix=cur_prompt_prefix, title_abstract_pairs=cur_title_abstract_pairs, screen_round=screen_round) for cur_title_abstract_pairs, cur_full_prompt, cur_prompt_prefix in screening_windows]
+        return self.organize_screen_results(screening_windows, structured_gene_list)
+
+
+    # asyncio version of one_round_screening(): all the screening windows are screened concurrently
+    async def aone_round_screening(self, bkg_research_question, inspiration_candidates=None, screen_round=0):
+        candidate_abstracts = await aget_screening_abstracts(inspiration_candidates, self.async_client)
+        screening_windows = self.prepare_screening_windows(bkg_research_question, inspiration_candidates, candidate_abstracts)
+        structured_gene_list = await asyncio.gather(*[self.ascreen_one_window(cur_full_prompt, bkg_research_question, prompt_prefix=cur_prompt_prefix, title_abstract_pairs=cur_title_abstract_pairs, screen_round=screen_round) for cur_title_abstract_pairs, cur_full_prompt, cur_prompt_prefix in screening_windows])
+        return self.organize_screen_results(screening_windows, structured_gene_list)
+
+
+    ## Function
+    #   split inspiration_candidates into screening windows of args.num_screening_window_size, and prepare the prompt for each window
+    ## Input
+    #   candidate_abstracts: the abstract of each candidate in the prompts (their digests with --abstract_digest_mode; see Method.abstract_digest); None: the full abstracts
+    ## Output
+    #   screening_windows: [[cur_title_abstract_pairs, full_prompt, prompt_prefix], ...]; full_prompt is None if the window has no more than args.num_screening_keep_size candidates (then they are kept without screening)
+    #       prompt_prefix: the beginning of full_prompt shared by all the windows (instructions, background question and survey); see llm_generation()
+    def prepare_screening_windows(self, bkg_research_question, inspiration_candidates, candidate_abstracts=None):
+        if candidate_abstracts == None:
+            candidate_abstracts = [cur_ta[1] for cur_ta in inspiration_candidates]
         # when self.custom_rq is not None, we don't need to check this (and also we won't initialize self.dict_bkg2insp)
         if self.custom_rq == None:
             assert bkg_research_question in self.dict_bkg2insp
@@ -117,10 +191,9 @@ class Screening(object):
         else:
             raise NotImplementedError
         assert len(prompts) == 4
-        # screen_results
-        screen_results = []
-        # next_round_inspiration_candidates: [[title, abstract], [title, abstract], ...], the ones that are selected this round, to be used to more fine-grained screening in the next round
-        next_round_inspiration_candidates = []
+        # the candidates come after the parts shared by all the windows, so that the windows can hit the provider's prompt cache
+        prompt_prefix = prompts[0] + bkg_research_question + prompts[1] + backgroud_survey + prompts[2]
+        screening_windows = []
         # select title_abstract for screening: [start_id, end_id) (not including end_id); start_id starts from id: 0 every time use self.one_round_screening()
         start_id = 0
         end_id = min(start_id + self.args.num_screening_window_size, len(inspiration_candidates))
@@ -133,49 +206,151 @@ class Screening(object):
                 # transfer selected title_abstract pairs to prompt
                 cur_title_abstract_pairs_prompt = ""
                 for cur_ta_id, cur_ta in enumerate(cur_title_abstract_pairs):
-                    cur_ta_prompt = "Next we will introduce inspiration candidate {}. Title: {}; Abstract: {}. The introduction of inspiration candidate {} has come to an end.\n".format(cur_ta_id, cur_ta[0], cur_ta[1], cur_ta_id)
+                    cur_ta_prompt = "Next we will introduce inspiration candidate {}. Title: {}; Abstract: {}. The introduction of inspiration candidate {} has come to an end.\n".format(cur_ta_id, cur_ta[0], candidate_abstracts[start_id + cur_ta_id], cur_ta_id)
                     cur_title_abstract_pairs_prompt += cur_ta_prompt
                 # add instruction prompts
-                full_prompt = prompts[0] + bkg_research_question + prompts[1] + backgroud_survey + prompts[2] + cur_title_abstract_pairs_prompt + prompts[3]
-                # cur_structured_gene: [[Title, Reason], [Title, Reason], ...]
-                # Use zero temperature to escavate heuristics in the model the most 
-                cur_structured_gene = llm_generation_while_loop(full_prompt, self.args.model_name, self.client, if_structured_generation=True, template=['Title:', 'Reason:'], temperature=0.0)  
+                full_prompt = prompt_prefix + cur_title_abstract_pairs_prompt + prompts[3]
             else:
-                cur_structured_gene = [[cur_title_abstract_pairs[cur_ta_id][0], "Less than num_screening_keep_size, so keep them without screening."] for cur_ta_id in range(len(cur_title_abstract_pairs))]
+                full_prompt = None
+            screening_windows.append([cur_title_abstract_pairs, full_prompt, prompt_prefix])
+            # update start_id & end_id
+            start_id = end_id
+            end_id = min(start_id + self.args.num_screening_window_size, len(inspiration_candidates))
+        return screening_windows
+
+
+    # cur_structured_gene: [[Title, Reason], [Title, Reason], ...]; None if full_prompt is None; [] if the window gave up (nothing is selected from it)
+    # with a cascade of 'screening', the window starts from the tier of screen_round, and escalates to the next tier when its selection is not confident or it gives up
+    def screen_one_window(self, full_prompt, bkg_research_question, prompt_prefix=None, title_abstract_pairs=None, screen_round=0):
+        if full_prompt == None:
+            return None
+        model_tiers = get_llm_cascade_tiers("screening", [self.args.model_name])
+        tier = get_llm_cascade_start_tier("screening", screen_round)
+        # the candidates of the window, built once for the confidence checks of all the tiers
+        candidate_titles = SimilarityMatcher([cur_ta[0] for cur_ta in title_abstract_pairs], record_stats=False) if tier + 1 < len(model_tiers) else None
+        while True:
+            record_llm_cascade_call("screening", model_tiers[tier])
+            try:
+                # Use zero temperature to escavate heuristics in the model the most 
+                cur_structured_gene = llm_generation_while_loop(full_prompt, model_tiers[tier], self.client, if_structured_generation=True, template=['Title:', 'Reason:'], temperature=0.0, stage="screening", early_stop_fn=self.screening_early_stop_fn, prompt_prefix=prompt_prefix)
+                if tier + 1 >= len(model_tiers) or self.if_confident_window(candidate_titles, cur_structured_gene):
+                    return cur_structured_gene
+                reason = "low_confidence"
+            except LLMGiveUpError as e:
+                if tier + 1 >= len(model_tiers):
+                    self.record_window_give_up(e, bkg_research_question)
+                    return []
+                reason = "give_up"
+            record_llm_escalation("screening", model_tiers[tier], model_tiers[tier + 1], reason)
+            tier += 1
+
+
+    async def ascreen_one_window(self, full_prompt, bkg_research_question, prompt_prefix=None, title_abstract_pairs=None, screen_round=0):
+        if full_prompt == None:
+            return None
+        model_tiers = get_llm_cascade_tiers("screening", [self.args.model_name])
+        tier = get_llm_cascade_start_tier("screening", screen_round)
+        # the candidates of the window, built once for the confidence checks of all the tiers
+        candidate_titles = SimilarityMatcher([cur_ta[0] for cur_ta in title_abstract_pairs], record_stats=False) if tier + 1 < len(model_tiers) else None
+        while True:
+            record_llm_cascade_call("screening", model_tiers[tier])
+            try:
+                cur_structured_gene = await allm_generation_while_loop(full_prompt, model_tiers[tier], self.async_client, if_structured_generation=True, template=['Title:', 'Reason:'], temperature=0.0, stage="screening", early_stop_fn=self.screening_early_stop_fn, prompt_prefix=prompt_prefix)
+                if tier + 1 >= len(model_tiers) or self.if_confident_window(candidate_titles, cur_structured_gene):
+                    return cur_structured_gene
+                reason = "low_confidence"
+            except LLMGiveUpError as e:
+                if tier + 1 >= len(model_tiers):
+                    self.record_window_give_up(e, bkg_research_question)
+                    return []
+                reason = "give_up"
+            record_llm_escalation("screening", model_tiers[tier], model_tiers[tier + 1], reason)
+            tier += 1
+
+
+    ## Function
+    #   whether the selection of a screening window can be trusted: args.num_screening_keep_size titles are selected, and each of them is one of the candidates of the window
+    ## Input
+    #   candidate_titles: SimilarityMatcher of the titles of the candidates of the window (without stats recording)
+    #   cur_structured_gene: [[Title, Reason], ...]
+    def if_confident_window(self, candidate_titles, cur_structured_gene):
+        if len(cur_structured_gene) < self.args.num_screening_keep_size:
+            return False
+        for cur_selected_insp in cur_structured_gene:
+            if not candidate_titles.contains(cur_selected_insp[0]):
+                return False
+        return True
+
+
+    def record_window_give_up(self, e, bkg_research_question):
+        background_id = self.bkg_q_list.index(bkg_research_question) if bkg_research_question in self.bkg_q_list else None
+        record_llm_give_up(e, background_id=background_id)
+
+
+    ## Function
+    #   recover the selected titles of each screening window to the exact version of title
+    ## Input
+    #   screening_windows: [[cur_title_abstract_pairs, full_prompt, prompt_prefix], ...]
+    #   structured_gene_list: [cur_structured_gene, ...]; the screening result of each window (None: kept without screening)
+    ## Output
+    #   see one_round_screening()
+    def organize_screen_results(self, screening_windows, structured_gene_list):
+        # screen_results
+        screen_results = []
+        # next_round_inspiration_candidates: [[title, abstract], [title, abstract], ...], the ones that are selected this round, to be used to more fine-grained screening in the next round
+        next_round_inspiration_candidates = []
+        structured_gene_list = list(structured_gene_list)
+        for cur_window_id, (cur_title_abstract_pairs, cur_full_prompt, cur_prompt_prefix) in enumerate(screening_windows):
+            if structured_gene_list[cur_window_id] == None:
+                structured_gene_list[cur_window_id] = [[cur_title_abstract_pairs[cur_ta_id][0], "Less than num_screening_keep_size, so keep them without screening."] for cur_ta_id in range(len(cur_title_abstract_pairs))]
+        # recover the selected titles of all the windows of the round in one batch
+        self.recover_titles([cur_selected_insp[0] for cur_structured_gene in structured_gene_list for cur_selected_insp in cur_structured_gene])
+        for cur_structured_gene in structured_gene_list:
             # update next_round_inspiration_candidates
             for cur_selected_insp_id, cur_selected_insp in enumerate(cur_structured_gene):
                 cur_selected_insp_title = cur_selected_insp[0]
                 # here the cur_selected_insp_title should have been recovered to the exact version of title
-                cur_selected_insp_title = recover_generated_title_to_exact_version_of_title(list(self.dict_title_2_abstract.keys()), cur_selected_insp_title)
+                cur_selected_insp_title = self.recovered_titles[cur_selected_insp_title]
                 cur_selected_insp_abstract = self.dict_title_2_abstract[cur_selected_insp_title]
                 next_round_inspiration_candidates.append([cur_selected_insp_title, cur_selected_insp_abstract])
                 # update cur_selected_insp to the exact version of title
                 cur_structured_gene[cur_selected_insp_id][0] = cur_selected_insp_title
             # update screen_results: now the cur_structured_gene uses the exact version of title
             screen_results.append(cur_structured_gene)
-            # update start_id & end_id
-            start_id = end_id
-            end_id = min(start_id + self.args.num_screening_window_size, len(inspiration_candidates))
         return screen_results, next_round_inspiration_candidates
 
+
+    ## Function
+    #   recover titles to the exact version of title; the titles that are not recovered before are recovered in one batch (recover_generated_titles_to_exact_version_of_titles())
+    ## Output
+    #   recovered_titles: [title, ...]; one for each title
+    def recover_titles(self, titles):
+        new_titles = ordered_set([cur_title for cur_title in titles if cur_title not in self.recovered_titles])
+        if len(new_titles) > 0:
+            for cur_title, cur_recovered_title in zip(new_titles, recover_generated_titles_to_exact_version_of_titles(self.title_index, new_titles)):
+                self.recovered_titles[cur_title] = cur_recovered_title
+        return [self.recovered_titles[cur_title] for cur_title in titles]
+
         
     # obtain ratio_hit_in_top1 and ratio_hit_in_top3
     def check_how_many_hit_groundtruth_insp(self, bkg_research_question, screen_results):
         all_extracted_titles = []
         top1_extracted_titles = []
         # obtain all_extracted_titles and top1_extracted_titles
+        # the titles of the round (and the groundtruth inspirations) are recovered in one batch, or reused from organize_screen_results()
+        self.recover_titles([cur_extracted_insp[0] for cur_sr in screen_results for cur_extracted_insp in cur_sr] + self.dict_bkg2insp[bkg_research_question])
         for cur_sr in screen_results:
             for cur_extracted_insp_id, cur_extracted_insp in enumerate(cur_sr):
                 cur_extracted_insp_title = cur_extracted_insp[0]
                 # here the cur_extracted_insp_title should have been recovered to the exact version of title
-                cur_extracted_insp_title = recover_generated_title_to_exact_version_of_title(list(self.dict_title_2_abstract.keys()), cur_extracted_insp_title)
+                cur_extracted_insp_title = self.recovered_titles[cur_extracted_insp_title]
                 all_extracted_titles.append(cur_extracted_insp_title)
                 if cur_extracted_insp_id == 0:
                     top1_extracted_titles.append(cur_extracted_insp_title)
         # check whether the groundtruth title is in the extracted titles
         gdth_insp = self.dict_bkg2insp[bkg_research_question]
         # recover the groundtruth inspirations to the exact version of title (the ones in title_abstract.json, even chem_research_2024.xlsx is not counted as groundtruth here, since title_abstract.json might have conflicts with chem_research_2024.xlsx, and title_abstract.json is more complete, so we choose title_abstract.json as the groundtruth, although chem_research_2024.xlsx is our benchmark and title_abstract.json is only a processed intermediate file) 
-        gdth_insp = [recover_generated_title_to_exact_version_of_title(list(self.dict_title_2_abstract.keys()), cur_gdth_insp) for cur_gdth_insp in gdth_insp]
+        gdth_insp = self.recover_titles(gdth_insp)
         # print("gdth_insp: ", gdth_insp)
         # The groundtruth inspirations collected so far all have more than or equal with 1 items
         assert len(gdth_insp) >= 1
@@ -222,10 +397,22 @@ if __name__ == '__main__':
     parser.add_argument("--if_use_background_survey", type=int, default=1, help="whether use background survey. 0: not use (replace the survey as 'Survey not provided. Please overlook the survey.'); 1: use")
     parser.add_argument("--num_round_of_screening", type=int, default=1, help="how many rounds of screening we use. For each round, we use the selected inspirations from the previous round to screen the next round.")
     parser.add_argument("--corpus_size", type=int, default=300, help="the number of total inspiration (paper) corpus (both groundtruth insp papers and non-groundtruth insp papers)")
+    add_llm_args(parser)
+    parser.add_argument("--llm_cascade_escalate_round", type=int, default=1, help="the screening windows of the rounds >= this one start from the second model of the cascade of 'screening' (the earlier rounds start from the first, cheapest one)")
+    parser.add_argument("--abstract_digest_mode", type=str, default="none", help="abstracts of the candidates in the screening prompts; none: the full abstracts; extractive: their leading sentences up to --abstract_digest_max_chars; llm: their LLM summaries (stage 'abstract_digest'); the digests are computed once per paper and cached (the full abstracts are still used for hypothesis generation)")
+    parser.add_argument("--abstract_digest_max_chars", type=int, default=400, help="upper bound of the length of a digest (characters)")
+    parser.add_argument("--abstract_digest_cache_path", type=str, default="", help="JSON file to cache the digests across runs; '': only cached in memory")
+    parser.add_argument("--abstract_digest_model_name", type=str, default="", help="model of the llm digests; '': --model_name")
+    parser.add_argument("--llm_early_stop", type=int, default=0, help="whether to stream the screening responses and stop reading once the selected [Title, Reason] blocks are complete; 0: wait for the full responses")
     args = parser.parse_args()
 
     assert args.model_name in ['chatgpt', 'chatgpt16k', 'gpt4', 'claude35S', 'gemini15P', 'llama318b', 'llama3170b', 'llama31405b']
     assert args.api_type in [0, 1]
+    check_llm_args(args)
+    assert args.llm_cascade_escalate_round >= 0
+    assert args.abstract_digest_mode in ['none', 'extractive', 'llm']
+    assert args.abstract_digest_max_chars > 0
+    assert args.llm_early_stop in [0, 1]
     # assert args.if_save in [0, 1]
     assert args.num_screening_window_size >= 10
     # currently cannot adjust corresponding prompts by args.num_screening_keep_size (default prompt is three, else need to change the prompt)
@@ -250,7 +437,16 @@ if __name__ == '__main__':
         print("Warning: The output_dir already exists. Will skip this retrival.")
     else:
         screening = Screening(args, custom_rq=custom_rq, custom_bs=custom_bs)
-        screening.run()
+        if args.if_async == 1:
+            asyncio.run(screening.arun())
+        else:
+            screening.run()
+        # saved only after a run, so that a skipped run does not overwrite the telemetry of the run that wrote output_dir
+        save_llm_telemetry(args.output_dir, prometheus_path=args.llm_telemetry_prometheus_path)
     
-
+    print_llm_stats()
+    if get_abstract_digest() != None:
+        get_abstract_digest().print_stats()
+    if get_title_match_stats().get_num_matches() > 0:
+        get_title_match_stats().print_stats()
     print("Finished!")
\ No newline at end of file
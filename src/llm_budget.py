@@ -0,0 +1,178 @@
+import os, json, time, threading, contextlib
+from Method.rate_limiter import LLMGiveUpError, estimate_num_tokens
+from Method.llm_telemetry import get_llm_telemetry
+
+
+# the retry budget of one LLM loop is used up
+class LLMBudgetExceededError(LLMGiveUpError):
+    pass
+
+
+## Function:
+#   parse per-stage retry budgets from text
+## Input
+#   stage_budgets_text: "stage0:max_attempts0:max_tokens0,..."; e.g., "screening:5:0,self_evaluation:8:60000"; 0: no limit
+## Output
+#   stage_budgets: {stage0: [max_attempts0, max_tokens0], ...}
+def parse_llm_stage_budgets(stage_budgets_text):
+    stage_budgets = {}
+    for cur_item in stage_budgets_text.split(","):
+        cur_item = cur_item.strip()
+        if cur_item == "":
+            continue
+        cur_item_split = cur_item.split(":")
+        assert len(cur_item_split) == 3, print("cur_item: ", cur_item)
+        cur_stage, cur_max_attempts, cur_max_tokens = cur_item_split[0].strip(), int(cur_item_split[1]), int(cur_item_split[2])
+        assert cur_max_attempts >= 0 and cur_max_tokens >= 0, print("cur_item: ", cur_item)
+        stage_budgets[cur_stage] = [cur_max_attempts, cur_max_tokens]
+    return stage_budgets
+
+
+# retry budget of one LLM loop (e.g., one call of llm_generation_while_loop()): the loop gives up when it has failed max_attempts times, or the failed attempts have used max_tokens (estimated) tokens
+class LLMRetryBudget(object):
+    ## Input
+    #   max_attempts / max_tokens: 0: no limit
+    #   estimated_tokens: estimated tokens of one attempt
+    def __init__(self, stage, max_attempts=0, max_tokens=0, estimated_tokens=0):
+        self.stage = stage
+        self.max_attempts = max_attempts
+        self.max_tokens = max_tokens
+        self.estimated_tokens = estimated_tokens
+        self.num_attempts = 0
+        self.num_tokens = 0
+
+    ## Function:
+    #   count one failed attempt
+    ## Raise
+    #   LLMBudgetExceededError (from e): the budget is used up
+    def fail(self, e):
+        self.num_attempts += 1
+        self.num_tokens += self.estimated_tokens
+        if get_llm_telemetry() != None:
+            get_llm_telemetry().record_failed_attempt(self.stage)
+        if (self.max_attempts > 0 and self.num_attempts >= self.max_attempts) or (self.max_tokens > 0 and self.num_tokens >= self.max_tokens):
+            raise LLMBudgetExceededError("stage {} gave up after {} failed attempts (~{} tokens); last error: {}".format(self.stage, self.num_attempts, self.num_tokens, repr(e)), stage=self.stage, num_attempts=self.num_attempts, num_tokens=self.num_tokens) from e
+
+
+# retry budgets of all stages: stage_budgets for the stages listed, max_attempts and max_tokens for the others
+class LLMRetryBudgets(object):
+    def __init__(self, max_attempts=0, max_tokens=0, stage_budgets=None):
+        self.max_attempts = max_attempts
+        self.max_tokens = max_tokens
+        self.stage_budgets = stage_budgets if stage_budgets != None else {}
+
+    def start(self, stage, estimated_tokens=0):
+        max_attempts, max_tokens = self.stage_budgets.get(stage, [self.max_attempts, self.max_tokens])
+        return LLMRetryBudget(stage, max_attempts=max_attempts, max_tokens=max_tokens, estimated_tokens=estimated_tokens)
+
+
+# the retry budgets used by the LLM loops of the whole process; by default, loops never give up
+LLM_RETRY_BUDGETS = LLMRetryBudgets()
+
+
+def get_llm_retry_budgets():
+    return LLM_RETRY_BUDGETS
+
+
+def set_llm_retry_budgets(llm_retry_budgets):
+    global LLM_RETRY_BUDGETS
+    LLM_RETRY_BUDGETS = llm_retry_budgets
+
+
+## Input
+#   max_attempts / max_tokens: budget of the stages not in stage_budgets_text; 0: no limit
+#   stage_budgets_text: see parse_llm_stage_budgets()
+def setup_llm_retry_budgets(max_attempts=0, max_tokens=0, stage_budgets_text=""):
+    set_llm_retry_budgets(LLMRetryBudgets(max_attempts=max_attempts, max_tokens=max_tokens, stage_budgets=parse_llm_stage_budgets(stage_budgets_text)))
+    return get_llm_retry_budgets()
+
+
+## Function:
+#   start the retry budget of one LLM loop on prompt
+def start_llm_retry_budget(stage, prompt):
+    return get_llm_retry_budgets().start(stage, estimated_tokens=estimate_num_tokens(prompt))
+
+
+## Function:
+#   add the context of the current level (e.g., the mutation id) to an LLMGiveUpError raised inside, so that the level which records it in the failure ledger knows which item gave up; works for both sync and async code
+@contextlib.contextmanager
+def llm_give_up_context(**context):
+    try:
+        yield
+    except LLMGiveUpError as e:
+        for cur_key in context:
+            e.context.setdefault(cur_key, context[cur_key])
+        raise
+
+
+# append-only JSON lines file of the items that gave up; the entries can be loaded to retry the items later (e.g., hypothesis_generation.py --retry_from_failure_ledger 1)
+class LLMFailureLedger(object):
+    def __init__(self, ledger_path):
+        self.ledger_path = ledger_path
+        ledger_dir = os.path.dirname(os.path.abspath(ledger_path))
+        os.makedirs(ledger_dir, exist_ok=True)
+        self.num_records = 0
+        self.lock = threading.Lock()
+
+    ## Input
+    #   e: LLMGiveUpError
+    #   background_id / inspiration / mutation: the item that gave up (mutation: the one in e.context if not given)
+    #   extra_fields: other fields to record (e.g., inspiration_id)
+    def record(self, e, background_id=None, inspiration=None, mutation=None, **extra_fields):
+        entry = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "stage": e.stage, "background_id": background_id, "inspiration": inspiration, "mutation": mutation if mutation != None else e.context.get("mutation"), "num_attempts": e.num_attempts, "num_tokens": e.num_tokens, "error": str(e)}
+        entry.update(extra_fields)
+        with self.lock:
+            with open(self.ledger_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.num_records += 1
+
+    def print_stats(self):
+        print("LLM failure ledger: {} items gave up in this run; recorded in {}".format(self.num_records, self.ledger_path))
+
+
+## Function:
+#   load the entries of a failure ledger
+## Input
+#   background_id / stage: only keep the entries of background_id / stage; None: no filter
+## Output
+#   entries: [entry, ...]; see LLMFailureLedger.record()
+def load_llm_failure_ledger(ledger_path, background_id=None, stage=None):
+    if not os.path.exists(ledger_path):
+        return []
+    with open(ledger_path, 'r', encoding='utf-8') as f:
+        entries = [json.loads(line) for line in f if line.strip() != ""]
+    if background_id != None:
+        entries = [cur_entry for cur_entry in entries if cur_entry["background_id"] == background_id]
+    if stage != None:
+        entries = [cur_entry for cur_entry in entries if cur_entry["stage"] == stage]
+    return entries
+
+
+# None: items that gave up are only printed
+LLM_FAILURE_LEDGER = None
+
+
+def get_llm_failure_ledger():
+    return LLM_FAILURE_LEDGER
+
+
+def set_llm_failure_ledger(llm_failure_ledger):
+    global LLM_FAILURE_LEDGER
+    LLM_FAILURE_LEDGER = llm_failure_ledger
+
+
+def setup_llm_failure_ledger(ledger_path):
+    if ledger_path == "":
+        set_llm_failure_ledger(None)
+    elif get_llm_failure_ledger() == None or get_llm_failure_ledger().ledger_path != ledger_path:
+        set_llm_failure_ledger(LLMFailureLedger(ledger_path))
+    return get_llm_failure_ledger()
+
+
+## Function:
+#   report an item that gave up (printed, and recorded in the failure ledger if there is one); see LLMFailureLedger.record() for the input
+def record_llm_give_up(e, background_id=None, inspiration=None, mutation=None, **extra_fields):
+    print("Warning: give up on (background_id: {}; inspiration: {}; mutation: {}): {}".format(background_id, inspiration, mutation if mutation != None else e.context.get("mutation"), e))
+    llm_failure_ledger = get_llm_failure_ledger()
+    if llm_failure_ledger != None:
+        llm_failure_ledger.record(e, background_id=background_id, inspiration=inspiration, mutation=mutation, **extra_fields)
@@ -0,0 +1,412 @@
+import os, json, time, sqlite3, hashlib, asyncio, threading
+import concurrent.futures
+from Method.rate_limiter import CHARS_PER_TOKEN
+
+
+# read_only: only read cached responses, do not store new ones; write_through: read cached responses and store new ones; bypass: neither read nor store
+LLM_CACHE_MODES = ["read_only", "write_through", "bypass"]
+# how many new entries are written before the size-based eviction is checked again
+EVICTION_CHECK_INTERVAL = 100
+# provider-side prompt caching (e.g., OpenAI's) only applies to prompts with at least this number of tokens
+PROMPT_CACHE_MIN_TOKENS = 1024
+# a cached prompt prefix is assumed to be evicted by the provider after this time without use
+PROMPT_CACHE_TTL_SECONDS = 300
+# requests sharing a prompt prefix wait at most this long for the first request of the prefix
+PREFIX_WARMUP_MAX_WAIT_SECONDS = 60
+# how often a coroutine waiting for the first request of a prefix checks again
+PREFIX_WARMUP_POLL_SECONDS = 0.05
+
+
+## Function:
+#   content-addressed key of one LLM request: the hash of (model, temperature, messages), response_format and early_stop (only when they are used, so that the keys of full text requests are not changed)
+## Input
+#   early_stop: None or the early-stop mode of a streamed request (early_stop_fn.cache_tag; see Method.utils.get_template_early_stop_fn()); a cut-off response is only returned to requests with the same early-stop mode
+def get_llm_cache_key(model_name, temperature, messages, response_format=None, early_stop=None):
+    content = [model_name, temperature, messages]
+    if response_format != None:
+        content.append(response_format)
+    if early_stop != None:
+        content.append({"early_stop": early_stop})
+    content = json.dumps(content, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+## Function:
+#   parse per-stage cache modes from text
+## Input
+#   stage_modes_text: "stage0:mode0,stage1:mode1,..."; e.g., "screening:read_only,restructuring:bypass"
+## Output
+#   stage_modes: {stage0: mode0, stage1: mode1, ...}
+def parse_llm_cache_stage_modes(stage_modes_text):
+    stage_modes = {}
+    for cur_item in stage_modes_text.split(","):
+        cur_item = cur_item.strip()
+        if cur_item == "":
+            continue
+        assert len(cur_item.split(":")) == 2, print("cur_item: ", cur_item)
+        cur_stage, cur_mode = [item.strip() for item in cur_item.split(":")]
+        assert cur_mode in LLM_CACHE_MODES, print("cur_mode: ", cur_mode)
+        stage_modes[cur_stage] = cur_mode
+    return stage_modes
+
+
+# persistent (SQLite) cache of LLM responses, shared by all threads of the process
+class LLMResponseCache(object):
+    ## Input
+    # cache_path: path of the SQLite file
+    # max_entries: keep at most max_entries responses (least recently used ones are evicted first); 0: no limit
+    # ttl_seconds: responses older than ttl_seconds are treated as missing and evicted; 0: never expire
+    # default_mode: mode for stages not in stage_modes; one of LLM_CACHE_MODES
+    # stage_modes: {stage: mode, ...}
+    def __init__(self, cache_path, max_entries=0, ttl_seconds=0, default_mode="write_through", stage_modes=None):
+        assert max_entries >= 0 and ttl_seconds >= 0
+        assert default_mode in LLM_CACHE_MODES
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.default_mode = default_mode
+        self.stage_modes = stage_modes if stage_modes != None else {}
+        for cur_stage in self.stage_modes:
+            assert self.stage_modes[cur_stage] in LLM_CACHE_MODES
+        # stats: {stage: {'hits': int, 'misses': int, 'writes': int}, ...}
+        self.stats = {}
+        self.num_evicted = 0
+        self.num_writes_since_eviction_check = 0
+        self.lock = threading.Lock()
+        cache_dir = os.path.dirname(os.path.abspath(cache_path))
+        os.makedirs(cache_dir, exist_ok=True)
+        self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, model TEXT, stage TEXT, response TEXT, created_at REAL, last_access REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_access ON llm_cache (last_access)")
+        self.connection.commit()
+        self.evict()
+
+    def get_mode(self, stage):
+        return self.stage_modes.get(stage, self.default_mode)
+
+    def update_stats(self, stage, item):
+        if stage not in self.stats:
+            self.stats[stage] = {'hits': 0, 'misses': 0, 'writes': 0}
+        self.stats[stage][item] += 1
+
+    ## Output
+    # response: cached response (text), or None if not cached (or expired, or the stage bypasses the cache)
+    def get(self, key, stage=None):
+        if self.get_mode(stage) == "bypass":
+            return None
+        with self.lock:
+            row = self.connection.execute("SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row != None and self.ttl_seconds > 0 and time.time() - row[1] > self.ttl_seconds:
+                row = None
+            if row == None:
+                self.update_stats(stage, 'misses')
+                return None
+            self.connection.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.connection.commit()
+            self.update_stats(stage, 'hits')
+        return row[0]
+
+    def put(self, key, response, model_name=None, stage=None):
+        if self.get_mode(stage) != "write_through":
+            return
+        cur_time = time.time()
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO llm_cache (key, model, stage, response, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)", (key, model_name, stage, response, cur_time, cur_time))
+            self.connection.commit()
+            self.update_stats(stage, 'writes')
+            self.num_writes_since_eviction_check += 1
+            if_check_eviction = self.num_writes_since_eviction_check >= EVICTION_CHECK_INTERVAL
+        if if_check_eviction:
+            self.evict()
+
+    ## Function:
+    #   remove expired responses (ttl_seconds) and the least recently used responses beyond max_entries
+    def evict(self):
+        with self.lock:
+            cnt_before = self.connection.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            if self.ttl_seconds > 0:
+                self.connection.execute("DELETE FROM llm_cache WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+            if self.max_entries > 0:
+                self.connection.execute("DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+            self.connection.commit()
+            cnt_after = self.connection.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            self.num_evicted += cnt_before - cnt_after
+            self.num_writes_since_eviction_check = 0
+
+    def print_stats(self):
+        for cur_stage in self.stats:
+            cur_stats = self.stats[cur_stage]
+            cur_hit_ratio = cur_stats['hits'] / max(1, cur_stats['hits'] + cur_stats['misses'])
+            print("LLM cache; stage: {}; mode: {}; hits: {}; misses: {}; writes: {}; hit ratio: {:.2f}".format(cur_stage, self.get_mode(cur_stage), cur_stats['hits'], cur_stats['misses'], cur_stats['writes'], cur_hit_ratio))
+        print("LLM cache; evicted entries: {}".format(self.num_evicted))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+# the cache used by llm_generation(); None: no cache
+LLM_CACHE = None
+
+
+def get_llm_cache():
+    return LLM_CACHE
+
+
+def set_llm_cache(llm_cache):
+    global LLM_CACHE
+    LLM_CACHE = llm_cache
+
+
+## Function:
+#   build the process-wide LLM response cache (once per cache_path) and let llm_generation() use it
+## Input
+#   cache_path: path of the SQLite file; "": no cache
+#   stage_modes_text: see parse_llm_cache_stage_modes()
+#   ttl_hours: 0: never expire
+def setup_llm_cache(cache_path, stage_modes_text="", max_entries=0, ttl_hours=0):
+    if cache_path == "":
+        return None
+    cur_cache = get_llm_cache()
+    if cur_cache == None or cur_cache.cache_path != cache_path:
+        cur_cache = LLMResponseCache(cache_path, max_entries=max_entries, ttl_seconds=ttl_hours * 3600, stage_modes=parse_llm_cache_stage_modes(stage_modes_text))
+        set_llm_cache(cur_cache)
+        print("Using LLM response cache: {}".format(cache_path))
+    return cur_cache
+
+
+# single-flight: concurrent identical requests (the same key as the response cache) share one pending call, so only the first one (the leader) is sent and the others wait for its response
+#   only deterministic requests (temperature 0) are coalesced: concurrent sampling requests with the same prompt (e.g., several mutations) should get independent responses
+class LLMSingleFlight(object):
+    def __init__(self):
+        # pending: {key: concurrent.futures.Future}; calls from threads
+        self.pending = {}
+        # async_pending: {(id(event loop), key): asyncio.Future}; calls from coroutines
+        self.async_pending = {}
+        # stats: {stage: {'calls': int, 'coalesced': int}, ...}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    ## Function:
+    #   whether a request with temperature can share the response of another request
+    def if_applicable(self, temperature):
+        return temperature == 0
+
+    def update_stats(self, stage, item):
+        if stage not in self.stats:
+            self.stats[stage] = {'calls': 0, 'coalesced': 0}
+        self.stats[stage][item] += 1
+
+    ## Function:
+    #   call fn() once for all concurrent calls with the same key
+    ## Input
+    #   fn: function without input that sends the request and returns the response
+    ## Output
+    #   the return of fn() (exceptions raised by fn() are raised in all the waiting calls)
+    def do(self, key, fn, stage=None):
+        with self.lock:
+            future = self.pending.get(key)
+            if_leader = future == None
+            if if_leader:
+                future = concurrent.futures.Future()
+                self.pending[key] = future
+            self.update_stats(stage, 'calls' if if_leader else 'coalesced')
+        if not if_leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            self.finish(self.pending, key)
+            future.set_exception(e)
+            raise
+        self.finish(self.pending, key)
+        future.set_result(result)
+        return result
+
+    ## Function:
+    #   async version of do(); fn() returns an awaitable
+    async def ado(self, key, fn, stage=None):
+        cur_loop = asyncio.get_running_loop()
+        pending_key = (id(cur_loop), key)
+        with self.lock:
+            future = self.async_pending.get(pending_key)
+            if_leader = future == None
+            if if_leader:
+                future = cur_loop.create_future()
+                self.async_pending[pending_key] = future
+            self.update_stats(stage, 'calls' if if_leader else 'coalesced')
+        if not if_leader:
+            # shield: cancelling one waiting call should not cancel the shared call
+            return await asyncio.shield(future)
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            self.finish(self.async_pending, pending_key)
+            future.cancel()
+            raise
+        except BaseException as e:
+            self.finish(self.async_pending, pending_key)
+            future.set_exception(e)
+            # mark the exception as retrieved, so that asyncio does not log it when no other call is waiting
+            future.exception()
+            raise
+        self.finish(self.async_pending, pending_key)
+        future.set_result(result)
+        return result
+
+    # new calls with the same key start a new request once the current one is finished
+    def finish(self, pending, key):
+        with self.lock:
+            pending.pop(key, None)
+
+    def print_stats(self):
+        for cur_stage in self.stats:
+            cur_stats = self.stats[cur_stage]
+            print("LLM single-flight; stage: {}; calls: {}; coalesced: {}".format(cur_stage, cur_stats['calls'], cur_stats['coalesced']))
+
+
+# the single-flight layer used by llm_generation(); None (default): identical requests in flight are sent separately
+LLM_SINGLE_FLIGHT = None
+
+
+def get_llm_single_flight():
+    return LLM_SINGLE_FLIGHT
+
+
+def set_llm_single_flight(llm_single_flight):
+    global LLM_SINGLE_FLIGHT
+    LLM_SINGLE_FLIGHT = llm_single_flight
+
+
+## Function:
+#   enable or disable coalescing of concurrent identical requests for the whole process (the existing layer and its stats are kept when it is already enabled)
+def setup_llm_single_flight(if_single_flight=True):
+    if not if_single_flight:
+        set_llm_single_flight(None)
+    elif get_llm_single_flight() == None:
+        set_llm_single_flight(LLMSingleFlight())
+    return get_llm_single_flight()
+
+
+## Function:
+#   key of the static prompt prefix of one request: the hash of (model, the messages before the last one, the prefix of the last message)
+def get_prompt_prefix_key(model_name, messages, prompt_prefix):
+    assert messages[-1]["content"].startswith(prompt_prefix)
+    content = json.dumps([model_name, messages[:-1], prompt_prefix], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+# warm-up of provider-side prompt caching: the provider only caches a prompt prefix after a request with it has been processed, so when many requests sharing a (long) static prefix are sent at the same time (e.g., all the screening windows of a background question), they all pay for the full prompt; here the first request of a prefix is sent alone, and the others wait until it is finished, so that they hit the provider's cache
+class LLMPromptPrefixWarmup(object):
+    def __init__(self, min_prefix_tokens=PROMPT_CACHE_MIN_TOKENS, ttl_seconds=PROMPT_CACHE_TTL_SECONDS, max_wait_seconds=PREFIX_WARMUP_MAX_WAIT_SECONDS):
+        self.min_prefix_tokens = min_prefix_tokens
+        self.ttl_seconds = ttl_seconds
+        self.max_wait_seconds = max_wait_seconds
+        # {prefix_key: the last time a request with the prefix was finished}
+        self.warm_prefixes = {}
+        # {prefix_key: threading.Event set when the first request of the prefix is finished}
+        self.in_flight = {}
+        # stats: {stage: {'warmup': int, 'waited': int, 'warm': int}, ...}
+        #   warmup: first requests of a prefix; waited: requests that waited for the first request; warm: requests sent at once since the prefix is already cached
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    # whether the prefix is long enough to be cached by the provider
+    def if_applicable(self, prompt_prefix):
+        return prompt_prefix != None and len(prompt_prefix) // CHARS_PER_TOKEN >= self.min_prefix_tokens
+
+    def update_stats(self, stage, item):
+        if stage not in self.stats:
+            self.stats[stage] = {'warmup': 0, 'waited': 0, 'warm': 0}
+        self.stats[stage][item] += 1
+
+    ## Output
+    #   if_leader: whether this request is the first request of the prefix
+    #   event: the event to wait for (None if no need to wait)
+    def begin(self, key, stage=None):
+        with self.lock:
+            cur_time = time.monotonic()
+            if key in self.warm_prefixes and cur_time - self.warm_prefixes[key] < self.ttl_seconds:
+                self.warm_prefixes[key] = cur_time
+                self.update_stats(stage, 'warm')
+                return False, None
+            event = self.in_flight.get(key)
+            if event == None:
+                self.in_flight[key] = threading.Event()
+                self.update_stats(stage, 'warmup')
+                return True, self.in_flight[key]
+            self.update_stats(stage, 'waited')
+            return False, event
+
+    # release the requests waiting for the first request of the prefix (the prefix is only marked as cached when the request succeeded)
+    def finish(self, key, if_successful):
+        with self.lock:
+            event = self.in_flight.pop(key, None)
+            if if_successful:
+                self.warm_prefixes[key] = time.monotonic()
+        if event != None:
+            event.set()
+
+    ## Function:
+    #   call fn() after the first request of the prefix is finished (at once if this is the first request, or the prefix is already cached)
+    ## Input
+    #   fn: function without input that sends the request and returns the response
+    def do(self, key, fn, stage=None):
+        if_leader, event = self.begin(key, stage=stage)
+        if not if_leader:
+            if event != None:
+                event.wait(self.max_wait_seconds)
+            return fn()
+        try:
+            result = fn()
+        except BaseException:
+            self.finish(key, False)
+            raise
+        self.finish(key, True)
+        return result
+
+    ## Function:
+    #   async version of do(); fn() returns an awaitable; waits with asyncio.sleep() so that the event loop is never blocked
+    async def ado(self, key, fn, stage=None):
+        if_leader, event = self.begin(key, stage=stage)
+        if not if_leader:
+            if event != None:
+                deadline = time.monotonic() + self.max_wait_seconds
+                while not event.is_set() and time.monotonic() < deadline:
+                    await asyncio.sleep(PREFIX_WARMUP_POLL_SECONDS)
+            return await fn()
+        try:
+            result = await fn()
+        except BaseException:
+            self.finish(key, False)
+            raise
+        self.finish(key, True)
+        return result
+
+    def print_stats(self):
+        for cur_stage in self.stats:
+            cur_stats = self.stats[cur_stage]
+            print("LLM prompt prefix warm-up; stage: {}; first requests of a prefix: {}; requests waited for them: {}; requests with a cached prefix: {}".format(cur_stage, cur_stats['warmup'], cur_stats['waited'], cur_stats['warm']))
+
+
+# None: requests sharing a prompt prefix are sent without waiting for each other
+LLM_PREFIX_WARMUP = None
+
+
+def get_llm_prefix_warmup():
+    return LLM_PREFIX_WARMUP
+
+
+def set_llm_prefix_warmup(llm_prefix_warmup):
+    global LLM_PREFIX_WARMUP
+    LLM_PREFIX_WARMUP = llm_prefix_warmup
+
+
+## Function:
+#   enable or disable the prompt prefix warm-up for the whole process (the existing state and its stats are kept when it is already enabled)
+def setup_llm_prefix_warmup(if_prefix_warmup=True):
+    if not if_prefix_warmup:
+        set_llm_prefix_warmup(None)
+    elif get_llm_prefix_warmup() == None:
+        set_llm_prefix_warmup(LLMPromptPrefixWarmup())
+    return get_llm_prefix_warmup()
@@ -0,0 +1,131 @@
+import threading
+from Method.llm_telemetry import get_llm_telemetry
+
+
+# Cost-aware model cascades: the calls of a stage start on a cheap model, and only escalate to a stronger model when needed
+#   screening: the windows of the first rounds run on the first tier; the later rounds (and the windows whose selection can not be trusted) escalate to the next tiers
+#   restructuring: every failed attempt escalates to the next tier
+
+
+# the tier that the windows of round >= DEFAULT_ESCALATE_ROUND start from is the second one
+DEFAULT_ESCALATE_ROUND = 1
+
+
+## Input
+#   stage_tiers_text: "stage0:model0>model1>...,..."; e.g., "screening:gpt-4o-mini>gpt-4o,restructuring:gpt-4o-mini>gpt-4o" (cheapest first)
+## Output
+#   stage_tiers: {stage0: [model0, model1, ...], ...}
+def parse_llm_cascade_stage_tiers(stage_tiers_text):
+    stage_tiers = {}
+    for cur_item in stage_tiers_text.split(","):
+        cur_item = cur_item.strip()
+        if cur_item == "":
+            continue
+        assert len(cur_item.split(":")) == 2, print("cur_item: ", cur_item)
+        cur_stage, cur_tiers = [item.strip() for item in cur_item.split(":")]
+        cur_tiers = [item.strip() for item in cur_tiers.split(">")]
+        assert len(cur_tiers) >= 1 and "" not in cur_tiers, print("cur_item: ", cur_item)
+        stage_tiers[cur_stage] = cur_tiers
+    return stage_tiers
+
+
+class LLMCascade(object):
+    ## Input
+    #   stage_tiers: {stage: [model names, cheapest first]}; see parse_llm_cascade_stage_tiers()
+    #   escalate_round: the calls of round >= escalate_round (e.g., the later screening rounds, which see fewer but harder candidates) start from the second tier
+    def __init__(self, stage_tiers, escalate_round=DEFAULT_ESCALATE_ROUND):
+        assert escalate_round >= 0
+        self.stage_tiers = stage_tiers
+        self.escalate_round = escalate_round
+        # stats: {stage: {'calls': {model_name: int}, 'escalations': {reason: int}}, ...}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    ## Input
+    #   default_tiers: the tiers of a stage without a cascade in stage_tiers
+    def get_tiers(self, stage, default_tiers):
+        return self.stage_tiers.get(stage, default_tiers)
+
+    def get_start_tier(self, stage, round_id=0):
+        if stage not in self.stage_tiers or round_id < self.escalate_round:
+            return 0
+        return min(1, len(self.stage_tiers[stage]) - 1)
+
+    def get_stage_stats(self, stage):
+        if stage not in self.stats:
+            self.stats[stage] = {'calls': {}, 'escalations': {}}
+        return self.stats[stage]
+
+    def record_call(self, stage, model_name):
+        with self.lock:
+            cur_calls = self.get_stage_stats(stage)['calls']
+            cur_calls[model_name] = cur_calls.get(model_name, 0) + 1
+
+    def record_escalation(self, stage, reason):
+        with self.lock:
+            cur_escalations = self.get_stage_stats(stage)['escalations']
+            cur_escalations[reason] = cur_escalations.get(reason, 0) + 1
+
+    def print_stats(self):
+        for cur_stage in self.stats:
+            cur_stats = self.stats[cur_stage]
+            print("LLM cascade; stage: {}; calls per model: {}; escalations per reason: {}".format(cur_stage, cur_stats['calls'], cur_stats['escalations']))
+
+
+# None: every stage uses its own single model (restructuring still escalates to RESTRUCTURE_ESCALATION_MODEL_NAME in Method.utils)
+LLM_CASCADE = None
+
+
+def get_llm_cascade():
+    return LLM_CASCADE
+
+
+def set_llm_cascade(llm_cascade):
+    global LLM_CASCADE
+    LLM_CASCADE = llm_cascade
+
+
+## Function:
+#   set the cascades of the whole process ("": no cascade); the existing stats are kept when the config does not change
+def setup_llm_cascade(stage_tiers_text="", escalate_round=DEFAULT_ESCALATE_ROUND):
+    stage_tiers = parse_llm_cascade_stage_tiers(stage_tiers_text)
+    if len(stage_tiers) == 0:
+        set_llm_cascade(None)
+    elif get_llm_cascade() == None or (get_llm_cascade().stage_tiers, get_llm_cascade().escalate_round) != (stage_tiers, escalate_round):
+        set_llm_cascade(LLMCascade(stage_tiers, escalate_round=escalate_round))
+    return get_llm_cascade()
+
+
+## Function:
+#   the tiers of the calls of stage: the cascade of the stage if any, otherwise default_tiers
+def get_llm_cascade_tiers(stage, default_tiers):
+    llm_cascade = get_llm_cascade()
+    if llm_cascade == None:
+        return default_tiers
+    return llm_cascade.get_tiers(stage, default_tiers)
+
+
+## Function:
+#   the tier (in the tiers of stage) that the calls of round round_id start from
+def get_llm_cascade_start_tier(stage, round_id=0):
+    llm_cascade = get_llm_cascade()
+    if llm_cascade == None:
+        return 0
+    return llm_cascade.get_start_tier(stage, round_id)
+
+
+def record_llm_cascade_call(stage, model_name):
+    if get_llm_cascade() != None:
+        get_llm_cascade().record_call(stage, model_name)
+
+
+## Function:
+#   record that a call of stage escalates from from_model_name to to_model_name (in the cascade stats and the telemetry)
+## Input
+#   reason: e.g., 'parse_failure', 'low_confidence'
+def record_llm_escalation(stage, from_model_name, to_model_name, reason):
+    print("LLM cascade; stage: {}; escalate from {} to {} ({})".format(stage, from_model_name, to_model_name, reason))
+    if get_llm_cascade() != None:
+        get_llm_cascade().record_escalation(stage, reason)
+    if get_llm_telemetry() != None:
+        get_llm_telemetry().record_escalation(stage)
@@ -0,0 +1,146 @@
+from Method.utils import set_llm_async_concurrency
+from Method.llm_router import setup_llm_router, get_llm_router
+from Method.llm_cache import setup_llm_cache, get_llm_cache, setup_llm_single_flight, get_llm_single_flight, setup_llm_prefix_warmup, get_llm_prefix_warmup
+from Method.template_parser import get_template_parser_stats
+from Method.structured_output import setup_llm_structured_output, get_llm_structured_output
+from Method.rate_limiter import setup_rate_limiter, setup_llm_circuit_breakers
+from Method.llm_budget import setup_llm_retry_budgets, setup_llm_failure_ledger, get_llm_failure_ledger
+from Method.llm_telemetry import setup_llm_telemetry
+from Method.llm_traffic import setup_llm_traffic_recorder, get_llm_traffic_recorder, TRAFFIC_PROMPT_MODES
+from Method.llm_hedging import setup_llm_hedging, get_llm_hedging
+from Method.llm_cascade import setup_llm_cascade, get_llm_cascade, DEFAULT_ESCALATE_ROUND
+from Method.llm_dispatcher import setup_llm_dispatcher, get_llm_dispatcher, parse_llm_priority_classes, DEFAULT_LLM_PRIORITY_CLASSES
+
+
+# Command line of the LLM layer shared by the pipeline scripts (inspiration_screening.py, hypothesis_generation.py, evaluate.py, groundtruth_hyp_ranking.py): the --llm_* arguments, the set-up of the process-wide LLM components from them, and their stats at the end of a run
+#   the arguments of one script only (e.g., --llm_cascade_escalate_round, --llm_early_stop of inspiration_screening.py) are still added by the script
+
+
+## Function:
+#   add the arguments of the LLM layer (and --if_async) to parser
+def add_llm_args(parser):
+    parser.add_argument("--llm_router_config", type=str, default="", help="JSON file mapping model names to one or more backends (base url, key, concurrency cap and rate limits of each; see Method.llm_router); the requests of a routed model are balanced over its backends and fail over between them, and --api_type/--api_key/--base_url are ignored for it; '': no router")
+    parser.add_argument("--llm_cache_path", type=str, default="", help="path of the SQLite file to cache LLM responses by (model, temperature, messages); re-running with the same cache only pays for new calls. '': no cache")
+    parser.add_argument("--llm_cache_stage_modes", type=str, default="", help="cache mode for each stage, e.g., 'screening:read_only,restructuring:bypass'; modes: read_only/write_through/bypass; stages not listed use write_through")
+    parser.add_argument("--llm_cache_max_entries", type=int, default=0, help="keep at most this number of cached responses (least recently used ones are evicted first); 0: no limit")
+    parser.add_argument("--llm_cache_ttl_hours", type=float, default=0, help="cached responses older than this are evicted; 0: never expire")
+    parser.add_argument("--llm_single_flight", type=int, default=0, help="whether identical (model, prompt) requests at temperature 0 in flight at the same time share one LLM call (requests at temperature > 0 are always sent separately, to sample independent responses); 0: send each of them")
+    parser.add_argument("--llm_dispatcher", type=int, default=0, help="whether the LLM requests of the process wait for a slot of a central dispatcher (--llm_max_concurrency slots), which shares the slots among the priority classes by weighted fair queuing; useful when pipelines of different priorities run in one process")
+    parser.add_argument("--llm_priority_classes", type=str, default=DEFAULT_LLM_PRIORITY_CLASSES, help="priority classes of the dispatcher, e.g., 'interactive:8:0,default:4:0,batch:1:4' (class:weight:max_concurrency; 0: no limit other than the dispatcher's)")
+    parser.add_argument("--llm_priority_class", type=str, default="", help="priority class of the LLM requests of this run; '': the default of the script: 'interactive' for a custom research question (custom_rq) in inspiration_screening.py and hypothesis_generation.py, 'batch' in groundtruth_hyp_ranking.py (a back-fill of all the background questions), 'default' otherwise")
+    parser.add_argument("--llm_hedge_stage_percentiles", type=str, default="", help="hedged requests for each stage, e.g., 'screening:95' (stage:latency percentile; '*': the stages not listed): a temperature-0 call still running after the percentile of its stage's latency is sent again and the first response is used; the duplicate requests are counted in the telemetry; '': no hedging")
+    parser.add_argument("--llm_cascades", type=str, default="", help="cascade of models for each stage, cheapest first, e.g., 'screening:gpt-4o-mini>gpt-4o,restructuring:gpt-4o-mini>gpt-4o' (see Method.llm_cascade): the calls start on the first model and escalate to the next one when their result can not be used (restructuring: a failed attempt; screening: a window with a low-confidence selection or that gives up); the escalations are counted in the telemetry; '': no cascade (restructuring still escalates from gpt-4o-mini to gpt-4o)")
+    parser.add_argument("--llm_prefix_warmup", type=int, default=0, help="whether the first request of a long static prompt prefix (e.g., the instructions, background question and survey shared by all the screening windows) is sent alone before the other requests sharing it, so that they hit the provider's prompt cache; it trades some concurrency for cheaper and faster prompts")
+    parser.add_argument("--llm_structured_output", type=int, default=0, help="whether to request structured generations (e.g., [Title, Reason] blocks, four-aspect scores) with a JSON schema (response_format), so that they never need an LLM restructuring call; backends without support fall back to text requests")
+    parser.add_argument("--llm_requests_per_min", type=int, default=0, help="requests per minute allowed by the LLM provider, shared by all threads; 0: no limit")
+    parser.add_argument("--llm_tokens_per_min", type=int, default=0, help="tokens per minute allowed by the LLM provider, shared by all threads; 0: no limit")
+    parser.add_argument("--llm_max_concurrency", type=int, default=64, help="upper bound of in-flight LLM requests; the real limit adapts (decreased when rate limited, slowly increased otherwise)")
+    parser.add_argument("--llm_max_attempts", type=int, default=0, help="an LLM loop (e.g., generation until the response can be parsed) gives up on its item after this number of failed attempts; 0: never give up")
+    parser.add_argument("--llm_max_retry_tokens", type=int, default=0, help="an LLM loop gives up on its item after its failed attempts have used this number of (estimated) tokens; 0: no limit")
+    parser.add_argument("--llm_stage_budgets", type=str, default="", help="retry budget for each stage, e.g., 'screening:5:0,self_evaluation:8:60000' (stage:max_attempts:max_tokens; 0: no limit); stages not listed use --llm_max_attempts and --llm_max_retry_tokens")
+    parser.add_argument("--llm_circuit_breaker_failures", type=int, default=0, help="after this number of failed requests in a row to a backend, requests to it fail fast (and their items give up) for --llm_circuit_breaker_cooldown_seconds; 0: no circuit breaker")
+    parser.add_argument("--llm_circuit_breaker_cooldown_seconds", type=float, default=60, help="how long the circuit of a failing backend stays open")
+    parser.add_argument("--llm_failure_ledger_path", type=str, default="", help="JSON lines file where the items that gave up are recorded (stage, background id, inspiration, mutation), so that they can be retried later; '': only print them")
+    parser.add_argument("--llm_telemetry", type=int, default=0, help="whether to record per-stage telemetry of the LLM calls (tokens, latency histogram, retries, failed attempts, cache hits, cost); it is printed and saved as a JSON summary beside --output_dir at the end of a run (not when the run is skipped since --output_dir already exists)")
+    parser.add_argument("--llm_model_prices", type=str, default="", help="prices used to estimate the cost in the telemetry, e.g., 'gpt-4o:2.5:10,gpt-4o-mini:0.15:0.6' (model:input_price:output_price, USD per million tokens); models not listed cost 0")
+    parser.add_argument("--llm_telemetry_prometheus_path", type=str, default="", help="file to write the telemetry in the Prometheus text format at the end (e.g., for the textfile collector of node_exporter); '': not written")
+    parser.add_argument("--llm_telemetry_port", type=int, default=0, help="serve the telemetry in the Prometheus text format at http://0.0.0.0:port/metrics while running; 0: not served")
+    parser.add_argument("--llm_traffic_path", type=str, default="", help="JSON lines file where every LLM request of the run is recorded (arrival time, stage, model, priority class, prompt / response sizes, latency, error), to be replayed against the mock server or an endpoint with Method/llm_traffic_replay.py (e.g., to find how many disciplines can run in parallel under a quota); appended to; '': not recorded")
+    parser.add_argument("--llm_traffic_prompts", type=str, default="hash", help="how the prompts are recorded in the traffic: 'hash' (replayed with synthetic prompts of the same size) / 'full'")
+    parser.add_argument("--if_async", type=int, default=0, help="whether to run with the asyncio engine (independent LLM requests are sent concurrently, bounded by --llm_max_concurrency and the rate limits); 0: the sequential version")
+
+
+## Function:
+#   add the arguments of the offline batch mode (Method.batch_llm) to parser; for the scripts with a batch entry point (evaluate.py, groundtruth_hyp_ranking.py)
+def add_llm_batch_args(parser):
+    parser.add_argument("--llm_batch_backend", type=str, default="", help="submit the LLM requests of the whole stage as one offline batch (higher throughput and lower cost, but the results can take hours); '': interactive requests; 'openai': OpenAI's batch API; 'local': a local stand-in that processes the batch file with interactive requests (for testing)")
+    parser.add_argument("--llm_batch_dir", type=str, default="./Checkpoints/llm_batches", help="where the batch files (and the outputs of the 'local' batch backend) are written")
+    parser.add_argument("--llm_batch_poll_seconds", type=float, default=60, help="how often the status of a submitted batch is checked")
+
+
+## Function:
+#   check the arguments added by add_llm_args()
+def check_llm_args(args):
+    assert args.if_async in [0, 1]
+    assert args.llm_single_flight in [0, 1]
+    assert args.llm_dispatcher in [0, 1]
+    assert args.llm_priority_class == "" or args.llm_priority_class in parse_llm_priority_classes(args.llm_priority_classes)
+    assert args.llm_prefix_warmup in [0, 1]
+    assert args.llm_structured_output in [0, 1]
+    assert args.llm_max_attempts >= 0 and args.llm_max_retry_tokens >= 0 and args.llm_circuit_breaker_failures >= 0
+    assert args.llm_telemetry in [0, 1]
+    assert args.llm_telemetry_port >= 0
+    assert args.llm_traffic_prompts in TRAFFIC_PROMPT_MODES
+
+
+## Function:
+#   check the arguments added by add_llm_batch_args() (with the ones of add_llm_args())
+def check_llm_batch_args(args):
+    assert args.llm_batch_backend in ["", "openai", "local"]
+    # the batch mode is a separate (sequential) entry point
+    assert args.if_async == 0 or args.llm_batch_backend == ""
+    # the openai batch API needs the files / batches endpoints of one backend, which the routed client does not have
+    assert args.llm_router_config == "" or args.llm_batch_backend != "openai"
+
+
+## Function:
+#   set up the LLM layer of the process from the arguments of add_llm_args(); every component is shared by the whole process
+#   the router is set up first, so the API client should be created after this (resolve_llm_client())
+## Input
+#   cascade_escalate_round: see Method.llm_cascade.setup_llm_cascade()
+def setup_llm_layer(args, cascade_escalate_round=DEFAULT_ESCALATE_ROUND):
+    ## Set router of the models to their backends (None: every request goes to args.base_url)
+    setup_llm_router(args.llm_router_config)
+    ## Set LLM response cache
+    setup_llm_cache(args.llm_cache_path, stage_modes_text=args.llm_cache_stage_modes, max_entries=args.llm_cache_max_entries, ttl_hours=args.llm_cache_ttl_hours)
+    ## Set coalescing of identical LLM requests in flight
+    setup_llm_single_flight(args.llm_single_flight == 1)
+    ## Set hedged requests of the slow temperature-0 calls
+    setup_llm_hedging(args.llm_hedge_stage_percentiles)
+    ## Set cascades of models of the stages: e.g., the restructuring calls start on a cheap model and escalate to a stronger one after each failed attempt
+    setup_llm_cascade(args.llm_cascades, escalate_round=cascade_escalate_round)
+    ## Set warm-up of the long prompt prefixes shared by many requests (for the provider's prompt cache)
+    setup_llm_prefix_warmup(args.llm_prefix_warmup == 1)
+    ## Set structured-output requests for structured generations
+    setup_llm_structured_output(args.llm_structured_output == 1)
+    ## Set rate limiter
+    setup_rate_limiter(requests_per_min=args.llm_requests_per_min, tokens_per_min=args.llm_tokens_per_min, max_concurrency=args.llm_max_concurrency)
+    ## Set dispatcher of the LLM requests over priority classes (the class of the requests of a pipeline is set by the pipeline)
+    setup_llm_dispatcher(args.llm_dispatcher == 1, priority_classes_text=args.llm_priority_classes, max_concurrency=args.llm_max_concurrency)
+    ## Set retry budgets of the LLM loops, circuit breakers of the backends, and the ledger of the items that gave up
+    setup_llm_retry_budgets(max_attempts=args.llm_max_attempts, max_tokens=args.llm_max_retry_tokens, stage_budgets_text=args.llm_stage_budgets)
+    setup_llm_circuit_breakers(failure_threshold=args.llm_circuit_breaker_failures, cooldown_seconds=args.llm_circuit_breaker_cooldown_seconds)
+    setup_llm_failure_ledger(args.llm_failure_ledger_path)
+    ## Set per-stage telemetry of the LLM calls (tokens, latency, retries, failed attempts, cache hits, cost)
+    setup_llm_telemetry(args.llm_telemetry == 1, prices_text=args.llm_model_prices, port=args.llm_telemetry_port)
+    ## Set recorder of the LLM traffic (the trace can be replayed by Method.llm_traffic_replay)
+    setup_llm_traffic_recorder(args.llm_traffic_path, prompt_mode=args.llm_traffic_prompts)
+    ## Set the number of LLM requests awaited at the same time by the asyncio entry points
+    set_llm_async_concurrency(args.llm_max_concurrency)
+
+
+## Function:
+#   print the stats of the components of the LLM layer that are enabled (at the end of a script; the telemetry is printed by save_llm_telemetry())
+def print_llm_stats():
+    if get_llm_cache() != None:
+        get_llm_cache().print_stats()
+    if get_llm_router() != None:
+        get_llm_router().print_stats()
+    if get_llm_single_flight() != None:
+        get_llm_single_flight().print_stats()
+    if get_llm_hedging() != None:
+        get_llm_hedging().print_stats()
+    if get_llm_cascade() != None:
+        get_llm_cascade().print_stats()
+    if get_llm_dispatcher() != None:
+        get_llm_dispatcher().print_stats()
+    if get_llm_prefix_warmup() != None:
+        get_llm_prefix_warmup().print_stats()
+    if get_llm_structured_output() != None:
+        get_llm_structured_output().print_stats()
+    if get_template_parser_stats().get_num_parsed() > 0:
+        get_template_parser_stats().print_stats()
+    if get_llm_traffic_recorder() != None:
+        get_llm_traffic_recorder().print_stats()
+    if get_llm_failure_ledger() != None:
+        get_llm_failure_ledger().print_stats()
@@ -0,0 +1,99 @@
+import threading
+from openai import OpenAI, AzureOpenAI, AsyncOpenAI, AsyncAzureOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient, DEFAULT_CONNECTION_LIMITS
+
+
+# api_version used by the azure client
+AZURE_API_VERSION = "2024-06-01"
+# default size of the keep-alive connection pool of each client; should be no smaller than the number of threads sharing the client
+DEFAULT_MAX_CONNECTIONS = 16
+
+# process-wide client registry: {(api_type, base_url, api_key, model_name, if_async): client}
+#   each client owns one keep-alive connection pool, so reusing the client avoids a new DNS lookup + TCP/TLS handshake for every request
+LLM_CLIENT_REGISTRY = {}
+# {(api_type, base_url, api_key, model_name, if_async): max_connections}
+LLM_CLIENT_POOL_SIZE = {}
+LLM_CLIENT_REGISTRY_LOCK = threading.Lock()
+
+
+## Function:
+#   build a new API client with a keep-alive connection pool of size max_connections
+## Input
+#   api_type: 0: openai's API toolkit; 1: azure's API toolkit
+#   if_async: whether to build an asyncio client (AsyncOpenAI / AsyncAzureOpenAI), used by the async LLM functions in utils.py
+def build_llm_client(api_type, api_key, base_url, max_connections=DEFAULT_MAX_CONNECTIONS, if_async=False):
+    assert max_connections >= 1
+    # keep every connection alive, so that threads sharing the client never need to open a new connection; the limits class is the one of the HTTP library used by the openai SDK
+    limits = type(DEFAULT_CONNECTION_LIMITS)(max_connections=max_connections, max_keepalive_connections=max_connections, keepalive_expiry=DEFAULT_CONNECTION_LIMITS.keepalive_expiry)
+    if if_async:
+        http_client = DefaultAsyncHttpxClient(limits=limits)
+        openai_class, azure_class = AsyncOpenAI, AsyncAzureOpenAI
+    else:
+        http_client = DefaultHttpxClient(limits=limits)
+        openai_class, azure_class = OpenAI, AzureOpenAI
+    # openai client
+    if api_type == 0:
+        client = openai_class(api_key=api_key, base_url=base_url, http_client=http_client)
+    # azure client
+    elif api_type == 1:
+        client = azure_class(
+            azure_endpoint = base_url,
+            api_key=api_key,
+            api_version=AZURE_API_VERSION,
+            http_client=http_client
+        )
+    else:
+        raise NotImplementedError
+    return client
+
+
+## Function:
+#   get the API client shared by the whole process for (base_url, api_key, model_name); the client is only built at the first call
+## Input
+#   api_type: 0: openai's API toolkit; 1: azure's API toolkit
+#   model_name: clients are also separated by model, so that each model has its own connection pool
+#   max_connections: size of the keep-alive connection pool; only used when the client is built (the first call with the same key); None: DEFAULT_MAX_CONNECTIONS
+#   if_async: whether to get the asyncio client; an asyncio client should only be used inside one event loop (e.g., one asyncio.run())
+## Output
+#   client: OpenAI or AzureOpenAI client (AsyncOpenAI or AsyncAzureOpenAI client if if_async)
+def get_llm_client(api_type, api_key, base_url, model_name=None, max_connections=None, if_async=False):
+    key = (api_type, base_url, api_key, model_name, if_async)
+    with LLM_CLIENT_REGISTRY_LOCK:
+        if key not in LLM_CLIENT_REGISTRY:
+            if max_connections == None:
+                max_connections = DEFAULT_MAX_CONNECTIONS
+            LLM_CLIENT_REGISTRY[key] = build_llm_client(api_type, api_key, base_url, max_connections=max_connections, if_async=if_async)
+            LLM_CLIENT_POOL_SIZE[key] = max_connections
+        elif max_connections != None and max_connections > LLM_CLIENT_POOL_SIZE[key]:
+            print("Warning: the shared client for {} (model: {}) already has a connection pool of size {}; requested size {} is ignored.".format(base_url, model_name, LLM_CLIENT_POOL_SIZE[key], max_connections))
+        client = LLM_CLIENT_REGISTRY[key]
+    return client
+
+
+## Function:
+#   name of the backend that a client sends requests to (used to share one circuit breaker per backend; see Method.rate_limiter); None for the clients of Method.llm_router, whose circuit breakers are per backend inside the router
+def get_llm_backend_name(client):
+    if getattr(client, "if_routed", False):
+        return None
+    return str(getattr(client, "base_url", ""))
+
+
+## Function:
+#   close all the shared (sync) clients (and their connection pools), e.g., at the end of a run; asyncio clients are closed with aclose_llm_clients()
+def close_llm_clients():
+    with LLM_CLIENT_REGISTRY_LOCK:
+        sync_keys = [key for key in LLM_CLIENT_REGISTRY if not key[4]]
+        for key in sync_keys:
+            LLM_CLIENT_REGISTRY.pop(key).close()
+            LLM_CLIENT_POOL_SIZE.pop(key)
+
+
+## Function:
+#   close all the shared asyncio clients; should be awaited inside the event loop that used them
+async def aclose_llm_clients():
+    with LLM_CLIENT_REGISTRY_LOCK:
+        async_keys = [key for key in LLM_CLIENT_REGISTRY if key[4]]
+        async_clients = [LLM_CLIENT_REGISTRY.pop(key) for key in async_keys]
+        for key in async_keys:
+            LLM_CLIENT_POOL_SIZE.pop(key)
+    for cur_client in async_clients:
+        await cur_client.close()
@@ -0,0 +1,222 @@
+import time, asyncio, threading, contextvars, collections
+
+
+# Central dispatcher of the LLM requests of the process: every request attempt (Method.rate_limiter.call_llm_with_retry()) waits for a slot here before it goes to the rate limiter
+#   each request belongs to a priority class (e.g., 'interactive' for the runs with a custom research question, 'batch' for back-fills like GroundTruth_Hyp_Ranking.looping()); free slots are given by weighted fair queuing over the classes, so that a class with weight w gets about w / (sum of the weights of the waiting classes) of the slots, and a class alone can use all of them
+#   a class can also have its own concurrency limit, so that a bulk job never holds all the slots when interactive requests arrive
+
+
+# "class:weight:max_concurrency,..."; max_concurrency 0: no limit other than the dispatcher's
+DEFAULT_LLM_PRIORITY_CLASSES = "interactive:8:0,default:4:0,batch:1:0"
+
+# the priority class of the LLM requests sent from the current context (thread / asyncio task); None: the default class of the dispatcher
+LLM_PRIORITY_CLASS = contextvars.ContextVar("llm_priority_class", default=None)
+
+
+## Function:
+#   set the priority class of the LLM requests sent from now on in the current context (the current thread, or the current asyncio task and the tasks it creates); e.g., at the beginning of the entry points of a pipeline
+def set_llm_priority_class(priority_class):
+    LLM_PRIORITY_CLASS.set(priority_class)
+
+
+def get_llm_priority_class():
+    return LLM_PRIORITY_CLASS.get()
+
+
+## Input
+#   priority_classes_text: "class0:weight0:max_concurrency0,..."; e.g., DEFAULT_LLM_PRIORITY_CLASSES
+## Output
+#   priority_classes: {class0: [weight0, max_concurrency0], ...}
+def parse_llm_priority_classes(priority_classes_text):
+    priority_classes = {}
+    for cur_item in priority_classes_text.split(","):
+        cur_item = cur_item.strip()
+        if cur_item == "":
+            continue
+        cur_item_split = cur_item.split(":")
+        assert len(cur_item_split) == 3, print("cur_item: ", cur_item)
+        cur_class, cur_weight, cur_max_concurrency = cur_item_split[0].strip(), float(cur_item_split[1]), int(cur_item_split[2])
+        assert cur_weight > 0 and cur_max_concurrency >= 0, print("cur_item: ", cur_item)
+        priority_classes[cur_class] = [cur_weight, cur_max_concurrency]
+    return priority_classes
+
+
+# one request waiting for (or holding) a slot of the dispatcher
+class LLMDispatchTicket(object):
+    ## Input
+    #   waiter: None (a thread waiting on the condition of the dispatcher) or [event loop, asyncio.Event] of a waiting coroutine, set when the ticket is granted
+    def __init__(self, priority_class, tag, waiter=None):
+        self.priority_class = priority_class
+        # virtual finish tag of weighted fair queuing: the waiting ticket with the smallest tag is served first
+        self.tag = tag
+        self.enqueue_time = time.monotonic()
+        self.if_granted = False
+        self.waiter = waiter
+
+
+# stats of one priority class
+class LLMPriorityClassStats(object):
+    def __init__(self):
+        self.num_requests = 0
+        self.num_waiting = 0
+        self.num_running = 0
+        self.max_queue_depth = 0
+        self.wait_seconds_sum = 0.0
+        self.wait_seconds_max = 0.0
+
+    def to_dict(self):
+        return {"num_requests": self.num_requests, "queue_depth": self.num_waiting, "num_running": self.num_running, "max_queue_depth": self.max_queue_depth, "wait_seconds_sum": self.wait_seconds_sum, "wait_seconds_max": self.wait_seconds_max, "wait_seconds_mean": self.wait_seconds_sum / self.num_requests if self.num_requests > 0 else 0.0}
+
+
+class LLMDispatcher(object):
+    ## Input
+    #   priority_classes: {class: [weight, max_concurrency]}; see parse_llm_priority_classes()
+    #   max_concurrency: number of requests of all the classes that can be sent at the same time
+    #   default_class: the class of the requests sent from a context without a priority class (see set_llm_priority_class())
+    def __init__(self, priority_classes, max_concurrency, default_class="default"):
+        assert max_concurrency >= 1
+        assert default_class in priority_classes, print("default_class: ", default_class)
+        self.priority_classes = priority_classes
+        self.max_concurrency = max_concurrency
+        self.default_class = default_class
+        self.num_running = 0
+        # {class: deque of the waiting tickets (in the order of their tags)}
+        self.queues = {cur_class: collections.deque() for cur_class in priority_classes}
+        # weighted fair queuing: the virtual time is the tag of the last served ticket, and each class remembers the tag of its last ticket
+        self.virtual_time = 0.0
+        self.last_tags = {cur_class: 0.0 for cur_class in priority_classes}
+        self.stats = {cur_class: LLMPriorityClassStats() for cur_class in priority_classes}
+        self.condition = threading.Condition()
+
+    def get_priority_class(self):
+        priority_class = get_llm_priority_class()
+        if priority_class == None:
+            return self.default_class
+        assert priority_class in self.priority_classes, print("priority_class: ", priority_class)
+        return priority_class
+
+    def enqueue(self, waiter=None):
+        priority_class = self.get_priority_class()
+        with self.condition:
+            tag = max(self.virtual_time, self.last_tags[priority_class]) + 1.0 / self.priority_classes[priority_class][0]
+            self.last_tags[priority_class] = tag
+            ticket = LLMDispatchTicket(priority_class, tag, waiter=waiter)
+            self.queues[priority_class].append(ticket)
+            cur_stats = self.stats[priority_class]
+            cur_stats.num_requests += 1
+            cur_stats.num_waiting += 1
+            cur_stats.max_queue_depth = max(cur_stats.max_queue_depth, cur_stats.num_waiting)
+            self.schedule()
+        return ticket
+
+    ## Function:
+    #   give the free slots to the waiting tickets with the smallest tags, skipping the classes at their concurrency limit; should be called with self.condition held
+    def schedule(self):
+        if_granted = False
+        while self.num_running < self.max_concurrency:
+            next_ticket = None
+            for cur_class, cur_queue in self.queues.items():
+                if len(cur_queue) == 0:
+                    continue
+                cur_max_concurrency = self.priority_classes[cur_class][1]
+                if cur_max_concurrency > 0 and self.stats[cur_class].num_running >= cur_max_concurrency:
+                    continue
+                if next_ticket == None or cur_queue[0].tag < next_ticket.tag:
+                    next_ticket = cur_queue[0]
+            if next_ticket == None:
+                break
+            self.queues[next_ticket.priority_class].popleft()
+            next_ticket.if_granted = True
+            if next_ticket.waiter != None:
+                # the release can come from another thread (or event loop) than the waiting coroutine
+                next_ticket.waiter[0].call_soon_threadsafe(next_ticket.waiter[1].set)
+            self.virtual_time = max(self.virtual_time, next_ticket.tag)
+            self.num_running += 1
+            cur_stats = self.stats[next_ticket.priority_class]
+            cur_stats.num_waiting -= 1
+            cur_stats.num_running += 1
+            wait_seconds = time.monotonic() - next_ticket.enqueue_time
+            cur_stats.wait_seconds_sum += wait_seconds
+            cur_stats.wait_seconds_max = max(cur_stats.wait_seconds_max, wait_seconds)
+            if_granted = True
+        if if_granted:
+            self.condition.notify_all()
+
+    ## Function:
+    #   wait for a slot for one request of the priority class of the current context
+    ## Output
+    #   ticket: to be given back with release()
+    def acquire(self):
+        ticket = self.enqueue()
+        with self.condition:
+            while not ticket.if_granted:
+                self.condition.wait()
+        return ticket
+
+    ## Function:
+    #   the same as acquire(), but waits on an asyncio.Event set by schedule() when the ticket is granted, so that the event loop is never blocked; the ticket is dropped if the waiting coroutine is cancelled
+    async def aacquire(self):
+        # the waiter is given to enqueue(), since the ticket can be granted by another thread as soon as it is queued
+        waiter = [asyncio.get_running_loop(), asyncio.Event()]
+        ticket = self.enqueue(waiter=waiter)
+        try:
+            if not ticket.if_granted:
+                await waiter[1].wait()
+        except BaseException:
+            self.cancel(ticket)
+            raise
+        return ticket
+
+    def cancel(self, ticket):
+        with self.condition:
+            if ticket.if_granted:
+                self.release(ticket)
+                return
+            self.queues[ticket.priority_class].remove(ticket)
+            self.stats[ticket.priority_class].num_waiting -= 1
+
+    def release(self, ticket):
+        with self.condition:
+            self.num_running -= 1
+            self.stats[ticket.priority_class].num_running -= 1
+            self.schedule()
+
+    ## Output
+    #   stats: {class: {...}, ...}; see LLMPriorityClassStats.to_dict()
+    def get_stats(self):
+        with self.condition:
+            return {cur_class: self.stats[cur_class].to_dict() for cur_class in self.priority_classes}
+
+    def print_stats(self):
+        stats = self.get_stats()
+        for cur_class in stats:
+            cur_stats = stats[cur_class]
+            print("LLM dispatcher; priority class: {}; requests: {}; mean wait: {:.2f}s; max wait: {:.2f}s; max queue depth: {}".format(cur_class, cur_stats["num_requests"], cur_stats["wait_seconds_mean"], cur_stats["wait_seconds_max"], cur_stats["max_queue_depth"]))
+
+
+# None: the requests are only limited by the rate limiter
+LLM_DISPATCHER = None
+
+
+def get_llm_dispatcher():
+    return LLM_DISPATCHER
+
+
+def set_llm_dispatcher(llm_dispatcher):
+    global LLM_DISPATCHER
+    LLM_DISPATCHER = llm_dispatcher
+
+
+## Function:
+#   enable or disable the dispatcher of the whole process; the existing dispatcher (with its queues) is kept when the config does not change
+## Input
+#   priority_classes_text: see parse_llm_priority_classes()
+def setup_llm_dispatcher(if_dispatcher=True, priority_classes_text=DEFAULT_LLM_PRIORITY_CLASSES, max_concurrency=64, default_class="default"):
+    if not if_dispatcher:
+        set_llm_dispatcher(None)
+        return None
+    priority_classes = parse_llm_priority_classes(priority_classes_text)
+    llm_dispatcher = get_llm_dispatcher()
+    if llm_dispatcher == None or (llm_dispatcher.priority_classes, llm_dispatcher.max_concurrency, llm_dispatcher.default_class) != (priority_classes, max_concurrency, default_class):
+        set_llm_dispatcher(LLMDispatcher(priority_classes, max_concurrency, default_class=default_class))
+    return get_llm_dispatcher()
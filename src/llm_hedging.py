@@ -0,0 +1,188 @@
+import math, time, asyncio, threading, contextvars, collections
+import concurrent.futures
+from Method.llm_telemetry import get_llm_telemetry
+
+
+# Hedged LLM requests: every stage is a barrier (e.g., a screening round waits for all its windows), so the slowest call sets the pace; when a call of a hedged stage is still not finished after the given latency percentile of the stage, a duplicate call is sent and the first successful response is used
+#   only idempotent calls (temperature 0) are hedged by the callers (see call_llm_with_hedging() in Method.utils)
+#   asyncio calls: the losing call is cancelled; sync calls: a running request can not be interrupted, so the losing call finishes in the background and its response is dropped
+
+
+# number of the latest latencies of each stage used to compute its percentile
+HEDGE_LATENCY_WINDOW = 200
+# a stage is only hedged after this number of latencies are observed
+HEDGE_MIN_SAMPLES = 20
+# a duplicate call is never sent earlier than this (seconds), so that fast stages are not hedged for noise
+HEDGE_MIN_DELAY_SECONDS = 1.0
+# threads running the hedged sync calls
+HEDGE_MAX_THREADS = 256
+
+
+## Input
+#   stage_percentiles_text: "stage0:percentile0,..."; e.g., "screening:95,self_evaluation:90"; "*": the percentile of the stages not listed
+## Output
+#   stage_percentiles: {stage0: percentile0, ...}
+def parse_llm_hedge_stage_percentiles(stage_percentiles_text):
+    stage_percentiles = {}
+    for cur_item in stage_percentiles_text.split(","):
+        cur_item = cur_item.strip()
+        if cur_item == "":
+            continue
+        assert len(cur_item.split(":")) == 2, print("cur_item: ", cur_item)
+        cur_stage, cur_percentile = [item.strip() for item in cur_item.split(":")]
+        cur_percentile = float(cur_percentile)
+        assert cur_percentile > 0 and cur_percentile < 100, print("cur_item: ", cur_item)
+        stage_percentiles[cur_stage] = cur_percentile
+    return stage_percentiles
+
+
+class LLMHedging(object):
+    ## Input
+    #   stage_percentiles: {stage: latency percentile after which a duplicate call is sent}; see parse_llm_hedge_stage_percentiles()
+    def __init__(self, stage_percentiles, min_samples=HEDGE_MIN_SAMPLES, min_delay_seconds=HEDGE_MIN_DELAY_SECONDS):
+        self.stage_percentiles = stage_percentiles
+        self.min_samples = min_samples
+        self.min_delay_seconds = min_delay_seconds
+        # {stage: deque of the latest latencies (seconds) of the first call of each request}
+        self.latencies = {}
+        # stats: {stage: {'calls': int, 'hedged': int, 'hedge_won': int}, ...}
+        self.stats = {}
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_percentile(self, stage):
+        if stage in self.stage_percentiles:
+            return self.stage_percentiles[stage]
+        return self.stage_percentiles.get("*")
+
+    def update_stats(self, stage, item):
+        if stage not in self.stats:
+            self.stats[stage] = {'calls': 0, 'hedged': 0, 'hedge_won': 0}
+        self.stats[stage][item] += 1
+
+    def record_latency(self, stage, latency):
+        with self.lock:
+            if stage not in self.latencies:
+                self.latencies[stage] = collections.deque(maxlen=HEDGE_LATENCY_WINDOW)
+            self.latencies[stage].append(latency)
+
+    ## Output
+    #   delay: seconds after which a duplicate call is sent; None: the stage is not hedged (yet)
+    def get_hedge_delay(self, stage):
+        percentile = self.get_percentile(stage)
+        if percentile == None:
+            return None
+        with self.lock:
+            self.update_stats(stage, 'calls')
+            latencies = sorted(self.latencies.get(stage, []))
+        if len(latencies) < self.min_samples:
+            return None
+        return max(self.min_delay_seconds, latencies[max(0, math.ceil(percentile / 100 * len(latencies)) - 1)])
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor == None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=HEDGE_MAX_THREADS, thread_name_prefix="llm_hedge")
+            return self.executor
+
+    def record_hedge(self, stage, model_name, prompt_tokens, if_hedge_won):
+        with self.lock:
+            self.update_stats(stage, 'hedged')
+            if if_hedge_won:
+                self.update_stats(stage, 'hedge_won')
+        if get_llm_telemetry() != None:
+            get_llm_telemetry().record_hedge(stage, model_name, prompt_tokens, if_hedge_won)
+
+    ## Function:
+    #   call call_fn(), and send a duplicate call_fn() if the first one is not finished after the hedge delay of the stage; the first successful result is returned (the error of the first call is raised if both fail)
+    ## Input
+    #   call_fn: function without input that sends the request (with its own retries) and returns the result
+    #   prompt_tokens: (estimated) prompt tokens of one call, recorded in the telemetry as the extra spend of a duplicate call
+    def call(self, call_fn, stage=None, model_name=None, prompt_tokens=0):
+        delay = self.get_hedge_delay(stage)
+        start_time = time.monotonic()
+        if delay == None:
+            result = call_fn()
+            self.record_latency(stage, time.monotonic() - start_time)
+            return result
+        executor = self.get_executor()
+        # the calls run in the context of the caller (e.g., its priority class; see Method.llm_dispatcher)
+        first_call = executor.submit(contextvars.copy_context().run, call_fn)
+        # the latency of the first call is recorded even if the duplicate one wins, so that the percentile is not biased by hedging
+        first_call.add_done_callback(lambda future: self.record_latency(stage, time.monotonic() - start_time))
+        done, pending = concurrent.futures.wait([first_call], timeout=delay)
+        if first_call in done:
+            return first_call.result()
+        hedge_call = executor.submit(contextvars.copy_context().run, call_fn)
+        pending = set([first_call, hedge_call])
+        while len(pending) > 0:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for cur_call in done:
+                if cur_call.exception() == None:
+                    self.record_hedge(stage, model_name, prompt_tokens, cur_call is hedge_call)
+                    return cur_call.result()
+        self.record_hedge(stage, model_name, prompt_tokens, False)
+        return first_call.result()
+
+    ## Function:
+    #   async version of call(); call_fn() returns an awaitable; the losing call is cancelled
+    async def acall(self, call_fn, stage=None, model_name=None, prompt_tokens=0):
+        delay = self.get_hedge_delay(stage)
+        start_time = time.monotonic()
+        if delay == None:
+            result = await call_fn()
+            self.record_latency(stage, time.monotonic() - start_time)
+            return result
+        first_call = asyncio.ensure_future(call_fn())
+        calls = [first_call]
+        try:
+            done, pending = await asyncio.wait([first_call], timeout=delay)
+            if first_call in done:
+                self.record_latency(stage, time.monotonic() - start_time)
+                return first_call.result()
+            hedge_call = asyncio.ensure_future(call_fn())
+            calls.append(hedge_call)
+            pending = set(calls)
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for cur_call in done:
+                    if cur_call.exception() == None:
+                        # the latency of a cancelled first call is only known to be at least the time until now
+                        self.record_latency(stage, time.monotonic() - start_time)
+                        self.record_hedge(stage, model_name, prompt_tokens, cur_call is hedge_call)
+                        return cur_call.result()
+            self.record_hedge(stage, model_name, prompt_tokens, False)
+            return first_call.result()
+        finally:
+            for cur_call in calls:
+                if not cur_call.done():
+                    cur_call.cancel()
+
+    def print_stats(self):
+        for cur_stage in self.stats:
+            cur_stats = self.stats[cur_stage]
+            print("LLM hedging; stage: {}; calls: {}; hedged: {}; won by the duplicate call: {}".format(cur_stage, cur_stats['calls'], cur_stats['hedged'], cur_stats['hedge_won']))
+
+
+# None: no hedged requests
+LLM_HEDGING = None
+
+
+def get_llm_hedging():
+    return LLM_HEDGING
+
+
+def set_llm_hedging(llm_hedging):
+    global LLM_HEDGING
+    LLM_HEDGING = llm_hedging
+
+
+## Function:
+#   set the hedging of the whole process ("": no hedging); the existing state (latencies and stats) is kept when the percentiles do not change
+def setup_llm_hedging(stage_percentiles_text=""):
+    stage_percentiles = parse_llm_hedge_stage_percentiles(stage_percentiles_text)
+    if len(stage_percentiles) == 0:
+        set_llm_hedging(None)
+    elif get_llm_hedging() == None or get_llm_hedging().stage_percentiles != stage_percentiles:
+        set_llm_hedging(LLMHedging(stage_percentiles))
+    return get_llm_hedging()
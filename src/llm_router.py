@@ -0,0 +1,282 @@
+import os, json, asyncio, threading
+from Method.llm_client import get_llm_client, get_llm_backend_name, DEFAULT_MAX_CONNECTIONS
+from Method.rate_limiter import RateLimiter, LLMFatalError, LLMCircuitOpenError, classify_llm_error, is_rate_limit_error, get_used_tokens, get_llm_circuit_breaker, estimate_num_tokens
+
+
+# Route the requests of each model to one or more backends (endpoint + key), so that one run (e.g., a multi-model benchmark sweep) can use the quotas of all of them at once
+#   each backend has its own concurrency cap and rate limits; a request goes to the backend of its model with the least outstanding requests (relative to its concurrency cap), and fails over to the next one on a retryable error
+# config file (JSON):
+#   {"backends": {"openai_a": {"base_url": "https://...", "api_key": "..." (or "api_key_env": "OPENAI_API_KEY_A"), "api_type": 0, "max_concurrency": 16, "requests_per_min": 0, "tokens_per_min": 0}, ...},
+#    "models": {"gpt4": ["openai_a", "openai_b"], "claude35S": [{"backend": "proxy", "model": "claude-3-5-sonnet-20240620"}], "*": ["proxy"]}}
+#   models: {model name used in the pipeline: [backend name, or {"backend": backend name, "model": model name sent to the backend}, ...]}; "*": backends of the models not listed (e.g., the restructuring model)
+
+
+# one endpoint + key of the router, with its own concurrency cap and rate limits
+class LLMRouterBackend(object):
+    ## Input
+    #   api_type: 0: openai's API toolkit; 1: azure's API toolkit
+    #   requests_per_min / tokens_per_min: 0: no limit
+    def __init__(self, name, api_type, base_url, api_key, max_concurrency=DEFAULT_MAX_CONNECTIONS, requests_per_min=0, tokens_per_min=0):
+        assert api_type in [0, 1]
+        assert max_concurrency >= 1
+        self.name = name
+        self.api_type = api_type
+        self.base_url = base_url
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        # adaptive (AIMD) concurrency limit of the backend, together with its requests/min and tokens/min
+        self.rate_limiter = RateLimiter(requests_per_min=requests_per_min, tokens_per_min=tokens_per_min, max_concurrency=max_concurrency)
+        # requests picked for this backend and not finished yet (including the ones waiting for its rate limiter)
+        self.num_outstanding = 0
+        # stats: requests finished; requests failed; requests failed here and sent to another backend
+        self.num_requests = 0
+        self.num_failures = 0
+        self.num_failovers = 0
+
+    def get_client(self, model_name, if_async=False):
+        return get_llm_client(self.api_type, self.api_key, self.base_url, model_name=model_name, max_connections=self.max_concurrency, if_async=if_async)
+
+    def get_load(self):
+        return self.num_outstanding / self.max_concurrency
+
+
+class LLMRouter(object):
+    ## Input
+    #   backends: {backend_name: LLMRouterBackend}
+    #   model_routes: {model_name: [[backend_name, model name sent to the backend], ...]}; "*": routes of the models not listed
+    #   config_path: the config file the router is loaded from (if any)
+    def __init__(self, backends, model_routes, config_path=""):
+        for cur_model_name in model_routes:
+            assert len(model_routes[cur_model_name]) > 0, print("no backend for model: ", cur_model_name)
+            for cur_backend_name, cur_provider_model_name in model_routes[cur_model_name]:
+                assert cur_backend_name in backends, print("unknown backend: ", cur_backend_name)
+        self.backends = backends
+        self.model_routes = model_routes
+        self.config_path = config_path
+        self.lock = threading.Lock()
+
+    def if_routed(self, model_name):
+        return model_name in self.model_routes or "*" in self.model_routes
+
+    def get_routes(self, model_name):
+        if model_name in self.model_routes:
+            return self.model_routes[model_name]
+        if "*" in self.model_routes:
+            return [[cur_backend_name, model_name if cur_provider_model_name == "*" else cur_provider_model_name] for cur_backend_name, cur_provider_model_name in self.model_routes["*"]]
+        raise LLMFatalError("model {} is not routed to any backend".format(model_name))
+
+    ## Function:
+    #   pick the backend of model_name with the least outstanding requests (relative to its concurrency cap; ties: the first one in the config), skipping the backends in excluded_backends and the ones with an open circuit
+    ## Output
+    #   [backend, model name sent to the backend]; None if no backend is left
+    ## Raise
+    #   LLMCircuitOpenError: the circuits of all the backends left are open
+    def acquire_route(self, model_name, excluded_backends):
+        circuit_open_error = None
+        with self.lock:
+            candidates = []
+            for cur_route_id, (cur_backend_name, cur_provider_model_name) in enumerate(self.get_routes(model_name)):
+                if cur_backend_name in excluded_backends:
+                    continue
+                cur_backend = self.backends[cur_backend_name]
+                circuit_breaker = get_llm_circuit_breaker(get_llm_backend_name(cur_backend.get_client(cur_provider_model_name)))
+                if circuit_breaker != None:
+                    try:
+                        circuit_breaker.before_request()
+                    except LLMCircuitOpenError as e:
+                        circuit_open_error = e
+                        continue
+                candidates.append([cur_backend.get_load(), cur_route_id, cur_backend, cur_provider_model_name])
+            if len(candidates) == 0:
+                if circuit_open_error != None:
+                    raise circuit_open_error
+                return None
+            cur_load, cur_route_id, backend, provider_model_name = min(candidates, key=lambda x: (x[0], x[1]))
+            backend.num_outstanding += 1
+        return [backend, provider_model_name]
+
+    ## Input
+    #   error: None if the request succeeded
+    #   if_failover: whether the request is sent to another backend after this failure
+    def release_route(self, backend, provider_model_name, error=None, if_failover=False):
+        circuit_breaker = get_llm_circuit_breaker(get_llm_backend_name(backend.get_client(provider_model_name)))
+        with self.lock:
+            backend.num_outstanding -= 1
+            backend.num_requests += 1
+            if error != None:
+                backend.num_failures += 1
+            if if_failover:
+                backend.num_failovers += 1
+        if circuit_breaker != None:
+            if error == None:
+                circuit_breaker.record_success()
+            elif classify_llm_error(error) == "retryable" and not is_rate_limit_error(error):
+                circuit_breaker.record_failure()
+
+    def print_stats(self):
+        for cur_backend_name in self.backends:
+            cur_backend = self.backends[cur_backend_name]
+            print("LLM router; backend: {}; requests: {}; failures: {}; failovers: {}".format(cur_backend_name, cur_backend.num_requests, cur_backend.num_failures, cur_backend.num_failovers))
+
+
+## Function:
+#   load the router from its config file (see the top of this file)
+def load_llm_router(config_path):
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+    backends = {}
+    for cur_backend_name, cur_backend_config in config["backends"].items():
+        if "api_key_env" in cur_backend_config:
+            api_key = os.environ[cur_backend_config["api_key_env"]]
+        else:
+            api_key = cur_backend_config["api_key"]
+        backends[cur_backend_name] = LLMRouterBackend(cur_backend_name, cur_backend_config.get("api_type", 0), cur_backend_config["base_url"], api_key, max_concurrency=cur_backend_config.get("max_concurrency", DEFAULT_MAX_CONNECTIONS), requests_per_min=cur_backend_config.get("requests_per_min", 0), tokens_per_min=cur_backend_config.get("tokens_per_min", 0))
+    model_routes = {}
+    for cur_model_name, cur_routes in config["models"].items():
+        # a route is a backend name (the model name is sent as it is) or {"backend": backend name, "model": model name sent to the backend}
+        model_routes[cur_model_name] = [[cur_route, cur_model_name] if isinstance(cur_route, str) else [cur_route["backend"], cur_route.get("model", cur_model_name)] for cur_route in cur_routes]
+    return LLMRouter(backends, model_routes, config_path=config_path)
+
+
+# a stream of a routed request: the request is outstanding on its backend until the stream is closed
+class RoutedLLMStream(object):
+    def __init__(self, stream, release_fn):
+        self.stream = stream
+        self.release_fn = release_fn
+
+    def __iter__(self):
+        return iter(self.stream)
+
+    def __aiter__(self):
+        return self.stream.__aiter__()
+
+    def release(self):
+        if self.release_fn != None:
+            self.release_fn()
+            self.release_fn = None
+
+    def close(self):
+        try:
+            return self.stream.close()
+        finally:
+            self.release()
+
+
+class RoutedChatCompletions(object):
+    def __init__(self, router, if_async):
+        self.router = router
+        self.if_async = if_async
+
+    def create(self, model, messages, stream=False, **request_kwargs):
+        if self.if_async:
+            return self.acreate(model, messages, stream=stream, **request_kwargs)
+        estimated_tokens = estimate_num_tokens(json.dumps(messages, ensure_ascii=False))
+        tried_backends = []
+        last_error = None
+        while True:
+            route = self.router.acquire_route(model, tried_backends)
+            if route == None:
+                raise last_error
+            backend, provider_model_name = route
+            backend.rate_limiter.acquire(estimated_tokens)
+            try:
+                completion = backend.get_client(provider_model_name).chat.completions.create(model=provider_model_name, messages=messages, stream=stream, **request_kwargs)
+            except Exception as e:
+                backend.rate_limiter.release(estimated_tokens, if_rate_limited=is_rate_limit_error(e))
+                if_failover = classify_llm_error(e) == "retryable"
+                self.router.release_route(backend, provider_model_name, error=e, if_failover=if_failover)
+                if not if_failover:
+                    raise
+                print("LLM router: backend {} failed ({}); fail over to the next backend of {}".format(backend.name, e, model))
+                tried_backends.append(backend.name)
+                last_error = e
+                continue
+            return self.finish_request(backend, provider_model_name, estimated_tokens, completion, stream)
+
+    async def acreate(self, model, messages, stream=False, **request_kwargs):
+        estimated_tokens = estimate_num_tokens(json.dumps(messages, ensure_ascii=False))
+        tried_backends = []
+        last_error = None
+        while True:
+            route = self.router.acquire_route(model, tried_backends)
+            if route == None:
+                raise last_error
+            backend, provider_model_name = route
+            try:
+                await backend.rate_limiter.aacquire(estimated_tokens)
+            except asyncio.CancelledError:
+                self.router.release_route(backend, provider_model_name)
+                raise
+            try:
+                completion = await backend.get_client(provider_model_name, if_async=True).chat.completions.create(model=provider_model_name, messages=messages, stream=stream, **request_kwargs)
+            except asyncio.CancelledError:
+                backend.rate_limiter.release(estimated_tokens)
+                self.router.release_route(backend, provider_model_name)
+                raise
+            except Exception as e:
+                backend.rate_limiter.release(estimated_tokens, if_rate_limited=is_rate_limit_error(e))
+                if_failover = classify_llm_error(e) == "retryable"
+                self.router.release_route(backend, provider_model_name, error=e, if_failover=if_failover)
+                if not if_failover:
+                    raise
+                print("LLM router: backend {} failed ({}); fail over to the next backend of {}".format(backend.name, e, model))
+                tried_backends.append(backend.name)
+                last_error = e
+                continue
+            return self.finish_request(backend, provider_model_name, estimated_tokens, completion, stream)
+
+    def finish_request(self, backend, provider_model_name, estimated_tokens, completion, stream):
+        def release_fn():
+            backend.rate_limiter.release(estimated_tokens, used_tokens=None if stream else get_used_tokens(completion))
+            self.router.release_route(backend, provider_model_name)
+        if stream:
+            return RoutedLLMStream(completion, release_fn)
+        release_fn()
+        return completion
+
+
+class RoutedChat(object):
+    def __init__(self, router, if_async):
+        self.completions = RoutedChatCompletions(router, if_async)
+
+
+# a client with the chat.completions.create() interface of OpenAI's client, whose requests are routed by their model (if_async: the same interface as AsyncOpenAI)
+class RoutedLLMClient(object):
+    def __init__(self, router, if_async=False):
+        self.router = router
+        self.if_async = if_async
+        self.chat = RoutedChat(router, if_async)
+        # the circuit breakers are per backend inside the router
+        self.if_routed = True
+
+
+# None: every run is pinned to its own --base_url / --api_key
+LLM_ROUTER = None
+
+
+def get_llm_router():
+    return LLM_ROUTER
+
+
+def set_llm_router(llm_router):
+    global LLM_ROUTER
+    LLM_ROUTER = llm_router
+
+
+## Function:
+#   load the router of the whole process from config_path ("": no router); the router is kept when it is already loaded from the same file, so that its state is kept
+def setup_llm_router(config_path=""):
+    if config_path == "":
+        set_llm_router(None)
+    elif get_llm_router() == None or get_llm_router().config_path != config_path:
+        set_llm_router(load_llm_router(config_path))
+    return get_llm_router()
+
+
+## Function:
+#   the client of model_name: the routed client when the router is set up and routes model_name, otherwise get_llm_client() (the same input)
+def resolve_llm_client(api_type, api_key, base_url, model_name=None, max_connections=None, if_async=False):
+    llm_router = get_llm_router()
+    if llm_router != None and llm_router.if_routed(model_name):
+        return RoutedLLMClient(llm_router, if_async=if_async)
+    return get_llm_client(api_type, api_key, base_url, model_name=model_name, max_connections=max_connections, if_async=if_async)
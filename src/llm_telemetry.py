@@ -0,0 +1,275 @@
+import os, json, time, threading
+import http.server
+from Method.llm_dispatcher import get_llm_dispatcher
+
+
+# upper bounds (seconds) of the buckets of the latency histograms (the last bucket is +Inf)
+LATENCY_BUCKETS = [0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300]
+
+
+## Function:
+#   parse the prices of models from text
+## Input
+#   prices_text: "model0:input_price0:output_price0,..."; prices are USD per million tokens; e.g., "gpt-4o:2.5:10,gpt-4o-mini:0.15:0.6"
+## Output
+#   model_prices: {model0: [input_price0, output_price0], ...}
+def parse_llm_model_prices(prices_text):
+    model_prices = {}
+    for cur_item in prices_text.split(","):
+        cur_item = cur_item.strip()
+        if cur_item == "":
+            continue
+        cur_item_split = cur_item.split(":")
+        assert len(cur_item_split) == 3, print("cur_item: ", cur_item)
+        cur_model, cur_input_price, cur_output_price = cur_item_split[0].strip(), float(cur_item_split[1]), float(cur_item_split[2])
+        assert cur_input_price >= 0 and cur_output_price >= 0, print("cur_item: ", cur_item)
+        model_prices[cur_model] = [cur_input_price, cur_output_price]
+    return model_prices
+
+
+# telemetry of one stage
+class LLMStageTelemetry(object):
+    def __init__(self):
+        # requests sent to the backend (cache hits excluded)
+        self.num_requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        # prompt tokens served from the provider's prompt cache (a part of prompt_tokens)
+        self.cached_prompt_tokens = 0
+        # requests whose tokens are estimated from the text (e.g., streamed responses that come without usage)
+        self.num_estimated_token_requests = 0
+        # API-level retries (e.g., rate limited, connection errors)
+        self.num_retries = 0
+        # failed attempts of the LLM loops (e.g., the response can not be parsed even after restructuring, or the scores can not be picked)
+        self.num_failed_attempts = 0
+        # responses that can not be parsed by template matching (they are restructured by another LLM call)
+        self.num_parse_failures = 0
+        self.num_cache_hits = 0
+        # duplicate requests sent by hedging (see Method.llm_hedging), the ones whose response was used, and their (estimated) prompt tokens, i.e., the extra spend of hedging
+        self.num_hedged_requests = 0
+        self.num_hedge_wins = 0
+        self.hedge_prompt_tokens = 0
+        # calls that escalate to a stronger model of the cascade of the stage (see Method.llm_cascade)
+        self.num_escalations = 0
+        self.cost = 0.0
+        # latency_buckets[i]: number of requests with latency <= LATENCY_BUCKETS[i]; the last one is +Inf
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+    def to_dict(self):
+        return {"num_requests": self.num_requests, "prompt_tokens": self.prompt_tokens, "completion_tokens": self.completion_tokens, "cached_prompt_tokens": self.cached_prompt_tokens, "num_estimated_token_requests": self.num_estimated_token_requests, "num_retries": self.num_retries, "num_failed_attempts": self.num_failed_attempts, "num_parse_failures": self.num_parse_failures, "num_cache_hits": self.num_cache_hits, "num_hedged_requests": self.num_hedged_requests, "num_hedge_wins": self.num_hedge_wins, "hedge_prompt_tokens": self.hedge_prompt_tokens, "num_escalations": self.num_escalations, "cost": self.cost, "latency_sum": self.latency_sum, "latency_max": self.latency_max, "latency_mean": self.latency_sum / self.num_requests if self.num_requests > 0 else 0.0, "latency_buckets": {str(cur_bound): cur_cnt for cur_bound, cur_cnt in zip(LATENCY_BUCKETS + ["+Inf"], self.latency_buckets)}}
+
+
+# per-stage telemetry of the LLM layer shared by the whole process: tokens, latency, retries, failed attempts, cache hits and cost of each stage (e.g., 'screening', 'hypothesis_generation', 'self_evaluation', 'restructuring')
+class LLMTelemetry(object):
+    ## Input
+    #   model_prices: {model: [input_price, output_price], ...} (USD per million tokens); models not listed cost 0
+    def __init__(self, model_prices=None):
+        self.model_prices = model_prices if model_prices != None else {}
+        # {stage: LLMStageTelemetry}
+        self.stages = {}
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+
+    def get_stage(self, stage):
+        if stage == None:
+            stage = "unknown"
+        if stage not in self.stages:
+            self.stages[stage] = LLMStageTelemetry()
+        return self.stages[stage]
+
+    ## Input
+    #   latency: seconds of the request (including API-level retries and rate limiting)
+    #   if_estimated_tokens: whether prompt_tokens / completion_tokens are estimated (the response has no usage)
+    #   cached_prompt_tokens: the prompt tokens served from the provider's prompt cache
+    def record_request(self, stage, model_name, latency, prompt_tokens, completion_tokens, if_estimated_tokens=False, cached_prompt_tokens=0):
+        with self.lock:
+            cur_stage = self.get_stage(stage)
+            cur_stage.num_requests += 1
+            cur_stage.prompt_tokens += prompt_tokens
+            cur_stage.completion_tokens += completion_tokens
+            cur_stage.cached_prompt_tokens += cached_prompt_tokens
+            if if_estimated_tokens:
+                cur_stage.num_estimated_token_requests += 1
+            if model_name in self.model_prices:
+                cur_stage.cost += (prompt_tokens * self.model_prices[model_name][0] + completion_tokens * self.model_prices[model_name][1]) / 1e6
+            cur_stage.latency_sum += latency
+            cur_stage.latency_max = max(cur_stage.latency_max, latency)
+            for cur_bucket_id, cur_bound in enumerate(LATENCY_BUCKETS):
+                if latency <= cur_bound:
+                    cur_stage.latency_buckets[cur_bucket_id] += 1
+            cur_stage.latency_buckets[-1] += 1
+
+    def record_retry(self, stage):
+        with self.lock:
+            self.get_stage(stage).num_retries += 1
+
+    def record_failed_attempt(self, stage):
+        with self.lock:
+            self.get_stage(stage).num_failed_attempts += 1
+
+    def record_parse_failure(self, stage):
+        with self.lock:
+            self.get_stage(stage).num_parse_failures += 1
+
+    def record_cache_hit(self, stage):
+        with self.lock:
+            self.get_stage(stage).num_cache_hits += 1
+
+    def record_escalation(self, stage):
+        with self.lock:
+            self.get_stage(stage).num_escalations += 1
+
+    ## Input
+    #   prompt_tokens: (estimated) prompt tokens of the duplicate request; they are added to the cost, since the request was sent whether its response was used or not
+    #   if_hedge_won: whether the response of the duplicate request was used
+    def record_hedge(self, stage, model_name, prompt_tokens, if_hedge_won):
+        with self.lock:
+            cur_stage = self.get_stage(stage)
+            cur_stage.num_hedged_requests += 1
+            if if_hedge_won:
+                cur_stage.num_hedge_wins += 1
+            cur_stage.hedge_prompt_tokens += prompt_tokens
+            if model_name in self.model_prices:
+                cur_stage.cost += prompt_tokens * self.model_prices[model_name][0] / 1e6
+
+    ## Output
+    #   summary: {"wall_time": float, "stages": {stage: {...}, ...}, "total": {...}}; see LLMStageTelemetry.to_dict()
+    def get_summary(self):
+        with self.lock:
+            stages = {cur_stage: self.stages[cur_stage].to_dict() for cur_stage in sorted(self.stages.keys())}
+        total = {}
+        for cur_item in ["num_requests", "prompt_tokens", "completion_tokens", "cached_prompt_tokens", "num_estimated_token_requests", "num_retries", "num_failed_attempts", "num_parse_failures", "num_cache_hits", "num_hedged_requests", "num_hedge_wins", "hedge_prompt_tokens", "num_escalations", "cost", "latency_sum"]:
+            total[cur_item] = sum([stages[cur_stage][cur_item] for cur_stage in stages])
+        summary = {"wall_time": time.time() - self.start_time, "stages": stages, "total": total}
+        # queues of the priority classes (see Method.llm_dispatcher)
+        if get_llm_dispatcher() != None:
+            summary["dispatcher"] = get_llm_dispatcher().get_stats()
+        return summary
+
+    ## Function:
+    #   the telemetry in the Prometheus text exposition format
+    def get_prometheus_text(self):
+        summary = self.get_summary()
+        lines = []
+        counters = [["num_requests", "llm_requests_total", "LLM requests sent to the backend"], ["prompt_tokens", "llm_prompt_tokens_total", "prompt tokens of the LLM requests"], ["completion_tokens", "llm_completion_tokens_total", "completion tokens of the LLM requests"], ["cached_prompt_tokens", "llm_cached_prompt_tokens_total", "prompt tokens served from the provider's prompt cache"], ["num_retries", "llm_retries_total", "API-level retries of the LLM requests"], ["num_failed_attempts", "llm_failed_attempts_total", "failed attempts of the LLM loops (e.g., responses that can not be parsed)"], ["num_parse_failures", "llm_parse_failures_total", "LLM responses that can not be parsed by template matching"], ["num_cache_hits", "llm_cache_hits_total", "LLM responses read from the cache"], ["num_hedged_requests", "llm_hedged_requests_total", "duplicate LLM requests sent by hedging"], ["num_hedge_wins", "llm_hedge_wins_total", "duplicate LLM requests whose response was used"], ["hedge_prompt_tokens", "llm_hedge_prompt_tokens_total", "estimated prompt tokens of the duplicate LLM requests"], ["num_escalations", "llm_cascade_escalations_total", "LLM calls escalated to a stronger model of the cascade"], ["cost", "llm_cost_usd_total", "estimated cost of the LLM requests in USD"]]
+        for cur_item, cur_metric, cur_help in counters:
+            lines.append("# HELP {} {}".format(cur_metric, cur_help))
+            lines.append("# TYPE {} counter".format(cur_metric))
+            for cur_stage in summary["stages"]:
+                lines.append('{}{{stage="{}"}} {}'.format(cur_metric, cur_stage, summary["stages"][cur_stage][cur_item]))
+        lines.append("# HELP llm_request_latency_seconds latency of the LLM requests")
+        lines.append("# TYPE llm_request_latency_seconds histogram")
+        for cur_stage in summary["stages"]:
+            for cur_bound, cur_cnt in summary["stages"][cur_stage]["latency_buckets"].items():
+                lines.append('llm_request_latency_seconds_bucket{{stage="{}",le="{}"}} {}'.format(cur_stage, cur_bound, cur_cnt))
+            lines.append('llm_request_latency_seconds_sum{{stage="{}"}} {}'.format(cur_stage, summary["stages"][cur_stage]["latency_sum"]))
+            lines.append('llm_request_latency_seconds_count{{stage="{}"}} {}'.format(cur_stage, summary["stages"][cur_stage]["num_requests"]))
+        if "dispatcher" in summary:
+            dispatcher_metrics = [["queue_depth", "llm_dispatcher_queue_depth", "gauge", "LLM requests waiting for a slot of the dispatcher"], ["num_running", "llm_dispatcher_running", "gauge", "LLM requests holding a slot of the dispatcher"], ["num_requests", "llm_dispatcher_requests_total", "counter", "LLM requests submitted to the dispatcher"], ["wait_seconds_sum", "llm_dispatcher_wait_seconds_total", "counter", "seconds the LLM requests waited for a slot of the dispatcher"]]
+            for cur_item, cur_metric, cur_type, cur_help in dispatcher_metrics:
+                lines.append("# HELP {} {}".format(cur_metric, cur_help))
+                lines.append("# TYPE {} {}".format(cur_metric, cur_type))
+                for cur_class in summary["dispatcher"]:
+                    lines.append('{}{{priority_class="{}"}} {}'.format(cur_metric, cur_class, summary["dispatcher"][cur_class][cur_item]))
+        return "\n".join(lines) + "\n"
+
+    def if_empty(self):
+        with self.lock:
+            return len(self.stages) == 0
+
+    def save_summary(self, summary_path):
+        with open(summary_path, 'w') as f:
+            json.dump(self.get_summary(), f, indent=2)
+        print("LLM telemetry summary saved to: ", summary_path)
+
+    def save_prometheus_text(self, prometheus_path):
+        # write to a temporary file first, so that a collector never reads a half-written file
+        tmp_path = prometheus_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(self.get_prometheus_text())
+        os.replace(tmp_path, prometheus_path)
+
+    def print_stats(self):
+        summary = self.get_summary()
+        for cur_stage in summary["stages"]:
+            cur_stats = summary["stages"][cur_stage]
+            print("LLM telemetry; stage: {}; requests: {}; prompt tokens: {}; completion tokens: {}; cached prompt tokens: {}; mean latency: {:.2f}s; max latency: {:.2f}s; retries: {}; failed attempts: {}; parse failures: {}; cache hits: {}; hedged requests: {} (won: {}, prompt tokens: {}); escalations: {}; cost: ${:.4f}".format(cur_stage, cur_stats["num_requests"], cur_stats["prompt_tokens"], cur_stats["completion_tokens"], cur_stats["cached_prompt_tokens"], cur_stats["latency_mean"], cur_stats["latency_max"], cur_stats["num_retries"], cur_stats["num_failed_attempts"], cur_stats["num_parse_failures"], cur_stats["num_cache_hits"], cur_stats["num_hedged_requests"], cur_stats["num_hedge_wins"], cur_stats["hedge_prompt_tokens"], cur_stats["num_escalations"], cur_stats["cost"]))
+
+
+## Function:
+#   serve the telemetry in the Prometheus text format at http://0.0.0.0:port/metrics from a daemon thread
+def serve_llm_telemetry(llm_telemetry, port):
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            content = llm_telemetry.get_prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("LLM telemetry served at http://0.0.0.0:{}/metrics".format(port))
+    return server
+
+
+# None: no telemetry is recorded
+LLM_TELEMETRY = None
+LLM_TELEMETRY_SERVER = None
+
+
+def get_llm_telemetry():
+    return LLM_TELEMETRY
+
+
+def set_llm_telemetry(llm_telemetry):
+    global LLM_TELEMETRY
+    LLM_TELEMETRY = llm_telemetry
+
+
+## Function:
+#   enable or disable the telemetry for the whole process (the existing telemetry is kept when it is already enabled)
+## Input
+#   prices_text: see parse_llm_model_prices()
+#   port: serve the Prometheus text at this port; 0: no endpoint
+def setup_llm_telemetry(if_telemetry=True, prices_text="", port=0):
+    global LLM_TELEMETRY_SERVER
+    if not if_telemetry:
+        set_llm_telemetry(None)
+        return None
+    if get_llm_telemetry() == None:
+        set_llm_telemetry(LLMTelemetry(model_prices=parse_llm_model_prices(prices_text)))
+    if port > 0 and LLM_TELEMETRY_SERVER == None:
+        LLM_TELEMETRY_SERVER = serve_llm_telemetry(get_llm_telemetry(), port)
+    return get_llm_telemetry()
+
+
+## Function:
+#   path of the JSON summary written beside an output file; e.g., ./Checkpoints/hyp.json -> ./Checkpoints/hyp_llm_telemetry.json
+def get_llm_telemetry_summary_path(output_path):
+    return os.path.splitext(output_path)[0] + "_llm_telemetry.json"
+
+
+## Function:
+#   print the telemetry, save its JSON summary beside output_path and its Prometheus text to prometheus_path (''/None: not saved); nothing is saved when no LLM call was made (e.g., the output already exists)
+def save_llm_telemetry(output_path, prometheus_path=""):
+    llm_telemetry = get_llm_telemetry()
+    if llm_telemetry == None or llm_telemetry.if_empty():
+        return
+    llm_telemetry.print_stats()
+    if output_path != None and output_path != "":
+        output_dir = os.path.dirname(os.path.abspath(output_path))
+        if os.path.exists(output_dir):
+            llm_telemetry.save_summary(get_llm_telemetry_summary_path(output_path))
+    if prometheus_path != None and prometheus_path != "":
+        llm_telemetry.save_prometheus_text(prometheus_path)
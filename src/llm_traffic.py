@@ -0,0 +1,119 @@
+import os, json, time, hashlib, threading
+from Method.rate_limiter import CHARS_PER_TOKEN
+from Method.llm_dispatcher import get_llm_priority_class
+
+
+# Recorder of the LLM traffic of the pipelines: one JSON line per LLM request (after the response cache and the coalescing of identical requests, i.e., the requests that reach the rate limiter and the backends), with its arrival time, stage, model, priority class, prompt / response sizes, latency (including the wait for the rate limiter and the dispatcher) and error
+#   the prompts are only kept as a hash by default ('hash'), or in full ('full') to replay them as they are
+#   the traces are replayed by Method.llm_traffic_replay (e.g., against the mock server) for capacity planning without spending real tokens
+
+
+TRAFFIC_PROMPT_MODES = ["hash", "full"]
+
+
+def get_prompt_hash(prompt):
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+
+
+class LLMTrafficRecorder(object):
+    ## Input
+    #   traffic_path: JSON lines file of the records; appended to, so that the traffic of several runs (e.g., the pipelines of several disciplines running at the same time) can be collected in one trace
+    #   prompt_mode: 'hash' / 'full'
+    def __init__(self, traffic_path, prompt_mode="hash"):
+        assert prompt_mode in TRAFFIC_PROMPT_MODES, print("prompt_mode: ", prompt_mode)
+        self.traffic_path = traffic_path
+        self.prompt_mode = prompt_mode
+        traffic_dir = os.path.dirname(os.path.abspath(traffic_path))
+        if not os.path.exists(traffic_dir):
+            os.makedirs(traffic_dir)
+        self.f = open(traffic_path, 'a')
+        self.num_records = 0
+        self.num_errors = 0
+        self.lock = threading.Lock()
+
+    ## Input
+    #   start_time: time.time() when the request arrived
+    #   generation: None if the request failed with error
+    def record(self, stage, model_name, temperature, prompt, start_time, latency, generation=None, error=None):
+        record = {"timestamp": round(start_time, 4), "stage": stage, "model": model_name, "temperature": temperature, "priority_class": get_llm_priority_class(), "prompt_chars": len(prompt), "prompt_tokens": len(prompt) // CHARS_PER_TOKEN, "completion_chars": len(generation) if generation != None else 0, "completion_tokens": len(generation) // CHARS_PER_TOKEN if generation != None else 0, "latency": round(latency, 4), "error": type(error).__name__ if error != None else None, "prompt_hash": get_prompt_hash(prompt)}
+        if self.prompt_mode == "full":
+            record["prompt"] = prompt
+        with self.lock:
+            self.f.write(json.dumps(record) + "\n")
+            self.f.flush()
+            self.num_records += 1
+            self.num_errors += int(error != None)
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+    def print_stats(self):
+        print("LLM traffic; recorded requests: {}; failed requests: {}; trace: {}".format(self.num_records, self.num_errors, self.traffic_path))
+
+
+# None: the traffic is not recorded
+LLM_TRAFFIC_RECORDER = None
+
+
+def get_llm_traffic_recorder():
+    return LLM_TRAFFIC_RECORDER
+
+
+def set_llm_traffic_recorder(llm_traffic_recorder):
+    global LLM_TRAFFIC_RECORDER
+    LLM_TRAFFIC_RECORDER = llm_traffic_recorder
+
+
+## Function:
+#   record the LLM traffic of the whole process to traffic_path ('': not recorded); the existing recorder is kept when the config does not change
+def setup_llm_traffic_recorder(traffic_path="", prompt_mode="hash"):
+    llm_traffic_recorder = get_llm_traffic_recorder()
+    if llm_traffic_recorder != None and (llm_traffic_recorder.traffic_path, llm_traffic_recorder.prompt_mode) == (traffic_path, prompt_mode):
+        return llm_traffic_recorder
+    if llm_traffic_recorder != None:
+        llm_traffic_recorder.close()
+    set_llm_traffic_recorder(LLMTrafficRecorder(traffic_path, prompt_mode=prompt_mode) if traffic_path != "" else None)
+    return get_llm_traffic_recorder()
+
+
+## Function:
+#   record one LLM request in the traffic (if enabled); for the callers that send their requests themselves (e.g., code/hypothesis_ranking/ranking.py)
+def record_llm_traffic(stage, model_name, temperature, prompt, start_time, latency, generation=None, error=None):
+    if get_llm_traffic_recorder() != None:
+        get_llm_traffic_recorder().record(stage, model_name, temperature, prompt, start_time, latency, generation=generation, error=error)
+
+
+## Function:
+#   request_fn (one LLM request: generation = request_fn()) recorded in the traffic; request_fn itself if the traffic is not recorded
+def get_llm_traffic_recorded_fn(request_fn, stage, model_name, temperature, prompt):
+    llm_traffic_recorder = get_llm_traffic_recorder()
+    if llm_traffic_recorder == None:
+        return request_fn
+    def recorded_request_fn():
+        start_time = time.time()
+        try:
+            generation = request_fn()
+        except Exception as e:
+            llm_traffic_recorder.record(stage, model_name, temperature, prompt, start_time, time.time() - start_time, error=e)
+            raise
+        llm_traffic_recorder.record(stage, model_name, temperature, prompt, start_time, time.time() - start_time, generation=generation)
+        return generation
+    return recorded_request_fn
+
+
+# async version of get_llm_traffic_recorded_fn(); request_fn() returns an awaitable
+def aget_llm_traffic_recorded_fn(request_fn, stage, model_name, temperature, prompt):
+    llm_traffic_recorder = get_llm_traffic_recorder()
+    if llm_traffic_recorder == None:
+        return request_fn
+    async def recorded_request_fn():
+        start_time = time.time()
+        try:
+            generation = await request_fn()
+        except Exception as e:
+            llm_traffic_recorder.record(stage, model_name, temperature, prompt, start_time, time.time() - start_time, error=e)
+            raise
+        llm_traffic_recorder.record(stage, model_name, temperature, prompt, start_time, time.time() - start_time, generation=generation)
+        return generation
+    return recorded_request_fn
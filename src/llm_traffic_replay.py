@@ -0,0 +1,174 @@
+import os, sys, json, time, argparse, asyncio
+import numpy as np
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Method.utils import allm_generation, set_llm_async_concurrency
+from Method.llm_client import get_llm_client
+from Method.llm_dispatcher import setup_llm_dispatcher, get_llm_dispatcher, set_llm_priority_class, DEFAULT_LLM_PRIORITY_CLASSES
+from Method.rate_limiter import setup_rate_limiter, CHARS_PER_TOKEN
+from Method.llm_telemetry import setup_llm_telemetry, set_llm_telemetry, get_llm_telemetry
+from Method.llm_traffic import setup_llm_traffic_recorder
+from Method.mock_llm_server import MockLLMBackend, MockModel, start_mock_llm_server
+
+
+# Replayer of the LLM traffic recorded by Method.llm_traffic: the requests of a trace are sent with the same arrival pattern (optionally sped up) through the same LLM layer as the pipelines (rate limiter, dispatcher and its priority classes, hedging, ...), to a real endpoint or to the mock server
+#   num_copies: the trace is replayed num_copies times at the same time (e.g., the pipelines of num_copies disciplines), to find how many of them can run in parallel under a quota (--llm_requests_per_min / --llm_tokens_per_min)
+#   the prompts recorded as a hash are replaced by synthetic prompts of the same size (the same hash gives the same prompt, so that repeated prompts stay repeated)
+
+
+## Output
+#   records: [record, ...] sorted by their arrival; see LLMTrafficRecorder.record()
+def load_llm_traffic(traffic_path):
+    records = []
+    with open(traffic_path, 'r') as f:
+        for cur_line in f:
+            if cur_line.strip() != "":
+                records.append(json.loads(cur_line))
+    records.sort(key=lambda cur_record: cur_record["timestamp"])
+    return records
+
+
+## Function:
+#   the prompt to replay a record; the copies of a trace get different prompts, so that they are not coalesced into one request
+def get_replay_prompt(record, copy_id):
+    copy_prefix = "Replay copy {}. ".format(copy_id) if copy_id > 0 else ""
+    if "prompt" in record:
+        return copy_prefix + record["prompt"]
+    filler = "Replay of prompt {}. ".format(record["prompt_hash"])
+    return copy_prefix + (filler * (record["prompt_chars"] // len(filler) + 1))[:record["prompt_chars"]]
+
+
+## Function:
+#   the largest number of requests in flight at the same time; intervals: [[start, end], ...]
+def get_peak_concurrency(intervals):
+    events = sorted([[cur_interval[0], 1] for cur_interval in intervals] + [[cur_interval[1], -1] for cur_interval in intervals], key=lambda cur_event: (cur_event[0], cur_event[1]))
+    peak_concurrency, cur_concurrency = 0, 0
+    for cur_event in events:
+        cur_concurrency += cur_event[1]
+        peak_concurrency = max(peak_concurrency, cur_concurrency)
+    return peak_concurrency
+
+
+## Function:
+#   replay records (num_copies times at the same time) with async_client
+## Input
+#   speedup: the arrival times are divided by speedup (the latency of the endpoint is not)
+#   model_name: None: the models of the records; otherwise all the requests are sent to model_name
+## Output
+#   replay_records: [[copy_id, record, start_time, latency, error], ...]; start_time: seconds since the start of the replay
+async def areplay_llm_traffic(records, async_client, num_copies=1, speedup=1.0, model_name=None):
+    assert len(records) > 0 and num_copies >= 1 and speedup > 0
+    trace_start_time = records[0]["timestamp"]
+    replay_start_time = time.time()
+    async def areplay_one(copy_id, record):
+        delay = (record["timestamp"] - trace_start_time) / speedup - (time.time() - replay_start_time)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        set_llm_priority_class(record["priority_class"])
+        start_time = time.time()
+        error = None
+        try:
+            await allm_generation(get_replay_prompt(record, copy_id), model_name if model_name != None else record["model"], async_client, temperature=record["temperature"] if record["temperature"] != None else 1.0, stage=record["stage"])
+        except Exception as e:
+            error = type(e).__name__
+        return [copy_id, record, start_time - replay_start_time, time.time() - start_time, error]
+    return await asyncio.gather(*[areplay_one(cur_copy_id, cur_record) for cur_copy_id in range(num_copies) for cur_record in records])
+
+
+## Function:
+#   summary of a replay, compared with the recorded trace
+def get_replay_summary(records, replay_records, num_copies, speedup):
+    # from the first arrival to the end of the last request (arrivals sped up, latencies not)
+    trace_span = max([(cur_record["timestamp"] - records[0]["timestamp"]) / speedup + cur_record["latency"] for cur_record in records])
+    replay_span = max([cur_replay[2] + cur_replay[3] for cur_replay in replay_records])
+    recorded_latencies = [cur_record["latency"] for cur_record in records if cur_record["error"] == None]
+    replay_latencies = [cur_replay[3] for cur_replay in replay_records if cur_replay[4] == None]
+    num_tokens = sum([(cur_replay[1]["prompt_chars"] + cur_replay[1]["completion_chars"]) // CHARS_PER_TOKEN for cur_replay in replay_records if cur_replay[4] == None])
+    # latency per stage: {stage: [p50, p95], ...}
+    stage_latencies = {}
+    for cur_stage in sorted(set([str(cur_replay[1]["stage"]) for cur_replay in replay_records])):
+        cur_latencies = [cur_replay[3] for cur_replay in replay_records if str(cur_replay[1]["stage"]) == cur_stage and cur_replay[4] == None]
+        if len(cur_latencies) > 0:
+            stage_latencies[cur_stage] = [round(float(np.percentile(cur_latencies, 50)), 3), round(float(np.percentile(cur_latencies, 95)), 3)]
+    return {
+        "num_copies": num_copies,
+        "num_requests": len(replay_records),
+        "num_errors": len([cur_replay for cur_replay in replay_records if cur_replay[4] != None]),
+        "trace_span_seconds": round(trace_span, 3),
+        "replay_span_seconds": round(replay_span, 3),
+        # >1: the replay could not keep up with the arrival pattern of the trace (e.g., limited by the quota)
+        "slowdown": round(replay_span / trace_span, 3) if trace_span > 0 else None,
+        "requests_per_min": round(len(replay_records) / replay_span * 60, 1) if replay_span > 0 else None,
+        "tokens_per_min": round(num_tokens / replay_span * 60, 1) if replay_span > 0 else None,
+        "recorded_peak_concurrency": get_peak_concurrency([[cur_record["timestamp"] / speedup, cur_record["timestamp"] / speedup + cur_record["latency"]] for cur_record in records]),
+        "replay_peak_concurrency": get_peak_concurrency([[cur_replay[2], cur_replay[2] + cur_replay[3]] for cur_replay in replay_records]),
+        "recorded_latency_p50_p95": [round(float(np.percentile(recorded_latencies, 50)), 3), round(float(np.percentile(recorded_latencies, 95)), 3)] if len(recorded_latencies) > 0 else None,
+        "replay_latency_p50_p95": [round(float(np.percentile(replay_latencies, 50)), 3), round(float(np.percentile(replay_latencies, 95)), 3)] if len(replay_latencies) > 0 else None,
+        "replay_stage_latency_p50_p95": stage_latencies,
+    }
+
+
+## Function:
+#   the mock models that reproduce the recorded latency of each model (lognormal, with the mean and standard deviation of its successful requests)
+def get_mock_models_from_traffic(records):
+    models = {}
+    for cur_model in set([cur_record["model"] for cur_record in records]):
+        cur_latencies = [cur_record["latency"] for cur_record in records if cur_record["model"] == cur_model and cur_record["error"] == None]
+        if len(cur_latencies) > 0:
+            models[cur_model] = MockModel(cur_model, latency_distribution="lognormal", latency_mean=float(np.mean(cur_latencies)), latency_std=float(np.std(cur_latencies)))
+    return models
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay recorded LLM traffic (see --llm_traffic_path of the pipeline scripts) for capacity planning')
+    parser.add_argument("--traffic_path", type=str, default="./Checkpoints/llm_traffic.jsonl", help="JSON lines trace recorded with --llm_traffic_path")
+    parser.add_argument("--base_url", type=str, default="", help="endpoint to replay against; '': an in-process mock server whose models reproduce the recorded latency of each model (no real tokens are spent)")
+    parser.add_argument("--api_type", type=int, default=0, help="0: openai's API toolkit; 1: azure's API toolkit")
+    parser.add_argument("--api_key", type=str, default="mock")
+    parser.add_argument("--model_name", type=str, default="", help="send all the requests to this model; '': the recorded model of each request")
+    parser.add_argument("--num_copies", type=str, default="1", help="number of copies of the trace replayed at the same time (e.g., disciplines running in parallel); a comma separated list (e.g., '1,2,4,8') replays once for each number")
+    parser.add_argument("--speedup", type=float, default=1.0, help="the arrival times of the trace are divided by this number (the latency of the endpoint is not)")
+    parser.add_argument("--llm_requests_per_min", type=int, default=0, help="requests per minute allowed by the quota; 0: no limit")
+    parser.add_argument("--llm_tokens_per_min", type=int, default=0, help="tokens per minute allowed by the quota; 0: no limit")
+    parser.add_argument("--llm_max_concurrency", type=int, default=64, help="upper bound of in-flight LLM requests")
+    parser.add_argument("--llm_dispatcher", type=int, default=0, help="whether the requests wait for a slot of the dispatcher, shared among the recorded priority classes by weighted fair queuing")
+    parser.add_argument("--llm_priority_classes", type=str, default=DEFAULT_LLM_PRIORITY_CLASSES, help="priority classes of the dispatcher; see the pipeline scripts")
+    parser.add_argument("--output_path", type=str, default="", help="JSON file of the summaries of the replays; '': only printed")
+    args = parser.parse_args()
+
+    assert args.llm_dispatcher in [0, 1]
+    assert args.speedup > 0
+    num_copies_list = [int(cur_item) for cur_item in args.num_copies.split(",")]
+    assert min(num_copies_list) >= 1
+
+    records = load_llm_traffic(args.traffic_path)
+    print("Loaded {} requests of {} stages from {}".format(len(records), len(set([cur_record["stage"] for cur_record in records])), args.traffic_path))
+    base_url = args.base_url
+    if base_url == "":
+        server = start_mock_llm_server(MockLLMBackend(MockModel("default"), models=get_mock_models_from_traffic(records)))
+        base_url = "http://127.0.0.1:{}/v1".format(server.server_port)
+    # the replayed requests are not recorded again
+    setup_llm_traffic_recorder("")
+    setup_rate_limiter(requests_per_min=args.llm_requests_per_min, tokens_per_min=args.llm_tokens_per_min, max_concurrency=args.llm_max_concurrency)
+    setup_llm_dispatcher(args.llm_dispatcher == 1, priority_classes_text=args.llm_priority_classes, max_concurrency=args.llm_max_concurrency)
+    set_llm_async_concurrency(args.llm_max_concurrency)
+
+    async def areplay_all():
+        # the asyncio client is created in the event loop that uses it
+        async_client = get_llm_client(args.api_type, args.api_key, base_url, if_async=True)
+        summary_list = []
+        for cur_num_copies in num_copies_list:
+            # a new telemetry for each replay
+            set_llm_telemetry(None)
+            setup_llm_telemetry(True)
+            replay_records = await areplay_llm_traffic(records, async_client, num_copies=cur_num_copies, speedup=args.speedup, model_name=args.model_name if args.model_name != "" else None)
+            cur_summary = get_replay_summary(records, replay_records, cur_num_copies, args.speedup)
+            print("Replay summary: ", json.dumps(cur_summary))
+            get_llm_telemetry().print_stats()
+            summary_list.append(cur_summary)
+        return summary_list
+    summary_list = asyncio.run(areplay_all())
+    if get_llm_dispatcher() != None:
+        get_llm_dispatcher().print_stats()
+    if args.output_path != "":
+        with open(args.output_path, 'w') as f:
+            json.dump(summary_list, f, indent=4)
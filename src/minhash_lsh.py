@@ -0,0 +1,176 @@
+import zlib
+import numpy as np
+
+
+# MinHash-LSH index of the titles (optionally with the abstracts) of a corpus, to find the near duplicates of a paper without comparing it with every paper of the corpus (e.g., the deduplication of a crawled corpus, or the title recovery of a corpus with 100k+ papers)
+#   the shingles of a text are its lower-cased word n-grams (shingle_size=1: the word set, the same as Method.utils.jaccard_similarity() and Method.title_index)
+#   the signature of a text has num_bands * rows_per_band MinHash values; two texts are candidates if all the rows of any band are the same, which happens with probability 1 - (1 - s ** rows_per_band) ** num_bands for a Jaccard similarity s
+#   the candidates are verified with their exact Jaccard similarity, so the index only misses near duplicates (with a probability that decreases quickly above get_lsh_threshold()) and never returns false ones
+
+
+# the hash functions of the permutations are multiply-shift hashes of the 32-bit hashes of the shingles: ((a * x + b) mod 2 ** 64) >> 32, with a random odd a and a random b (uint64 arithmetic wraps around)
+MINHASH_SHIFT = np.uint64(32)
+MAX_MINHASH_VALUE = np.uint64(2 ** 32 - 1)
+# the rows of a band are combined into one 64-bit key (band keys that collide only add candidates, which are verified)
+BAND_KEY_MULTIPLIER = np.uint64(1099511628211)
+# number of shingles hashed at the same time in get_signatures() (a [num_shingles, num_perm] uint64 array)
+SIGNATURE_CHUNK_SIZE = 32768
+
+
+## Function:
+#   the text of a paper to index; abstract: None to only index the title
+def get_paper_text(title, abstract=None):
+    return title if abstract == None else title + " " + abstract
+
+
+class MinHashLSH(object):
+    ## Input
+    #   num_bands, rows_per_band: a larger rows_per_band makes the candidates stricter, a larger num_bands finds more of them (see get_lsh_threshold())
+    #   shingle_size: number of words in a shingle; 1 for titles, 2~3 for abstracts
+    #   seed: seed of the hash functions; indexes compared with each other should use the same seed
+    def __init__(self, num_bands=20, rows_per_band=5, shingle_size=1, seed=0):
+        assert num_bands >= 1 and rows_per_band >= 1 and shingle_size >= 1
+        self.num_bands = num_bands
+        self.rows_per_band = rows_per_band
+        self.shingle_size = shingle_size
+        num_perm = num_bands * rows_per_band
+        rng = np.random.RandomState(seed)
+        self.hash_a = rng.randint(0, 2 ** 63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.hash_b = rng.randint(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+        # shingle_sets: [frozenset(shingle hash, ...), ...], one for each indexed text (for the verification of the candidates)
+        self.shingle_sets = []
+        # buckets: [{band key: [text id, ...]}, ...], one dict for each band
+        self.buckets = [{} for _ in range(num_bands)]
+
+    def __len__(self):
+        return len(self.shingle_sets)
+
+    ## Function:
+    #   the Jaccard similarity above which two texts are likely to be candidates ((1 / num_bands) ** (1 / rows_per_band))
+    def get_lsh_threshold(self):
+        return (1 / self.num_bands) ** (1 / self.rows_per_band)
+
+    ## Output
+    #   shingles: frozenset of the 32-bit hashes of the word n-grams of text
+    def get_shingles(self, text):
+        words = text.lower().split()
+        if len(words) < self.shingle_size:
+            words = [" ".join(words)] if len(words) > 0 else []
+        else:
+            words = [" ".join(words[cur_id:cur_id+self.shingle_size]) for cur_id in range(len(words) - self.shingle_size + 1)]
+        return frozenset([zlib.crc32(cur_word.encode("utf-8")) for cur_word in words])
+
+    ## Output
+    #   signatures: [len(shingle_sets), num_bands * rows_per_band] uint64 array; the rows of empty shingle sets are MAX_MINHASH_VALUE
+    def get_signatures(self, shingle_sets):
+        signatures = np.full((len(shingle_sets), len(self.hash_a)), MAX_MINHASH_VALUE, dtype=np.uint64)
+        # the shingles of all the texts in one array; text_ids: the text of each shingle
+        shingles = np.array([cur_shingle for cur_shingles in shingle_sets for cur_shingle in cur_shingles], dtype=np.uint64)
+        text_ids = np.repeat(np.arange(len(shingle_sets)), [len(cur_shingles) for cur_shingles in shingle_sets])
+        for cur_start in range(0, len(shingles), SIGNATURE_CHUNK_SIZE):
+            cur_shingles = shingles[cur_start:cur_start+SIGNATURE_CHUNK_SIZE]
+            cur_hashes = (np.outer(cur_shingles, self.hash_a) + self.hash_b) >> MINHASH_SHIFT
+            # the minimum of each permutation over the shingles of each text (the shingles of a text are contiguous; a text might span two chunks)
+            cur_text_ids, cur_offsets = np.unique(text_ids[cur_start:cur_start+SIGNATURE_CHUNK_SIZE], return_index=True)
+            signatures[cur_text_ids] = np.minimum(signatures[cur_text_ids], np.minimum.reduceat(cur_hashes, cur_offsets, axis=0))
+        return signatures
+
+    ## Output
+    #   band_keys: [len(signatures), num_bands] uint64 array
+    def get_band_keys(self, signatures):
+        band_rows = signatures.reshape(len(signatures), self.num_bands, self.rows_per_band)
+        band_keys = np.zeros((len(signatures), self.num_bands), dtype=np.uint64)
+        for cur_row in range(self.rows_per_band):
+            band_keys = band_keys * BAND_KEY_MULTIPLIER + band_rows[:, :, cur_row]
+        return band_keys
+
+    ## Function:
+    #   index texts; the texts without any word are kept (their ids are counted) but can not be found
+    ## Output
+    #   text_ids: [text id, ...]; the ids are the order of the texts added to the index
+    def add_batch(self, texts):
+        shingle_sets = [self.get_shingles(cur_text) for cur_text in texts]
+        band_keys = self.get_band_keys(self.get_signatures(shingle_sets)).tolist()
+        return [self.add_shingles(cur_shingles, cur_band_keys) for cur_shingles, cur_band_keys in zip(shingle_sets, band_keys)]
+
+    ## Function:
+    #   index a text by its shingles and band keys (see get_shingles() and get_band_keys())
+    def add_shingles(self, shingles, band_keys):
+        text_id = len(self.shingle_sets)
+        self.shingle_sets.append(shingles)
+        if len(shingles) > 0:
+            for cur_buckets, cur_key in zip(self.buckets, band_keys):
+                cur_buckets.setdefault(cur_key, []).append(text_id)
+        return text_id
+
+    def add(self, text):
+        return self.add_batch([text])[0]
+
+    ## Output
+    #   candidate_ids: [text id, ...] (ascending) that share at least one band with text; not verified
+    def query_candidates(self, text, shingles=None, band_keys=None):
+        if shingles == None:
+            shingles = self.get_shingles(text)
+        if len(shingles) == 0:
+            return []
+        if band_keys == None:
+            band_keys = self.get_band_keys(self.get_signatures([shingles]))[0].tolist()
+        candidate_ids = set()
+        for cur_band, cur_key in enumerate(band_keys):
+            candidate_ids.update(self.buckets[cur_band].get(cur_key, []))
+        return sorted(candidate_ids)
+
+    ## Function:
+    #   the indexed texts whose Jaccard similarity (of the shingles) with text is at least threshold
+    ## Output
+    #   similar_texts: [[text id, similarity], ...]; sorted by similarity (descending), then by id (ascending)
+    def query(self, text, threshold=0.8, shingles=None, band_keys=None):
+        if shingles == None:
+            shingles = self.get_shingles(text)
+        similar_texts = []
+        for cur_id in self.query_candidates(text, shingles=shingles, band_keys=band_keys):
+            cur_inter = len(shingles & self.shingle_sets[cur_id])
+            cur_similarity = cur_inter / (len(shingles) + len(self.shingle_sets[cur_id]) - cur_inter)
+            if cur_similarity >= threshold:
+                similar_texts.append([cur_id, cur_similarity])
+        similar_texts.sort(key=lambda cur_item: (-cur_item[1], cur_item[0]))
+        return similar_texts
+
+
+## Function:
+#   find the near duplicates in texts; a text is a duplicate if its Jaccard similarity with an earlier text that is kept is at least threshold
+## Input
+#   lsh: None (a new MinHashLSH with lsh_kwargs) or an index of the texts to deduplicate against (e.g., the papers already in a corpus); the kept texts are added to it
+## Output
+#   duplicate_of: [None or id, ...] for each text; None: kept; id: the id in lsh of the text it duplicates
+def get_near_duplicates(texts, threshold=0.8, lsh=None, **lsh_kwargs):
+    if lsh == None:
+        lsh = MinHashLSH(**lsh_kwargs)
+    shingle_sets = [lsh.get_shingles(cur_text) for cur_text in texts]
+    band_keys = lsh.get_band_keys(lsh.get_signatures(shingle_sets)).tolist()
+    duplicate_of = []
+    for cur_text, cur_shingles, cur_band_keys in zip(texts, shingle_sets, band_keys):
+        cur_similar_texts = lsh.query(cur_text, threshold=threshold, shingles=cur_shingles, band_keys=cur_band_keys)
+        if len(cur_similar_texts) > 0:
+            duplicate_of.append(cur_similar_texts[0][0])
+        else:
+            lsh.add_shingles(cur_shingles, cur_band_keys)
+            duplicate_of.append(None)
+    return duplicate_of
+
+
+## Function:
+#   remove the near duplicate papers (by their titles, optionally with their abstracts); the first one of the duplicates is kept
+## Input
+#   title_abstract_pairs: [[title, abstract], ...]
+#   lsh: see get_near_duplicates(); its texts should be indexed with the same if_use_abstract
+## Output
+#   deduplicated_pairs: [[title, abstract], ...]
+#   removed_pairs: [[title, abstract], ...]
+def deduplicate_title_abstract_pairs(title_abstract_pairs, threshold=0.8, if_use_abstract=False, lsh=None, **lsh_kwargs):
+    assert if_use_abstract in [True, False]
+    texts = [get_paper_text(cur_pair[0], cur_pair[1] if if_use_abstract else None) for cur_pair in title_abstract_pairs]
+    duplicate_of = get_near_duplicates(texts, threshold=threshold, lsh=lsh, **lsh_kwargs)
+    deduplicated_pairs = [cur_pair for cur_pair, cur_duplicate_of in zip(title_abstract_pairs, duplicate_of) if cur_duplicate_of == None]
+    removed_pairs = [cur_pair for cur_pair, cur_duplicate_of in zip(title_abstract_pairs, duplicate_of) if cur_duplicate_of != None]
+    return deduplicated_pairs, removed_pairs
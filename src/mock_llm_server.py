@@ -0,0 +1,392 @@
+import os, sys, re, json, time, math, random, hashlib, argparse, threading
+import http.server
+
+
+# Offline OpenAI-compatible chat-completions server with deterministic fake models, to run the whole pipeline (and benchmark its own overhead) without network, e.g.:
+#   python mock_llm_server.py --port 8000 --latency_mean 0.5 --malformed_rate 0.1
+#   python inspiration_screening.py --base_url http://127.0.0.1:8000/v1 --api_key mock ...
+#   (code/hypothesis_ranking/ranking.py: set BASE_URL = "http://127.0.0.1:8000/v1")
+# the fake models answer every prompt family of instruction_prompts() (with the response format asked by the prompt), the restructuring prompt, and the pairwise comparison prompt of ranking.py; responses are a function of (seed, model, request, how many times the same request has been seen), so that a retry of the same request gets a new response
+
+
+LATENCY_DISTRIBUTIONS = ["fixed", "uniform", "exponential", "lognormal"]
+# rough number of characters per token (the same as Method.rate_limiter), used for the usage of responses
+CHARS_PER_TOKEN = 4
+# number of characters of one chunk of a streamed response
+STREAM_CHUNK_CHARS = 16
+# simulated provider-side prompt caching: prompts of at least PROMPT_CACHE_MIN_CHARS characters are cached in blocks of PROMPT_CACHE_BLOCK_CHARS characters (about 1024 and 128 tokens, as OpenAI does)
+PROMPT_CACHE_MIN_CHARS = 4096
+PROMPT_CACHE_BLOCK_CHARS = 512
+
+FAKE_WORDS = ["catalyst", "electrolyte", "polymer", "ligand", "lattice", "interface", "dopant", "solvent", "nanoparticle", "membrane", "framework", "oxidation", "photon", "enzyme", "surface", "crystal", "additive", "precursor", "coating", "anode", "cathode", "semiconductor", "hydrogel", "zeolite"]
+FAKE_VERBS = ["stabilizes", "enhances", "modulates", "suppresses", "accelerates", "templates", "tunes", "protects", "activates", "confines"]
+
+
+# configuration of one fake model
+class MockModel(object):
+    ## Input
+    #   latency_distribution: one of LATENCY_DISTRIBUTIONS; latency_mean / latency_std: seconds (latency_std is used by 'uniform' (half width) and 'lognormal')
+    #   error_rate: ratio of requests that fail with 500; rate_limit_rate: ratio of requests that fail with 429 (with a retry-after header)
+    #   malformed_rate: ratio of responses that do not follow the response format asked by the prompt
+    #   max_context_tokens: requests with more (estimated) prompt tokens fail with a context length error; 0: no limit
+    def __init__(self, name, latency_distribution="lognormal", latency_mean=0.5, latency_std=0.2, error_rate=0.0, rate_limit_rate=0.0, malformed_rate=0.0, max_context_tokens=0):
+        assert latency_distribution in LATENCY_DISTRIBUTIONS, print("latency_distribution: ", latency_distribution)
+        assert latency_mean >= 0 and latency_std >= 0
+        assert 0 <= error_rate <= 1 and 0 <= rate_limit_rate <= 1 and 0 <= malformed_rate <= 1
+        self.name = name
+        self.latency_distribution = latency_distribution
+        self.latency_mean = latency_mean
+        self.latency_std = latency_std
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.malformed_rate = malformed_rate
+        self.max_context_tokens = max_context_tokens
+
+    def sample_latency(self, rng):
+        if self.latency_mean == 0:
+            return 0.0
+        if self.latency_distribution == "fixed":
+            return self.latency_mean
+        elif self.latency_distribution == "uniform":
+            return max(0.0, rng.uniform(self.latency_mean - self.latency_std, self.latency_mean + self.latency_std))
+        elif self.latency_distribution == "exponential":
+            return rng.expovariate(1.0 / self.latency_mean)
+        elif self.latency_distribution == "lognormal":
+            # parameters of the underlying normal distribution, so that the latency has mean latency_mean and standard deviation latency_std
+            sigma2 = math.log(1 + (self.latency_std / self.latency_mean) ** 2)
+            return rng.lognormvariate(math.log(self.latency_mean) - sigma2 / 2, math.sqrt(sigma2))
+        else:
+            raise NotImplementedError
+
+
+# 'Reasoning Process:' -> 'reasoning_process' (the same as Method.structured_output.get_field_name(), so that the fields of JSON schemas match the template items)
+def get_field_name(template_item):
+    return re.sub("[^a-z0-9]+", "_", template_item.lower()).strip("_")
+
+
+# fake content of one request; the same rng gives the same content
+class FakeResponseGenerator(object):
+    def __init__(self, prompt, rng):
+        self.prompt = prompt
+        self.rng = rng
+        # titles of the inspiration candidates in the prompt (screening prompts); selected without replacement
+        self.candidate_titles = [cur_title.strip() for cur_title in re.findall(r"candidate \d+\. Title: (.*?); Abstract:", prompt, re.S)]
+        self.rng.shuffle(self.candidate_titles)
+
+    def get_sentence(self, num_words=12):
+        words = [self.rng.choice(FAKE_WORDS) for _ in range(num_words)]
+        words.insert(num_words // 2, self.rng.choice(FAKE_VERBS))
+        return " ".join(words).capitalize() + "."
+
+    def get_paragraph(self, num_sentences=3):
+        return " ".join([self.get_sentence(self.rng.randint(8, 16)) for _ in range(num_sentences)])
+
+    ## Function:
+    #   fake content of one field of the response format (field: get_field_name() of the template item)
+    def get_field_value(self, field):
+        if field == "title":
+            if len(self.candidate_titles) > 0:
+                return self.candidate_titles.pop()
+            return "no more needed"
+        if field.endswith("_score"):
+            return self.rng.randint(1, 5)
+        if field in ["if_need_extra_knowledge", "yes_or_no"]:
+            return self.rng.choice(["Yes", "No"])
+        if field in ["hypothesis", "refined_hypothesis"]:
+            return self.get_paragraph(self.rng.randint(2, 4))
+        return self.get_paragraph(self.rng.randint(1, 3))
+
+    ## Function:
+    #   text response that follows the response format (or the restructuring template / comparison format) asked by the prompt; free text (e.g., feedback) for prompts without a response format
+    def get_text_response(self):
+        # pairwise comparison (code/hypothesis_ranking/ranking.py)
+        if "**Selection of research hypothesis candidate**" in self.prompt:
+            return "**Analysis**: {}\n**Selection of research hypothesis candidate**: candidate {}".format(self.get_paragraph(), self.rng.choice([1, 2]))
+        # restructuring (Method.utils.get_restructure_prompt())
+        restructure_template = re.search(r"The template is: \n(.*?) \n(.*?) \n\. Now, please restructure", self.prompt, re.S)
+        if restructure_template != None:
+            template = [restructure_template.group(1), restructure_template.group(2)]
+            return "{} {}\n{} {}".format(template[0], self.get_field_value(get_field_name(template[0])), template[1], self.get_field_value(get_field_name(template[1])))
+        # batched self-evaluation (Method.self_evaluation_batch): one block of the response format for each hypothesis of the prompt, starting with 'Hypothesis index: i'
+        batched_response_format = re.findall(r"\(response format: for each hypothesis in order, '(.*?)'\)", self.prompt, re.S)
+        if len(batched_response_format) > 0:
+            template_items = [cur_item.strip() for cur_item in batched_response_format[-1].split("\n") if cur_item.strip() != ""]
+            hyp_ids = re.findall(r"\nHypothesis index: (\d+); hypothesis: ", self.prompt)
+            return "\n\n".join(["{} {}\n".format(template_items[0], cur_hyp_id) + "\n".join(["{} {}".format(cur_item, self.get_field_value(get_field_name(cur_item))) for cur_item in template_items[1:]]) for cur_hyp_id in hyp_ids])
+        # prompts with a response format; e.g., (response format: 'Title: \nReason: \nTitle: \nReason: \n')
+        response_format = re.findall(r"\(response format: '(.*?)'\)", self.prompt, re.S)
+        if len(response_format) == 0:
+            return self.get_paragraph(self.rng.randint(3, 6))
+        template_items = [cur_item.strip() for cur_item in response_format[-1].split("\n") if cur_item.strip() != ""]
+        return "\n".join(["{} {}".format(cur_item, self.get_field_value(get_field_name(cur_item))) for cur_item in template_items])
+
+    ## Function:
+    #   a response that does not follow the format asked by the prompt (e.g., the model ignores the template)
+    def get_malformed_response(self):
+        return "Sure! Here is my answer.\n\n" + self.get_paragraph(self.rng.randint(2, 4))
+
+    ## Function:
+    #   JSON value that follows a JSON schema (response_format of structured-output requests)
+    def get_json_value(self, schema, field=""):
+        if "enum" in schema:
+            return self.rng.choice(schema["enum"])
+        if schema.get("type") == "object":
+            return {cur_field: self.get_json_value(cur_schema, cur_field) for cur_field, cur_schema in schema.get("properties", {}).items()}
+        if schema.get("type") == "array":
+            item_schema = schema.get("items", {})
+            # one block per selected title (three, as asked by the screening prompts); one block otherwise
+            num_items = 3 if "title" in item_schema.get("properties", {}) else 1
+            return [self.get_json_value(item_schema) for _ in range(num_items)]
+        if schema.get("type") == "integer":
+            return self.rng.randint(1, 5)
+        if schema.get("type") == "boolean":
+            return self.rng.choice([True, False])
+        return str(self.get_field_value(field))
+
+
+# state of the server: the fake models and how many times each request has been seen
+class MockLLMBackend(object):
+    ## Input
+    #   default_model: MockModel used for the models not in models (its name is ignored)
+    #   models: {model_name: MockModel}
+    def __init__(self, default_model, models=None, seed=0):
+        self.default_model = default_model
+        self.models = models if models != None else {}
+        self.seed = seed
+        # {request_key: number of times seen}
+        self.request_counts = {}
+        # {hash of (model, prompt prefix) of a cached prompt block: the time since when it is cached}
+        self.prompt_cache = {}
+        self.lock = threading.Lock()
+
+    def get_model(self, model_name):
+        return self.models.get(model_name, self.default_model)
+
+    ## Function:
+    #   the rng of one request: the same request gets the same responses in the same order in every run with the same seed
+    def get_request_rng(self, body):
+        content = json.dumps([self.seed, body.get("model"), body.get("messages"), body.get("temperature"), body.get("response_format")], ensure_ascii=False, sort_keys=True)
+        request_key = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        with self.lock:
+            cnt_seen = self.request_counts.get(request_key, 0)
+            self.request_counts[request_key] = cnt_seen + 1
+        return random.Random("{}_{}".format(request_key, cnt_seen))
+
+    ## Function:
+    #   simulate the provider's prompt cache: the longest cached prefix of the prompt (in whole blocks) is reported as cached tokens, and all the blocks of the prompt are cached once the response is sent (after latency), so that requests sent at the same time do not hit each other's blocks
+    def get_cached_prompt_tokens(self, model_name, prompt, latency):
+        cur_hash = hashlib.sha256(str(model_name).encode("utf-8"))
+        block_keys = []
+        for cur_end in range(PROMPT_CACHE_BLOCK_CHARS, len(prompt) + 1, PROMPT_CACHE_BLOCK_CHARS):
+            cur_hash.update(prompt[cur_end - PROMPT_CACHE_BLOCK_CHARS:cur_end].encode("utf-8"))
+            if cur_end >= PROMPT_CACHE_MIN_CHARS:
+                block_keys.append([cur_end, cur_hash.hexdigest()])
+        cached_chars = 0
+        cur_time = time.monotonic()
+        with self.lock:
+            for cur_end, cur_key in block_keys:
+                if self.prompt_cache.get(cur_key, math.inf) > cur_time:
+                    break
+                cached_chars = cur_end
+            for cur_end, cur_key in block_keys:
+                self.prompt_cache[cur_key] = min(self.prompt_cache.get(cur_key, math.inf), cur_time + latency)
+        return cached_chars // CHARS_PER_TOKEN
+
+    ## Function:
+    #   handle one chat-completions request
+    ## Output
+    #   status: HTTP status code
+    #   headers: {name: value}
+    #   latency: seconds to wait before (or, for streams, while) sending the response
+    #   response: the response body (dict) if status != 200 or not streaming, otherwise the generation (text) to stream
+    def handle_chat_completion(self, body):
+        model = self.get_model(body.get("model"))
+        rng = self.get_request_rng(body)
+        prompt = "\n".join([cur_message.get("content") or "" for cur_message in body.get("messages", [])])
+        prompt_tokens = len(prompt) // CHARS_PER_TOKEN
+        latency = model.sample_latency(rng)
+        if model.max_context_tokens > 0 and prompt_tokens > model.max_context_tokens:
+            return 400, {}, 0.0, get_error_body("This model's maximum context length is {} tokens. However, your messages resulted in {} tokens.".format(model.max_context_tokens, prompt_tokens), "invalid_request_error", "context_length_exceeded")
+        cur_rand = rng.random()
+        if cur_rand < model.rate_limit_rate:
+            return 429, {"retry-after": "1"}, 0.0, get_error_body("Rate limit reached for {} (mock).".format(body.get("model")), "rate_limit_error", "rate_limit_exceeded")
+        if cur_rand < model.rate_limit_rate + model.error_rate:
+            return 500, {}, latency, get_error_body("The server had an error while processing your request (mock).", "server_error", None)
+        cached_prompt_tokens = self.get_cached_prompt_tokens(body.get("model"), prompt, latency)
+        generator = FakeResponseGenerator(prompt, rng)
+        if_malformed = rng.random() < model.malformed_rate
+        response_format = body.get("response_format")
+        if response_format != None and response_format.get("type") == "json_schema":
+            generation = generator.get_malformed_response() if if_malformed else json.dumps(generator.get_json_value(response_format["json_schema"]["schema"]), ensure_ascii=False)
+        else:
+            generation = generator.get_malformed_response() if if_malformed else generator.get_text_response()
+        if body.get("stream", False):
+            return 200, {}, latency, generation
+        completion = {
+            "id": "chatcmpl-mock-{}".format(rng.getrandbits(64)),
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": generation}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(generation) // CHARS_PER_TOKEN, "total_tokens": prompt_tokens + len(generation) // CHARS_PER_TOKEN, "prompt_tokens_details": {"cached_tokens": cached_prompt_tokens}}
+        }
+        return 200, {}, latency, completion
+
+
+def get_error_body(message, error_type, code):
+    return {"error": {"message": message, "type": error_type, "param": None, "code": code}}
+
+
+def get_mock_llm_handler(backend):
+    class MockLLMHandler(http.server.BaseHTTPRequestHandler):
+        # keep-alive connections, as the clients' connection pools expect
+        protocol_version = "HTTP/1.1"
+
+        def send_json(self, status, content, headers=None):
+            content = json.dumps(content, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            for cur_name, cur_value in (headers if headers != None else {}).items():
+                self.send_header(cur_name, cur_value)
+            self.end_headers()
+            try:
+                self.wfile.write(content)
+            except (BrokenPipeError, ConnectionResetError):
+                # the client gave up the request (e.g., the losing call of a hedged request)
+                self.close_connection = True
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/models"):
+                model_names = sorted(backend.models.keys())
+                self.send_json(200, {"object": "list", "data": [{"id": cur_name, "object": "model", "owned_by": "mock"} for cur_name in model_names]})
+            else:
+                self.send_json(404, get_error_body("Not found: {}".format(self.path), "invalid_request_error", None))
+
+        def do_POST(self):
+            content_length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(content_length).decode("utf-8"))
+            # openai: /v1/chat/completions; azure: /openai/deployments/{deployment}/chat/completions?api-version=...
+            if not self.path.split("?")[0].rstrip("/").endswith("/chat/completions"):
+                self.send_json(404, get_error_body("Not found: {}".format(self.path), "invalid_request_error", None))
+                return
+            status, headers, latency, response = backend.handle_chat_completion(body)
+            if status == 200 and body.get("stream", False):
+                self.send_stream(body, response, latency)
+                return
+            time.sleep(latency)
+            self.send_json(status, response, headers)
+
+        ## Function:
+        #   send the generation as server-sent events; the latency is spread over the chunks, so that a client that stops reading early (e.g., Method.utils.stream_chat_completion_with_early_stop()) also saves time
+        def send_stream(self, body, generation, latency):
+            chunks = [generation[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(generation), STREAM_CHUNK_CHARS)]
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            # no content length: the connection is closed at the end of the stream
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            try:
+                for cur_chunk in chunks + [None]:
+                    time.sleep(latency / max(1, len(chunks)))
+                    if cur_chunk == None:
+                        delta, finish_reason = {}, "stop"
+                    else:
+                        delta, finish_reason = {"role": "assistant", "content": cur_chunk}, None
+                    event = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": body.get("model"), "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+                    self.wfile.write("data: {}\n\n".format(json.dumps(event, ensure_ascii=False)).encode("utf-8"))
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # the client stopped reading
+                pass
+
+        def log_message(self, format, *args):
+            pass
+
+    return MockLLMHandler
+
+
+## Function:
+#   start the mock server in a daemon thread (e.g., for benchmarks and tests in the same process)
+## Output
+#   server: ThreadingHTTPServer; its base url is "http://{host}:{server.server_port}/v1" (port 0: a free port is chosen)
+def start_mock_llm_server(backend, host="127.0.0.1", port=0):
+    server = http.server.ThreadingHTTPServer((host, port), get_mock_llm_handler(backend))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+## Function:
+#   load the fake models from a JSON file: {model_name: {latency_distribution, latency_mean, latency_std, error_rate, rate_limit_rate, malformed_rate, max_context_tokens}, ...}; fields not given use the default model
+def load_mock_models(model_configs_path, default_model):
+    with open(model_configs_path, 'r') as f:
+        model_configs = json.load(f)
+    models = {}
+    for cur_name, cur_config in model_configs.items():
+        cur_model_config = {"latency_distribution": default_model.latency_distribution, "latency_mean": default_model.latency_mean, "latency_std": default_model.latency_std, "error_rate": default_model.error_rate, "rate_limit_rate": default_model.rate_limit_rate, "malformed_rate": default_model.malformed_rate, "max_context_tokens": default_model.max_context_tokens}
+        cur_model_config.update(cur_config)
+        models[cur_name] = MockModel(cur_name, **cur_model_config)
+    return models
+
+
+## Function:
+#   check that the fake responses to batched self-evaluation prompts (Method.self_evaluation_batch) are parsed by pick_batched_scores() into the scores of every hypothesis, so that batched runs against the mock server exercise the batched path instead of evaluating every hypothesis one by one again
+## Output
+#   num_failed_checks: number of (num_hyps, seed) whose response is not fully parsed
+def check_mock_batched_self_evaluation(max_num_hyps=8, num_seeds=5):
+    # imported here so that the server itself keeps running without the dependencies of the pipeline
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from Method.utils import pick_batched_scores
+    from Method.self_evaluation_batch import prepare_prompt_for_batched_self_evaluation
+    num_failed_checks = 0
+    for num_hyps in range(2, max_num_hyps + 1):
+        hyp_list = ["Fake hypothesis {} on the catalyst.".format(cur_hyp_id) for cur_hyp_id in range(num_hyps)]
+        full_prompt, prompt_prefix = prepare_prompt_for_batched_self_evaluation(hyp_list)
+        for cur_seed in range(num_seeds):
+            generation = FakeResponseGenerator(full_prompt, random.Random(cur_seed)).get_text_response()
+            dict_idx2score = pick_batched_scores(generation, full_prompt, num_hyps)
+            if sorted(dict_idx2score.keys()) != list(range(num_hyps)):
+                num_failed_checks += 1
+                print("Check failed; num_hyps: {}; seed: {}; parsed hypothesis indexes: {}; generation: {}".format(num_hyps, cur_seed, sorted(dict_idx2score.keys()), generation))
+    print("Mock batched self-evaluation checks: {}; failed: {}".format((max_num_hyps - 1) * num_seeds, num_failed_checks))
+    return num_failed_checks
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Offline OpenAI-compatible mock server')
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--seed", type=int, default=0, help="seed of the fake responses; the same seed gives the same responses to the same requests")
+    parser.add_argument("--latency_distribution", type=str, default="lognormal", help="latency distribution of the fake models: fixed / uniform / exponential / lognormal")
+    parser.add_argument("--latency_mean", type=float, default=0.5, help="mean latency of one response (seconds)")
+    parser.add_argument("--latency_std", type=float, default=0.2, help="standard deviation of the latency (lognormal) / half width of its range (uniform)")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="ratio of requests that fail with a server error (500)")
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0, help="ratio of requests that fail with a rate limit error (429)")
+    parser.add_argument("--malformed_rate", type=float, default=0.0, help="ratio of responses that do not follow the response format asked by the prompt")
+    parser.add_argument("--max_context_tokens", type=int, default=0, help="requests with more prompt tokens fail with a context length error; 0: no limit")
+    parser.add_argument("--model_configs_path", type=str, default="", help="JSON file with the configuration of each fake model ({model_name: {latency_mean: 1.0, malformed_rate: 0.2, ...}, ...}); models not listed use the configuration above")
+    parser.add_argument("--check_batched_self_evaluation", type=int, default=0, help="1: only check that the fake responses to batched self-evaluation prompts are fully parsed, then exit; 0: run the server")
+    args = parser.parse_args()
+
+    assert args.latency_distribution in LATENCY_DISTRIBUTIONS
+    assert args.port >= 0
+    assert args.check_batched_self_evaluation in [0, 1]
+    if args.check_batched_self_evaluation == 1:
+        sys.exit(int(check_mock_batched_self_evaluation() > 0))
+
+    default_model = MockModel("default", latency_distribution=args.latency_distribution, latency_mean=args.latency_mean, latency_std=args.latency_std, error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate, malformed_rate=args.malformed_rate, max_context_tokens=args.max_context_tokens)
+    models = load_mock_models(args.model_configs_path, default_model) if args.model_configs_path != "" else {}
+    backend = MockLLMBackend(default_model, models=models, seed=args.seed)
+    server = http.server.ThreadingHTTPServer((args.host, args.port), get_mock_llm_handler(backend))
+    server.daemon_threads = True
+    print("Mock LLM server at http://{}:{}/v1".format(args.host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
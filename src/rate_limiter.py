@@ -0,0 +1,467 @@
+import time, random, asyncio, threading, collections, email.utils
+import openai
+from Method.llm_telemetry import get_llm_telemetry
+from Method.llm_dispatcher import get_llm_dispatcher
+
+
+# rough number of characters per token, used to estimate the tokens of a request before it is sent
+CHARS_PER_TOKEN = 4
+# completion tokens assumed for a request before its usage is known
+ESTIMATED_COMPLETION_TOKENS = 1024
+# backoff: the delay before retry n is drawn from [0, min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2^n)] (full jitter)
+BASE_BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+# error messages of a bad request (400) that indicate the prompt is too long for the model; retrying the same request will never work
+CONTEXT_LENGTH_KEYWORDS = ["maximum context length", "context_length_exceeded", "context length", "maximum length", "string too long", "too many tokens"]
+
+
+# errors that should not be retried (e.g., authentication, permission, bad request)
+class LLMFatalError(Exception):
+    pass
+
+
+# the prompt (plus the completion) is longer than the context window of the model
+class LLMContextLengthError(LLMFatalError):
+    pass
+
+
+# an LLM loop gave up on its item (e.g., its retry budget is used up, or the circuit of the backend is open); the caller of the item can skip it and record it in the failure ledger (Method.llm_budget)
+class LLMGiveUpError(LLMFatalError):
+    def __init__(self, message, stage=None, num_attempts=0, num_tokens=0):
+        super().__init__(message)
+        self.stage = stage
+        self.num_attempts = num_attempts
+        self.num_tokens = num_tokens
+        # context of the item added by the callers on the way up (e.g., {'mutation': '0'}); see llm_give_up_context()
+        self.context = {}
+
+
+# requests to the backend fail fast since it has failed too many times in a row
+class LLMCircuitOpenError(LLMGiveUpError):
+    pass
+
+
+## Function:
+#   classify an exception raised by the API client
+## Output
+#   error_type: 'retryable' / 'context_length' / 'fatal'
+def classify_llm_error(e):
+    # retryable errors first: a rate limit message may also mention tokens (e.g., "too many tokens per minute")
+    if isinstance(e, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError, openai.ConflictError)):
+        return "retryable"
+    if is_bad_request_error(e) and any(keyword in str(e).lower() for keyword in CONTEXT_LENGTH_KEYWORDS):
+        return "context_length"
+    if isinstance(e, (openai.AuthenticationError, openai.PermissionDeniedError, openai.NotFoundError, openai.BadRequestError, openai.UnprocessableEntityError)):
+        return "fatal"
+    if isinstance(e, openai.APIStatusError):
+        return "retryable" if e.status_code == 429 or e.status_code >= 500 else "fatal"
+    # unknown errors (e.g., malformed responses from a proxy) are retried as before
+    return "retryable"
+
+
+def is_bad_request_error(e):
+    return isinstance(e, openai.BadRequestError) or (isinstance(e, openai.APIStatusError) and e.status_code == 400)
+
+
+def is_rate_limit_error(e):
+    return isinstance(e, openai.RateLimitError) or (isinstance(e, openai.APIStatusError) and e.status_code == 429)
+
+
+## Function:
+#   seconds to wait suggested by the server ('retry-after-ms' / 'retry-after' headers); None if not provided
+def get_retry_after(e):
+    response = getattr(e, "response", None)
+    if response == None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms") != None:
+            return float(headers.get("retry-after-ms")) / 1000
+        retry_after = headers.get("retry-after")
+        if retry_after == None:
+            return None
+        try:
+            return float(retry_after)
+        except ValueError:
+            # HTTP-date format
+            retry_date = email.utils.parsedate_to_datetime(retry_after)
+            return max(0.0, retry_date.timestamp() - time.time())
+    except Exception:
+        return None
+
+
+## Function:
+#   exponential backoff with full jitter, so that threads failing at the same time do not retry in lockstep
+## Input
+#   attempt: 0 for the first retry
+#   retry_after: seconds suggested by the server; when given, wait at least that long (plus a small jitter)
+def compute_backoff_delay(attempt, retry_after=None, base_delay=BASE_BACKOFF_SECONDS, max_delay=MAX_BACKOFF_SECONDS):
+    if retry_after != None:
+        return retry_after + random.uniform(0, base_delay)
+    return random.uniform(0, min(max_delay, base_delay * (2 ** min(attempt, 30))))
+
+
+def estimate_num_tokens(text, completion_tokens=ESTIMATED_COMPLETION_TOKENS):
+    return len(text) // CHARS_PER_TOKEN + completion_tokens
+
+
+# token bucket: refills rate_per_min per minute, holds at most rate_per_min
+class TokenBucket(object):
+    def __init__(self, rate_per_min):
+        assert rate_per_min > 0
+        self.capacity = rate_per_min
+        self.refill_per_second = rate_per_min / 60.0
+        self.tokens = rate_per_min
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        cur_time = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (cur_time - self.last_refill) * self.refill_per_second)
+        self.last_refill = cur_time
+
+    ## Function:
+    #   the seconds to wait before amount can be taken; takes it if no wait is needed (then returns 0)
+    def try_take(self, amount):
+        # a single request larger than the whole bucket only waits for a full bucket
+        amount = min(amount, self.capacity)
+        with self.lock:
+            self.refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0.0
+            return (amount - self.tokens) / self.refill_per_second
+
+    def take(self, amount):
+        while True:
+            wait_time = self.try_take(amount)
+            if wait_time <= 0:
+                return
+            time.sleep(wait_time)
+
+    ## Function:
+    #   correct the bucket after the real usage is known (the balance might become negative, which delays later requests)
+    def adjust(self, amount):
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+# additive-increase / multiplicative-decrease limit on the number of in-flight requests
+class AIMDConcurrencyLimiter(object):
+    ## Input
+    # decrease_cooldown: seconds; many requests failing in the same burst only decrease the limit once
+    def __init__(self, max_concurrency, min_concurrency=1, decrease_factor=0.5, decrease_cooldown=2.0):
+        assert max_concurrency >= min_concurrency >= 1
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+        # [event loop, asyncio.Event] of the coroutines waiting for a slot, in the order they came; set by wake_async_waiters()
+        self.async_waiters = collections.deque()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    ## Function:
+    #   the same as acquire(), but waits on an asyncio.Event set when a slot is released (wake_async_waiters()), so that the event loop is never blocked
+    async def aacquire(self):
+        while True:
+            waiter = [asyncio.get_running_loop(), asyncio.Event()]
+            with self.condition:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                self.async_waiters.append(waiter)
+            try:
+                await waiter[1].wait()
+            except BaseException:
+                with self.condition:
+                    if waiter in self.async_waiters:
+                        self.async_waiters.remove(waiter)
+                    else:
+                        # woken but cancelled: pass the free slot on
+                        self.wake_async_waiters()
+                raise
+
+    ## Function:
+    #   wake as many waiting coroutines as there are free slots (a woken coroutine that loses its slot to another request waits again); should be called with self.condition held
+    def wake_async_waiters(self):
+        num_free_slots = int(self.limit) - self.in_flight
+        while num_free_slots > 0 and len(self.async_waiters) > 0:
+            cur_loop, cur_event = self.async_waiters.popleft()
+            # the release can come from another thread (or event loop) than the waiting coroutine
+            cur_loop.call_soon_threadsafe(cur_event.set)
+            num_free_slots -= 1
+
+    def release(self, if_rate_limited=False):
+        with self.condition:
+            self.in_flight -= 1
+            if if_rate_limited:
+                cur_time = time.monotonic()
+                if cur_time - self.last_decrease > self.decrease_cooldown:
+                    self.limit = max(self.min_concurrency, self.limit * self.decrease_factor)
+                    self.last_decrease = cur_time
+                    print("Rate limited: decrease LLM concurrency limit to {}".format(int(self.limit)))
+            else:
+                # +1 after a full window of successful requests
+                self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+            self.wake_async_waiters()
+
+
+# shared limiter of requests/min, tokens/min and concurrency (AIMD)
+class RateLimiter(object):
+    ## Input
+    # requests_per_min / tokens_per_min: 0: no limit
+    # max_concurrency: upper bound of the adaptive concurrency limit
+    def __init__(self, requests_per_min=0, tokens_per_min=0, max_concurrency=64):
+        self.config = (requests_per_min, tokens_per_min, max_concurrency)
+        self.request_bucket = TokenBucket(requests_per_min) if requests_per_min > 0 else None
+        self.token_bucket = TokenBucket(tokens_per_min) if tokens_per_min > 0 else None
+        self.concurrency_limiter = AIMDConcurrencyLimiter(max_concurrency)
+
+    def acquire(self, estimated_tokens=0):
+        self.concurrency_limiter.acquire()
+        if self.request_bucket != None:
+            self.request_bucket.take(1)
+        if self.token_bucket != None:
+            self.token_bucket.take(estimated_tokens)
+
+    ## Function:
+    #   the same as acquire(), but waits with asyncio so that the event loop is never blocked (the buckets are waited for with asyncio.sleep() until their next refill)
+    async def aacquire(self, estimated_tokens=0):
+        await self.concurrency_limiter.aacquire()
+        for cur_bucket, cur_amount in [(self.request_bucket, 1), (self.token_bucket, estimated_tokens)]:
+            if cur_bucket == None:
+                continue
+            while True:
+                wait_time = cur_bucket.try_take(cur_amount)
+                if wait_time <= 0:
+                    break
+                await asyncio.sleep(wait_time)
+
+    ## Input
+    # used_tokens: the real number of tokens of the request (from its usage) if known, to correct the estimated tokens
+    def release(self, estimated_tokens=0, used_tokens=None, if_rate_limited=False):
+        if self.token_bucket != None and used_tokens != None:
+            self.token_bucket.adjust(used_tokens - estimated_tokens)
+        self.concurrency_limiter.release(if_rate_limited=if_rate_limited)
+
+
+# the limiter shared by all LLM call sites of the process
+RATE_LIMITER = RateLimiter()
+
+
+def get_rate_limiter():
+    return RATE_LIMITER
+
+
+def set_rate_limiter(rate_limiter):
+    global RATE_LIMITER
+    RATE_LIMITER = rate_limiter
+
+
+## Function:
+#   set the limits of the process-wide rate limiter (the limiter is only rebuilt when the limits change, so that its state is kept)
+def setup_rate_limiter(requests_per_min=0, tokens_per_min=0, max_concurrency=64):
+    if get_rate_limiter().config != (requests_per_min, tokens_per_min, max_concurrency):
+        set_rate_limiter(RateLimiter(requests_per_min=requests_per_min, tokens_per_min=tokens_per_min, max_concurrency=max_concurrency))
+    return get_rate_limiter()
+
+
+def get_used_tokens(completion):
+    usage = getattr(completion, "usage", None)
+    if usage == None:
+        return None
+    return usage.total_tokens
+
+
+# circuit breaker of one backend: after failure_threshold retryable failures in a row (rate limiting excluded), the circuit is open and requests fail fast with LLMCircuitOpenError for cooldown_seconds; after that, requests are sent again, and the circuit is closed by the first success (or open again by the first failure)
+class LLMCircuitBreaker(object):
+    def __init__(self, backend, failure_threshold, cooldown_seconds):
+        assert failure_threshold >= 1 and cooldown_seconds >= 0
+        self.backend = backend
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.num_consecutive_failures = 0
+        # None: closed; otherwise the time when the circuit was opened
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def before_request(self):
+        with self.lock:
+            if self.opened_at != None and time.monotonic() - self.opened_at < self.cooldown_seconds:
+                raise LLMCircuitOpenError("circuit of backend {} is open after {} failures in a row".format(self.backend, self.num_consecutive_failures))
+
+    def record_success(self):
+        with self.lock:
+            self.num_consecutive_failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.num_consecutive_failures += 1
+            # a failure after the cooldown (half-open) opens the circuit again at once
+            if self.num_consecutive_failures >= self.failure_threshold or self.opened_at != None:
+                if self.opened_at == None:
+                    print("Warning: {} failures in a row; open the circuit of backend {} for {} seconds".format(self.num_consecutive_failures, self.backend, self.cooldown_seconds))
+                self.opened_at = time.monotonic()
+
+
+# (failure_threshold, cooldown_seconds) of the circuit breakers; failure_threshold 0: no circuit breaker
+LLM_CIRCUIT_BREAKER_CONFIG = (0, 0)
+# {backend: LLMCircuitBreaker}
+LLM_CIRCUIT_BREAKERS = {}
+LLM_CIRCUIT_BREAKERS_LOCK = threading.Lock()
+
+
+## Function:
+#   the circuit breaker shared by all requests to backend (e.g., the base url of the client); None if circuit breakers are disabled
+def get_llm_circuit_breaker(backend):
+    if LLM_CIRCUIT_BREAKER_CONFIG[0] == 0 or backend == None:
+        return None
+    with LLM_CIRCUIT_BREAKERS_LOCK:
+        if backend not in LLM_CIRCUIT_BREAKERS:
+            LLM_CIRCUIT_BREAKERS[backend] = LLMCircuitBreaker(backend, LLM_CIRCUIT_BREAKER_CONFIG[0], LLM_CIRCUIT_BREAKER_CONFIG[1])
+        return LLM_CIRCUIT_BREAKERS[backend]
+
+
+## Function:
+#   set the circuit breakers of the whole process (existing circuit breakers are only rebuilt when the config changes)
+## Input
+#   failure_threshold: 0: no circuit breaker
+def setup_llm_circuit_breakers(failure_threshold=0, cooldown_seconds=60):
+    global LLM_CIRCUIT_BREAKER_CONFIG
+    if LLM_CIRCUIT_BREAKER_CONFIG != (failure_threshold, cooldown_seconds):
+        with LLM_CIRCUIT_BREAKERS_LOCK:
+            LLM_CIRCUIT_BREAKER_CONFIG = (failure_threshold, cooldown_seconds)
+            LLM_CIRCUIT_BREAKERS.clear()
+
+
+## Function:
+#   send one request through the shared rate limiter; retry retryable errors with exponential backoff (with jitter, and honoring Retry-After)
+## Input
+#   request_fn: function without input that sends the request and returns the completion
+#   estimated_tokens: estimated prompt + completion tokens of the request, for the tokens/min limit
+#   max_attempts: None: retry retryable errors forever
+#   backend: name of the backend (e.g., get_llm_backend_name(client)) whose circuit breaker is used; None: no circuit breaker
+## Output
+#   completion: the return of request_fn
+## Raise
+#   LLMContextLengthError / LLMFatalError: for errors that should not be retried
+#   LLMCircuitOpenError: the circuit of the backend is open
+def call_llm_with_retry(request_fn, estimated_tokens=0, max_attempts=None, rate_limiter=None, backend=None, stage=None):
+    if rate_limiter == None:
+        rate_limiter = get_rate_limiter()
+    circuit_breaker = get_llm_circuit_breaker(backend)
+    llm_dispatcher = get_llm_dispatcher()
+    attempt = 0
+    while True:
+        if circuit_breaker != None:
+            circuit_breaker.before_request()
+        # each attempt waits for a slot of its priority class first (see Method.llm_dispatcher); the slot is not held during the backoff
+        dispatch_ticket = llm_dispatcher.acquire() if llm_dispatcher != None else None
+        try:
+            rate_limiter.acquire(estimated_tokens)
+        except BaseException:
+            if dispatch_ticket != None:
+                llm_dispatcher.release(dispatch_ticket)
+            raise
+        try:
+            completion = request_fn()
+        except Exception as e:
+            if dispatch_ticket != None:
+                llm_dispatcher.release(dispatch_ticket)
+            rate_limiter.release(estimated_tokens, if_rate_limited=is_rate_limit_error(e))
+            error_type = classify_llm_error(e)
+            if circuit_breaker != None and error_type == "retryable" and not is_rate_limit_error(e):
+                circuit_breaker.record_failure()
+            if error_type == "context_length":
+                raise LLMContextLengthError(str(e)) from e
+            if error_type == "fatal":
+                raise LLMFatalError(repr(e)) from e
+            if max_attempts != None and attempt + 1 >= max_attempts:
+                raise
+            delay = compute_backoff_delay(attempt, retry_after=get_retry_after(e))
+            print("LLM API error (attempt {}): {}; retry in {:.2f}s".format(attempt + 1, e, delay))
+            if get_llm_telemetry() != None:
+                get_llm_telemetry().record_retry(stage)
+            time.sleep(delay)
+            attempt += 1
+            continue
+        except BaseException:
+            # e.g., the coroutine is cancelled (the losing call of a hedged request)
+            if dispatch_ticket != None:
+                llm_dispatcher.release(dispatch_ticket)
+            rate_limiter.release(estimated_tokens)
+            raise
+        if dispatch_ticket != None:
+            llm_dispatcher.release(dispatch_ticket)
+        rate_limiter.release(estimated_tokens, used_tokens=get_used_tokens(completion))
+        if circuit_breaker != None:
+            circuit_breaker.record_success()
+        return completion
+
+
+## Function:
+#   async version of call_llm_with_retry()
+## Input
+#   request_fn: function without input that returns an awaitable of the completion (e.g., lambda: async_client.chat.completions.create(...))
+async def acall_llm_with_retry(request_fn, estimated_tokens=0, max_attempts=None, rate_limiter=None, backend=None, stage=None):
+    if rate_limiter == None:
+        rate_limiter = get_rate_limiter()
+    circuit_breaker = get_llm_circuit_breaker(backend)
+    llm_dispatcher = get_llm_dispatcher()
+    attempt = 0
+    while True:
+        if circuit_breaker != None:
+            circuit_breaker.before_request()
+        dispatch_ticket = await llm_dispatcher.aacquire() if llm_dispatcher != None else None
+        try:
+            await rate_limiter.aacquire(estimated_tokens)
+        except BaseException:
+            if dispatch_ticket != None:
+                llm_dispatcher.release(dispatch_ticket)
+            raise
+        try:
+            completion = await request_fn()
+        except Exception as e:
+            if dispatch_ticket != None:
+                llm_dispatcher.release(dispatch_ticket)
+            rate_limiter.release(estimated_tokens, if_rate_limited=is_rate_limit_error(e))
+            error_type = classify_llm_error(e)
+            if circuit_breaker != None and error_type == "retryable" and not is_rate_limit_error(e):
+                circuit_breaker.record_failure()
+            if error_type == "context_length":
+                raise LLMContextLengthError(str(e)) from e
+            if error_type == "fatal":
+                raise LLMFatalError(repr(e)) from e
+            if max_attempts != None and attempt + 1 >= max_attempts:
+                raise
+            delay = compute_backoff_delay(attempt, retry_after=get_retry_after(e))
+            print("LLM API error (attempt {}): {}; retry in {:.2f}s".format(attempt + 1, e, delay))
+            if get_llm_telemetry() != None:
+                get_llm_telemetry().record_retry(stage)
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+        except BaseException:
+            # e.g., the coroutine is cancelled (the losing call of a hedged request)
+            if dispatch_ticket != None:
+                llm_dispatcher.release(dispatch_ticket)
+            rate_limiter.release(estimated_tokens)
+            raise
+        if dispatch_ticket != None:
+            llm_dispatcher.release(dispatch_ticket)
+        rate_limiter.release(estimated_tokens, used_tokens=get_used_tokens(completion))
+        if circuit_breaker != None:
+            circuit_breaker.record_success()
+        return completion
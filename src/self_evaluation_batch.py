@@ -0,0 +1,163 @@
+import asyncio, threading, contextlib, contextvars
+from Method.utils import instruction_prompts, llm_generation, allm_generation, pick_batched_scores
+from Method.rate_limiter import LLMFatalError
+
+
+# Batched self-evaluation: the four-aspect scores of K hypotheses are asked in one request (four_aspects_self_numerical_evaluation_batched) instead of K requests; the hypotheses whose block is missing or can not be parsed are evaluated one by one again (by the caller's single-hypothesis evaluation)
+#   the EA in hypothesis_generation.py only needs the scores at the end of each unit of work (e.g., when the mutation lines of an inspiration are all developed), so the evaluations requested inside a unit are collected in a SelfEvaluationBatch and flushed together at its end (see self_evaluation_batch())
+
+
+## Output
+#   full_prompt: the prompt to evaluate all of hyp_list
+#   prompt_prefix: the instructions shared with the single-hypothesis evaluation; see llm_generation()
+def prepare_prompt_for_batched_self_evaluation(hyp_list):
+    prompts = instruction_prompts("four_aspects_self_numerical_evaluation_batched")
+    assert len(prompts) == 2
+    hyp_list_prompt = "".join(["\nHypothesis index: {}; hypothesis: {}.".format(cur_hyp_id, cur_hyp) for cur_hyp_id, cur_hyp in enumerate(hyp_list)])
+    full_prompt = prompts[0] + hyp_list_prompt + prompts[1]
+    return full_prompt, prompts[0]
+
+
+class SelfEvaluationBatchStats(object):
+    def __init__(self):
+        # number of batched requests, hypotheses scored by them, and hypotheses evaluated one by one again
+        self.num_batches = 0
+        self.num_batched_hyps = 0
+        self.num_fallback_hyps = 0
+        self.lock = threading.Lock()
+
+    def record_batch(self, num_hyps, num_fallback_hyps):
+        with self.lock:
+            self.num_batches += 1
+            self.num_batched_hyps += num_hyps - num_fallback_hyps
+            self.num_fallback_hyps += num_fallback_hyps
+
+    def print_stats(self):
+        print("Self-evaluation batches: {}; hypotheses scored in batches: {}; hypotheses evaluated one by one after a mismatch: {}".format(self.num_batches, self.num_batched_hyps, self.num_fallback_hyps))
+
+
+SELF_EVALUATION_BATCH_STATS = SelfEvaluationBatchStats()
+
+
+def get_self_evaluation_batch_stats():
+    return SELF_EVALUATION_BATCH_STATS
+
+
+## Output
+#   dict_idx2score: {hyp_idx: [score_collection, score_reason_collection], ...}; see pick_batched_scores(); {} if the request failed
+def evaluate_one_batch(hyp_list, model_name, client):
+    full_prompt, prompt_prefix = prepare_prompt_for_batched_self_evaluation(hyp_list)
+    try:
+        score_text = llm_generation(full_prompt, model_name, client, stage="self_evaluation", prompt_prefix=prompt_prefix)
+    except LLMFatalError:
+        raise
+    except Exception as e:
+        print("Warning: batched self-evaluation failed ({}), evaluate the hypotheses one by one..".format(repr(e)))
+        return {}
+    return pick_batched_scores(score_text, full_prompt, len(hyp_list))
+
+
+async def aevaluate_one_batch(hyp_list, model_name, async_client):
+    full_prompt, prompt_prefix = prepare_prompt_for_batched_self_evaluation(hyp_list)
+    try:
+        score_text = await allm_generation(full_prompt, model_name, async_client, stage="self_evaluation", prompt_prefix=prompt_prefix)
+    except LLMFatalError:
+        raise
+    except Exception as e:
+        print("Warning: batched self-evaluation failed ({}), evaluate the hypotheses one by one..".format(repr(e)))
+        return {}
+    return pick_batched_scores(score_text, full_prompt, len(hyp_list))
+
+
+## Function:
+#   self-evaluate hyp_list in batches of batch_size
+## Input
+#   evaluate_one_fn: evaluate_one_fn(hyp_idx) -> [score_collection, score_reason_collection] (or None, e.g., if it gave up); evaluates hyp_list[hyp_idx] alone, used for the hypotheses that the batched request did not score
+## Output
+#   score_and_reason_list: [[score_collection, score_reason_collection], ...]; aligned with hyp_list
+def evaluate_hypotheses_in_batches(hyp_list, batch_size, model_name, client, evaluate_one_fn):
+    assert batch_size >= 1
+    score_and_reason_list = [None] * len(hyp_list)
+    for start_id in range(0, len(hyp_list), batch_size):
+        cur_hyp_list = hyp_list[start_id:start_id+batch_size]
+        dict_idx2score = {}
+        if len(cur_hyp_list) > 1:
+            dict_idx2score = evaluate_one_batch(cur_hyp_list, model_name, client)
+            get_self_evaluation_batch_stats().record_batch(len(cur_hyp_list), len(cur_hyp_list) - len(dict_idx2score))
+        for cur_idx in range(len(cur_hyp_list)):
+            if cur_idx in dict_idx2score:
+                score_and_reason_list[start_id+cur_idx] = dict_idx2score[cur_idx]
+            else:
+                score_and_reason_list[start_id+cur_idx] = evaluate_one_fn(start_id+cur_idx)
+    return score_and_reason_list
+
+
+# asyncio version of evaluate_hypotheses_in_batches(): the batches are sent concurrently; aevaluate_one_fn(hyp_idx) returns an awaitable
+async def aevaluate_hypotheses_in_batches(hyp_list, batch_size, model_name, async_client, aevaluate_one_fn):
+    assert batch_size >= 1
+    async def aevaluate_batch(start_id):
+        cur_hyp_list = hyp_list[start_id:start_id+batch_size]
+        dict_idx2score = {}
+        if len(cur_hyp_list) > 1:
+            dict_idx2score = await aevaluate_one_batch(cur_hyp_list, model_name, async_client)
+            get_self_evaluation_batch_stats().record_batch(len(cur_hyp_list), len(cur_hyp_list) - len(dict_idx2score))
+        fallback_list = await asyncio.gather(*[aevaluate_one_fn(start_id+cur_idx) for cur_idx in range(len(cur_hyp_list)) if cur_idx not in dict_idx2score])
+        fallback_list.reverse()
+        return [dict_idx2score[cur_idx] if cur_idx in dict_idx2score else fallback_list.pop() for cur_idx in range(len(cur_hyp_list))]
+    batch_result_list = await asyncio.gather(*[aevaluate_batch(start_id) for start_id in range(0, len(hyp_list), batch_size)])
+    return [item for cur_batch_result in batch_result_list for item in cur_batch_result]
+
+
+# the self-evaluations requested inside one unit of work, to be flushed together at its end
+class SelfEvaluationBatch(object):
+    def __init__(self, batch_size):
+        assert batch_size > 1
+        self.batch_size = batch_size
+        # pending: [[hyp, hyp_numerical_self_eval], ...]; hyp_numerical_self_eval: the list given to the caller of add(), filled with [score_collection, score_reason_collection] by flush()
+        self.pending = []
+
+    ## Output
+    #   hyp_numerical_self_eval: [] until flush(), then [score_collection, score_reason_collection]
+    def add(self, hyp):
+        hyp_numerical_self_eval = []
+        self.pending.append([hyp, hyp_numerical_self_eval])
+        return hyp_numerical_self_eval
+
+    ## Input
+    #   evaluate_one_fn: evaluate_one_fn(hyp) -> [score_collection, score_reason_collection]; the single-hypothesis evaluation
+    def flush(self, model_name, client, evaluate_one_fn):
+        pending, self.pending = self.pending, []
+        hyp_list = [cur_pending[0] for cur_pending in pending]
+        score_and_reason_list = evaluate_hypotheses_in_batches(hyp_list, self.batch_size, model_name, client, lambda cur_idx: evaluate_one_fn(hyp_list[cur_idx]))
+        for cur_pending, cur_score_and_reason in zip(pending, score_and_reason_list):
+            cur_pending[1].extend(cur_score_and_reason)
+
+    async def aflush(self, model_name, async_client, aevaluate_one_fn):
+        pending, self.pending = self.pending, []
+        hyp_list = [cur_pending[0] for cur_pending in pending]
+        score_and_reason_list = await aevaluate_hypotheses_in_batches(hyp_list, self.batch_size, model_name, async_client, lambda cur_idx: aevaluate_one_fn(hyp_list[cur_idx]))
+        for cur_pending, cur_score_and_reason in zip(pending, score_and_reason_list):
+            cur_pending[1].extend(cur_score_and_reason)
+
+
+# the batch of the current unit of work (thread / asyncio task and the tasks it creates); None: the hypotheses are evaluated right away
+CURRENT_SELF_EVALUATION_BATCH = contextvars.ContextVar("self_evaluation_batch", default=None)
+
+
+def get_self_evaluation_batch():
+    return CURRENT_SELF_EVALUATION_BATCH.get()
+
+
+## Function:
+#   collect the self-evaluations requested inside the with block in a new SelfEvaluationBatch (None if batch_size <= 1); the block should flush it before it ends
+@contextlib.contextmanager
+def self_evaluation_batch(batch_size):
+    if batch_size <= 1:
+        yield None
+        return
+    batch = SelfEvaluationBatch(batch_size)
+    token = CURRENT_SELF_EVALUATION_BATCH.set(batch)
+    try:
+        yield batch
+    finally:
+        CURRENT_SELF_EVALUATION_BATCH.reset(token)
@@ -0,0 +1,126 @@
+import re, json, threading
+import openai
+from Method.rate_limiter import LLMContextLengthError
+
+
+# the score block parsed by pick_score() (used as the template of the self-evaluation requests)
+FOUR_ASPECT_SCORE_TEMPLATE = ['Validness score:', 'Novelty score:', 'Significance score:', 'Potential score:']
+FOUR_ASPECT_REASON_FORMAT = 'Concise reason:'
+POTENTIAL_SCORES = [1, 2, 3, 4, 5]
+
+
+# 'Reasoning Process:' -> 'reasoning_process'
+def get_field_name(template_item):
+    return re.sub("[^a-z0-9]+", "_", template_item.lower()).strip("_")
+
+
+def get_strict_object_schema(properties):
+    return {"type": "object", "properties": properties, "required": list(properties.keys()), "additionalProperties": False}
+
+
+## Function:
+#   JSON schema of the structured output of a template
+## Input
+#   template: ['Title:', 'Reason:'] (a list of [template[0], template[1]] blocks) or FOUR_ASPECT_SCORE_TEMPLATE (the four scores and their reasons)
+## Output
+#   schema_name: text
+#   schema: JSON schema (strict mode)
+def get_template_json_schema(template):
+    if template == FOUR_ASPECT_SCORE_TEMPLATE:
+        properties = {}
+        for cur_score_format in FOUR_ASPECT_SCORE_TEMPLATE:
+            cur_field = get_field_name(cur_score_format)
+            properties[cur_field] = {"type": "integer", "enum": POTENTIAL_SCORES}
+            properties[cur_field.replace("_score", "_reason")] = {"type": "string"}
+        return "four_aspect_scores", get_strict_object_schema(properties)
+    assert len(template) == 2, print("template: ", template)
+    block_schema = get_strict_object_schema({get_field_name(template[0]): {"type": "string"}, get_field_name(template[1]): {"type": "string"}})
+    schema_name = "{}_{}".format(get_field_name(template[0]), get_field_name(template[1]))
+    return schema_name, get_strict_object_schema({"blocks": {"type": "array", "items": block_schema}})
+
+
+# response_format parameter of chat.completions.create()
+def get_response_format(template):
+    schema_name, schema = get_template_json_schema(template)
+    return {"type": "json_schema", "json_schema": {"name": schema_name, "strict": True, "schema": schema}}
+
+
+## Function:
+#   render the structured output (JSON text) in the text format of the template, so that it is parsed by get_structured_generation_from_raw_generation() / pick_score() without a restructuring call
+## Output
+#   generation: text; e.g., "Title: ...\nReason: ...\n\nTitle: ...\nReason: ..."
+def structured_output_to_generation(structured_output, template):
+    content = json.loads(structured_output)
+    if template == FOUR_ASPECT_SCORE_TEMPLATE:
+        generation = []
+        for cur_score_format in FOUR_ASPECT_SCORE_TEMPLATE:
+            cur_field = get_field_name(cur_score_format)
+            assert content[cur_field] in POTENTIAL_SCORES, print("content[cur_field]: ", content[cur_field])
+            generation.append("{} {}\n{} {}".format(cur_score_format, content[cur_field], FOUR_ASPECT_REASON_FORMAT, content[cur_field.replace("_score", "_reason")].strip()))
+        return "\n".join(generation)
+    assert len(content["blocks"]) > 0, print("content: ", content)
+    generation = []
+    for cur_block in content["blocks"]:
+        generation.append("{} {}\n{} {}".format(template[0], cur_block[get_field_name(template[0])].strip(), template[1], cur_block[get_field_name(template[1])].strip()))
+    return "\n\n".join(generation)
+
+
+# a bad request that is caused by response_format (the backend does not support structured output); errors are raised by call_llm_with_retry() as LLMFatalError from the original error
+def if_structured_output_unsupported_error(e):
+    return not isinstance(e, LLMContextLengthError) and isinstance(e.__cause__, (openai.BadRequestError, openai.UnprocessableEntityError))
+
+
+# state of the structured-output request mode shared by the whole process: the models whose backend does not support response_format (they are sent as text requests afterwards), and the stats
+class LLMStructuredOutput(object):
+    def __init__(self):
+        self.unsupported_models = set()
+        # stats: {stage: {'structured': int, 'unsupported': int, 'restructuring': int}, ...}
+        #   structured: responses received as structured output (parsed without a restructuring call)
+        #   unsupported: requests sent as text since the backend does not support structured output
+        #   restructuring: restructuring calls made for text responses that could not be parsed
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def if_supported(self, model_name):
+        with self.lock:
+            return model_name not in self.unsupported_models
+
+    def mark_unsupported(self, model_name, e):
+        with self.lock:
+            if model_name not in self.unsupported_models:
+                self.unsupported_models.add(model_name)
+                print("Warning: structured output is not supported for {} ({}); using text requests instead".format(model_name, repr(e)))
+
+    def update_stats(self, stage, item):
+        with self.lock:
+            if stage not in self.stats:
+                self.stats[stage] = {'structured': 0, 'unsupported': 0, 'restructuring': 0}
+            self.stats[stage][item] += 1
+
+    def print_stats(self):
+        for cur_stage in self.stats:
+            cur_stats = self.stats[cur_stage]
+            print("LLM structured output; stage: {}; structured responses (no restructuring call needed): {}; text requests (not supported): {}; restructuring calls: {}".format(cur_stage, cur_stats['structured'], cur_stats['unsupported'], cur_stats['restructuring']))
+
+
+# None: structured generations are always requested as text and parsed by template matching
+LLM_STRUCTURED_OUTPUT = None
+
+
+def get_llm_structured_output():
+    return LLM_STRUCTURED_OUTPUT
+
+
+def set_llm_structured_output(llm_structured_output):
+    global LLM_STRUCTURED_OUTPUT
+    LLM_STRUCTURED_OUTPUT = llm_structured_output
+
+
+## Function:
+#   enable or disable the structured-output request mode for the whole process (the existing state and its stats are kept when it is already enabled)
+def setup_llm_structured_output(if_structured_output=True):
+    if not if_structured_output:
+        set_llm_structured_output(None)
+    elif get_llm_structured_output() == None:
+        set_llm_structured_output(LLMStructuredOutput())
+    return get_llm_structured_output()
@@ -0,0 +1,391 @@
+import os, re, sys, json, threading
+
+
+# Tolerant single-pass parsers of the generations that follow a template (e.g., ['Title:', 'Reason:']) or the four-aspect score format; a generation with a small deviation from the asked format is parsed instead of costing a new generation (or an LLM restructuring call)
+#   deviations that are tolerated: text before the first label, labels in a different case, with markdown ('**Title:**'), with a bullet / number ('1. Title:', 'Title 1:'), with a modifier added or dropped ('Hypothesis:' for 'Refined Hypothesis:'), on the same line as the previous field ('Title: A; Reason: B'), repeated labels in one block, and scores as '4/5', '4 points' or '4 out of 5'
+#   each parse reports its deviations and a confidence; the counts (and the generations that the previous strict parsers could not parse, i.e., the retries avoided) are kept in TemplateParserStats
+
+
+# '#' and '*' are removed from the generation, since they are usually added by the LLM as markdown format; used to match text (e.g., title) with the benchmark
+MARKDOWN_PATTERN = re.compile(r"[#*]")
+# words that the LLM adds to / drops from a label, e.g., 'Refined Hypothesis:' vs 'Hypothesis:'
+LABEL_MODIFIERS = ["refined", "revised", "updated", "improved", "final", "new"]
+# bullet or number before a label at the start of a line, e.g., '- Title:', '1. Title:', '(2) Title:'
+LINE_PREFIX = r"(?:[-•>]+[ \t]*|\(?\d{1,2}[.)][ \t]*)?"
+# confidence of a parse with each deviation; the confidence of a parse is the product over its deviations
+DEVIATION_CONFIDENCE = {"leading_text": 0.95, "case": 0.95, "list_prefix": 0.95, "alias": 0.9, "inline_label": 0.85, "repeated_label": 0.8, "empty_field": 0.6, "score_format": 0.95, "score_next_line": 0.95}
+
+SCORE_ASPECTS = ['Validness', 'Novelty', 'Significance', 'Potential']
+SCORE_LINE_PATTERN = re.compile(r"^" + LINE_PREFIX + r"(validness|novelty|significance|potential)[ \t]+score[ \t]*[:：](.*)$", re.I)
+REASON_LINE_PATTERN = re.compile(r"^" + LINE_PREFIX + r"(?:concise[ \t]+)?reason[ \t]*[:：](.*)$", re.I)
+# a score in [1, 5], optionally followed by its scale, e.g., '4', '4/5', '4 points', '4 out of 5', '(4)'
+SCORE_VALUE_PATTERN = re.compile(r"^\(?([1-5])(?:\.0)?\)?[ \t]*(/[ \t]*5|out[ \t]+of[ \t]+5|points?|pts)?(?:[ \t]*[;,(\-]|\.(?!\d)|[ \t]*$)", re.I)
+
+
+## Function:
+#   the regex of a template label, tolerant of a dropped / added modifier (the case is tolerated by compiling it with re.I), a number and spaces before the colon
+## Input
+#   label: e.g., 'Refined Hypothesis:'
+#   if_exact: only tolerate the number and the spaces (the words of the label as they are, e.g., 'Hypothesis:' is not 'Refined Hypothesis:')
+def compile_label_pattern(label, if_exact=False):
+    words = label.strip().rstrip(":：").split()
+    modifiers = ""
+    if not if_exact:
+        while len(words) > 1 and words[0].lower() in LABEL_MODIFIERS:
+            words = words[1:]
+        modifiers = r"(?:(?:" + "|".join(LABEL_MODIFIERS) + r")[ \t]+)?"
+    return modifiers + r"[ \t]+".join([re.escape(cur_word) for cur_word in words]) + r"(?:[ \t]*\d{1,2})?[ \t]*[:：]"
+
+
+class TemplateParser(object):
+    ## Input
+    #   template: e.g., ['Title:', 'Reason:']
+    def __init__(self, template):
+        assert len(template) == 2, print("template: ", template)
+        self.template = template
+        # a label at the start of a line (preferred), or anywhere; the exact labels (case-sensitive, without alias) are preferred, so that a label echoed in another form (e.g., the 'Hypothesis:' before a 'Refined Hypothesis:', or 'hypothesis:' in a content line) is not taken as a label when the exact one is there
+        self.exact_line_patterns = [re.compile(r"^[ \t]*(" + LINE_PREFIX + r")(" + compile_label_pattern(cur_label, if_exact=True) + r")", re.M) for cur_label in template]
+        self.exact_inline_patterns = [re.compile(compile_label_pattern(cur_label, if_exact=True)) for cur_label in template]
+        self.line_patterns = [re.compile(r"^[ \t]*(" + LINE_PREFIX + r")(" + compile_label_pattern(cur_label) + r")", re.I | re.M) for cur_label in template]
+        self.inline_patterns = [re.compile(compile_label_pattern(cur_label), re.I) for cur_label in template]
+
+    ## Output
+    #   label_matches: [[start, end, matched_label, line_prefix], ...] of template[label_id] in text; the exact labels first (at the start of a line, then anywhere), then the tolerant ones only if there is no exact one
+    #   if_inline: whether the labels are matched anywhere (not at the start of a line)
+    #   inline_pattern: the pattern of the matched labels anywhere (to count the repeated labels)
+    def find_labels(self, label_id, text):
+        for cur_line_pattern, cur_inline_pattern in [[self.exact_line_patterns[label_id], self.exact_inline_patterns[label_id]], [self.line_patterns[label_id], self.inline_patterns[label_id]]]:
+            label_matches = [[m.start(), m.end(), m.group(2), m.group(1)] for m in cur_line_pattern.finditer(text)]
+            if len(label_matches) > 0:
+                return label_matches, False, cur_inline_pattern
+            label_matches = [[m.start(), m.end(), m.group(0), ""] for m in cur_inline_pattern.finditer(text)]
+            if len(label_matches) > 0:
+                return label_matches, True, cur_inline_pattern
+        return [], False, None
+
+    # the deviation of a matched label from the template label
+    def add_label_deviations(self, matched_label, label, line_prefix, deviations):
+        matched_label = re.sub(r"[ \t]+", " ", matched_label.strip())
+        if line_prefix.strip() != "":
+            deviations.add("list_prefix")
+        if matched_label == label:
+            return
+        if matched_label.lower() == label.lower():
+            deviations.add("case")
+        else:
+            deviations.add("alias")
+
+    ## Output
+    #   structured_gene: [[content0, content1], ...]; e.g., [[title, reason], [title, reason], ...]
+    #   confidence: in (0, 1]; 1: the generation follows the template exactly
+    #   deviations: sorted list of the deviations; see DEVIATION_CONFIDENCE
+    ## Exception
+    #   AssertionError if the generation can not be parsed with the template
+    def parse(self, gene):
+        gene = MARKDOWN_PATTERN.sub("", gene).strip()
+        deviations = set()
+        # label_matches: [[start, end, matched_label, line_prefix], ...] of template[0]
+        label_matches, if_inline, _ = self.find_labels(0, gene)
+        assert len(label_matches) > 0, "can't find {} in the generation".format(self.template[0])
+        if if_inline:
+            deviations.add("inline_label")
+        if gene[:label_matches[0][0]].strip() != "":
+            deviations.add("leading_text")
+        structured_gene = []
+        for cur_id, (cur_start, cur_end, cur_label, cur_prefix) in enumerate(label_matches):
+            self.add_label_deviations(cur_label, self.template[0], cur_prefix, deviations)
+            cur_block = gene[cur_end:label_matches[cur_id+1][0]] if cur_id + 1 < len(label_matches) else gene[cur_end:]
+            # the first template[1] at the start of a line (preferred, since it matches more as the designed format), otherwise the first one anywhere
+            cur_second_matches, if_inline, cur_inline_pattern = self.find_labels(1, cur_block)
+            assert len(cur_second_matches) > 0, "can't find {} in the block: {}".format(self.template[1], cur_block)
+            cur_second = cur_second_matches[0]
+            if if_inline:
+                deviations.add("inline_label")
+            self.add_label_deviations(cur_second[2], self.template[1], cur_second[3], deviations)
+            # the other template[1] in the block are kept in the content
+            if len(cur_inline_pattern.findall(cur_block)) > 1:
+                deviations.add("repeated_label")
+            cur_contents = [cur_block[:cur_second[0]], cur_block[cur_second[1]:]]
+            cur_contents = [cur_content.strip().strip(";").strip() for cur_content in cur_contents]
+            if "" in cur_contents:
+                deviations.add("empty_field")
+            structured_gene.append(cur_contents)
+        return structured_gene, get_confidence(deviations), sorted(deviations)
+
+
+def get_confidence(deviations):
+    confidence = 1.0
+    for cur_deviation in deviations:
+        confidence *= DEVIATION_CONFIDENCE[cur_deviation]
+    return confidence
+
+
+# compiled parsers of the templates in use: {tuple(template): TemplateParser}
+TEMPLATE_PARSERS = {}
+TEMPLATE_PARSERS_LOCK = threading.Lock()
+
+
+def get_template_parser(template):
+    key = tuple(template)
+    if key not in TEMPLATE_PARSERS:
+        with TEMPLATE_PARSERS_LOCK:
+            if key not in TEMPLATE_PARSERS:
+                TEMPLATE_PARSERS[key] = TemplateParser(template)
+    return TEMPLATE_PARSERS[key]
+
+
+## Function:
+#   the score in [1, 5] at the start of text; e.g., '4', '4/5', '4 points', '4 out of 5'
+## Output
+#   score: int, or None if text does not start with a score
+#   if_scale: whether the score is followed by its scale (e.g., '/5', 'points')
+def parse_score_value(text):
+    m = SCORE_VALUE_PATTERN.match(text.strip())
+    if m == None:
+        return None, False
+    return int(m.group(1)), m.group(2) != None
+
+
+## Function:
+#   parse the four-aspect scores and their reasons of a self-evaluation in one pass (the same output as Method.utils.pick_score())
+## Output
+#   score_collection: [score0, score1, score2, score3]
+#   score_reason_collection: [reason0, reason1, reason2, reason3]
+#   if_successful: whether four scores (of the four aspects, in order) and four reasons are found
+#   confidence, deviations: see TemplateParser.parse()
+## Exception
+#   Exception if a score label is not followed by a score
+def parse_four_aspect_scores(cur_generation):
+    lines = [MARKDOWN_PATTERN.sub("", cur_line).strip() for cur_line in cur_generation.split('\n')]
+    score_collection, score_reason_collection, aspect_collection = [], [], []
+    deviations = set()
+    # 'score' / 'reason': the value of the label on the previous line is on the next non-empty line
+    expect_next_line = None
+    for cur_line in lines:
+        if expect_next_line != None:
+            if cur_line == "":
+                continue
+            if expect_next_line == "score":
+                cur_score, cur_if_scale = parse_score_value(cur_line)
+                if cur_score == None:
+                    raise Exception("Can't find score: ", cur_line)
+                score_collection.append(cur_score)
+                deviations.add("score_next_line")
+                if cur_if_scale:
+                    deviations.add("score_format")
+            else:
+                cur_reason_m = REASON_LINE_PATTERN.match(cur_line)
+                score_reason_collection.append(cur_reason_m.group(1).strip() if cur_reason_m != None else cur_line)
+            expect_next_line = None
+            continue
+        cur_score_m = SCORE_LINE_PATTERN.match(cur_line)
+        if cur_score_m != None:
+            aspect_collection.append(cur_score_m.group(1).capitalize())
+            if cur_score_m.group(1) != cur_score_m.group(1).capitalize():
+                deviations.add("case")
+            cur_rest = cur_score_m.group(2).strip()
+            if cur_rest == "":
+                expect_next_line = "score"
+                continue
+            cur_score, cur_if_scale = parse_score_value(cur_rest)
+            if cur_score == None:
+                raise Exception("Can't find score: ", cur_line)
+            score_collection.append(cur_score)
+            if cur_if_scale:
+                deviations.add("score_format")
+            # the reason on the same line, e.g., 'Validness score: 4; Concise reason: ...'
+            cur_reason_m = re.search(r"(?:concise[ \t]+)?reason[ \t]*[:：](.*)$", cur_rest, re.I)
+            if cur_reason_m != None and cur_reason_m.group(1).strip() != "":
+                score_reason_collection.append(cur_reason_m.group(1).strip())
+                deviations.add("inline_label")
+            continue
+        cur_reason_m = REASON_LINE_PATTERN.match(cur_line)
+        if cur_reason_m != None:
+            if cur_reason_m.group(1).strip() == "":
+                expect_next_line = "reason"
+            else:
+                score_reason_collection.append(cur_reason_m.group(1).strip())
+    if_successful = len(score_collection) == 4 and len(score_reason_collection) == 4 and aspect_collection == SCORE_ASPECTS
+    return score_collection, score_reason_collection, if_successful, get_confidence(deviations), sorted(deviations)
+
+
+## Function:
+#   the previous (strict) parser of Method.utils.get_structured_generation_from_raw_generation(); only used to count the generations that it can not parse (each one was a new generation or a restructuring call); see TemplateParserStats
+def strict_parse_structured_generation(gene, template):
+    gene = MARKDOWN_PATTERN.sub("", gene).strip()
+    if not gene.startswith(template[0]):
+        gene_split = [item for item in gene.split('\n') if item.strip() != ""]
+        assert len(gene_split) >= 2
+        for id_line, line in enumerate(gene_split):
+            if gene_split[id_line].find(template[0]) > 0 and gene_split[id_line].find(template[0]) < 15:
+                gene_split_split = gene_split[id_line].split(template[0])
+                assert len(gene_split_split) == 2
+                gene_split[id_line] = template[0] + gene_split_split[1]
+            if gene_split[id_line].startswith(template[0]):
+                gene = '\n'.join(gene_split[id_line:])
+                break
+        assert gene.startswith(template[0])
+    structured_gene = []
+    for cur_gs in gene.split(template[0]):
+        cur_gs = cur_gs.strip()
+        if cur_gs == "":
+            continue
+        cur_gs_split = cur_gs.split(template[1])
+        if len(cur_gs_split) > 2:
+            cur_gs_split = cur_gs.split('\n' + template[1])
+            if len(cur_gs_split) > 2:
+                cur_gs_split = [cur_gs_split[0], '\n'.join(cur_gs_split[1:])]
+            elif len(cur_gs_split) == 1:
+                cur_gs_split = cur_gs.split(template[1])
+                cur_gs_split = [cur_gs_split[0], '\n'.join(cur_gs_split[1:])]
+        assert len(cur_gs_split) == 2
+        structured_gene.append([item.strip().strip(";").strip() for item in cur_gs_split])
+    return structured_gene
+
+
+## Function:
+#   the previous (strict) parser of Method.utils.pick_score(); see strict_parse_structured_generation()
+def strict_parse_four_aspect_scores(cur_generation):
+    score_format = [cur_aspect + ' score:' for cur_aspect in SCORE_ASPECTS]
+    reason_format = 'Concise reason:'
+    score_collection, score_reason_collection = [], []
+    if_mode1_next_is_reason = 0
+    for cur_sent in cur_generation.split('\n'):
+        if if_mode1_next_is_reason == 1:
+            cur_sent = cur_sent.replace(reason_format, "").strip()
+            if len(cur_sent) == 0:
+                return False
+            score_reason_collection.append(cur_sent)
+            if_mode1_next_is_reason = 0
+        elif reason_format in cur_sent:
+            cur_sent = cur_sent.replace(reason_format, "").strip()
+            if len(cur_sent) > 0:
+                score_reason_collection.append(cur_sent)
+            else:
+                if_mode1_next_is_reason = 1
+        else:
+            for cur_score_format in score_format:
+                if cur_score_format in cur_sent:
+                    cur_score = cur_sent.replace(cur_score_format, "").replace("points", "").replace("point", "").replace("*", "").strip()
+                    if cur_score not in ['1', '2', '3', '4', '5']:
+                        return False
+                    score_collection.append(int(cur_score))
+                    break
+    return len(score_collection) == len(score_reason_collection) and len(score_collection) == 4
+
+
+class TemplateParserStats(object):
+    def __init__(self):
+        # {template key (e.g., 'Title:' or 'four_aspect_scores'): {'parsed': int, 'failed': int, 'with_deviations': int, 'recovered': int, 'deviations': {deviation: int}}}
+        #   recovered: parsed generations that the previous strict parser could not parse (each one saved a new generation or a restructuring call)
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def get_template_stats(self, key):
+        if key not in self.stats:
+            self.stats[key] = {'parsed': 0, 'failed': 0, 'with_deviations': 0, 'recovered': 0, 'deviations': {}}
+        return self.stats[key]
+
+    def record(self, key, if_parsed, deviations=[], if_recovered=False):
+        with self.lock:
+            cur_stats = self.get_template_stats(key)
+            if not if_parsed:
+                cur_stats['failed'] += 1
+                return
+            cur_stats['parsed'] += 1
+            if len(deviations) > 0:
+                cur_stats['with_deviations'] += 1
+            if if_recovered:
+                cur_stats['recovered'] += 1
+            for cur_deviation in deviations:
+                cur_stats['deviations'][cur_deviation] = cur_stats['deviations'].get(cur_deviation, 0) + 1
+
+    def get_num_parsed(self):
+        return sum([cur_stats['parsed'] + cur_stats['failed'] for cur_stats in self.stats.values()])
+
+    def print_stats(self):
+        for cur_key in self.stats:
+            cur_stats = self.stats[cur_key]
+            print("Template parser; template: {}; parsed: {}; failed: {}; parsed with deviations: {}; retries avoided (not parsed by the strict parser): {}; deviations: {}".format(cur_key, cur_stats['parsed'], cur_stats['failed'], cur_stats['with_deviations'], cur_stats['recovered'], cur_stats['deviations']))
+
+
+TEMPLATE_PARSER_STATS = TemplateParserStats()
+
+
+def get_template_parser_stats():
+    return TEMPLATE_PARSER_STATS
+
+
+## Function:
+#   TemplateParser.parse() of template, recorded in the stats
+def parse_structured_generation(gene, template):
+    try:
+        structured_gene, confidence, deviations = get_template_parser(template).parse(gene)
+    except AssertionError:
+        get_template_parser_stats().record(template[0], False)
+        raise
+    # only a generation with deviations might not be parsed by the strict parser
+    if_recovered = False
+    if len(deviations) > 0:
+        try:
+            strict_parse_structured_generation(gene, template)
+        except Exception:
+            if_recovered = True
+    get_template_parser_stats().record(template[0], True, deviations, if_recovered)
+    return structured_gene, confidence, deviations
+
+
+## Function:
+#   parse_four_aspect_scores(), recorded in the stats
+def parse_four_aspect_scores_with_stats(cur_generation):
+    try:
+        score_collection, score_reason_collection, if_successful, confidence, deviations = parse_four_aspect_scores(cur_generation)
+    except Exception:
+        get_template_parser_stats().record("four_aspect_scores", False)
+        raise
+    if not if_successful:
+        get_template_parser_stats().record("four_aspect_scores", False)
+    else:
+        if_recovered = len(deviations) > 0 and not strict_parse_four_aspect_scores(cur_generation)
+        get_template_parser_stats().record("four_aspect_scores", True, deviations, if_recovered)
+    return score_collection, score_reason_collection, if_successful, confidence, deviations
+
+
+## Function:
+#   check the parsers on the fixtures (generations with the deviations met in real runs) and count how many of them the strict parsers parse the same way
+## Input
+#   fixture_path: JSON file; [{"template": ['Title:', 'Reason:'] or "four_aspect_scores", "generation": str, "expected": structured_gene / [score_collection, score_reason_collection] / null (not parseable)}, ...]
+## Output
+#   num_failed_fixtures: number of fixtures whose parse is not the expected one
+def check_fixtures(fixture_path):
+    with open(fixture_path, 'r') as f:
+        fixtures = json.load(f)
+    num_failed_fixtures, num_strict_parsed = 0, 0
+    for cur_id, cur_fixture in enumerate(fixtures):
+        try:
+            if cur_fixture["template"] == "four_aspect_scores":
+                score_collection, score_reason_collection, if_successful, confidence, deviations = parse_four_aspect_scores(cur_fixture["generation"])
+                assert if_successful
+                parsed = [score_collection, score_reason_collection]
+                if_strict_parsed = strict_parse_four_aspect_scores(cur_fixture["generation"])
+            else:
+                parsed, confidence, deviations = get_template_parser(cur_fixture["template"]).parse(cur_fixture["generation"])
+                try:
+                    if_strict_parsed = strict_parse_structured_generation(cur_fixture["generation"], cur_fixture["template"]) == parsed
+                except Exception:
+                    if_strict_parsed = False
+        except Exception:
+            parsed, confidence, deviations, if_strict_parsed = None, 0.0, [], False
+        num_strict_parsed += int(if_strict_parsed)
+        if parsed != cur_fixture["expected"]:
+            num_failed_fixtures += 1
+            print("Fixture {} failed; expected: {}; parsed: {}".format(cur_id, cur_fixture["expected"], parsed))
+        else:
+            print("Fixture {} passed; confidence: {:.2f}; deviations: {}; strict parser: {}".format(cur_id, confidence, deviations, "same parse" if if_strict_parsed else "failed or different"))
+    print("Fixtures: {}; failed: {}; parsed by the strict parsers: {}".format(len(fixtures), num_failed_fixtures, num_strict_parsed))
+    return num_failed_fixtures
+
+
+if __name__ == "__main__":
+    fixture_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "template_parser_fixtures.json")
+    sys.exit(int(check_fixtures(fixture_path) > 0))
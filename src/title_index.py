@@ -0,0 +1,336 @@
+# Index of the titles of a corpus, to recover a title generated by an LLM to the exact version of the title in the corpus (the title with the highest Jaccard similarity of the lower-cased word sets; see Method.utils.jaccard_similarity()) without comparing it with every title of the corpus
+#   built once per corpus: the word set of each title, and an inverted index from each word to the titles that contain it
+#   best_match() visits the words of the query from the rarest one; it stops once the titles that are not visited yet can not reach the best similarity found so far, and skips the titles whose size alone bounds their similarity below it
+#   the result is the same as the linear scan (including the tie-break: the first title in the list wins)
+#   match() looks the title up by its exact and its normalized version (get_normalized_title()) first, and only falls back to best_match() on a miss; the hits of each path are counted in TitleMatchStats
+#   lsh_threshold > 0 (for corpora with 100k+ papers): before best_match(), match() accepts the most similar of the candidates of a MinHash-LSH index (Method.minhash_lsh) if its similarity is at least lsh_threshold; it is approximate (a more similar title that is not a candidate is missed)
+#   match_batch() matches the titles of a whole screening round at once: the intersections of all the fuzzy queries with all the titles are one sparse product of token-incidence matrices (the same result as best_match())
+# SimilarityMatcher: the threshold membership checks of Method.utils.if_element_in_list_with_similarity_threshold() against a list that is tokenized once (e.g., the groundtruth inspirations of a background, checked for every hypothesis)
+import re, bisect, threading
+import numpy as np
+from scipy import sparse
+from Method.minhash_lsh import MinHashLSH
+
+
+# the paths of a title lookup; 'exact': the title itself is in the corpus; 'normalized': its normalized version is; 'lsh': a candidate of the MinHash-LSH index is similar enough; 'fuzzy': the most similar title by best_match(); 'miss': not similar enough to any title (if_element_in_list_with_similarity_threshold())
+TITLE_MATCH_PATHS = ["exact", "normalized", "lsh", "fuzzy", "miss"]
+# the characters the LLMs add around titles (quotes and markdown)
+# number of queries of best_match_id_batch() in one sparse product (the product stores every title that shares a token with a query)
+BATCH_MATCH_CHUNK_SIZE = 256
+TITLE_DECORATION_PATTERN = re.compile(r"[\"'`*#\u201c\u201d\u2018\u2019]")
+
+
+def get_title_tokens(title):
+    return frozenset(title.lower().split())
+
+
+## Function:
+#   the key of a title that ignores quotes, markdown '*' / '#', case, whitespace and a trailing period (e.g., '**"Title of a Paper."**' -> 'title of a paper')
+def get_normalized_title(title):
+    return " ".join(TITLE_DECORATION_PATTERN.sub("", title).lower().split()).rstrip(".").strip()
+
+
+class TitleMatchStats(object):
+    def __init__(self):
+        # {caller (e.g., 'recover_title'): {path: int}}; path: see TITLE_MATCH_PATHS
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def record(self, key, match_path):
+        assert match_path in TITLE_MATCH_PATHS, print("match_path: ", match_path)
+        with self.lock:
+            if key not in self.stats:
+                self.stats[key] = {cur_path: 0 for cur_path in TITLE_MATCH_PATHS}
+            self.stats[key][match_path] += 1
+
+    def get_num_matches(self):
+        return sum([sum(cur_stats.values()) for cur_stats in self.stats.values()])
+
+    def print_stats(self):
+        for cur_key in self.stats:
+            cur_stats = self.stats[cur_key]
+            num_matches = sum(cur_stats.values())
+            print("Title matching; caller: {}; lookups: {}; exact: {}; normalized: {}; lsh: {}; fuzzy: {}; miss: {}; hit rate of the exact paths (exact + normalized): {:.3f}".format(cur_key, num_matches, cur_stats['exact'], cur_stats['normalized'], cur_stats['lsh'], cur_stats['fuzzy'], cur_stats['miss'], (cur_stats['exact'] + cur_stats['normalized']) / num_matches))
+
+
+TITLE_MATCH_STATS = TitleMatchStats()
+
+
+def get_title_match_stats():
+    return TITLE_MATCH_STATS
+
+
+class TitleIndex(object):
+    ## Input
+    #   titles: [title, ...]; e.g., list(dict_title_2_abstract.keys())
+    #   lsh_threshold: 0: no MinHash-LSH index; otherwise the similarity to accept a candidate of the MinHash-LSH index in match()
+    #   lsh_kwargs: num_bands / rows_per_band / seed of the MinHash-LSH index
+    def __init__(self, titles, lsh_threshold=0, **lsh_kwargs):
+        assert lsh_threshold >= 0 and lsh_threshold <= 1
+        self.titles = list(titles)
+        self.token_sets = [get_title_tokens(cur_title) for cur_title in self.titles]
+        # inverted_index: {token: [title_id, ...]}; title ids in ascending order
+        self.inverted_index = {}
+        for cur_id, cur_tokens in enumerate(self.token_sets):
+            for cur_token in cur_tokens:
+                if cur_token not in self.inverted_index:
+                    self.inverted_index[cur_token] = []
+                self.inverted_index[cur_token].append(cur_id)
+        # title_ids: {title: title_id}; normalized_title_ids: {normalized title: title_id}; the first title wins, as in best_match()
+        self.title_ids = {}
+        self.normalized_title_ids = {}
+        for cur_id, cur_title in enumerate(self.titles):
+            if cur_title not in self.title_ids:
+                self.title_ids[cur_title] = cur_id
+            cur_normalized_title = get_normalized_title(cur_title)
+            if cur_normalized_title != "" and cur_normalized_title not in self.normalized_title_ids:
+                self.normalized_title_ids[cur_normalized_title] = cur_id
+        # the token-incidence matrix of the titles, for best_match_id_batch(); built on its first call
+        self.token_ids = None
+        self.incidence_matrix = None
+        self.title_sizes = None
+        self.lsh_threshold = lsh_threshold
+        self.lsh = None
+        if lsh_threshold > 0:
+            self.lsh = MinHashLSH(shingle_size=1, **lsh_kwargs)
+            self.lsh.add_batch(self.titles)
+
+    def __len__(self):
+        return len(self.titles)
+
+    ## Function:
+    #   the title with the highest Jaccard similarity with title (the first one in self.titles if tied)
+    ## Output
+    #   best_id: index in self.titles
+    #   similarity: Jaccard similarity between title and self.titles[best_id]
+    def best_match_id(self, title):
+        assert len(self.titles) > 0
+        query_tokens = get_title_tokens(title)
+        num_query_tokens = len(query_tokens)
+        # the best similarity so far as a fraction (best_inter / best_union), to compare the similarities exactly
+        best_id, best_inter, best_union = None, 0, 1
+        visited_ids = set()
+        # the rarest tokens first: they have the shortest lists of titles to visit
+        sorted_tokens = sorted(query_tokens, key=lambda cur_token: len(self.inverted_index.get(cur_token, [])))
+        for cur_token_id, cur_token in enumerate(sorted_tokens):
+            # a title without any of the tokens visited so far shares at most (num_query_tokens - cur_token_id) tokens with the query, so its similarity is at most (num_query_tokens - cur_token_id) / num_query_tokens
+            if best_id != None and (num_query_tokens - cur_token_id) * best_union < best_inter * num_query_tokens:
+                break
+            for cur_id in self.inverted_index.get(cur_token, []):
+                if cur_id in visited_ids:
+                    continue
+                visited_ids.add(cur_id)
+                cur_size = len(self.token_sets[cur_id])
+                # the similarity is at most min(size) / max(size)
+                if best_id != None and min(cur_size, num_query_tokens) * best_union < best_inter * max(cur_size, num_query_tokens):
+                    continue
+                cur_inter = len(query_tokens & self.token_sets[cur_id])
+                cur_union = num_query_tokens + cur_size - cur_inter
+                if best_id == None or cur_inter * best_union > best_inter * cur_union or (cur_inter * best_union == best_inter * cur_union and cur_id < best_id):
+                    best_id, best_inter, best_union = cur_id, cur_inter, cur_union
+        # no title shares a token with the query: all the similarities are 0
+        if best_id == None:
+            return 0, 0.0
+        return best_id, best_inter / best_union
+
+    ## Function:
+    #   the most similar title among the candidates of the MinHash-LSH index (the first one if tied), if its similarity is at least self.lsh_threshold
+    ## Output
+    #   best_id: None if no candidate is similar enough
+    #   similarity
+    def lsh_match_id(self, title):
+        query_tokens = get_title_tokens(title)
+        best_id, best_similarity = None, 0.0
+        for cur_id in self.lsh.query_candidates(title):
+            cur_inter = len(query_tokens & self.token_sets[cur_id])
+            cur_similarity = cur_inter / (len(query_tokens) + len(self.token_sets[cur_id]) - cur_inter)
+            if cur_similarity > best_similarity:
+                best_id, best_similarity = cur_id, cur_similarity
+        if best_id == None or best_similarity < self.lsh_threshold:
+            return None, best_similarity
+        return best_id, best_similarity
+
+    ## Output
+    #   matched_title: the title in self.titles with the highest Jaccard similarity with title
+    #   similarity
+    def best_match(self, title):
+        best_id, similarity = self.best_match_id(title)
+        return self.titles[best_id], similarity
+
+    ## Function:
+    #   the exact / normalized lookup of title, before the Jaccard similarity of best_match()
+    ## Output
+    #   matched_title
+    #   similarity: 1.0 for the exact and normalized paths
+    #   match_path: 'exact' / 'normalized' / 'lsh' / 'fuzzy'
+    def match(self, title, stats_key=None):
+        if title in self.title_ids:
+            matched_title, similarity, match_path = title, 1.0, "exact"
+        elif get_normalized_title(title) in self.normalized_title_ids:
+            matched_title, similarity, match_path = self.titles[self.normalized_title_ids[get_normalized_title(title)]], 1.0, "normalized"
+        else:
+            lsh_id, similarity = self.lsh_match_id(title) if self.lsh != None else (None, 0.0)
+            if lsh_id != None:
+                matched_title, match_path = self.titles[lsh_id], "lsh"
+            else:
+                matched_title, similarity = self.best_match(title)
+                match_path = "fuzzy"
+        if stats_key != None:
+            get_title_match_stats().record(stats_key, match_path)
+        return matched_title, similarity, match_path
+
+    ## Function:
+    #   the sparse token-incidence matrix of the titles: [num titles, num tokens], 1 if the title contains the token
+    def get_incidence_matrix(self):
+        if self.incidence_matrix is None:
+            self.token_ids = {cur_token: cur_id for cur_id, cur_token in enumerate(self.inverted_index)}
+            row_ids = [cur_id for cur_id, cur_tokens in enumerate(self.token_sets) for cur_token in cur_tokens]
+            column_ids = [self.token_ids[cur_token] for cur_tokens in self.token_sets for cur_token in cur_tokens]
+            self.incidence_matrix = sparse.csr_matrix((np.ones(len(row_ids), dtype=np.int32), (row_ids, column_ids)), shape=(len(self.titles), len(self.token_ids)))
+            self.title_sizes = np.array([len(cur_tokens) for cur_tokens in self.token_sets], dtype=np.int64)
+        return self.incidence_matrix
+
+    ## Function:
+    #   best_match_id() of several titles at once; the intersections of the titles with every title of the corpus are the sparse product of their token-incidence matrices
+    ## Output
+    #   [[best_id, similarity], ...]; one for each title
+    def best_match_id_batch(self, titles):
+        assert len(self.titles) > 0
+        incidence_matrix = self.get_incidence_matrix()
+        best_matches = []
+        for cur_start in range(0, len(titles), BATCH_MATCH_CHUNK_SIZE):
+            cur_token_sets = [get_title_tokens(cur_title) for cur_title in titles[cur_start:cur_start+BATCH_MATCH_CHUNK_SIZE]]
+            # the tokens that are not in any title only count in the size of the query
+            query_sizes = np.array([len(cur_tokens) for cur_tokens in cur_token_sets], dtype=np.int64)
+            row_ids = [cur_id for cur_id, cur_tokens in enumerate(cur_token_sets) for cur_token in cur_tokens if cur_token in self.token_ids]
+            column_ids = [self.token_ids[cur_token] for cur_tokens in cur_token_sets for cur_token in cur_tokens if cur_token in self.token_ids]
+            query_matrix = sparse.csr_matrix((np.ones(len(row_ids), dtype=np.int32), (row_ids, column_ids)), shape=(len(cur_token_sets), len(self.token_ids)))
+            # intersections: [num queries, num titles]; only the pairs that share a token are stored
+            intersections = (query_matrix @ incidence_matrix.T).tocoo()
+            query_ids, title_ids, num_inters = intersections.row, intersections.col, intersections.data.astype(np.int64)
+            similarities = num_inters / (query_sizes[query_ids] + self.title_sizes[title_ids] - num_inters)
+            # the first pair of each query after sorting by (query, -similarity, title id): the highest similarity, and the first title if tied
+            order = np.lexsort((title_ids, -similarities, query_ids))
+            if_first = np.ones(len(order), dtype=bool)
+            if_first[1:] = query_ids[order][1:] != query_ids[order][:-1]
+            # no title shares a token with the query: all the similarities are 0 (the same as best_match_id())
+            cur_best_matches = [[0, 0.0] for _ in cur_token_sets]
+            for cur_pair in order[if_first]:
+                cur_best_matches[query_ids[cur_pair]] = [int(title_ids[cur_pair]), float(similarities[cur_pair])]
+            best_matches += cur_best_matches
+        return best_matches
+
+    ## Function:
+    #   match() of several titles at once (e.g., all the titles selected in a screening round); the titles that miss the exact / normalized (/ lsh) lookups are matched together by best_match_id_batch()
+    ## Output
+    #   [[matched_title, similarity, match_path], ...]; one for each title
+    def match_batch(self, titles, stats_key=None):
+        matches = [None for _ in titles]
+        fuzzy_query_ids = []
+        for cur_id, cur_title in enumerate(titles):
+            if cur_title in self.title_ids:
+                matches[cur_id] = [cur_title, 1.0, "exact"]
+            elif get_normalized_title(cur_title) in self.normalized_title_ids:
+                matches[cur_id] = [self.titles[self.normalized_title_ids[get_normalized_title(cur_title)]], 1.0, "normalized"]
+            else:
+                lsh_id, similarity = self.lsh_match_id(cur_title) if self.lsh != None else (None, 0.0)
+                if lsh_id != None:
+                    matches[cur_id] = [self.titles[lsh_id], similarity, "lsh"]
+                else:
+                    fuzzy_query_ids.append(cur_id)
+        if len(fuzzy_query_ids) > 0:
+            for cur_id, (cur_best_id, cur_similarity) in zip(fuzzy_query_ids, self.best_match_id_batch([titles[cur_id] for cur_id in fuzzy_query_ids])):
+                matches[cur_id] = [self.titles[cur_best_id], cur_similarity, "fuzzy"]
+        if stats_key != None:
+            for cur_match in matches:
+                get_title_match_stats().record(stats_key, cur_match[2])
+        return matches
+
+
+## Function:
+#   the version of an element compared by SimilarityMatcher (the same as Method.utils.if_element_in_list_with_similarity_threshold())
+def get_stripped_element(element):
+    return element.strip().strip('"').strip()
+
+
+class SimilarityMatcher(object):
+    ## Input
+    #   references: [element, ...]; e.g., the groundtruth inspiration titles of a background
+    #   record_stats: whether contains() records its match paths in the title match stats (under 'similarity_threshold'); False for internal lookups that are not title matching
+    def __init__(self, references, record_stats=True):
+        self.record_stats = record_stats
+        self.references = [get_stripped_element(cur_reference) for cur_reference in references]
+        self.reference_set = set(self.references)
+        self.normalized_reference_set = set([get_normalized_title(cur_reference) for cur_reference in self.references])
+        # the token sets of the references sorted by their sizes, so that contains() only visits the sizes that can pass the threshold
+        self.token_sets = [get_title_tokens(cur_reference) for cur_reference in self.references]
+        sorted_ids = sorted(range(len(self.references)), key=lambda cur_id: len(self.token_sets[cur_id]))
+        self.sorted_token_sets = [self.token_sets[cur_id] for cur_id in sorted_ids]
+        self.sorted_sizes = [len(cur_tokens) for cur_tokens in self.sorted_token_sets]
+
+    def __len__(self):
+        return len(self.references)
+
+    ## Function:
+    #   whether element is one of the references, its normalized version is, or its Jaccard similarity (of the lower-cased word sets) with any reference is larger than threshold
+    #   the Jaccard similarity of two sets is at most min(size) / max(size), so only the references with threshold * size < reference size < size / threshold are compared
+    def contains(self, element, threshold=0.7):
+        element = get_stripped_element(element)
+        if element in self.reference_set:
+            self.record_match_path("exact")
+            return True
+        normalized_element = get_normalized_title(element)
+        if normalized_element != "" and normalized_element in self.normalized_reference_set:
+            self.record_match_path("normalized")
+            return True
+        element_tokens = get_title_tokens(element)
+        num_element_tokens = len(element_tokens)
+        start_id = bisect.bisect_right(self.sorted_sizes, threshold * num_element_tokens)
+        end_id = len(self.sorted_sizes) if threshold <= 0 else bisect.bisect_left(self.sorted_sizes, num_element_tokens / threshold)
+        for cur_tokens in self.sorted_token_sets[start_id:end_id]:
+            cur_inter = len(element_tokens & cur_tokens)
+            if cur_inter / (num_element_tokens + len(cur_tokens) - cur_inter) > threshold:
+                self.record_match_path("fuzzy")
+                return True
+        self.record_match_path("miss")
+        return False
+
+    def record_match_path(self, match_path):
+        if self.record_stats:
+            get_title_match_stats().record("similarity_threshold", match_path)
+
+    ## Function:
+    #   the similarities of several queries with every reference at once (a sparse product of their token-incidence matrices); the queries that are a reference or whose normalized version is have the similarity 1.0 with it
+    #   (match_matrix(queries) > threshold).any(axis=1) is the same as contains() of each query (threshold < 1)
+    ## Output
+    #   similarity_matrix: [len(queries), len(references)] float array
+    def match_matrix(self, queries):
+        queries = [get_stripped_element(cur_query) for cur_query in queries]
+        query_token_sets = [get_title_tokens(cur_query) for cur_query in queries]
+        token_ids = {}
+        for cur_tokens in self.token_sets + query_token_sets:
+            for cur_token in cur_tokens:
+                if cur_token not in token_ids:
+                    token_ids[cur_token] = len(token_ids)
+        def get_incidence_matrix(token_sets):
+            row_ids = [cur_id for cur_id, cur_tokens in enumerate(token_sets) for cur_token in cur_tokens]
+            column_ids = [token_ids[cur_token] for cur_tokens in token_sets for cur_token in cur_tokens]
+            return sparse.csr_matrix((np.ones(len(row_ids), dtype=np.int32), (row_ids, column_ids)), shape=(len(token_sets), len(token_ids)))
+        intersections = (get_incidence_matrix(query_token_sets) @ get_incidence_matrix(self.token_sets).T).toarray().astype(np.int64)
+        unions = np.array([len(cur_tokens) for cur_tokens in query_token_sets], dtype=np.int64)[:, None] + np.array([len(cur_tokens) for cur_tokens in self.token_sets], dtype=np.int64)[None, :] - intersections
+        # two empty elements are only similar if they are the same (the exact path below)
+        similarity_matrix = np.divide(intersections, unions, out=np.zeros(intersections.shape), where=unions > 0)
+        normalized_references = [get_normalized_title(cur_reference) for cur_reference in self.references]
+        for cur_query_id, cur_query in enumerate(queries):
+            normalized_query = get_normalized_title(cur_query)
+            for cur_reference_id, cur_reference in enumerate(self.references):
+                if cur_query == cur_reference or (normalized_query != "" and normalized_query == normalized_references[cur_reference_id]):
+                    similarity_matrix[cur_query_id, cur_reference_id] = 1.0
+        return similarity_matrix
+
+    ## Function:
+    #   the number of references that contain() any of queries (e.g., the number of groundtruth inspirations found by a hypothesis)
+    def count_matched_references(self, queries, threshold=0.7):
+        if len(queries) == 0 or len(self.references) == 0:
+            return 0
+        return int((self.match_matrix(queries) > threshold).any(axis=0).sum())
@@ -1,5 +1,16 @@
-import os, re, json, random, time, math
+import os, re, json, random, time, math, asyncio
 import pandas as pd
+from Method.llm_cache import get_llm_cache, get_llm_cache_key, get_llm_single_flight, get_llm_prefix_warmup, get_prompt_prefix_key
+from Method.rate_limiter import call_llm_with_retry, acall_llm_with_retry, estimate_num_tokens, LLMFatalError, CHARS_PER_TOKEN
+from Method.llm_telemetry import get_llm_telemetry
+from Method.llm_hedging import get_llm_hedging
+from Method.llm_cascade import get_llm_cascade_tiers, record_llm_cascade_call, record_llm_escalation
+from Method.llm_client import get_llm_backend_name
+from Method.llm_budget import start_llm_retry_budget
+from Method.title_index import TitleIndex, SimilarityMatcher, get_title_match_stats
+from Method.llm_traffic import get_llm_traffic_recorded_fn, aget_llm_traffic_recorded_fn
+from Method.template_parser import parse_structured_generation, parse_four_aspect_scores_with_stats
+from Method.structured_output import get_llm_structured_output, get_response_format, structured_output_to_generation, if_structured_output_unsupported_error
 # from model.api_key import OPENAI_KEY
 
 
@@ -69,6 +80,9 @@ def instruction_prompts(module_name):
         prompts = ["You are helping to evaluate the quality of a proposed research hypothesis in Chemistry by a phd student. The groundtruth hypothesis will also be provided to compare. Here we mainly focus on whether the proposed hypothesis has covered the key points in terms of the methodology in the groundtruth hypothesis. You will also be given a summary of the key points in the methodology of the groundtruth hypothesis for reference. Please note that for the proposed hypothesis to cover one key point, it is not necessary to explicitly mention the name of the key point, but might also can integrate the key point implicitly in the proposed method. The evaluation criteria is called 'Matched score', which is in a 6-point Likert scale (from 5 to 0). Particularly, 5 points mean that the proposed hypothesis (1) covers all the key points and leverage them similarly as in the methodology of the groundtruth hypothesis, and (2) does not contain any extra key point that has apparent flaws; 4 points mean that the proposed hypothesis (1) covers all the key points (or at least three key points) and leverage them similarly as in the methodology of the groundtruth hypothesis, (2) but also with extra key points that have apparent flaws; 3 points mean that the proposed hypothesis (1) covers at least two key points and leverage them similarly as in the methodology of the groundtruth hypothesis, (2) but does not cover all key points in the groundtruth hypothesis, (3) might or might not contain extra key points; 2 points mean that the proposed hypothesis (1) covers at least one key point in the methodology of the groundtruth hypothesis, and leverage it similarly as in the methodology of groundtruth hypothesis, (2) but does not cover all key points in the groundtruth hypothesis, and (3) might or might not contain extra key points; 1 point means that the proposed hypothesis (1) covers at least one key point in the methodology of the groundtruth hypothesis, (2) but is used differently as in the methodology of groundtruth hypothesis, and (3) might or might not contain extra key points; 0 point means that the proposed hypothesis does not cover any key point in the methodology of the groundtruth hypothesis at all. Please note that the total number of key points in the groundtruth hypothesis might be less than three, so that multiple points can be given. E.g., there's only one key point in the groundtruth hypothesis, and the proposed hypothesis covers the one key point, it's possible to give 2 points, 4 points, and 5 points. In this case, we should choose score from 4 points and 5 points, depending on the existence and quality of extra key points. 'Leveraging a key point similarly as in the methodology of the groundtruth hypothesis' means that in the proposed hypothesis, the same (or very related) concept (key point) is used in a similar way with a similar goal compared to the groundtruth hypothesis (not necessarily for the proposed hypothesis to be exactly the same with the groudtruth hypothesis to be classified as 'similar'). When judging whether an extra key point has apparent flaws, you should use your own knowledge to judge, but rather than to rely on the count number of pieces of extra key point to judge. \nPlease evaluate the proposed hypothesis based on the groundtruth hypothesis. \nThe proposed hypothesis is: ", "\n\nThe groundtruth hypothesis is: ", "\n\nThe key points in the groundtruth hypothesis are: ", "\n\nPlease evaluate the proposed hypothesis based on the groundtruth hypothesis, and give a score. (response format: 'Matched score: \nReason:\n')"]
     elif module_name == "eval_matched_score_hard":
         prompts = ["You are helping to evaluate the quality of a proposed research hypothesis by a phd student. The groundtruth hypothesis will also be provided to compare. Here we mainly focus on whether the proposed hypothesis has covered the key points of the groundtruth hypothesis. You will also be given a summary of the key points in the groundtruth hypothesis for reference. The evaluation criteria is called 'Matched score', which is in a 6-point Likert scale (from 5 to 0). Particularly, \n5 points mean that the proposed hypothesis (1) covers three key points (or covers all the key points) in the groundtruth hypothesis, where every key point is leveraged nearly identically as in the groundtruth hypothesis, and (2) does not contain any extra key point(s) that is redundant, unnecessary, unhelpful, or harmful; \n4 points mean that the proposed hypothesis (1) covers three key points (or covers all the key points) in the groundtruth hypothesis, where every key point is leveraged nearly identically as in the groundtruth hypothesis, and (2) but also contain extra key point(s) that is redundant, unnecessary, unhelpful, or harmful; \n3 points mean that the proposed hypothesis (1) covers two key points in the groundtruth hypothesis, where every key point is leveraged nearly identically as in the groundtruth hypothesis, (2) but does not cover all key points in the groundtruth hypothesis, and (3) might or might not contain extra key points; \n2 points mean that the proposed hypothesis (1) covers one key point in the groundtruth hypothesis, and leverage it nearly identically as in the groundtruth hypothesis, (2) but does not cover all key points in the groundtruth hypothesis, and (3) might or might not contain extra key points; \n1 point means that the proposed hypothesis (1) covers at least one key point in the groundtruth hypothesis, but all the covered key point(s) are used differently as in the groundtruth hypothesis, and (2) might or might not contain extra key points; \n0 point means that the proposed hypothesis does not cover any key point in the groundtruth hypothesis at all. \nUsually total the number of key points a groundtruth hypothesis contain is less than or equal to three. Please note that the total number of key points in the groundtruth hypothesis might be less than three, so that multiple points can be given. E.g., there's only one key point in the groundtruth hypothesis, and the proposed hypothesis covers the one key point nearly identically, it's possible to give 2 points, 4 points, and 5 points. In this case, we should choose score from 4 points and 5 points, depending on the existence and quality of extra key points. 'Leveraging a key point nearly identically as in the groundtruth hypothesis means that in the proposed hypothesis, the same (or very related) concept (key point) is used in a very similar way with a very similar goal compared to the groundtruth hypothesis. \nWhen judging whether an extra key point has apparent flaws, you should use your own knowledge and understanding of that discipline to judge, rather than only relying on the count number of pieces of extra key point to judge. \nPlease evaluate the proposed hypothesis based on the groundtruth hypothesis. \nThe proposed hypothesis is: ", "\n\nThe groundtruth hypothesis is: ", "\n\nThe key points in the groundtruth hypothesis are: ", "\n\nPlease evaluate the proposed hypothesis based on the groundtruth hypothesis, and give a score. (response format: 'Matched score: \nReason:\n')"]
+    elif module_name == "four_aspects_self_numerical_evaluation_batched":
+        # the same instructions as four_aspects_self_numerical_evaluation (so that the two share the prompt prefix), for several hypotheses indexed from 0
+        prompts = [instruction_prompts("four_aspects_self_numerical_evaluation")[0], "\nPlease give a response to the initial question on scoring each of the hypotheses above from four aspects. Please evaluate each hypothesis independently, as if it were the only one given to you. Remember that you are a diligent and harsh reviewer. (response format: for each hypothesis in order, 'Hypothesis index: \nValidness score: \nConcise reason: \nNovelty score: \nConcise reason: \nSignificance score: \nConcise reason: \nPotential score: \nConcise reason: \n')."]
     else:
         raise NotImplementedError
     
@@ -319,6 +333,15 @@ def load_grouped_inspirations(inspiration_group_path):
     return insp_grouping_results
 
 
+# messages of one request with prompt (also used as part of the LLM response cache key)
+def get_llm_messages(prompt):
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": prompt}
+        ]
+    return messages
+
+
 # coarse_grained_hypotheses: {core_insp_title: [[hypothesis, reasoning process], ...]}
 def load_coarse_grained_hypotheses(coarse_grained_hypotheses_path):
     with open(coarse_grained_hypotheses_path, 'r') as f:
@@ -326,44 +349,298 @@ def load_coarse_grained_hypotheses(coarse_grained_hypotheses_path):
     return coarse_grained_hypotheses
     
 
+## Function:
+#   early-stop functions of streamed generation: return True once the part of the generation that will be used is complete
+#   the cache_tag of an early-stop function describes its mode; it is part of the response cache key, since a cut-off response should not be returned to a request expecting the full response (or another cut-off point)
+#   new_scanner() of an early-stop function gives the incremental scanner used by a stream (see RegexEarlyStopScanner / TemplateEarlyStopScanner)
+# complete once the regex pattern is found (e.g., the selection line of compare_candidate() in ranking.py)
+# max_match_chars: upper bound of the length of a match; a stream only searches the last max_match_chars - 1 characters before each new chunk again
+def get_regex_early_stop_fn(pattern, max_match_chars=256):
+    compiled_pattern = re.compile(pattern)
+    early_stop_fn = lambda generation: compiled_pattern.search(generation) != None
+    early_stop_fn.new_scanner = lambda: RegexEarlyStopScanner(compiled_pattern, max_match_chars)
+    early_stop_fn.cache_tag = ["regex", pattern]
+    return early_stop_fn
+
+
+# complete once num_blocks [template[0], template[1]] blocks are found (e.g., the 'Title:'/'Reason:' blocks in screening); the last block is complete when the first line of its template[1] content ends
+def get_template_early_stop_fn(template, num_blocks):
+    assert len(template) == 2 and num_blocks >= 1
+    early_stop_fn = lambda generation: TemplateEarlyStopScanner(template, num_blocks).feed(generation) != None
+    early_stop_fn.new_scanner = lambda: TemplateEarlyStopScanner(template, num_blocks)
+    early_stop_fn.cache_tag = ["template", template, num_blocks]
+    return early_stop_fn
+
+
+## Function:
+#   incremental scanners of a streamed generation: feed() is called with the generation so far after each chunk, and only searches the new chunk plus the tail before it where a tag split over two chunks can start, so that a stream is scanned in linear time
+#   feed() returns the length of the complete prefix of generation (the end of the regex match / of the first content line of the last block; the last chunk may continue after it, e.g., with the beginning of the next block, which is dropped); None: not complete yet
+class RegexEarlyStopScanner(object):
+    def __init__(self, compiled_pattern, max_match_chars):
+        self.compiled_pattern = compiled_pattern
+        self.max_match_chars = max_match_chars
+        self.num_scanned_chars = 0
+
+    def feed(self, generation):
+        start_pos = max(0, self.num_scanned_chars - self.max_match_chars + 1)
+        self.num_scanned_chars = len(generation)
+        match = self.compiled_pattern.search(generation, start_pos)
+        if match == None:
+            return None
+        return match.end()
+
+
+class TemplateEarlyStopScanner(object):
+    NON_SPACE_PATTERN = re.compile(r"\S")
+
+    def __init__(self, template, num_blocks):
+        assert len(template) == 2 and num_blocks >= 1
+        self.template = template
+        self.num_blocks = num_blocks
+        # the generation without '#' and '*' (the same as get_structured_generation_from_raw_generation(): they are markdown format), and the number of characters of the generation in it
+        self.text = ""
+        self.num_scanned_chars = 0
+        # positions in self.text: the end of the last template[0] found; the start of the template[0] after the last block (None: not found yet); the end of the template[1] of the last block; the first character of its content
+        self.num_found_blocks = 0
+        self.search_pos = 0
+        self.next_block_pos = None
+        self.content_pos = None
+        self.content_start_pos = None
+
+    # find sub at or after start_pos; the text before prev_len - len(sub) + 1 was searched by the previous feed()
+    def find(self, sub, start_pos, prev_len):
+        return self.text.find(sub, max(start_pos, prev_len - len(sub) + 1))
+
+    def feed(self, generation):
+        new_generation = generation[self.num_scanned_chars:]
+        prev_len = len(self.text)
+        self.text += re.sub("[#*]", "", new_generation)
+        self.num_scanned_chars = len(generation)
+        end_pos = self.scan(prev_len)
+        if end_pos == None:
+            return None
+        # the end of the first content line is in the new text: count its characters back in the new part of the generation
+        num_left_chars = end_pos - prev_len + 1
+        for cur_id, cur_char in enumerate(new_generation):
+            if cur_char not in "#*":
+                num_left_chars -= 1
+                if num_left_chars == 0:
+                    return len(generation) - len(new_generation) + cur_id + 1
+
+    ## Output
+    #   end_pos: the position of the end of the first content line of the last block in self.text; None: not complete yet
+    def scan(self, prev_len):
+        while self.num_found_blocks < self.num_blocks:
+            cur_pos = self.find(self.template[0], self.search_pos, prev_len)
+            if cur_pos == -1:
+                return None
+            self.num_found_blocks += 1
+            self.search_pos = cur_pos + len(self.template[0])
+        # the last block ends where the next template[0] starts
+        if self.next_block_pos == None:
+            cur_pos = self.find(self.template[0], self.search_pos, prev_len)
+            if cur_pos != -1:
+                self.next_block_pos = cur_pos
+        block_end_pos = self.next_block_pos if self.next_block_pos != None else len(self.text)
+        if self.content_pos == None:
+            cur_pos = self.find(self.template[1], self.search_pos, prev_len)
+            if cur_pos == -1 or cur_pos + len(self.template[1]) > block_end_pos:
+                return None
+            self.content_pos = cur_pos + len(self.template[1])
+        if self.content_start_pos == None:
+            cur_match = self.NON_SPACE_PATTERN.search(self.text, max(self.content_pos, prev_len))
+            if cur_match == None or cur_match.start() >= block_end_pos:
+                return None
+            self.content_start_pos = cur_match.start()
+        cur_pos = self.text.find("\n", max(self.content_start_pos + 1, prev_len))
+        if cur_pos == -1 or cur_pos >= block_end_pos:
+            return None
+        return cur_pos
+
+
+# the early-stop mode of a request in its response cache key; None: the full response is requested (no early_stop_fn, or a structured-output request, which does not use it)
+def get_early_stop_cache_tag(early_stop_fn, response_format=None):
+    if early_stop_fn == None or response_format != None:
+        return None
+    return early_stop_fn.cache_tag
+
+
+## Function:
+#   send a streamed request, and stop reading the stream as soon as early_stop_fn(generation so far) is True (the rest of the completion is cancelled by closing the stream)
+## Output
+#   generation: text
+def stream_chat_completion_with_early_stop(client, early_stop_fn, **request_kwargs):
+    stream = client.chat.completions.create(stream=True, **request_kwargs)
+    early_stop_scanner = early_stop_fn.new_scanner()
+    generation = ""
+    try:
+        for chunk in stream:
+            if len(chunk.choices) == 0 or chunk.choices[0].delta.content == None:
+                continue
+            generation += chunk.choices[0].delta.content
+            stop_len = early_stop_scanner.feed(generation)
+            if stop_len != None:
+                generation = generation[:stop_len]
+                break
+    finally:
+        stream.close()
+    return generation
+
+
+# async version of stream_chat_completion_with_early_stop(); client should be an asyncio client
+async def astream_chat_completion_with_early_stop(client, early_stop_fn, **request_kwargs):
+    stream = await client.chat.completions.create(stream=True, **request_kwargs)
+    early_stop_scanner = early_stop_fn.new_scanner()
+    generation = ""
+    try:
+        async for chunk in stream:
+            if len(chunk.choices) == 0 or chunk.choices[0].delta.content == None:
+                continue
+            generation += chunk.choices[0].delta.content
+            stop_len = early_stop_scanner.feed(generation)
+            if stop_len != None:
+                generation = generation[:stop_len]
+                break
+    finally:
+        await stream.close()
+    return generation
+
+
+## Function:
+#   response_format of a request with structured_output_template; None if the structured-output mode is disabled or not supported by the backend of the model (then the request is sent as text)
+def get_structured_output_response_format(structured_output_template, model_name, stage=None):
+    llm_structured_output = get_llm_structured_output()
+    if structured_output_template == None or llm_structured_output == None:
+        return None
+    if not llm_structured_output.if_supported(model_name):
+        llm_structured_output.update_stats(stage, 'unsupported')
+        return None
+    return get_response_format(structured_output_template)
+
+
+## Function:
+#   record one LLM request in the telemetry (if enabled); the tokens are estimated from the text when the completion has no usage (e.g., streamed responses)
+def record_llm_request_telemetry(stage, model_name, latency, prompt, generation, completion=None):
+    llm_telemetry = get_llm_telemetry()
+    if llm_telemetry == None:
+        return
+    usage = getattr(completion, "usage", None)
+    if usage != None:
+        # cached_tokens: the prompt tokens served from the provider's prompt cache (not reported by every backend)
+        prompt_tokens_details = getattr(usage, "prompt_tokens_details", None)
+        cached_prompt_tokens = getattr(prompt_tokens_details, "cached_tokens", None)
+        if cached_prompt_tokens == None:
+            cached_prompt_tokens = 0
+        llm_telemetry.record_request(stage, model_name, latency, usage.prompt_tokens, usage.completion_tokens, cached_prompt_tokens=cached_prompt_tokens)
+    else:
+        llm_telemetry.record_request(stage, model_name, latency, len(prompt) // CHARS_PER_TOKEN, len(generation) // CHARS_PER_TOKEN, if_estimated_tokens=True)
+
+
+## Function:
+#   call call_fn() (one request with its retries), hedged with a duplicate call if the stage is hedged (see Method.llm_hedging); only temperature-0 calls are hedged, since a duplicate of a sampled call is not the same request
+def call_llm_with_hedging(call_fn, stage, temperature, model_name, prompt):
+    llm_hedging = get_llm_hedging()
+    if llm_hedging == None or temperature != 0:
+        return call_fn()
+    return llm_hedging.call(call_fn, stage=stage, model_name=model_name, prompt_tokens=len(prompt) // CHARS_PER_TOKEN)
+
+
+# async version of call_llm_with_hedging(); call_fn() returns an awaitable
+async def acall_llm_with_hedging(call_fn, stage, temperature, model_name, prompt):
+    llm_hedging = get_llm_hedging()
+    if llm_hedging == None or temperature != 0:
+        return await call_fn()
+    return await llm_hedging.acall(call_fn, stage=stage, model_name=model_name, prompt_tokens=len(prompt) // CHARS_PER_TOKEN)
+
+
 # Call Openai API,k input is prompt, output is response
 # model: by default is gpt3.5, can also use gpt4
-def llm_generation(prompt, model_name, client, temperature=1.0):
-    # which model to use
-    if_api_completed = False
-    # start inference util we get generation
-    while if_api_completed == False:
-        try:
-            completion = client.chat.completions.create(
-            model=model_name,
-            temperature=temperature,
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": prompt}
-                ]
-            )
+# stage: the logical pipeline stage of this call (e.g., 'screening', 'restructuring'); used to select the cache mode of the stage
+# if_read_cache: whether a cached response can be returned; set it to False when re-generating after the previous (maybe cached) response could not be used, so that the new response replaces the cached one
+# early_stop_fn: None or a function from get_regex_early_stop_fn() / get_template_early_stop_fn(); when given, the response is streamed and cut off once early_stop_fn() returns True (the cut-off response is what gets cached, under a key that includes the early-stop mode)
+# structured_output_template: None or the template of the expected generation (e.g., ['Title:', 'Reason:'], FOUR_ASPECT_SCORE_TEMPLATE); when the structured-output mode is enabled (setup_llm_structured_output()), the response is requested with the JSON schema of the template and rendered in the text format of the template (early_stop_fn is not used then)
+# prompt_prefix: None or the static beginning of prompt shared by many requests (e.g., the instructions, background question and survey of all the screening windows); when the prefix warm-up is enabled (setup_llm_prefix_warmup()), the first request of a long enough prefix is sent alone and the others sharing it wait for it, so that they hit the provider's prompt cache
+def llm_generation(prompt, model_name, client, temperature=1.0, stage=None, if_read_cache=True, early_stop_fn=None, structured_output_template=None, prompt_prefix=None):
+    if prompt_prefix != None:
+        assert prompt.startswith(prompt_prefix)
+    messages = get_llm_messages(prompt)
+    response_format = get_structured_output_response_format(structured_output_template, model_name, stage=stage)
+    cache_key = get_llm_cache_key(model_name, temperature, messages, response_format=response_format, early_stop=get_early_stop_cache_tag(early_stop_fn, response_format))
+    # check the response cache first
+    llm_cache = get_llm_cache()
+    if llm_cache != None and if_read_cache:
+        generation = llm_cache.get(cache_key, stage=stage)
+        if generation != None:
+            if get_llm_telemetry() != None:
+                get_llm_telemetry().record_cache_hit(stage)
+            return generation
+    def request_fn():
+        start_time = time.time()
+        # completion: None for streamed responses
+        completion = None
+        # start inference util we get generation: requests go through the shared rate limiter, and retryable errors are retried with backoff (fatal errors are raised); slow temperature-0 calls of the hedged stages are duplicated
+        if response_format != None:
+            completion = call_llm_with_hedging(lambda: call_llm_with_retry(lambda: client.chat.completions.create(
+                model=model_name,
+                temperature=temperature,
+                messages=messages,
+                response_format=response_format
+                ), estimated_tokens=estimate_num_tokens(prompt), backend=get_llm_backend_name(client), stage=stage), stage, temperature, model_name, prompt)
+            generation = structured_output_to_generation(completion.choices[0].message.content, structured_output_template)
+            get_llm_structured_output().update_stats(stage, 'structured')
+        elif early_stop_fn == None:
+            completion = call_llm_with_hedging(lambda: call_llm_with_retry(lambda: client.chat.completions.create(
+                model=model_name,
+                temperature=temperature,
+                messages=messages
+                ), estimated_tokens=estimate_num_tokens(prompt), backend=get_llm_backend_name(client), stage=stage), stage, temperature, model_name, prompt)
             generation = completion.choices[0].message.content
-            if_api_completed = True
-        except Exception as e:
-            print("OpenAI reaches its rate limit: ", e)
-            time.sleep(0.25)
-    return generation
+        else:
+            generation = call_llm_with_hedging(lambda: call_llm_with_retry(lambda: stream_chat_completion_with_early_stop(client, early_stop_fn, model=model_name, temperature=temperature, messages=messages), estimated_tokens=estimate_num_tokens(prompt), backend=get_llm_backend_name(client), stage=stage), stage, temperature, model_name, prompt)
+        record_llm_request_telemetry(stage, model_name, time.time() - start_time, prompt, generation, completion=completion)
+        if llm_cache != None:
+            llm_cache.put(cache_key, generation, model_name=model_name, stage=stage)
+        return generation
+    # the requests that reach the rate limiter are recorded in the traffic (if enabled; see Method.llm_traffic)
+    request_fn = get_llm_traffic_recorded_fn(request_fn, stage, model_name, temperature, prompt)
+    send_fn = request_fn
+    llm_prefix_warmup = get_llm_prefix_warmup()
+    if llm_prefix_warmup != None and llm_prefix_warmup.if_applicable(prompt_prefix):
+        prefix_key = get_prompt_prefix_key(model_name, messages, prompt_prefix)
+        send_fn = lambda: llm_prefix_warmup.do(prefix_key, request_fn, stage=stage)
+    try:
+        # identical requests already in flight share one call (temperature 0 only); a retry (if_read_cache=False) asks for a new response, so it is always sent
+        llm_single_flight = get_llm_single_flight()
+        if llm_single_flight == None or not if_read_cache or not llm_single_flight.if_applicable(temperature):
+            return send_fn()
+        return llm_single_flight.do(cache_key, send_fn, stage=stage)
+    except LLMFatalError as e:
+        if response_format == None or not if_structured_output_unsupported_error(e):
+            raise
+        # the backend does not support structured output: send this request (and the later ones of the model) as text
+        get_llm_structured_output().mark_unsupported(model_name, e)
+        return llm_generation(prompt, model_name, client, temperature=temperature, stage=stage, if_read_cache=if_read_cache, early_stop_fn=early_stop_fn, structured_output_template=structured_output_template, prompt_prefix=prompt_prefix)
 
 
 ## Function:
 #   llm inference with the prompt + guarantee to reply a structured generation accroding to the template (guarantee by the while loop)
 #   gene_format_constraint: [id of structured gene to comply with the constraint, constraint (['Yes', 'No'], where the content in the id of structured gene should be inside the constraint)]
 #   if_only_return_one_structured_gene_component: True or False; most of the time structured_gene will only have one component (eg, [[hyp, reasoning process]]). When it is True, this function will only return the first element of structured_gene. If it is set to true and structured_gene has more than one component, a warning will be raised
-def llm_generation_while_loop(prompt, model_name, client, if_structured_generation=False, template=None, gene_format_constraint=None, if_only_return_one_structured_gene_component=False, temperature=1.0, restructure_output_model_name="gpt-4o-mini"):
+#   stage / early_stop_fn / prompt_prefix: see llm_generation()
+def llm_generation_while_loop(prompt, model_name, client, if_structured_generation=False, template=None, gene_format_constraint=None, if_only_return_one_structured_gene_component=False, temperature=1.0, restructure_output_model_name="gpt-4o-mini", stage=None, early_stop_fn=None, prompt_prefix=None):
     # assertions
     assert if_structured_generation in [True, False]
     if if_structured_generation:
         assert template is not None
 
-    # while loop to make sure there will be one successful generation
+    # while loop to make sure there will be one successful generation (unless the retry budget of the stage is used up; see Method.llm_budget)
+    # the cached response is only used in the first try; if it can not be used, a new response is generated (and replaces the cached one)
+    if_read_cache = True
+    retry_budget = start_llm_retry_budget(stage, prompt)
     while True:
         try:
-            generation = llm_generation(prompt, model_name, client, temperature=temperature)
+            generation = llm_generation(prompt, model_name, client, temperature=temperature, stage=stage, if_read_cache=if_read_cache, early_stop_fn=early_stop_fn, structured_output_template=template if if_structured_generation else None, prompt_prefix=prompt_prefix)
+            if_read_cache = False
             # structured_gene
             if if_structured_generation:
                 # structured_gene: [[title, reason], [title, reason], ...]
@@ -373,16 +650,24 @@ def llm_generation_while_loop(prompt, model_name, client, if_structured_generati
                     structured_gene = get_structured_generation_from_raw_generation(generation, template=template)
                 except:
                     # print("Information to be extracted by an LLM from the LLM's generation")
+                    if get_llm_structured_output() != None:
+                        get_llm_structured_output().update_stats(stage, 'restructuring')
+                    if get_llm_telemetry() != None:
+                        get_llm_telemetry().record_parse_failure(stage)
                     structured_gene = get_structured_generation_from_raw_generation_by_llm(generation, template=template, client=client, temperature=temperature, model_name=restructure_output_model_name)
                 if gene_format_constraint != None:
                     assert len(gene_format_constraint) == 2, print("gene_format_constraint: ", gene_format_constraint)
                     # we use structured_gene[0] here since most of the time structured_gene will only have one component (eg, [[hyp, reasoning process]])
                     assert structured_gene[0][gene_format_constraint[0]].strip() in gene_format_constraint[1], print("structured_gene[0][gene_format_constraint[0]].strip(): {}; gene_format_constraint[1]: {}".format(structured_gene[0][gene_format_constraint[0]].strip(), gene_format_constraint[1]))
             break
+        except LLMFatalError:
+            # errors that can not be solved by trying again (e.g., authentication, context length)
+            raise
         except Exception as e:
             # if the format of feedback is wrong, try again in the while loop
             # print("generation: ", generation)
             print("AssertionError: {}, try again..".format(repr(e)))
+            retry_budget.fail(e)
             
 
     # structured_gene
@@ -398,95 +683,248 @@ def llm_generation_while_loop(prompt, model_name, client, if_structured_generati
 
 
 
+# prompt to restructure gene (text) with template (e.g., ['Title:', 'Reason:'])
+def get_restructure_prompt(gene, template):
+    # In your answer, please only mention the words in the template when use it as a template. For example, if the template is ['Hypothesis:', 'Reasoning Process:'], then your answer should not contain 'Analysis of the Hypothesis:', since it also contain 'Hypothesis:'.
+    # Whenever there are information in the passage related to the template, please restructure the information into the template format;
+    prompt = "You are a helpful assistant.\nPlease help to organize the following passage into a structured format, following the template. When restructure the passage with the template, please try not to rephrase but to use the original information in the passage (to avoid information distortion). If the template is only about a subset of information in the passage, you can extract only that subset of information to fill the template. If there is no such information for the template in the passage, please still output the exact template first, and fill the content for the template as 'None'. \n\nThe passage is: \n" + gene + f"\n\nThe template is: \n{template[0]} \n{template[1]} \n. Now, please restructure the passage strictly with the template (literally strictly, e.g., the case style of the template should also remain the same when used to restructure the passage)."
+    return prompt
+
+
+# without a cascade of 'restructuring' (see Method.llm_cascade), the restructuring escalates from model_name to RESTRUCTURE_ESCALATION_MODEL_NAME once the temperature reaches RESTRUCTURE_ESCALATION_TEMPERATURE
+RESTRUCTURE_ESCALATION_MODEL_NAME = "gpt-4o"
+RESTRUCTURE_ESCALATION_TEMPERATURE = 0.7
+
+
+## Output
+#   model_tiers: the models of the restructuring, cheapest first; with a cascade of 'restructuring', every failed attempt escalates to the next tier
+#   escalate_temperature: a failed attempt only escalates when the (updated) temperature is not lower than it
+def get_restructuring_model_tiers(model_name):
+    model_tiers = get_llm_cascade_tiers("restructuring", None)
+    if model_tiers != None:
+        return model_tiers, 0.0
+    if model_name == RESTRUCTURE_ESCALATION_MODEL_NAME:
+        return [model_name], RESTRUCTURE_ESCALATION_TEMPERATURE
+    return [model_name, RESTRUCTURE_ESCALATION_MODEL_NAME], RESTRUCTURE_ESCALATION_TEMPERATURE
+
+
+## Output
+#   tier: the tier (in model_tiers) of the next attempt after a failed one
+def escalate_restructuring_tier(model_tiers, tier, temperature, escalate_temperature):
+    if temperature >= escalate_temperature and tier + 1 < len(model_tiers):
+        record_llm_escalation("restructuring", model_tiers[tier], model_tiers[tier + 1], "parse_failure")
+        tier += 1
+    return tier
+
+
 def get_structured_generation_from_raw_generation_by_llm(gene, template, client, temperature, model_name="gpt-4o-mini"):
     assert isinstance(gene, str), print("type(gene): ", type(gene))
     # use .strip("#") to remove the '#' or "*" in the gene (the '#' or "*" is usually added by the LLM as a markdown format); used to match text (eg, title)
     gene = re.sub("[#*]", "", gene).strip()
     assert len(template) == 2, print("template: ", template)
-    # In your answer, please only mention the words in the template when use it as a template. For example, if the template is ['Hypothesis:', 'Reasoning Process:'], then your answer should not contain 'Analysis of the Hypothesis:', since it also contain 'Hypothesis:'.
-    # Whenever there are information in the passage related to the template, please restructure the information into the template format;
-    prompt = "You are a helpful assistant.\nPlease help to organize the following passage into a structured format, following the template. When restructure the passage with the template, please try not to rephrase but to use the original information in the passage (to avoid information distortion). If the template is only about a subset of information in the passage, you can extract only that subset of information to fill the template. If there is no such information for the template in the passage, please still output the exact template first, and fill the content for the template as 'None'. \n\nThe passage is: \n" + gene + f"\n\nThe template is: \n{template[0]} \n{template[1]} \n. Now, please restructure the passage strictly with the template (literally strictly, e.g., the case style of the template should also remain the same when used to restructure the passage)."
+    prompt = get_restructure_prompt(gene, template)
     # print("prompt: ", prompt)
     
     # while loop to make sure there will be one successful generation
+    if_read_cache = True
+    retry_budget = start_llm_retry_budget("restructuring", prompt)
+    model_tiers, escalate_temperature = get_restructuring_model_tiers(model_name)
+    tier = 0
     while True:
         try:
-            generation = llm_generation(prompt, model_name, client, temperature=temperature)
+            model_name = model_tiers[tier]
+            record_llm_cascade_call("restructuring", model_name)
+            generation = llm_generation(prompt, model_name, client, temperature=temperature, stage="restructuring", if_read_cache=if_read_cache)
+            if_read_cache = False
             # print("generation (in): ", generation)
             structured_gene = get_structured_generation_from_raw_generation(generation, template=template)
             # print("structured_gene (in): ", structured_gene)
             break
+        except LLMFatalError:
+            raise
         except Exception as e:
             if temperature < 1.5:
                 temperature += 0.25
-            if temperature >= 0.7:
-                model_name = "gpt-4o"
+            tier = escalate_restructuring_tier(model_tiers, tier, temperature, escalate_temperature)
+            model_name = model_tiers[tier]
             # if the format of feedback is wrong, try again in the while loop
             print("generation (in): ", generation)
             print("template: ", template)
             print("Exception (in): {}, try again..".format(repr(e)))
             print(f"update temperature to {temperature} and use {model_name} for extraction in case new generation can be successful..")
+            retry_budget.fail(e)
     # print("structured_gene: ", structured_gene)
     return structured_gene
 
 
 
+## asyncio version of the LLM layer
+# number of LLM requests that the asyncio entry points of the whole process can await at the same time
+LLM_ASYNC_CONCURRENCY = 16
+# (event loop, semaphore): an asyncio.Semaphore can only be used inside one event loop, so it is rebuilt for a new loop
+LLM_ASYNC_SEMAPHORE = (None, None)
+
+
+def set_llm_async_concurrency(concurrency):
+    global LLM_ASYNC_CONCURRENCY, LLM_ASYNC_SEMAPHORE
+    assert concurrency >= 1
+    LLM_ASYNC_CONCURRENCY = concurrency
+    LLM_ASYNC_SEMAPHORE = (None, None)
+
+
+# the semaphore shared by all allm_generation() calls of the current event loop
+def get_llm_async_semaphore():
+    global LLM_ASYNC_SEMAPHORE
+    cur_loop = asyncio.get_running_loop()
+    if LLM_ASYNC_SEMAPHORE[0] is not cur_loop:
+        LLM_ASYNC_SEMAPHORE = (cur_loop, asyncio.Semaphore(LLM_ASYNC_CONCURRENCY))
+    return LLM_ASYNC_SEMAPHORE[1]
+
+
+# async version of llm_generation(); client should be an asyncio client (get_llm_client(..., if_async=True))
+async def allm_generation(prompt, model_name, client, temperature=1.0, stage=None, if_read_cache=True, early_stop_fn=None, structured_output_template=None, prompt_prefix=None):
+    if prompt_prefix != None:
+        assert prompt.startswith(prompt_prefix)
+    messages = get_llm_messages(prompt)
+    response_format = get_structured_output_response_format(structured_output_template, model_name, stage=stage)
+    cache_key = get_llm_cache_key(model_name, temperature, messages, response_format=response_format, early_stop=get_early_stop_cache_tag(early_stop_fn, response_format))
+    # check the response cache first
+    llm_cache = get_llm_cache()
+    if llm_cache != None and if_read_cache:
+        generation = llm_cache.get(cache_key, stage=stage)
+        if generation != None:
+            if get_llm_telemetry() != None:
+                get_llm_telemetry().record_cache_hit(stage)
+            return generation
+    async def request_fn():
+        async with get_llm_async_semaphore():
+            start_time = time.time()
+            completion = None
+            if response_format != None:
+                completion = await acall_llm_with_hedging(lambda: acall_llm_with_retry(lambda: client.chat.completions.create(
+                    model=model_name,
+                    temperature=temperature,
+                    messages=messages,
+                    response_format=response_format
+                    ), estimated_tokens=estimate_num_tokens(prompt), backend=get_llm_backend_name(client), stage=stage), stage, temperature, model_name, prompt)
+                generation = structured_output_to_generation(completion.choices[0].message.content, structured_output_template)
+                get_llm_structured_output().update_stats(stage, 'structured')
+            elif early_stop_fn == None:
+                completion = await acall_llm_with_hedging(lambda: acall_llm_with_retry(lambda: client.chat.completions.create(
+                    model=model_name,
+                    temperature=temperature,
+                    messages=messages
+                    ), estimated_tokens=estimate_num_tokens(prompt), backend=get_llm_backend_name(client), stage=stage), stage, temperature, model_name, prompt)
+                generation = completion.choices[0].message.content
+            else:
+                generation = await acall_llm_with_hedging(lambda: acall_llm_with_retry(lambda: astream_chat_completion_with_early_stop(client, early_stop_fn, model=model_name, temperature=temperature, messages=messages), estimated_tokens=estimate_num_tokens(prompt), backend=get_llm_backend_name(client), stage=stage), stage, temperature, model_name, prompt)
+            record_llm_request_telemetry(stage, model_name, time.time() - start_time, prompt, generation, completion=completion)
+        if llm_cache != None:
+            llm_cache.put(cache_key, generation, model_name=model_name, stage=stage)
+        return generation
+    request_fn = aget_llm_traffic_recorded_fn(request_fn, stage, model_name, temperature, prompt)
+    send_fn = request_fn
+    llm_prefix_warmup = get_llm_prefix_warmup()
+    if llm_prefix_warmup != None and llm_prefix_warmup.if_applicable(prompt_prefix):
+        # the requests waiting for the first request of the prefix do not hold the semaphore
+        prefix_key = get_prompt_prefix_key(model_name, messages, prompt_prefix)
+        send_fn = lambda: llm_prefix_warmup.ado(prefix_key, request_fn, stage=stage)
+    try:
+        llm_single_flight = get_llm_single_flight()
+        if llm_single_flight == None or not if_read_cache or not llm_single_flight.if_applicable(temperature):
+            return await send_fn()
+        return await llm_single_flight.ado(cache_key, send_fn, stage=stage)
+    except LLMFatalError as e:
+        if response_format == None or not if_structured_output_unsupported_error(e):
+            raise
+        get_llm_structured_output().mark_unsupported(model_name, e)
+        return await allm_generation(prompt, model_name, client, temperature=temperature, stage=stage, if_read_cache=if_read_cache, early_stop_fn=early_stop_fn, structured_output_template=structured_output_template, prompt_prefix=prompt_prefix)
+
+
+# async version of llm_generation_while_loop()
+async def allm_generation_while_loop(prompt, model_name, client, if_structured_generation=False, template=None, gene_format_constraint=None, if_only_return_one_structured_gene_component=False, temperature=1.0, restructure_output_model_name="gpt-4o-mini", stage=None, early_stop_fn=None, prompt_prefix=None):
+    assert if_structured_generation in [True, False]
+    if if_structured_generation:
+        assert template is not None
+    if_read_cache = True
+    retry_budget = start_llm_retry_budget(stage, prompt)
+    while True:
+        try:
+            generation = await allm_generation(prompt, model_name, client, temperature=temperature, stage=stage, if_read_cache=if_read_cache, early_stop_fn=early_stop_fn, structured_output_template=template if if_structured_generation else None, prompt_prefix=prompt_prefix)
+            if_read_cache = False
+            if if_structured_generation:
+                try:
+                    structured_gene = get_structured_generation_from_raw_generation(generation, template=template)
+                except:
+                    if get_llm_structured_output() != None:
+                        get_llm_structured_output().update_stats(stage, 'restructuring')
+                    if get_llm_telemetry() != None:
+                        get_llm_telemetry().record_parse_failure(stage)
+                    structured_gene = await aget_structured_generation_from_raw_generation_by_llm(generation, template=template, client=client, temperature=temperature, model_name=restructure_output_model_name)
+                if gene_format_constraint != None:
+                    assert len(gene_format_constraint) == 2, print("gene_format_constraint: ", gene_format_constraint)
+                    assert structured_gene[0][gene_format_constraint[0]].strip() in gene_format_constraint[1], print("structured_gene[0][gene_format_constraint[0]].strip(): {}; gene_format_constraint[1]: {}".format(structured_gene[0][gene_format_constraint[0]].strip(), gene_format_constraint[1]))
+            break
+        except LLMFatalError:
+            raise
+        except Exception as e:
+            print("AssertionError: {}, try again..".format(repr(e)))
+            retry_budget.fail(e)
+
+    if if_structured_generation:
+        if if_only_return_one_structured_gene_component:
+            if len(structured_gene) > 1:
+                print("Warning: structured_gene has more than one component: ", structured_gene)
+            return structured_gene[0]
+        else:
+            return structured_gene
+    else:
+        return generation
+
+
+# async version of get_structured_generation_from_raw_generation_by_llm()
+async def aget_structured_generation_from_raw_generation_by_llm(gene, template, client, temperature, model_name="gpt-4o-mini"):
+    assert isinstance(gene, str), print("type(gene): ", type(gene))
+    gene = re.sub("[#*]", "", gene).strip()
+    assert len(template) == 2, print("template: ", template)
+    prompt = get_restructure_prompt(gene, template)
+    if_read_cache = True
+    retry_budget = start_llm_retry_budget("restructuring", prompt)
+    model_tiers, escalate_temperature = get_restructuring_model_tiers(model_name)
+    tier = 0
+    while True:
+        try:
+            model_name = model_tiers[tier]
+            record_llm_cascade_call("restructuring", model_name)
+            generation = await allm_generation(prompt, model_name, client, temperature=temperature, stage="restructuring", if_read_cache=if_read_cache)
+            if_read_cache = False
+            structured_gene = get_structured_generation_from_raw_generation(generation, template=template)
+            break
+        except LLMFatalError:
+            raise
+        except Exception as e:
+            if temperature < 1.5:
+                temperature += 0.25
+            tier = escalate_restructuring_tier(model_tiers, tier, temperature, escalate_temperature)
+            model_name = model_tiers[tier]
+            print("generation (in): ", generation)
+            print("template: ", template)
+            print("Exception (in): {}, try again..".format(repr(e)))
+            print(f"update temperature to {temperature} and use {model_name} for extraction in case new generation can be successful..")
+            retry_budget.fail(e)
+    return structured_gene
+
+
+
 
 
 # gene: (generated) text; '#' and '*' will be removed from gene, since they are assumed to be generated by LLM as markdown format --- this format can result in not exact match between the title extracted from generation and the groundtruth title in the benchmark
 # template: ['Title:', 'Reason:']
 # structured_gene: [[Title, Reason], ...]
 def get_structured_generation_from_raw_generation(gene, template):
-    # use .strip("#") to remove the '#' or "*" in the gene (the '#' or "*" is usually added by the LLM as a markdown format); used to match text (eg, title)
-    gene = re.sub("[#*]", "", gene).strip()
     assert len(template) == 2, print("template: ", template)
-    # # some times generation will capitalize the first letter of the template, so we use the lower case for both generation and template to match: not adopting it since it might influence chemistry terms (e.g., Fe2+ -> fe2+)
-    # gene = gene.lower()
-    # template = [item.lower() for item in template]
-    # the template might not appear in the first sentence of the gene, get rid of noise sentences before the first template[0]
-    if not gene.startswith(template[0]):
-        gene_split = gene.split('\n')
-        # if the gene is not starting with the title, the second paragraph in gene_split might be the title
-        gene_split = [item for item in gene_split if item.strip() != ""]
-        assert len(gene_split) >= 2, print("gene_split: ", gene_split)
-        # iterate to find the first template[0] in gene_split
-        for id_line, line in enumerate(gene_split):
-            if gene_split[id_line].find(template[0]) > 0 and gene_split[id_line].find(template[0]) < 15:
-                gene_split_split = gene_split[id_line].split(template[0])
-                assert len(gene_split_split) == 2, print("gene_split_split: ", gene_split_split)
-                gene_split[id_line] = template[0] + gene_split_split[1]
-            if gene_split[id_line].startswith(template[0]):
-                gene = '\n'.join(gene_split[id_line:])
-                break
-        # assert gene.startswith(template[0]), print("gene: ", gene)
-        assert gene.startswith(template[0])
-    # structured_gene: [[title, reason], [title, reason], ...]
-    structured_gene = []
-    gene_split = gene.split(template[0])
-    # split to every title block, including one title and one reason
-    for cur_gs in gene_split:
-        # split the one title and one reason
-        cur_gs = cur_gs.strip()
-        if cur_gs == "":
-            continue
-        cur_gs_split = cur_gs.split(template[1])
-        # deal with unexpected situations
-        if len(cur_gs_split) > 2:
-            # if there are more than one template[1] in cur_gs, we prefer the one with prefix as '\n' (since it matches more as the designed format)
-            cur_gs_split = cur_gs.split('\n' + template[1])
-            # by preferring the one with prefix as '\n' still do not work, so we simply concatenate the rest of the elements other than the first element
-            if len(cur_gs_split) > 2:
-                cur_gs_split = [cur_gs_split[0], '\n'.join(cur_gs_split[1:])]
-            # in case none of the template[1] is with prefix as '\n'
-            elif len(cur_gs_split) == 1:
-                cur_gs_split = cur_gs.split(template[1])
-                cur_gs_split = [cur_gs_split[0], '\n'.join(cur_gs_split[1:])]
-        # assert len(cur_gs_split) == 2, print("cur_gs_split: ", cur_gs_split)
-        assert len(cur_gs_split) == 2
-        # strip every elements in cur_gs_split
-        for i in range(len(cur_gs_split)):
-            cur_gs_split[i] = cur_gs_split[i].strip().strip(";").strip()
-        structured_gene.append(cur_gs_split)
+    # tolerant to small deviations from the template (e.g., noise text before the first template[0], markdown, case, repeated template[1]); see Method.template_parser
+    structured_gene, confidence, deviations = parse_structured_generation(gene, template)
     return structured_gene
 
 
@@ -497,47 +935,9 @@ def get_structured_generation_from_raw_generation(gene, template):
 #   score_reason_collection: ['reason0', 'reason1', 'reason2', 'reason3']
 #   if_successful: True or False
 def pick_score(cur_generation, input_txt):
-    score_format = ['Validness score:', 'Novelty score:', 'Significance score:', 'Potential score:']
-    reason_format = 'Concise reason:'
-    potential_scores = ['1', '2', '3', '4', '5']
-    # score_collection, score_reason_collection
-    cur_generation_split = cur_generation.split('\n')
-    score_collection, score_reason_collection = [], []
-    # format_mode: 0: Validness score: 2\nConcise Reason:; 1: Validness score:\n2 points\nConcise Reason:
-    if_mode1_next_is_reason = 0
-    for cur_sent in cur_generation_split:
-        cur_if_succeed = 0
-        # format_mode 1 reason
-        if if_mode1_next_is_reason == 1:
-            cur_sent = cur_sent.replace(reason_format, "").strip()
-            if len(cur_sent) > 0:
-                score_reason_collection.append(cur_sent)
-                if_mode1_next_is_reason = 0
-            else:
-                raise Exception("Can't find reason for score: ", cur_generation_split)
-        else:
-            # normal reason
-            if reason_format in cur_sent:
-                cur_sent = cur_sent.replace(reason_format, "").strip()
-                if len(cur_sent) > 0:
-                    score_reason_collection.append(cur_sent)
-                else:
-                    if_mode1_next_is_reason = 1
-            else:
-                for cur_score_format in score_format:
-                    if cur_score_format in cur_sent:
-                        cur_score = cur_sent.replace(cur_score_format, "").replace("points", "").replace("point", "").replace("*", "").strip()
-                        if cur_score in potential_scores:
-                            score_collection.append(int(cur_score))
-                            cur_if_succeed = 1
-                        else:
-                            raise Exception("Can't find score: ", cur_sent)
-                        break
-    # if_successful
-    if len(score_collection) == len(score_reason_collection) and len(score_collection) == 4:
-        if_successful = True
-    else:
-        if_successful = False
+    # tolerant to '4/5', '4 points', markdown and case; see Method.template_parser
+    score_collection, score_reason_collection, if_successful, confidence, deviations = parse_four_aspect_scores_with_stats(cur_generation)
+    if not if_successful:
         print("input_txt: ", input_txt)
         print("score_collection: ", score_collection)
         print("len(score_collection): ", len(score_collection))
@@ -546,6 +946,41 @@ def pick_score(cur_generation, input_txt):
     return score_collection, score_reason_collection, if_successful
 
 
+# Function:
+#   pick the scores and reasons of several hypotheses from the textual generation of a four_aspects_self_numerical_evaluation_batched prompt; each block starts with 'Hypothesis index: i' and is parsed by pick_score()
+# INPUT:
+#   num_hyps: number of hypotheses in the prompt
+# OUTPUT:
+#   dict_idx2score: {hyp_idx: [score_collection, score_reason_collection], ...}; only the hypotheses with exactly one block that can be parsed (the others should be evaluated one by one)
+def pick_batched_scores(cur_generation, input_txt, num_hyps):
+    index_format = 'Hypothesis index:'
+    cur_generation = re.sub("[#*]", "", cur_generation)
+    # dict_idx2blocks: {hyp_idx: [block, ...]}
+    dict_idx2blocks = {}
+    for cur_block in cur_generation.split(index_format)[1:]:
+        cur_block_split = cur_block.strip().split('\n', 1)
+        cur_idx = cur_block_split[0].strip().strip('.:').strip()
+        if not cur_idx.isdigit() or int(cur_idx) >= num_hyps or len(cur_block_split) < 2:
+            print("Warning: can't find the hypothesis index of the block: ", cur_block_split[0])
+            continue
+        if int(cur_idx) not in dict_idx2blocks:
+            dict_idx2blocks[int(cur_idx)] = []
+        dict_idx2blocks[int(cur_idx)].append(cur_block_split[1])
+    dict_idx2score = {}
+    for cur_idx in dict_idx2blocks:
+        if len(dict_idx2blocks[cur_idx]) != 1:
+            print("Warning: {} blocks for hypothesis index {}".format(len(dict_idx2blocks[cur_idx]), cur_idx))
+            continue
+        try:
+            score_collection, score_reason_collection, if_successful = pick_score(dict_idx2blocks[cur_idx][0], input_txt)
+        except Exception as e:
+            print("Warning: the block of hypothesis index {} can not be parsed: {}".format(cur_idx, repr(e)))
+            continue
+        if if_successful:
+            dict_idx2score[cur_idx] = [score_collection, score_reason_collection]
+    return dict_idx2score
+
+
 ## Function
 #  calculate the average score of the four aspects. The score range is [0, 1]
 def jaccard_similarity(str1, str2):
@@ -558,59 +993,73 @@ def jaccard_similarity(str1, str2):
 
 
 # some titles are generated by LLM, which might have slight different from the exact title extracted from the markdown file
-# groundtruth_titles: [title, ...], extracted from markdown file
+# groundtruth_titles: [title, ...], extracted from markdown file; or a TitleIndex of them (built once for a corpus, e.g., self.title_index of the pipelines)
 # title: title generated by LLM 
-def title_transform_to_exact_version_of_title_abstract_from_markdown(title, groundtruth_titles, if_print_warning=True):
+# stats_key: None or the caller to count the match path under (see Method.title_index.TitleMatchStats)
+def title_transform_to_exact_version_of_title_abstract_from_markdown(title, groundtruth_titles, if_print_warning=True, stats_key=None):
     assert if_print_warning in [True, False]
-    # groundtruth_titles:  [title, ...]
-    similarity_collector = []
-    for cur_item in groundtruth_titles:
-        cur_similarity = jaccard_similarity(title.lower(), cur_item.lower()) 
-        similarity_collector.append(cur_similarity)
-    # get the most similar one
-    max_similarity = max(similarity_collector)
-    max_similarity_index = similarity_collector.index(max_similarity)
-    matched_title = groundtruth_titles[max_similarity_index]
+    if not isinstance(groundtruth_titles, TitleIndex):
+        groundtruth_titles = TitleIndex(groundtruth_titles)
+    # the title itself or its normalized version (quotes, markdown, case, whitespace, trailing period) if it is in groundtruth_titles; otherwise the most similar one (the same as the Jaccard similarity with every title; see Method.title_index)
+    matched_title, max_similarity, match_path = groundtruth_titles.match(title, stats_key=stats_key)
     if max_similarity < 0.3 and if_print_warning:
         print("max_similarity: {}; original title: {}; \nmatched title: {}\n".format(max_similarity, title, matched_title))
     return matched_title, max_similarity
 
 
 # dict_title_2_abstract: a dict with groundtruth title as key, and abstract as value
-# groundtruth_titles: [title, ...], extracted from markdown file
 # title: title generated by LLM, that might not be exactly the same as the groundtruth title key in dict_title_2_abstract
+# title_index: None or the TitleIndex of the keys of dict_title_2_abstract (to avoid indexing them again for every title)
 ## Output
 # value: the abstract corresponding to the title
-def get_item_from_dict_with_very_similar_but_not_exact_key(dict_title_2_abstract, title):
-    groundtruth_titles = list(dict_title_2_abstract.keys())
+def get_item_from_dict_with_very_similar_but_not_exact_key(dict_title_2_abstract, title, title_index=None):
     try:
         value = dict_title_2_abstract[title]
+        get_title_match_stats().record("get_abstract", "exact")
     except:
-        title, similarity = title_transform_to_exact_version_of_title_abstract_from_markdown(title, groundtruth_titles)
+        if title_index == None:
+            title_index = TitleIndex(list(dict_title_2_abstract.keys()))
+        title, similarity = title_transform_to_exact_version_of_title_abstract_from_markdown(title, title_index, stats_key="get_abstract")
         value = dict_title_2_abstract[title]
     return value
 
 
 ## Function:
 #   generated title might be different from the exact title in the groundtruth title list, this function is to recover the generated title to the exact version of the title in the groundtruth title list
-# groundtruth_titles: [title, ...]
+# groundtruth_titles: [title, ...] or their TitleIndex
 # title: title generated by LLM
 def recover_generated_title_to_exact_version_of_title(groundtruth_titles, title):
     title = title.strip().strip('"').strip()
-    recovered_title, similarity = title_transform_to_exact_version_of_title_abstract_from_markdown(title, groundtruth_titles)
+    recovered_title, similarity = title_transform_to_exact_version_of_title_abstract_from_markdown(title, groundtruth_titles, stats_key="recover_title")
     return recovered_title
 
 
+## Function:
+#   recover_generated_title_to_exact_version_of_title() of several titles at once (e.g., all the titles selected in a screening round); the titles that are not found by their exact or normalized version are matched together (see Method.title_index.TitleIndex.match_batch())
+# groundtruth_titles: [title, ...] or their TitleIndex
+# titles: [title generated by LLM, ...]
+## Output
+# recovered_titles: [title, ...]; one for each title
+def recover_generated_titles_to_exact_version_of_titles(groundtruth_titles, titles):
+    if not isinstance(groundtruth_titles, TitleIndex):
+        groundtruth_titles = TitleIndex(groundtruth_titles)
+    titles = [cur_title.strip().strip('"').strip() for cur_title in titles]
+    recovered_titles = []
+    for cur_title, (cur_matched_title, cur_similarity, cur_match_path) in zip(titles, groundtruth_titles.match_batch(titles, stats_key="recover_title")):
+        if cur_similarity < 0.3:
+            print("max_similarity: {}; original title: {}; \nmatched title: {}\n".format(cur_similarity, cur_title, cur_matched_title))
+        recovered_titles.append(cur_matched_title)
+    return recovered_titles
+
+
 ## Function:
 #   whether an element is in a list with a similarity threshold (if th element has a similarity larger than the threshold with any element in the list, return True)
+#   an element that is in the list, or whose normalized version is (see Method.title_index.get_normalized_title()), is in the list without computing the similarities
+#   list_elements: [element, ...] or their SimilarityMatcher (to check many elements against the same list without tokenizing it again)
 def if_element_in_list_with_similarity_threshold(list_elements, element, threshold=0.7):
-    element = element.strip().strip('"').strip()
-
-    for cur_element in list_elements:
-        cur_element = cur_element.strip().strip('"').strip()
-        if jaccard_similarity(element.lower(), cur_element.lower()) > threshold:
-            return True
-    return False
+    if not isinstance(list_elements, SimilarityMatcher):
+        list_elements = SimilarityMatcher(list_elements)
+    return list_elements.contains(element, threshold=threshold)
 
 
 def save_with_json(data, file_dir):